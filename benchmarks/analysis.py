@@ -0,0 +1,75 @@
+"""
+Compares scans/sec of the legacy analysis path (text scan, `scan_data.count("o")`, one pool task per scan) with the
+vectorized batch analysis of packed scans (common/analysis.py, one pool task per batch), for growing grid sizes:
+
+    python3 -m benchmarks.analysis --workers 4 --batch-size 8
+"""
+import argparse
+import json
+import multiprocessing
+import time
+
+from common.analysis import analyze_scans
+from common.scan_codec import decode_scan, format_text_scan
+from common.utils import generate_brain_scan
+
+# grid size and number of scans analyzed for it
+SIZES = [((10, 10), 4000), ((256, 256), 400), ((1024, 1024), 40)]
+
+
+def count_lesions(text_scan: str) -> int:
+    """The legacy analysis"""
+    return text_scan.count("o")
+
+
+def analyze_batch(scans: list) -> int:
+    """Like FrBRAIN workers, only the number of analyzed scans goes back to the parent"""
+    return len(analyze_scans(scans))
+
+
+def scans_per_s(scans: int, started: float) -> float:
+    return round(scans / (time.perf_counter() - started), 1)
+
+
+def run(workers: int, batch_size: int) -> list:
+    results = []
+    with multiprocessing.Pool(workers) as pool:
+        for (rows, cols), count in SIZES:
+            # a few distinct scans repeated, generating thousands of large ones would dominate the run
+            distinct = [generate_brain_scan(rows, cols) for _ in range(min(count, 8))]
+            packed = [distinct[index % len(distinct)] for index in range(count)]
+            text = [format_text_scan(decode_scan(scan)) for scan in packed]
+            batches = [packed[start:start + batch_size] for start in range(0, count, batch_size)]
+            result = {"grid": f"{rows}x{cols}", "scans": count}
+
+            started = time.perf_counter()
+            for scan in text:
+                count_lesions(scan)
+            result["legacy_inline_scans_per_s"] = scans_per_s(count, started)
+
+            started = time.perf_counter()
+            for batch in batches:
+                analyze_scans(batch)
+            result["batch_inline_scans_per_s"] = scans_per_s(count, started)
+
+            started = time.perf_counter()
+            list(pool.imap_unordered(count_lesions, text))
+            result["legacy_pool_scans_per_s"] = scans_per_s(count, started)
+
+            started = time.perf_counter()
+            list(pool.imap_unordered(analyze_batch, batches))
+            result["batch_pool_scans_per_s"] = scans_per_s(count, started)
+            results.append(result)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Legacy vs vectorized batch lesion analysis")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--batch-size", type=int, default=8)
+    args = parser.parse_args()
+    print(json.dumps(run(args.workers, args.batch_size), indent=2))
+
+
+if __name__ == "__main__":
+    main()
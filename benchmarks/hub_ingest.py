@@ -0,0 +1,81 @@
+"""
+Load generator for the FrHUB brain scan server.
+
+Opens many concurrent FrPACS-like connections against a running FrHUB, sends scans over each one and prints
+connections/sec and scans/sec as JSON, so the threaded and asyncio server modes (and pipelining windows) can be
+compared:
+
+    python3 fr_hub/main.py --server asyncio
+    python3 -m benchmarks.hub_ingest --connections 500 --scans 20 --window 8
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from common.config import BRAIN_SCAN_HOST, BRAIN_SCAN_PORT, MessageType
+from common.protocol import encode_brain_scan, read_frame, write_frame
+from common.utils import generate_brain_scan
+
+
+def build_scan_payloads(scans: int) -> list:
+    scan = (1, 1, "2025-01-01 00:00:00", "BRAIN", generate_brain_scan())
+    return [encode_brain_scan(seq, scan) for seq in range(1, scans + 1)]
+
+
+async def run_connection(host: str, port: int, payloads: list, window: int, stats: dict) -> None:
+    started = time.perf_counter()
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+    except OSError:
+        stats["failed_connections"] += 1
+        return
+    stats["connect_time"] += time.perf_counter() - started
+    stats["connections"] += 1
+    try:
+        # keeping up to `window` scans unacknowledged, like FrPACSBrainScanClient does
+        for start in range(0, len(payloads), window):
+            batch = payloads[start:start + window]
+            for payload in batch:
+                await write_frame(writer, MessageType.brain_scan, payload)
+            for _ in batch:
+                if await read_frame(reader) is None:
+                    raise ConnectionError("FrHUB closed the connection")
+                stats["scans"] += 1
+    except Exception:
+        stats["failed_scans"] += 1
+    finally:
+        writer.close()
+
+
+async def run(host: str, port: int, connections: int, scans: int, window: int = 1) -> dict:
+    payloads = build_scan_payloads(scans)
+    stats = {"connections": 0, "failed_connections": 0, "scans": 0, "failed_scans": 0, "connect_time": 0.0}
+    started = time.perf_counter()
+    await asyncio.gather(*(run_connection(host, port, payloads, window, stats) for _ in range(connections)))
+    elapsed = time.perf_counter() - started
+    return {
+        "connections": stats["connections"],
+        "failed_connections": stats["failed_connections"],
+        "scans": stats["scans"],
+        "failed_scans": stats["failed_scans"],
+        "elapsed_s": round(elapsed, 3),
+        "connections_per_s": round(stats["connections"] / elapsed, 1),
+        "scans_per_s": round(stats["scans"] / elapsed, 1),
+        "avg_connect_ms": round(1000 * stats["connect_time"] / max(stats["connections"], 1), 3),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="FrHUB ingest load generator")
+    parser.add_argument("--host", default=BRAIN_SCAN_HOST)
+    parser.add_argument("--port", type=int, default=BRAIN_SCAN_PORT)
+    parser.add_argument("--connections", type=int, default=100, help="concurrent FrPACS connections")
+    parser.add_argument("--scans", type=int, default=10, help="scans sent per connection")
+    parser.add_argument("--window", type=int, default=1, help="unacknowledged scans allowed per connection")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args.host, args.port, args.connections, args.scans, args.window)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
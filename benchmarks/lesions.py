@@ -0,0 +1,58 @@
+"""
+Time and peak memory of labelling the lesions of a large volume (common/lesions.py), for each 3D connectivity:
+
+    python3 -m benchmarks.lesions --shape 200 512 512 --lesion-prob 0.1
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+import numpy as np
+
+from common.config import ScanCell
+from common.lesions import label_lesions
+from common.scan_codec import encode_scan
+
+
+def generate_volume(shape: tuple, lesion_prob: float) -> bytes:
+    """Packed volume of clear cells with random lesion cells, generated slice by slice to keep memory down"""
+    rng = np.random.default_rng(0)
+    cells = np.empty(shape, dtype=np.uint8)
+    for index in range(shape[0]):
+        cells[index] = np.where(rng.random(shape[1:]) < lesion_prob, ScanCell.lesion, ScanCell.clear)
+    return encode_scan(cells)
+
+
+def run(shape: tuple, lesion_prob: float) -> list:
+    scan_data = generate_volume(shape, lesion_prob)
+    results = []
+    for connectivity in (6, 26):
+        tracemalloc.start()
+        started = time.perf_counter()
+        lesions = label_lesions(scan_data, connectivity)
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results.append({
+            "shape": "x".join(map(str, shape)),
+            "connectivity": connectivity,
+            "lesions": lesions["lesion_count"],
+            "largest_lesion": lesions["lesion_sizes"][0] if lesions["lesion_sizes"] else 0,
+            "seconds": round(elapsed, 2),
+            "packed_scan_mb": round(len(scan_data) / 2 ** 20, 1),
+            "peak_labelling_mb": round(peak / 2 ** 20, 1),
+        })
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Lesion labelling of a large volume")
+    parser.add_argument("--shape", type=int, nargs=3, default=[200, 512, 512], metavar=("DEPTH", "ROWS", "COLS"))
+    parser.add_argument("--lesion-prob", type=float, default=0.1)
+    args = parser.parse_args()
+    print(json.dumps(run(tuple(args.shape), args.lesion_prob), indent=2))
+
+
+if __name__ == "__main__":
+    main()
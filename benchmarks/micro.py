@@ -0,0 +1,337 @@
+"""
+Microbenchmarks of the hot-path primitives, each timed in isolation and compared with a baseline:
+
+    python3 -m benchmarks.micro --save-baseline    # on the reference commit
+    python3 -m benchmarks.micro                    # after a change, exits with 1 if a case regressed
+    python3 -m benchmarks.micro --only db. --threshold 0.1
+
+Cases are named <subsystem>.<primitive> (scan, protocol, models, analysis, db), --only takes name prefixes so a
+single subsystem can be measured. DBManager cases run against an in-memory mongomock stand-in, so they measure
+DBManager and driver overhead rather than MongoDB itself, or against a SQLite file with --sqlite. Baselines are machine
+specific, compare runs of one machine.
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from benchmarks.pipeline import use_db
+from benchmarks.scan_codec import legacy_payload
+from common.analysis import analyze_scans
+from common.config import NeuroDataCollections, ReportStatus
+from common.db_manager import DBManager
+from common.models.brain_report import BrainReport
+from common.models.brain_scan import BrainScan
+from common.protocol import (
+    decode_brain_reports,
+    decode_brain_scan,
+    decode_legacy_brain_scan,
+    encode_brain_reports,
+    encode_brain_scan,
+)
+from common.scan_codec import decode_scan, format_text_scan
+from common.utils import analyze_scan, generate_brain_scan
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "micro_baseline.json")
+# a case is slower than its baseline by more than this fraction is a regression
+DEFAULT_THRESHOLD = 0.2
+# documents in the collections the DBManager cases read from
+DB_DOCUMENTS = 1000
+BENCH_COLLECTION = "bench"
+
+# case name -> setup, returning the function to time
+CASES: Dict[str, Callable[[], Callable[[], object]]] = {}
+
+
+def case(name: str):
+    def register(setup: Callable[[], Callable[[], object]]):
+        CASES[name] = setup
+        return setup
+    return register
+
+
+def sample_scan(rows: int = 10, cols: int = 10) -> tuple:
+    return 1, 1, "2025-01-01 00:00:00", "BRAIN", generate_brain_scan(rows, cols)
+
+
+def sample_report() -> dict:
+    return {
+        "patient_id": 1, "scan_id": 1, "report_datetime": datetime(2025, 1, 1), "report_data": "3 brain lesions.",
+        "lesion_cells": 20, "lesion_area": 0.2, "region_density": [[0.2] * 4] * 4,
+        "lesion_count": 3, "lesion_sizes": [10, 6, 4], "lesion_centroids": [[1.5, 2.0], [5.0, 5.5], [8.0, 1.0]],
+    }
+
+
+@case("scan.generate_brain_scan")
+def setup_generate_brain_scan():
+    return generate_brain_scan
+
+
+@case("scan.generate_brain_scan_256")
+def setup_generate_brain_scan_256():
+    return lambda: generate_brain_scan(256, 256)
+
+
+@case("protocol.encode_brain_scan")
+def setup_encode_brain_scan():
+    scan = sample_scan()
+    return lambda: encode_brain_scan(1, scan)
+
+
+@case("protocol.decode_brain_scan")
+def setup_decode_brain_scan():
+    payload = encode_brain_scan(1, sample_scan())
+    return lambda: decode_brain_scan(payload)
+
+
+@case("protocol.encode_legacy_brain_scan")
+def setup_encode_legacy_brain_scan():
+    # base64 + JSON frame of FrPACS before scans were packed
+    scan = sample_scan()
+    legacy = (*scan[:4], format_text_scan(decode_scan(scan[4])))
+    return lambda: legacy_payload(1, legacy)
+
+
+@case("protocol.decode_legacy_brain_scan")
+def setup_decode_legacy_brain_scan():
+    scan = sample_scan()
+    payload = legacy_payload(1, (*scan[:4], format_text_scan(decode_scan(scan[4]))))
+    return lambda: decode_legacy_brain_scan(payload)
+
+
+@case("protocol.encode_brain_reports")
+def setup_encode_brain_reports():
+    reports = [{**sample_report(), "report_datetime": "2025-01-01 00:00:00"}] * 100
+    return lambda: encode_brain_reports(1, reports)
+
+
+@case("protocol.decode_brain_reports")
+def setup_decode_brain_reports():
+    payload = encode_brain_reports(1, [{**sample_report(), "report_datetime": "2025-01-01 00:00:00"}] * 100)
+    return lambda: decode_brain_reports(payload)
+
+
+@case("models.brain_scan_to_bson")
+def setup_brain_scan_to_bson():
+    patient_id, scan_id, scan_datetime, scan_type, scan_data = sample_scan()
+    return lambda: BrainScan(
+        patient_id=patient_id, scan_id=scan_id, scan_datetime=scan_datetime, scan_type=scan_type, scan_data=scan_data
+    ).to_bson()
+
+
+@case("models.brain_report_to_bson")
+def setup_brain_report_to_bson():
+    report = sample_report()
+    return lambda: BrainReport(**report).to_bson()
+
+
+@case("models.brain_scan_bson")
+def setup_brain_scan_bson():
+    patient_id, scan_id, scan_datetime, scan_type, scan_data = sample_scan()
+    return lambda: BrainScan.bson(
+        patient_id=patient_id, scan_id=scan_id, scan_datetime=scan_datetime, scan_type=scan_type, scan_data=scan_data
+    )
+
+
+@case("models.brain_report_bson")
+def setup_brain_report_bson():
+    report = sample_report()
+    return lambda: BrainReport.bson(**report)
+
+
+@case("analysis.analyze_scan")
+def setup_analyze_scan():
+    scan_data = generate_brain_scan()
+    return lambda: analyze_scan(scan_data)
+
+
+@case("analysis.analyze_scans_batch")
+def setup_analyze_scans_batch():
+    scans = [generate_brain_scan() for _ in range(8)]
+    return lambda: analyze_scans(scans)
+
+
+def seed_collection() -> DBManager:
+    """Fresh collection of DB_DOCUMENTS scans for a DBManager case"""
+    db_manager = DBManager()
+    db_manager.drop_collection(BENCH_COLLECTION)
+    db_manager.insert_many(BENCH_COLLECTION, [
+        {"patient_id": index % 100, "scan_id": index, "report_generated": ReportStatus.to_do, "scan_data": b"x" * 41}
+        for index in range(DB_DOCUMENTS)
+    ])
+    return db_manager
+
+
+@case("db.insert")
+def setup_db_insert():
+    db_manager = seed_collection()
+    # a new dict every call, as pymongo sets _id on the inserted one
+    return lambda: db_manager.insert(BENCH_COLLECTION, {"patient_id": 1, "scan_id": 1, "scan_data": b"x" * 41})
+
+
+@case("db.insert_many")
+def setup_db_insert_many():
+    db_manager = seed_collection()
+    return lambda: db_manager.insert_many(
+        BENCH_COLLECTION, [{"patient_id": 1, "scan_id": index, "scan_data": b"x" * 41} for index in range(32)]
+    )
+
+
+@case("db.fetch_one")
+def setup_db_fetch_one():
+    db_manager = seed_collection()
+    return lambda: db_manager.fetch_one(BENCH_COLLECTION, {"scan_id": DB_DOCUMENTS // 2})
+
+
+@case("db.fetch_one_and_update")
+def setup_db_fetch_one_and_update():
+    db_manager = seed_collection()
+    return lambda: db_manager.fetch_one_and_update(
+        BENCH_COLLECTION, {"scan_id": DB_DOCUMENTS // 2}, {"report_generated": ReportStatus.to_do}
+    )
+
+
+@case("db.fetch_all")
+def setup_db_fetch_all():
+    db_manager = seed_collection()
+    return lambda: db_manager.fetch_all(BENCH_COLLECTION, {"patient_id": 1}, {"scan_id": 1}, limit=100)
+
+
+@case("db.iterate")
+def setup_db_iterate():
+    db_manager = seed_collection()
+    return lambda: sum(1 for _ in db_manager.iterate(BENCH_COLLECTION, {"patient_id": 1}, {"scan_id": 1}))
+
+
+@case("db.update")
+def setup_db_update():
+    db_manager = seed_collection()
+    return lambda: db_manager.update(BENCH_COLLECTION, {"scan_id": 1}, {"report_generated": ReportStatus.to_do})
+
+
+@case("db.update_many")
+def setup_db_update_many():
+    db_manager = seed_collection()
+    return lambda: db_manager.update_many(BENCH_COLLECTION, {"patient_id": 1}, {"report_generated": ReportStatus.to_do})
+
+
+@case("db.claim_many")
+def setup_db_claim_many():
+    db_manager = seed_collection()
+    # claimed scans stay claimable, so every call claims a full batch
+    return lambda: db_manager.claim_many(
+        BENCH_COLLECTION, {"report_generated": ReportStatus.to_do}, {"report_generated": ReportStatus.to_do}, 32,
+        projection={"scan_id": 1, "scan_data": 1}, sort=[("_id", 1)],
+    )
+
+
+@case("db.gridfs_upload")
+def setup_db_gridfs_upload():
+    db_manager = DBManager()
+    scan_data = generate_brain_scan(1024, 1024)
+
+    def upload():
+        stream = db_manager.open_upload_stream(NeuroDataCollections.brain_scan_files, "bench", 64 * 1024)
+        stream.write(scan_data)
+        stream.close()
+    return upload
+
+
+@case("db.gridfs_download")
+def setup_db_gridfs_download():
+    db_manager = DBManager()
+    stream = db_manager.open_upload_stream(NeuroDataCollections.brain_scan_files, "bench", 64 * 1024)
+    stream.write(generate_brain_scan(1024, 1024))
+    stream.close()
+
+    def download():
+        with db_manager.open_download_stream(NeuroDataCollections.brain_scan_files, stream._id) as download_stream:
+            return sum(len(chunk) for chunk in iter(download_stream.readchunk, b""))
+    return download
+
+
+def time_case(function: Callable[[], object], repeat: int) -> float:
+    """
+    Best time per call of `repeat` rounds, every round running long enough for the clock to be accurate
+    :return: microseconds
+    """
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number * 1e6
+
+
+def run(only: Optional[List[str]] = None, repeat: int = 5, sqlite_path: Optional[str] = None) -> Dict[str, float]:
+    use_db(None, sqlite_path)
+    results = {}
+    for name, setup in CASES.items():
+        if only and not any(name.startswith(prefix) for prefix in only):
+            continue
+        results[name] = round(time_case(setup(), repeat), 3)
+    return results
+
+
+def compare(results: Dict[str, float], baseline: Dict[str, float], threshold: float) -> Dict[str, dict]:
+    """
+    Every case against its baseline
+    :param results: microseconds per call of every case
+    :param baseline: same, of the baseline run
+    :param threshold: fraction a case may be slower or faster than its baseline by before it's reported
+    :return: time, baseline time, ratio and status (ok, regression, improvement or new) of every case
+    """
+    comparison = {}
+    for name, us_per_call in results.items():
+        if name not in baseline:
+            comparison[name] = {"us_per_call": us_per_call, "status": "new"}
+            continue
+        ratio = us_per_call / baseline[name]
+        if ratio > 1 + threshold:
+            status = "regression"
+        elif ratio < 1 - threshold:
+            status = "improvement"
+        else:
+            status = "ok"
+        comparison[name] = {
+            "us_per_call": us_per_call, "baseline_us_per_call": baseline[name], "ratio": round(ratio, 3), "status": status
+        }
+    return comparison
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the hot-path primitives")
+    parser.add_argument("--only", nargs="*", default=None, help="name prefixes of the cases to run, e.g. db. models.")
+    parser.add_argument("--repeat", type=int, default=5, help="rounds per case, the best one is kept")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline file to compare with or save to")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="allowed slowdown, 0.2 is 20%%")
+    parser.add_argument("--save-baseline", action="store_true", help="save the results as the new baseline")
+    parser.add_argument("--sqlite", default=None, help="SQLite file the db. cases run against instead of mongomock")
+    args = parser.parse_args()
+
+    results = run(args.only, args.repeat, args.sqlite)
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as baseline_file:
+                baseline = json.load(baseline_file)
+        # saving a subset of the cases keeps the baseline of the others
+        with open(args.baseline, "w") as baseline_file:
+            json.dump({**baseline, **results}, baseline_file, indent=2, sort_keys=True)
+        print(json.dumps(results, indent=2))
+        return
+    if not os.path.exists(args.baseline):
+        print(json.dumps(results, indent=2))
+        print(f"No baseline in {args.baseline}, save one with --save-baseline", file=sys.stderr)
+        return
+    with open(args.baseline) as baseline_file:
+        comparison = compare(results, json.load(baseline_file), args.threshold)
+    print(json.dumps(comparison, indent=2))
+    regressions = [name for name, result in comparison.items() if result["status"] == "regression"]
+    if regressions:
+        print(f"Slower than the baseline by more than {args.threshold:.0%}: {', '.join(regressions)}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
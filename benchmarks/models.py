@@ -0,0 +1,76 @@
+"""
+Compares the per-document cost of building the MongoDB documents of brain scans and reports through the validated
+model (`BrainScan(...).to_bson()`) with the fast path (`BrainScan.bson(...)`, see common/models/base.py):
+
+    python3 -m benchmarks.models --documents 20000
+
+Also times the fields the fast path can't take as they are (e.g. a text scan), which go through the model anyway.
+"""
+import argparse
+import json
+import time
+from datetime import datetime
+from typing import Callable, Dict, List
+
+from common.models.brain_report import BrainReport
+from common.models.brain_scan import BrainScan
+from common.scan_codec import decode_scan, format_text_scan
+from common.utils import generate_brain_scan
+
+
+def scan_fields() -> dict:
+    return {
+        "patient_id": 1, "scan_id": 1, "scan_datetime": "2025-01-01 00:00:00", "scan_type": "BRAIN",
+        "scan_data": generate_brain_scan(), "trace_id": "0" * 32, "stage_times": {"hub_received": time.time()},
+    }
+
+
+def report_fields() -> dict:
+    # as FrBRAIN saves them, with the analysis details of common/analysis.py
+    return {
+        "patient_id": 1, "scan_id": 1, "report_datetime": datetime.now(), "report_data": "3 brain lesions.",
+        "sent": False, "lesion_cells": 20, "lesion_area": 0.2, "region_density": [[0.2] * 4] * 4,
+        "lesion_count": 3, "lesion_sizes": [10, 6, 4], "lesion_centroids": [[1.5, 2.0], [5.0, 5.5], [8.0, 1.0]],
+        "trace_id": "0" * 32, "stage_times": {"pacs_sent": 1.0, "analyzed": 2.0},
+    }
+
+
+def us_per_document(build: Callable[[dict], dict], fields: dict, documents: int) -> float:
+    """Best of 3 rounds"""
+    timings = []
+    for _ in range(3):
+        started = time.perf_counter()
+        for _ in range(documents):
+            build(fields)
+        timings.append(time.perf_counter() - started)
+    return round(min(timings) / documents * 1e6, 3)
+
+
+def run(documents: int) -> List[Dict[str, object]]:
+    text_scan = {**scan_fields(), "scan_data": format_text_scan(decode_scan(generate_brain_scan()))}
+    cases = [("BrainScan", BrainScan, scan_fields()), ("BrainReport", BrainReport, report_fields()),
+             ("BrainScan of a text scan", BrainScan, text_scan)]
+    results = []
+    for name, model, fields in cases:
+        # same document both ways
+        assert model.bson(**fields) == model(**fields).to_bson()
+        validated = us_per_document(lambda fields: model(**fields).to_bson(), fields, documents)
+        fast = us_per_document(lambda fields: model.bson(**fields), fields, documents)
+        results.append({
+            "document": name,
+            "validated_us_per_document": validated,
+            "fast_us_per_document": fast,
+            "speedup": round(validated / fast, 2),
+        })
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Validated model vs fast path of brain scan and report documents")
+    parser.add_argument("--documents", type=int, default=20000, help="documents built per round")
+    args = parser.parse_args()
+    print(json.dumps(run(args.documents), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+"""
+End-to-end benchmark of the FrPACS -> FrHUB -> FrBRAIN -> FrPACS pipeline.
+
+Boots FrPACSBrainReportServer, FrHUBBrainScanServer (or its asyncio version), FrBRAINScanProcessor and
+FrHUBBrainReportClient in this process on free ports, drives a configurable load of scans through them like FrPACS does
+and prints throughput, per-stage latency percentiles, CPU and peak RSS as JSON, so runs can be compared between releases:
+
+    python3 -m benchmarks.pipeline --scans 2000 --connections 4 --window 32
+    python3 -m benchmarks.pipeline --scans 200 --rows 256 --cols 256 --depth 64 --mongo-uri mongodb://localhost:27017
+    python3 -m benchmarks.pipeline --scans 2000 --sqlite /tmp/bench.db
+
+Without --mongo-uri or --sqlite the DB is an in-memory mongomock stand-in. FrBRAIN workers are then threads of this
+process, as worker processes wouldn't see its data, so only --mongo-uri and --sqlite numbers are representative of a
+real deployment.
+Stages of a scan:
+    - ingest: sent by FrPACS -> acked by FrHUB (stored in DB)
+    - analysis: acked -> report saved by FrBRAIN (report_datetime of the report)
+    - delivery: report saved -> received by FrPACS
+    - end_to_end: sent -> report received by FrPACS
+"""
+import argparse
+import json
+import random as rn
+import resource
+import socket
+import threading
+import time
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from common.config import (
+    BRAIN_SCAN_HOST,
+    BRAIN_SCAN_WINDOW,
+    AckStatus,
+    MessageType,
+    NeuroDataCollections,
+    ScanCell,
+    TraceStage,
+)
+from common.db_manager import DBManager
+from common.protocol import brain_scan_frames, decode_ack, recv_frame, send_frame
+from common.scan_codec import encode_scan
+from common.stage_latency import stage_latencies
+from common.storage.mongo import MongoBackend
+from common.storage.sqlite import SQLiteBackend
+from common.tracing import traced
+from fr_brain.processor import FrBRAINScanProcessor
+from fr_hub.async_server import FrHUBAsyncBrainScanServer
+from fr_hub.client import FrHUBBrainReportClient
+from fr_hub.server import FrHUBBrainScanServer
+from fr_pacs.server import FrPACSBrainReportServer
+
+PERCENTILES = (50, 90, 99)
+# distinct scans sent round robin, so generating them isn't part of the load
+SCAN_VARIANTS = 16
+
+
+def use_db(mongo_uri: Optional[str], sqlite_path: Optional[str] = None) -> str:
+    """Points the DBManager of every unit at the given MongoDB or SQLite file, or at an in-memory stand-in when None"""
+    db_manager = DBManager()
+    if mongo_uri:
+        db_manager.use_backend(MongoBackend.connect(mongo_uri))
+        db_manager.ensure_indexes()
+        return "mongodb"
+    if sqlite_path:
+        db_manager.use_backend(SQLiteBackend(sqlite_path))
+        db_manager.ensure_indexes()
+        return "sqlite"
+    import mongomock
+    from mongomock.gridfs import enable_gridfs_integration
+
+    enable_gridfs_integration()
+    db_manager.use_backend(MongoBackend(mongomock.MongoClient()))
+    return "mongomock"
+
+
+def thread_pool(processes: int, maxtasksperchild: Optional[int] = None) -> ThreadPool:
+    return ThreadPool(processes)
+
+
+def free_port(host: str) -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind((host, 0))
+        return probe.getsockname()[1]
+
+
+def wait_listening(host: str, port: int, timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.01)
+
+
+def build_scans(rows: int, cols: int, depth: int, lesion_prob: float) -> List[bytes]:
+    rng = np.random.default_rng(0)
+    shape = (depth, rows, cols) if depth else (rows, cols)
+    scans = []
+    for _ in range(SCAN_VARIANTS):
+        occupied = rng.random(shape) < lesion_prob
+        scans.append(encode_scan(np.where(occupied, ScanCell.lesion, ScanCell.clear)))
+    return scans
+
+
+class PipelineRun:
+    """Timestamps (wall clock, as report_datetime) of every stage of the scans of one run, keyed by scan id"""
+
+    def __init__(self, scans: int) -> None:
+        # scans of this run are told apart from whatever else is in the DB by their patient id
+        self.patient_id = rn.randint(10 ** 8, 10 ** 9)
+        self.scans = scans
+        self.sent: Dict[int, float] = {}
+        self.acked: Dict[int, float] = {}
+        self.received: Dict[int, float] = {}
+        self.failed = 0
+        self.lock = threading.Lock()
+        self.all_received = threading.Event()
+
+    def on_brain_reports(self, reports: List[dict]) -> None:
+        now = time.time()
+        with self.lock:
+            for report in reports:
+                if report["patient_id"] == self.patient_id:
+                    self.received.setdefault(report["scan_id"], now)
+            if len(self.received) + self.failed >= self.scans:
+                self.all_received.set()
+
+    def on_ack(self, scan_id: int, status: str) -> None:
+        with self.lock:
+            if status == AckStatus.stored:
+                self.acked[scan_id] = time.time()
+            else:
+                self.failed += 1
+            if len(self.received) + self.failed >= self.scans:
+                self.all_received.set()
+
+    def send_scans(
+        self, host: str, port: int, scan_ids: range, scans: List[bytes], window: int, interval: float
+    ) -> None:
+        """
+        Sends scans over one connection with up to `window` of them unacknowledged, like FrPACSBrainScanClient
+        :param interval: seconds between two sends of this connection, 0 sends as fast as the window allows
+        """
+        client_socket = socket.create_connection((host, port))
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        slots = threading.Semaphore(window)
+        acks = threading.Thread(target=self.receive_acks, args=(client_socket, slots, len(scan_ids)), daemon=True)
+        acks.start()
+        scan_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        started = time.monotonic()
+        for position, scan_id in enumerate(scan_ids):
+            if interval:
+                time.sleep(max(started + position * interval - time.monotonic(), 0))
+            slots.acquire()
+            scan = (self.patient_id, scan_id, scan_datetime, "BRAIN", scans[scan_id % len(scans)])
+            scan = traced(scan, TraceStage.pacs_sent)
+            self.sent[scan_id] = time.time()
+            # the scan id doubles as sequence number
+            for msg_type, payload in brain_scan_frames(scan_id, scan):
+                send_frame(client_socket, msg_type, payload)
+        acks.join()
+        client_socket.close()
+
+    def receive_acks(self, client_socket: socket.socket, slots: threading.Semaphore, expected: int) -> None:
+        for _ in range(expected):
+            frame = recv_frame(client_socket)
+            if frame is None or frame[0] != MessageType.ack:
+                break
+            seq, status, _ = decode_ack(frame[1])
+            self.on_ack(seq, status)
+            slots.release()
+
+    def report_times(self) -> Dict[int, float]:
+        """When FrBRAIN saved the report of every scan of the run"""
+        reports = DBManager().find(
+            NeuroDataCollections.brain_reports,
+            {"patient_id": self.patient_id},
+            projection={"scan_id": 1, "report_datetime": 1},
+        )
+        return {report["scan_id"]: report["report_datetime"].timestamp() for report in reports or []}
+
+
+def summarize(latencies: List[float]) -> dict:
+    if not latencies:
+        return {"count": 0}
+    latencies_ms = np.array(latencies) * 1000
+    summary = {"count": len(latencies), "mean_ms": round(float(latencies_ms.mean()), 3)}
+    for percentile in PERCENTILES:
+        summary[f"p{percentile}_ms"] = round(float(np.percentile(latencies_ms, percentile)), 3)
+    summary["max_ms"] = round(float(latencies_ms.max()), 3)
+    return summary
+
+
+def usage() -> dict:
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        "cpu_s": usage_self.ru_utime + usage_self.ru_stime + usage_children.ru_utime + usage_children.ru_stime,
+        # kilobytes on Linux
+        "max_rss_mb": round(usage_self.ru_maxrss / 1024, 1),
+        "children_max_rss_mb": round(usage_children.ru_maxrss / 1024, 1),
+    }
+
+
+def run(
+    scans: int = 1000,
+    connections: int = 1,
+    window: int = BRAIN_SCAN_WINDOW,
+    rate: float = 0,
+    rows: int = 10,
+    cols: int = 10,
+    depth: int = 0,
+    lesion_prob: float = 0.2,
+    workers: Optional[int] = None,
+    hub_server: str = "threads",
+    mongo_uri: Optional[str] = None,
+    timeout: float = 300,
+    sqlite_path: Optional[str] = None,
+) -> dict:
+    db = use_db(mongo_uri, sqlite_path)
+    # worker processes only share a real DB with this process
+    brain_workers = "threads" if db == "mongomock" else "processes"
+    host = BRAIN_SCAN_HOST
+    pipeline_run = PipelineRun(scans)
+    report_port, scan_port = free_port(host), free_port(host)
+
+    report_server = FrPACSBrainReportServer(host, report_port, on_brain_reports=pipeline_run.on_brain_reports)
+    scan_server_class = FrHUBAsyncBrainScanServer if hub_server == "asyncio" else FrHUBBrainScanServer
+    scan_server = scan_server_class(host=host, port=scan_port)
+    report_client = FrHUBBrainReportClient(host, report_port)
+    processor = FrBRAINScanProcessor(workers=workers, pool_factory=thread_pool if brain_workers == "threads" else None)
+    for target in (report_server.run_brain_report_server, scan_server.run_brain_scan_server):
+        threading.Thread(target=target, daemon=True).start()
+    wait_listening(host, report_port)
+    wait_listening(host, scan_port)
+    threading.Thread(target=report_client.send_brain_report, daemon=True).start()
+    processor_thread = threading.Thread(target=processor.process_brain_scans, daemon=True)
+    processor_thread.start()
+
+    scan_data = build_scans(rows, cols, depth, lesion_prob)
+    usage_before = usage()
+    started = time.time()
+    # scan ids are split evenly between connections, each sending its share of the rate
+    senders = [
+        threading.Thread(
+            target=pipeline_run.send_scans,
+            args=(host, scan_port, range(index + 1, scans + 1, connections), scan_data, window,
+                  connections / rate if rate else 0),
+            daemon=True,
+        )
+        for index in range(connections)
+    ]
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+    sent_elapsed = time.time() - started
+    completed = pipeline_run.all_received.wait(timeout)
+    elapsed = time.time() - started
+    usage_after = usage()
+
+    report_client.stop()
+    processor.stop()
+    processor_thread.join(timeout=10)
+    scan_server.stop()
+    report_server.stop()
+
+    reported = pipeline_run.report_times()
+    sent, acked, received = pipeline_run.sent, pipeline_run.acked, pipeline_run.received
+    cpu_s = usage_after["cpu_s"] - usage_before["cpu_s"]
+    return {
+        "config": {
+            "scans": scans, "connections": connections, "window": window, "rate": rate,
+            "shape": "x".join(map(str, (depth, rows, cols) if depth else (rows, cols))),
+            "scan_bytes": len(scan_data[0]), "workers": processor.workers,
+            "brain_workers": brain_workers, "hub_server": hub_server, "db": db,
+        },
+        "completed": completed,
+        "scans_sent": len(sent),
+        "scans_stored": len(acked),
+        "scans_failed": pipeline_run.failed,
+        "reports_received": len(received),
+        "elapsed_s": round(elapsed, 3),
+        "ingest_scans_per_s": round(len(acked) / sent_elapsed, 1),
+        "reports_per_s": round(len(received) / elapsed, 1),
+        "latency": {
+            "ingest": summarize([acked[i] - sent[i] for i in acked]),
+            "analysis": summarize([reported[i] - acked[i] for i in acked if i in reported]),
+            "delivery": summarize([received[i] - reported[i] for i in received if i in reported]),
+            "end_to_end": summarize([received[i] - sent[i] for i in received]),
+        },
+        # the same hops as timed on the traces by the units themselves, see common/stage_latency.py
+        "stage_latency_ms": stage_latencies(started, time.time()),
+        "cpu_s": round(cpu_s, 3),
+        "cpu_utilization": round(cpu_s / elapsed, 2),
+        "max_rss_mb": usage_after["max_rss_mb"],
+        "children_max_rss_mb": usage_after["children_max_rss_mb"],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the FrPACS -> FrHUB -> FrBRAIN pipeline")
+    parser.add_argument("--scans", type=int, default=1000, help="scans sent in total")
+    parser.add_argument("--connections", type=int, default=1, help="FrPACS connections sending scans")
+    parser.add_argument("--window", type=int, default=BRAIN_SCAN_WINDOW, help="unacknowledged scans per connection")
+    parser.add_argument("--rate", type=float, default=0, help="scans/sec offered in total, 0 sends as fast as possible")
+    parser.add_argument("--rows", type=int, default=10)
+    parser.add_argument("--cols", type=int, default=10)
+    parser.add_argument("--depth", type=int, default=0, help="slices of 3D scans, 0 for 2D scans")
+    parser.add_argument("--lesion-prob", type=float, default=0.2)
+    parser.add_argument("--workers", type=int, default=None, help="FrBRAIN workers (default: CPUs)")
+    parser.add_argument("--hub-server", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--mongo-uri", default=None, help="MongoDB to run against, in-memory stand-in by default")
+    parser.add_argument("--sqlite", default=None, help="SQLite file to run against instead of MongoDB")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds to wait for the last reports")
+    parser.add_argument("--output", default=None, help="also write the results to this JSON file")
+    args = parser.parse_args()
+    results = run(
+        args.scans, args.connections, args.window, args.rate, args.rows, args.cols, args.depth, args.lesion_prob,
+        args.workers, args.hub_server, args.mongo_uri, args.timeout, args.sqlite,
+    )
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
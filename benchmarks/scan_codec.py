@@ -0,0 +1,72 @@
+"""
+Compares the legacy text scan format (text, base64'd and JSON-wrapped on the wire) with the packed one:
+bytes on the wire, bytes stored in MongoDB and decode time, for growing grid sizes:
+
+    python3 -m benchmarks.scan_codec
+"""
+import argparse
+import base64
+import json
+import timeit
+
+import bson
+
+from common.protocol import decode_brain_scan, decode_legacy_brain_scan, encode_brain_scan
+from common.scan_codec import decode_scan, format_text_scan, parse_text_scan
+from common.utils import generate_brain_scan
+
+SIZES = [(10, 10), (256, 256), (1024, 1024)]
+
+
+def legacy_payload(seq: int, scan: tuple) -> bytes:
+    """JSON payload as sent by FrPACS before scans were packed"""
+    patient_id, scan_id, scan_datetime, scan_type, text_scan = scan
+    encoded_scan = base64.b64encode(text_scan.encode("utf-8")).decode("utf-8")
+    return json.dumps({"seq": seq, "scan": (patient_id, scan_id, scan_datetime, scan_type, encoded_scan)}).encode()
+
+
+def decode_legacy_text(payload: bytes):
+    return parse_text_scan(base64.b64decode(json.loads(payload)["scan"][4]).decode("utf-8"))
+
+
+def time_per_call(function, repeat: int) -> float:
+    return min(timeit.repeat(function, number=1, repeat=repeat)) * 1000
+
+
+def run(sizes: list, repeat: int = 5) -> list:
+    results = []
+    for rows, cols in sizes:
+        packed_scan = generate_brain_scan(rows, cols)
+        text_scan = format_text_scan(decode_scan(packed_scan))
+        packed = (1, 1, "2025-01-01 00:00:00", "BRAIN", packed_scan)
+        legacy = (1, 1, "2025-01-01 00:00:00", "BRAIN", text_scan)
+        packed_payload = encode_brain_scan(1, packed)
+        text_payload = legacy_payload(1, legacy)
+        results.append(
+            {
+                "grid": f"{rows}x{cols}",
+                "legacy_wire_bytes": len(text_payload),
+                "packed_wire_bytes": len(packed_payload),
+                "legacy_stored_bytes": len(bson.encode({"scan_data": text_scan})),
+                "packed_stored_bytes": len(bson.encode({"scan_data": packed_scan})),
+                # decoding the frame and getting to the cells of the scan
+                "legacy_decode_ms": round(time_per_call(lambda: decode_legacy_text(text_payload), repeat), 3),
+                "packed_decode_ms": round(
+                    time_per_call(lambda: decode_scan(decode_brain_scan(packed_payload)[1][4]), repeat), 3
+                ),
+                # what FrHUB does with a frame of an older FrPACS
+                "legacy_convert_ms": round(time_per_call(lambda: decode_legacy_brain_scan(text_payload), repeat), 3),
+            }
+        )
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Legacy text vs packed brain scan format")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    print(json.dumps(run(SIZES, args.repeat), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+from collections import defaultdict
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from common.config import ANALYSIS_REGIONS, ScanCell
+from common.lesions import label_lesions, label_scan_batch, label_slices, resolve_connectivity
+from common.logger import logger
+from common.scan_codec import (
+    CELLS_PER_BYTE,
+    cells_per_byte,
+    read_header,
+    read_scan_chunks,
+    stack_cell_bytes,
+    to_packed_scan,
+    unpack_cells,
+)
+
+ScanData = Union[str, bytes]
+
+
+def region_bounds(size: int, regions: int) -> np.ndarray:
+    """Start index of every region along an axis of `size` cells, split into at most `regions` even parts."""
+    parts = min(regions, size)
+    return np.array([size * part // parts for part in range(parts)], dtype=np.intp)
+
+
+@lru_cache(maxsize=64)
+def region_layout(rows: int, cols: int, regions: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Regions of a scan slice, the same for every scan of a shape so they are only computed once
+    :return: start row and start col of the regions, and the cells of every region (row regions, col regions)
+    """
+    row_starts, col_starts = region_bounds(rows, regions), region_bounds(cols, regions)
+    region_cells = np.outer(np.diff(row_starts, append=rows), np.diff(col_starts, append=cols))
+    return row_starts, col_starts, region_cells
+
+
+def summarize(region_lesions: np.ndarray, region_cells: np.ndarray) -> List[dict]:
+    """
+    Builds the analysis of every scan from its lesion cells per region
+    :param region_lesions: lesion cells shaped (scans, row regions, col regions)
+    :param region_cells: cells of every region, shaped (row regions, col regions)
+    :return:
+    """
+    lesion_cells = region_lesions.sum(axis=(1, 2))
+    lesion_area = lesion_cells / region_cells.sum()
+    region_density = (region_lesions / region_cells).round(4).tolist()
+    return [
+        {"lesion_cells": int(cells), "lesion_area": float(area), "region_density": density}
+        for cells, area, density in zip(lesion_cells, lesion_area, region_density)
+    ]
+
+
+def analyze_cells(cells: np.ndarray, regions: int = ANALYSIS_REGIONS) -> List[dict]:
+    """
+    Analyzes a batch of scans of the same shape in one go
+    :param cells: ScanCell states shaped (scans, rows, cols) or (scans, depth, rows, cols)
+    :param regions: every scan is split into regions x regions areas (over rows and cols) for the density
+    :return: analysis of every scan, see analyze_scans
+    """
+    rows, cols = cells.shape[-2:]
+    depth = cells.shape[1] if cells.ndim == 4 else 1
+    lesions = (cells == ScanCell.lesion).reshape(len(cells), depth, rows, cols)
+    return analyze_lesions(lesions.sum(axis=1, dtype=np.int32), depth, regions)
+
+
+def analyze_lesions(lesions: np.ndarray, depth: int, regions: int = ANALYSIS_REGIONS) -> List[dict]:
+    """
+    Analyzes a batch of scans of the same shape from their lesion cells
+    :param lesions: lesion cells at every (row, col) summed over the slices of the scan, shaped (scans, rows, cols)
+    :param depth: slices of the scans
+    :param regions:
+    :return: analysis of every scan, see analyze_scans
+    """
+    rows, cols = lesions.shape[1:]
+    if not rows or not cols:
+        return [{"lesion_cells": 0, "lesion_area": 0.0, "region_density": []} for _ in range(len(lesions))]
+    row_starts, col_starts, region_cells = region_layout(rows, cols, regions)
+    # lesion cells of every region, for all scans at once
+    region_lesions = np.add.reduceat(np.add.reduceat(lesions, row_starts, axis=1), col_starts, axis=2)
+    # density is per area of the slices, over the whole depth
+    return summarize(region_lesions, region_cells * depth)
+
+
+def analyze_packed(packed: np.ndarray, shape: Tuple[int, ...], regions: int = ANALYSIS_REGIONS) -> List[dict]:
+    """
+    Analyzes a batch of packed scans of the same shape
+    When rows and regions start on byte boundaries (cols multiple of 4, like 256x256 or 1024x1024), lesions are counted
+    per packed byte with bitwise operations, without unpacking the cells. Otherwise the cells are unpacked first
+    :param packed: packed cells, one row per scan (see stack_cell_bytes)
+    :param shape: shape of one scan
+    :param regions:
+    :return: analysis of every scan, see analyze_scans
+    """
+    rows, cols = shape[-2:]
+    row_starts, col_starts, region_cells = region_layout(rows, cols, regions)
+    if not rows or not cols or cols % CELLS_PER_BYTE or (col_starts % CELLS_PER_BYTE).any():
+        return analyze_cells(unpack_cells(packed, shape), regions)
+    # lesion cells of every packed byte, shaped (scans, depth, rows, bytes per row)
+    lesions = cells_per_byte(packed, ScanCell.lesion).reshape(len(packed), -1, rows, cols // CELLS_PER_BYTE)
+    depth = lesions.shape[1]
+    # summing slices only when there are several, it costs a copy of the whole batch
+    lesions = lesions.sum(axis=1, dtype=np.int32) if depth > 1 else lesions[:, 0]
+    region_lesions = np.add.reduceat(
+        np.add.reduceat(lesions, col_starts // CELLS_PER_BYTE, axis=2, dtype=np.int32), row_starts, axis=1
+    )
+    return summarize(region_lesions, region_cells * depth)
+
+
+def analyze_scans(
+    scans: Sequence[ScanData], regions: int = ANALYSIS_REGIONS, connectivity: Optional[int] = None
+) -> List[Optional[dict]]:
+    """
+    Analyzes a batch of scans. Scans of the same shape are analyzed together with vectorized NumPy operations,
+    so the cost per scan is a few array operations instead of a Python loop over cells
+    :param scans: packed scans, or legacy text scans
+    :param regions:
+    :param connectivity: for labelling lesions, see resolve_connectivity
+    :return: for every scan (None if it isn't a valid scan):
+        - lesion_cells: number of lesion cells
+        - lesion_area: fraction of the scan covered by lesion cells
+        - region_density: fraction of lesion cells in each of the regions x regions areas of the scan
+        - lesion_count, lesion_sizes, lesion_centroids: connected lesions (see common/lesions.py), unless labelling is off
+    """
+    results: List[Optional[dict]] = [None] * len(scans)
+    # scans grouped by shape, as only scans of the same shape can be stacked into one array
+    by_shape: Dict[Tuple[int, ...], List[Tuple[int, bytes]]] = defaultdict(list)
+    for index, scan_data in enumerate(scans):
+        try:
+            if isinstance(scan_data, str):
+                # legacy text scans are rare (only ones stored before scans were packed), packing them keeps one path
+                scan_data = to_packed_scan(scan_data)
+            shape, _ = read_header(scan_data)
+            by_shape[shape].append((index, scan_data))
+        except Exception as e:
+            logger.error(f"Invalid brain scan at position {index} of the batch: {e}")
+    for shape, group in by_shape.items():
+        packed = stack_cell_bytes([scan_data for _, scan_data in group])
+        for (index, _), analysis in zip(group, analyze_packed(packed, shape, regions)):
+            results[index] = analysis
+        scan_connectivity = resolve_connectivity(len(shape), connectivity)
+        if scan_connectivity is None:
+            continue
+        if len(shape) == 2:
+            # 2D scans are small enough to be labelled together
+            lesions = label_scan_batch(unpack_cells(packed, shape), scan_connectivity)
+        else:
+            # volumes are labelled one by one, slice by slice, to bound memory
+            lesions = [label_lesions(scan_data, scan_connectivity) for _, scan_data in group]
+        for (index, _), scan_lesions in zip(group, lesions):
+            results[index].update(scan_lesions)
+    return results
+
+
+def analyze_scan_chunks(
+    chunks: Iterable[bytes], regions: int = ANALYSIS_REGIONS, connectivity: Optional[int] = None
+) -> dict:
+    """
+    Analyzes a packed scan read chunk by chunk (e.g. from chunk storage, see common/scan_store.py). Slices are analyzed
+    as soon as their chunks are read, so the analysis starts before the whole scan is loaded and never holds all of it
+    :param chunks:
+    :param regions:
+    :param connectivity: see analyze_scans
+    :raises ScanFormatError: if the chunks aren't a valid packed scan
+    :return: see analyze_scans
+    """
+    shape, slices = read_scan_chunks(chunks)
+    lesions = np.zeros(shape[-2:], dtype=np.int32)
+
+    def count_lesions() -> Iterator[np.ndarray]:
+        for cells in slices:
+            np.add(lesions, cells == ScanCell.lesion, out=lesions)
+            yield cells
+
+    scan_connectivity = resolve_connectivity(len(shape), connectivity)
+    if scan_connectivity is None:
+        scan_lesions = {}
+        for _ in count_lesions():
+            pass
+    else:
+        scan_lesions = label_slices(count_lesions(), scan_connectivity)
+    analysis = analyze_lesions(lesions[None], shape[0] if len(shape) == 3 else 1, regions)[0]
+    analysis.update(scan_lesions)
+    return analysis
+
+
+def format_report(analysis: dict) -> str:
+    """Report text for FrPACS, from the analysis of a scan: connected lesions, or lesion cells if they weren't labelled."""
+    return f"The analysed scan showed {analysis.get('lesion_count', analysis['lesion_cells'])} brain lesions."
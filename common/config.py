@@ -1,3 +1,5 @@
+from enum import IntEnum
+
 from strenum import StrEnum
 
 
@@ -9,6 +11,8 @@ class Queues(StrEnum):
 class NeuroDataCollections(StrEnum):
     brain_scans = "brain_scans"
     brain_reports = "brain_reports"
+    # GridFS bucket (brain_scan_files.files and brain_scan_files.chunks) of scans too large for a document
+    brain_scan_files = "brain_scan_files"
 
 
 class ReportStatus(StrEnum):
@@ -18,10 +22,193 @@ class ReportStatus(StrEnum):
     error = "Error"
 
 
+class AckStatus(StrEnum):
+    stored = "stored"
+    received = "received"
+    error = "error"
+    # FrHUB over its budget rejecting a connection, with a retry-after hint
+    busy = "busy"
+    # scan (patient_id, scan_id) FrHUB had stored already, e.g. sent again after its ack was lost: no need to resend it
+    duplicate = "duplicate"
+
+
+class CircuitState(StrEnum):
+    """States of the FrPACS circuit breaker (see fr_pacs/circuit_breaker.py)"""
+    closed = "closed"
+    open = "open"
+    half_open = "half_open"
+
+
+class TraceStage(StrEnum):
+    """Stages of a scan's trip through the units, in order, each timed on the scan's trace (see common/tracing.py)"""
+    pacs_sent = "pacs_sent"
+    hub_received = "hub_received"
+    hub_persisted = "hub_persisted"
+    brain_claimed = "brain_claimed"
+    analyzed = "analyzed"
+    report_saved = "report_saved"
+    report_sent = "report_sent"
+    pacs_acked = "pacs_acked"
+
+
+class ScanCell(IntEnum):
+    """States of a brain scan cell, as stored in the packed scan format (see common/scan_codec.py)"""
+    empty = 0
+    clear = 1
+    lesion = 2
+
+
+class MessageType(IntEnum):
+    """Message types carried in the header of every frame on the socket channels"""
+    brain_scan = 1
+    ack = 2
+    brain_report_batch = 3
+    # large scans are streamed: a begin frame with the scan metadata, chunks of the packed scan, and an end frame
+    brain_scan_begin = 4
+    brain_scan_chunk = 5
+    brain_scan_end = 6
+
+
 # should be in some env file or probably or some more secure Secrets Manager like AWS
 MONGO_DB_URI = "mongodb://localhost:27017"
+# storage engine behind DBManager (see common/storage): "mongo", or "sqlite" for single box installs without a MongoDB
+# server, overridden with the STORAGE_BACKEND env variable
+STORAGE_BACKEND = "mongo"
+# SQLite database file shared by the units of the box, overridden with the SQLITE_PATH env variable
+SQLITE_DB_PATH = "neuro_data.db"
+# a SQLite write waits this long for the write of another unit to finish before failing
+SQLITE_BUSY_TIMEOUT_S = 30
 BRAIN_SCAN_HOST = "127.0.0.1"
 BRAIN_SCAN_PORT = 12345
+# pending connections the OS queues for FrHUB before refusing new ones
+BRAIN_SCAN_BACKLOG = 1024
+# open FrPACS connections allowed at once, more are rejected with a retry-after hint
+BRAIN_SCAN_MAX_CONNECTIONS = 4096
+# group commit of received scans: a batch is written once it has MAX_SIZE scans or its first scan waited MAX_LINGER_MS
+BRAIN_SCAN_BATCH_MAX_SIZE = 256
+BRAIN_SCAN_BATCH_MAX_LINGER_MS = 5
+BRAIN_SCAN_BATCH_WRITERS = 2
+# optional write-ahead log of FrHUB (see fr_hub/wal.py, --wal-dir, empty for none): scans are acked once they're in
+# the log, appended by batches of up to BATCH_MAX_SIZE scans with one fsync every WAL_FSYNC_MS at most, to segment
+# files of about WAL_SEGMENT_BYTES. A drainer loads them into MongoDB by batches of WAL_DRAIN_BATCH_SIZE, trying again
+# every WAL_RETRY_S while MongoDB is unavailable
+BRAIN_SCAN_WAL_DIR = ""
+BRAIN_SCAN_WAL_SEGMENT_BYTES = 64 * 1024 * 1024
+BRAIN_SCAN_WAL_FSYNC_MS = 2
+BRAIN_SCAN_WAL_DRAIN_BATCH_SIZE = 1000
+BRAIN_SCAN_WAL_RETRY_S = 1
+# (patient_id, scan_id) of the scans FrHUB stored lately, kept in memory to ack their retransmissions as duplicates
+# without a DB round trip (see fr_hub/dedup.py), 0 leaves them all to the unique index of brain_scans
+BRAIN_SCAN_RECENT_KEYS = 100000
+# pipelining: scans FrPACS may send before waiting for their acks, and scans FrHUB stores concurrently per connection
+BRAIN_SCAN_WINDOW = 32
+BRAIN_SCAN_MAX_IN_FLIGHT = 64
+# persistent connections of a FrPACS to FrHUB, scans go to whichever connection has room in its window
+BRAIN_SCAN_CONNECTIONS = 4
+# a connection with a scan unacknowledged for this long is considered stuck and replaced
+BRAIN_SCAN_ACK_TIMEOUT_S = 30
+# reconnecting to FrHUB backs off exponentially with jitter: the n-th failed attempt in a row of a connection waits
+# between half and all of RECONNECT_S * 2 ** (n - 1), capped at RECONNECT_MAX_S
+BRAIN_SCAN_RECONNECT_S = 1
+BRAIN_SCAN_RECONNECT_MAX_S = 30
+# after this many failed attempts in a row of the whole pool the circuit opens: FrHUB is considered down, scans aren't
+# handed to the connections, and a single attempt is made once the circuit's own backoff is over
+BRAIN_SCAN_CIRCUIT_FAILURES = 3
+# scans FrPACS generates per second, 0 for as fast as FrHUB takes them. While the circuit is open scans generated at a
+# rate are logged as not sent, without a rate none are generated
+BRAIN_SCAN_RATE = 0
+# flow control: with every ack FrHUB grants the connection credits, the number of scans it may have unacknowledged
+# (up to BRAIN_SCAN_MAX_IN_FLIGHT). FrHUB's load is the larger of its group commit queue depth / QUEUE_BUDGET and its
+# batch write time / LATENCY_BUDGET_S: credits shrink from half the budget on, down to 1 at the full budget, and over
+# it new connections are rejected with a retry-after hint of RETRY_AFTER_S times the load
+BRAIN_SCAN_QUEUE_BUDGET = 4096
+BRAIN_SCAN_LATENCY_BUDGET_S = 0.5
+BRAIN_SCAN_RETRY_AFTER_S = 1
+# packed scans bigger than this are sent as a stream of chunk frames and stored in GridFS chunks of this size
+BRAIN_SCAN_CHUNK_SIZE = 1024 * 1024
+# scans bigger than this are kept in GridFS instead of in their document (MongoDB caps documents at 16 MB)
+BRAIN_SCAN_INLINE_MAX_SIZE = 4 * 1024 * 1024
 
 BRAIN_REPORT_HOST = "127.0.0.1"
 BRAIN_REPORT_PORT = 12346
+# reports FrHUB claims from DB and sends to FrPACS in one frame
+BRAIN_REPORT_BATCH_SIZE = 100
+# reports claimed longer ago than this (e.g. by a crashed FrHUB) can be claimed again
+BRAIN_REPORT_CLAIM_TIMEOUT_S = 60
+
+# FrBRAIN worker pool, None means one worker per CPU
+BRAIN_PROCESSOR_WORKERS = None
+# batches of claimed scans (of up to BRAIN_PROCESSOR_BATCH_SIZE scans each) handed to a worker at once
+BRAIN_PROCESSOR_CHUNKSIZE = 1
+# workers are replaced after this many tasks (CHUNKSIZE batches each) to cap their memory growth
+BRAIN_PROCESSOR_MAX_TASKS_PER_CHILD = 1000
+# scans dispatched to the pool but not yet processed
+BRAIN_PROCESSOR_MAX_PENDING = 256
+
+# scans analyzed together by a FrBRAIN worker
+BRAIN_PROCESSOR_BATCH_SIZE = 8
+# scans are split into ANALYSIS_REGIONS x ANALYSIS_REGIONS areas for the lesion density of the report
+ANALYSIS_REGIONS = 4
+# lesions are connected components of lesion cells (see common/lesions.py), None turns the labelling off.
+# 2D: 4 (sides) or 8 (sides and corners), 3D: 6 (faces) or 26 (faces, edges and corners)
+LESION_CONNECTIVITY_2D = 8
+LESION_CONNECTIVITY_3D = 26
+# sizes and centroids are reported for the largest lesions only, so reports of noisy volumes stay small
+LESION_REPORT_MAX_LESIONS = 100
+
+# scans are claimed by a FrBRAIN with a lease, scans whose lease expired (e.g. crashed FrBRAIN) go back to 'To Do'
+BRAIN_SCAN_LEASE_S = 300
+BRAIN_SCAN_CLAIM_BATCH_SIZE = 32
+BRAIN_SCAN_LEASE_REAP_INTERVAL_S = 30
+
+# local pub/sub (UDP on loopback) used to wake up consumers when new work is stored
+NOTIFY_HOST = "127.0.0.1"
+BRAIN_SCAN_NOTIFY_PORT = 12347
+BRAIN_REPORT_NOTIFY_PORT = 12348
+# bounds of the adaptive polling interval, used when no notification arrives
+POLL_MIN_INTERVAL_S = 0.05
+POLL_MAX_INTERVAL_S = 5
+
+# Prometheus /metrics endpoint of every unit (see common/metrics.py), None turns the endpoint and the recording off
+METRICS_HOST = "127.0.0.1"
+FR_PACS_METRICS_PORT = 9101
+FR_HUB_METRICS_PORT = 9102
+FR_BRAIN_METRICS_PORT = 9103
+# latency histograms split every power of 2 into this many buckets, so values are known within 1/8 of themselves
+METRICS_HISTOGRAM_SUB_BUCKETS = 8
+
+# logging of every unit (see common/logger.py), overridden with --log-level, --log-format and --log-sample
+LOG_LEVEL = "INFO"
+# "json" (one object per line) or "text"
+LOG_FORMAT = "json"
+# records waiting for the background writer thread, further ones are dropped (and counted) instead of blocking
+LOG_QUEUE_SIZE = 10000
+# payloads are logged as their size, a hash and this many of their first bytes instead of in full
+LOG_PAYLOAD_PREVIEW_BYTES = 32
+# fraction of the records kept of events logged for every scan, report or batch, warnings and errors are never sampled
+LOG_SAMPLE_RATES = {
+    "scan_sent": 0.01,
+    "scan_acked": 0.01,
+    "scan_received": 0.01,
+    "scan_stored": 0.01,
+    "scan_duplicate": 0.1,
+    "report_duplicate": 0.1,
+    "report_received": 0.01,
+    "scan_batch_stored": 0.1,
+    "scans_claimed": 0.1,
+    "scan_batch_processed": 0.1,
+    "report_batch_sent": 0.1,
+    "report_batch_acked": 0.1,
+    "wal_drained": 0.1,
+    # scans generated while FrHUB is down, their count is logged with every failed attempt to connect again
+    "scan_not_sent": 0.01,
+}
+
+# stage latency report (see common/stage_latency.py): default time window and percentiles of every hop
+STAGE_LATENCY_WINDOW_S = 3600
+STAGE_LATENCY_PERCENTILES = (50, 90, 99)
+
+# framing protocol shared by FrPACS and FrHUB (see common/protocol.py)
+PROTOCOL_VERSION = 1
+# upper bound for a single frame payload, anything bigger is treated as a corrupted stream
+MAX_FRAME_SIZE = 256 * 1024 * 1024
@@ -1,17 +1,47 @@
+import functools
 import multiprocessing
 import os
-from typing import Dict, Optional, List
+import time
+import uuid
+from typing import Dict, Iterator, Optional, List, Tuple
 
-from pymongo import MongoClient
-
-from common.config import MONGO_DB_URI
+from common import metrics
+from common.config import MONGO_DB_URI, SQLITE_DB_PATH, STORAGE_BACKEND
 from common.logger import logger
+from common.storage.backend import Sort, StorageBackend
+from common.storage.mongo import MongoBackend
+from common.storage.sqlite import SQLiteBackend
+
+DB_OPERATION_SECONDS = metrics.histogram(
+    "db_operation_seconds", "Time of DBManager calls, DB round trips included", ("operation", "collection")
+)
+
+
+def timed(method):
+    """Observes the time of a DBManager method taking the collection (or bucket) name as first argument"""
+    @functools.wraps(method)
+    def timed_method(self, collection_name, *args, **kwargs):
+        if not metrics.REGISTRY.enabled:
+            return method(self, collection_name, *args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return method(self, collection_name, *args, **kwargs)
+        finally:
+            DB_OPERATION_SECONDS.labels(method.__name__, collection_name).observe(time.perf_counter() - started)
+    return timed_method
+
+
+# unique indexes the units don't start without, or retransmitted scans and reports would be stored twice
+IDEMPOTENCY_INDEXES = ("scans_idempotency_key", "reports_idempotency_key")
 
 
 class DBManager:
     _instance = None
     lock = multiprocessing.Lock()
 
+    # indexes of the MongoDB storage, see MongoBackend
+    INDEXES = MongoBackend.INDEXES
+
     def __new__(cls, mongo_uri: Optional[str] = None, *args, **kwargs):
         """Ensures only one instance of DBManager is created."""
         with cls.lock:
@@ -24,66 +54,268 @@ class DBManager:
         return cls._instance
 
     # to initialize the database connection
-    def initialize_db(self, mongo_uri) -> None:
-        self.client = None
-        self.db = None
+    def initialize_db(self, mongo_uri, storage: Optional[str] = None) -> None:
+        """
+        Opens the storage picked by STORAGE_BACKEND (or the STORAGE_BACKEND env variable)
+        :param mongo_uri: MongoDB server of the mongo storage
+        :param storage: "mongo" or "sqlite", overrides the configured one
+        """
+        storage = storage or os.getenv("STORAGE_BACKEND", STORAGE_BACKEND)
+        self.backend: Optional[StorageBackend] = None
         try:
-            # as it's local, so not providing any authentication
-            self.client = MongoClient(mongo_uri)
-            self.db = self.client.get_database("neuroData")
+            if storage == SQLiteBackend.name:
+                self.backend = SQLiteBackend(os.getenv("SQLITE_PATH", SQLITE_DB_PATH))
+            elif storage == MongoBackend.name:
+                self.backend = MongoBackend.connect(mongo_uri)
+            else:
+                raise ValueError(f"Unknown storage backend: {storage}")
         except Exception as e:
             # Handling exceptions and printing an error message if connection fails
             logger.error(f"Error in creating DB or collections {e}")
-            if self.client is not None:
-                self.client.close()
-                logger.info("DB Connection closed.")
 
+    def use_backend(self, backend: StorageBackend) -> None:
+        """Replaces the storage, closing the former one"""
+        if self.backend is not None:
+            self.backend.close()
+            logger.info("DB Connection closed.")
+        self.backend = backend
+
+    def ensure_indexes(self) -> List[str]:
+        """
+        Creates the indexes the units rely on one by one, so one that can't be created (e.g. a unique index over
+        duplicates) doesn't keep the others from being created. Existing ones are left as they are
+        :return: names of the indexes that couldn't be created
+        """
+        missing = []
+        for collection_name in self.backend.collection_names():
+            for index_name in self.backend.index_names(collection_name):
+                try:
+                    self.backend.ensure_index(collection_name, index_name)
+                except Exception as e:
+                    logger.error(f"Error creating index {index_name} of {collection_name}: {e}")
+                    missing.append(index_name)
+            logger.info(f"Ensured indexes of {collection_name}")
+        return missing
+
+    @timed
     def insert(self, collection_name: str, data: Dict) -> Optional[str]:
         """Insert document into DB."""
         try:
-            collection = self.db[collection_name]
-            result = collection.insert_one(data)
-            return result.inserted_id
+            return self.backend.insert(collection_name, data)
         except Exception as e:
             logger.error(f"Error inserting document into {collection_name}: {e}")
             return None
 
-    def fetch_one(self, collection_name: str, query: Dict) -> Optional[Dict]:
+    @timed
+    def insert_many(
+        self, collection_name: str, data: List[Dict], durable: bool = False, ignore_duplicates: bool = False
+    ) -> Optional[List]:
+        """
+        Inserts several documents into DB with a single round trip.
+        :param collection_name:
+        :param data:
+        :param durable: wait until the DB has written the documents to its journal
+        :param ignore_duplicates: documents already in the collection (duplicate key) count as inserted, e.g. when
+            inserting again documents with their _id after not knowing whether a former insert went through
+        :return: inserted ids, or None if the write failed
+        """
+        try:
+            return self.backend.insert_many(collection_name, data, durable, ignore_duplicates)
+        except Exception as e:
+            logger.error(f"Error inserting documents into {collection_name}: {e}")
+            return None
+
+    @timed
+    def insert_new(self, collection_name: str, data: List[Dict], durable: bool = False) -> Optional[List[int]]:
+        """
+        Inserts several documents with a single round trip, skipping those breaking a unique index (idempotency keys)
+        :param collection_name:
+        :param data:
+        :param durable: wait until the DB has written the documents to its journal
+        :return: positions in `data` of the duplicates, or None if the write failed
+        """
+        try:
+            return self.backend.insert_new(collection_name, data, durable)
+        except Exception as e:
+            logger.error(f"Error inserting documents into {collection_name}: {e}")
+            return None
+
+    @timed
+    def fetch_one(self, collection_name: str, query: Dict, projection: Optional[Dict] = None) -> Optional[Dict]:
         """Fetches a single document from DB."""
         try:
-            collection = self.db[collection_name]
-            return collection.find_one(query)
+            return self.backend.find_one(collection_name, query, projection)
         except Exception as e:
             logger.error(f"Error fetching document from {collection_name}: {e}")
             return None
 
+    @timed
     def fetch_one_and_update(self, collection_name: str, query: Dict, update: Dict) -> Optional[Dict]:
         """Fetches and updates a document"""
         try:
-            collection = self.db[collection_name]
-            return collection.find_one_and_update(query, {"$set": update}, return_document=True)
+            return self.backend.find_one_and_update(collection_name, query, update)
         except Exception as e:
             logger.error(
                 f"Error in fetch_one_and_update of DB Manager {collection_name}: {e}"
             )
             return None
 
-    def fetch_all(self, collection_name: str, query: Dict) -> Optional[List]:
+    def find(
+        self,
+        collection_name: str,
+        query: Dict,
+        projection: Optional[Dict] = None,
+        sort: Optional[Sort] = None,
+        limit: int = 0,
+    ):
+        """Builds a cursor, projection/sort/limit are left to the DB so only the needed documents and fields are sent."""
+        return self.backend.find(collection_name, query, projection, sort, limit)
+
+    @timed
+    def fetch_all(
+        self,
+        collection_name: str,
+        query: Dict,
+        projection: Optional[Dict] = None,
+        sort: Optional[Sort] = None,
+        limit: int = 0,
+    ) -> Optional[List]:
         """Fetches all documents based of query"""
         try:
-            collection = self.db[collection_name]
-            return list(collection.find(query))
+            return list(self.find(collection_name, query, projection, sort, limit))
         except Exception as e:
             logger.error(
                 f"Error in fetch_all of DB Manager {collection_name}: {e}"
             )
             return None
 
+    def iterate(
+        self,
+        collection_name: str,
+        query: Dict,
+        projection: Optional[Dict] = None,
+        sort: Optional[Sort] = None,
+        limit: int = 0,
+    ) -> Iterator[Dict]:
+        """
+        Yields documents based of query one by one, the cursor fetches them from the DB in batches
+        so the whole result is never held in memory. Iteration just stops if the query fails.
+        """
+        try:
+            yield from self.find(collection_name, query, projection, sort, limit)
+        except Exception as e:
+            logger.error(
+                f"Error in iterate of DB Manager {collection_name}: {e}"
+            )
+
+    @timed
+    def aggregate(self, collection_name: str, pipeline: List[Dict]) -> Optional[List]:
+        """Runs an aggregation pipeline, stages that outgrow MongoDB's memory limit may spill to disk"""
+        try:
+            return self.backend.aggregate(collection_name, pipeline)
+        except Exception as e:
+            logger.error(f"Error in aggregate of DB Manager {collection_name}: {e}")
+            return None
+
+    @timed
     def update(self, collection_name: str, query: Dict, update_data: Dict) -> Optional[int]:
         try:
-            collection = self.db[collection_name]
-            result = collection.update_one(query, {"$set": update_data})
-            return result.modified_count
+            return self.backend.update_one(collection_name, query, update_data)
         except Exception as e:
             logger.error(f"Error updating document in {collection_name}: {e}")
             return None
+
+    @timed
+    def update_many(self, collection_name: str, query: Dict, update_data: Dict) -> Optional[int]:
+        """Updates all documents matching the query with a single write."""
+        try:
+            return self.backend.update_many(collection_name, query, update_data)
+        except Exception as e:
+            logger.error(f"Error updating documents in {collection_name}: {e}")
+            return None
+
+    @timed
+    def claim_many(
+        self,
+        collection_name: str,
+        query: Dict,
+        update: Dict,
+        limit: int,
+        token_field: str = "claim_token",
+        projection: Optional[Dict] = None,
+        sort: Optional[Sort] = None,
+    ) -> Tuple[Optional[str], List[Dict]]:
+        """
+        Claims up to `limit` documents matching the query, so that no other process picks them up.
+        The query is re-checked while claiming, so a document claimed by someone else in between is skipped
+        :param collection_name:
+        :param query: documents that can be claimed
+        :param update: fields set on the claimed documents, along with a unique claim token
+        :param limit: max number of documents to claim
+        :param token_field: field storing the claim token
+        :param projection: fields of the claimed documents to return
+        :param sort: which documents to claim first
+        :return: the claim token and the claimed documents
+        """
+        try:
+            claim_token = uuid.uuid4().hex
+            documents = self.backend.claim_many(
+                collection_name, query, update, limit, token_field, claim_token, projection, sort
+            )
+            if documents is None:
+                return None, []
+            return claim_token, documents
+        except Exception as e:
+            logger.error(f"Error in claim_many of DB Manager {collection_name}: {e}")
+            return None, []
+
+    def drop_collection(self, collection_name: str) -> bool:
+        try:
+            self.backend.drop_collection(collection_name)
+            return True
+        except Exception as e:
+            logger.error(f"Error dropping {collection_name}: {e}")
+            return False
+
+    @timed
+    def open_upload_stream(self, bucket_name: str, filename: str, chunk_size: int, metadata: Optional[Dict] = None):
+        """
+        Opens a file (GridFS with MongoDB) to be written chunk by chunk, for data too large for a document.
+        Every `chunk_size` bytes written are stored as one chunk, so the data is never held in memory as a whole
+        :return: the stream (its _id identifies the file), or None if it couldn't be opened
+        """
+        try:
+            return self.backend.open_upload_stream(bucket_name, filename, chunk_size, metadata)
+        except Exception as e:
+            logger.error(f"Error opening upload stream in {bucket_name}: {e}")
+            return None
+
+    @timed
+    def open_download_stream(self, bucket_name: str, file_id):
+        """Opens a file for reading, its readchunk() returns its chunks one by one."""
+        try:
+            return self.backend.open_download_stream(bucket_name, file_id)
+        except Exception as e:
+            logger.error(f"Error opening download stream of {file_id} in {bucket_name}: {e}")
+            return None
+
+    @timed
+    def delete_file(self, bucket_name: str, file_id) -> bool:
+        """Deletes a file and its chunks."""
+        try:
+            self.backend.delete_file(bucket_name, file_id)
+            return True
+        except Exception as e:
+            logger.error(f"Error deleting file {file_id} from {bucket_name}: {e}")
+            return False
+
+    def watch(self, collection_name: str, pipeline: List[Dict], max_await_time_ms: int = 1000):
+        """
+        Opens a change stream on a collection.
+        Change streams need MongoDB to run as a replica set, on a standalone server (or SQLite) this returns None
+        """
+        try:
+            return self.backend.watch(collection_name, pipeline, max_await_time_ms)
+        except Exception as e:
+            logger.warning(f"Change stream not available for {collection_name}: {e}")
+            return None
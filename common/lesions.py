@@ -0,0 +1,249 @@
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from common.config import LESION_CONNECTIVITY_2D, LESION_CONNECTIVITY_3D, LESION_REPORT_MAX_LESIONS, ScanCell
+from common.scan_codec import iter_slices, read_header
+
+# Lesions are connected components of lesion cells. They are labelled on runs (horizontal stretches of lesion cells of
+# a row) instead of cells: two runs are connected if they overlap on neighbouring rows (or slices), and runs are merged
+# with a union-find. Volumes are labelled one slice at a time: lesions not touching the last slice can't grow anymore,
+# so they're finished and dropped, and memory stays bounded by the size of a slice whatever the depth.
+
+# connectivity -> dimensions of the scan, and how far (in cells) runs reach diagonally to touch each other
+CONNECTIVITIES = {4: (2, 0), 8: (2, 1), 6: (3, 0), 26: (3, 1)}
+DEFAULT_CONNECTIVITY = {2: LESION_CONNECTIVITY_2D, 3: LESION_CONNECTIVITY_3D}
+
+Runs = Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+
+def find_runs(mask: np.ndarray) -> Runs:
+    """
+    Runs of set cells of a 2D mask
+    :param mask:
+    :return: row, start col and end col (exclusive) of every run, ordered by row then col
+    """
+    rows, cols = mask.shape
+    padded = np.zeros((rows, cols + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    # every run is a rising edge followed by a falling edge on the same row
+    edge_rows, edge_cols = np.nonzero(np.diff(padded, axis=1))
+    return edge_rows[::2], edge_cols[::2], edge_cols[1::2]
+
+
+def touching_runs(runs: Runs, other_runs: Runs, row_offset: int, reach: int, cols: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pairs of touching runs, every run of `other_runs` is checked against the runs of `runs` on row (its row + row_offset)
+    Runs are ordered, so the runs touching a run are a contiguous range found with binary searches
+    :param runs:
+    :param other_runs:
+    :param row_offset:
+    :param reach: 0 when runs only touch by overlapping, 1 when they touch by a corner too
+    :param cols: cols of the slices
+    :return: index in `runs` and index in `other_runs` of every pair
+    """
+    run_rows, starts, ends = runs
+    other_rows, other_starts, other_ends = other_runs
+    # (row, col) keys, rows are far enough apart that a search can't spill over to the next or previous row
+    width = cols + 2
+    row_keys = (other_rows + row_offset) * width
+    first = np.searchsorted(run_rows * width + ends, row_keys + other_starts - reach, side="right")
+    last = np.searchsorted(run_rows * width + starts, row_keys + other_ends + reach, side="left")
+    counts = np.maximum(last - first, 0)
+    other_index = np.repeat(np.arange(len(other_rows)), counts)
+    # position of every pair among the pairs of its run of `other_runs`
+    positions = np.arange(len(other_index)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(first, counts) + positions, other_index
+
+
+def find_roots(parent: np.ndarray) -> np.ndarray:
+    """Points every element of a union-find straight to its root."""
+    while True:
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            return parent
+        parent = grandparent
+
+
+def merge(parent: np.ndarray, left: np.ndarray, right: np.ndarray) -> np.ndarray:
+    """
+    Union-find merging the sets of every (left, right) pair, all pairs at once
+    Every round hooks the root of each pair onto the smaller root, then compresses paths, until all pairs share a root
+    :param parent: parent of every element
+    :param left:
+    :param right:
+    :return: root of every element, roots being the smallest element of their set
+    """
+    parent = find_roots(parent)
+    while len(left):
+        left_roots, right_roots = parent[left], parent[right]
+        apart = left_roots != right_roots
+        if not apart.any():
+            break
+        left, right = left[apart], right[apart]
+        left_roots, right_roots = left_roots[apart], right_roots[apart]
+        np.minimum.at(parent, np.maximum(left_roots, right_roots), np.minimum(left_roots, right_roots))
+        parent = find_roots(parent)
+    return parent
+
+
+def resolve_connectivity(dimensions: int, connectivity: Optional[int] = None) -> Optional[int]:
+    """
+    Connectivity to label a scan of the given dimensions with
+    :param dimensions:
+    :param connectivity: used if it applies to these dimensions, otherwise the default of the dimensions is
+    :return: None if lesions shouldn't be labelled
+    """
+    if connectivity is not None and connectivity not in CONNECTIVITIES:
+        raise ValueError(f"Unsupported connectivity {connectivity}, expected one of {list(CONNECTIVITIES)}")
+    if connectivity is not None and CONNECTIVITIES[connectivity][0] == dimensions:
+        return connectivity
+    return DEFAULT_CONNECTIVITY[dimensions]
+
+
+def iter_lesions(slices: Iterable[np.ndarray], reach: int) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Labels lesions slice by slice, only the previous slice's runs are kept between slices
+    :param slices: 2D arrays of ScanCell states (a single one for a 2D scan)
+    :param reach: see CONNECTIVITIES
+    :return: size and sum of the (slice, row, col) of the cells of the lesions, yielded as soon as they're finished
+    """
+    # lesions touching the previous slice, and the lesion of each run of that slice
+    open_sizes, open_sums = np.empty(0), np.empty((0, 3))
+    previous_runs, previous_lesions = None, None
+    for index, cells in enumerate(slices):
+        runs = find_runs(cells == ScanCell.lesion)
+        run_rows, starts, ends = runs
+        cols = cells.shape[1]
+        # elements of the union-find: open lesions first, then the runs of this slice
+        open_count = len(open_sizes)
+        elements = open_count + len(run_rows)
+        left, right = touching_runs(runs, runs, -1, reach, cols)
+        left_parts, right_parts = [left + open_count], [right + open_count]
+        if previous_runs is not None:
+            for row_offset in (-1, 0, 1) if reach else (0,):
+                left, right = touching_runs(previous_runs, runs, row_offset, reach, cols)
+                left_parts.append(previous_lesions[left])
+                right_parts.append(right + open_count)
+        roots = merge(np.arange(elements), np.concatenate(left_parts), np.concatenate(right_parts))
+
+        lengths = ends - starts
+        sizes = np.bincount(roots, np.concatenate([open_sizes, lengths]), minlength=elements)
+        run_sums = np.stack([lengths * index, lengths * run_rows, lengths * (starts + ends - 1) / 2], axis=1)
+        element_sums = np.concatenate([open_sums, run_sums])
+        sums = np.stack([np.bincount(roots, element_sums[:, axis], minlength=elements) for axis in range(3)], axis=1)
+
+        # lesions without a run in this slice are finished
+        is_open = np.zeros(elements, dtype=bool)
+        is_open[roots[open_count:]] = True
+        finished = np.flatnonzero((roots == np.arange(elements)) & ~is_open)
+        if len(finished):
+            yield sizes[finished], sums[finished]
+        open_roots = np.flatnonzero(is_open)
+        open_sizes, open_sums = sizes[open_roots], sums[open_roots]
+        # open lesions are renumbered from 0 for the next slice
+        previous_runs, previous_lesions = runs, (np.cumsum(is_open) - 1)[roots[open_count:]]
+    if len(open_sizes):
+        yield open_sizes, open_sums
+
+
+def keep_largest(sizes: np.ndarray, sums: np.ndarray, max_lesions: Optional[int]) -> Tuple[np.ndarray, np.ndarray]:
+    """Lesions ordered by size (largest first, equal ones in the order they were found), keeping at most `max_lesions`."""
+    if max_lesions is not None and len(sizes) > max_lesions:
+        # only lesions at least as large as the smallest one kept need sorting
+        candidates = sizes >= np.partition(sizes, len(sizes) - max_lesions)[len(sizes) - max_lesions]
+        sizes, sums = sizes[candidates], sums[candidates]
+    order = np.argsort(-sizes, kind="stable")[:max_lesions]
+    return sizes[order], sums[order]
+
+
+def lesion_summary(count: int, sizes: np.ndarray, sums: np.ndarray, dimensions: int) -> dict:
+    """
+    Lesions of a scan as stored in its report
+    :param count: number of lesions
+    :param sizes: sizes of the reported lesions, see keep_largest
+    :param sums: sum of the (slice, row, col) of the cells of these lesions
+    :param dimensions:
+    :return:
+        - lesion_count: number of lesions
+        - lesion_sizes: cells of the largest lesions, largest first
+        - lesion_centroids: centroid of these lesions, [row, col] or [slice, row, col]
+    """
+    centroids = (sums / sizes[:, None]).round(2)
+    return {
+        "lesion_count": count,
+        "lesion_sizes": sizes.astype(np.int64).tolist(),
+        "lesion_centroids": (centroids if dimensions == 3 else centroids[:, 1:]).tolist(),
+    }
+
+
+def label_slices(
+    slices: Iterable[np.ndarray], connectivity: int, max_lesions: Optional[int] = LESION_REPORT_MAX_LESIONS
+) -> dict:
+    """
+    Labels the lesions of one scan given slice by slice
+    :param slices: 2D arrays of ScanCell states (a single one for a 2D scan)
+    :param connectivity: see CONNECTIVITIES
+    :param max_lesions: sizes and centroids are only kept for this many lesions (the largest), None keeps all
+    :return: see lesion_summary
+    """
+    dimensions, reach = CONNECTIVITIES[connectivity]
+    count = 0
+    kept_sizes, kept_sums = np.empty(0), np.empty((0, 3))
+    for sizes, sums in iter_lesions(slices, reach):
+        count += len(sizes)
+        kept_sizes, kept_sums = keep_largest(
+            np.concatenate([kept_sizes, sizes]), np.concatenate([kept_sums, sums]), max_lesions
+        )
+    return lesion_summary(count, kept_sizes, kept_sums, dimensions)
+
+
+def label_scan_batch(
+    cells: np.ndarray, connectivity: int, max_lesions: Optional[int] = LESION_REPORT_MAX_LESIONS
+) -> List[dict]:
+    """
+    Labels the lesions of a batch of 2D scans of the same shape in one go: the scans are stacked into one slice with
+    an empty row between them, so no lesion spans two scans, and every lesion goes back to the scan of its rows
+    :param cells: ScanCell states shaped (scans, rows, cols)
+    :param connectivity: 4 or 8
+    :param max_lesions:
+    :return: see lesion_summary, for every scan
+    """
+    dimensions, reach = CONNECTIVITIES[connectivity]
+    scans, rows, cols = cells.shape
+    if not rows or not cols:
+        return [lesion_summary(0, np.empty(0), np.empty((0, 3)), dimensions) for _ in range(scans)]
+    stacked = np.zeros((scans, rows + 1, cols), dtype=cells.dtype)
+    stacked[:, :rows] = cells
+    found = list(iter_lesions([stacked.reshape(-1, cols)], reach))
+    sizes = np.concatenate([np.empty(0)] + [sizes for sizes, _ in found])
+    sums = np.concatenate([np.empty((0, 3))] + [sums for _, sums in found])
+    # a lesion's centroid is within the rows of its scan
+    scan_index = (sums[:, 1] / np.maximum(sizes, 1) // (rows + 1)).astype(np.intp)
+    sums[:, 1] -= sizes * scan_index * (rows + 1)
+    # by scan, then as keep_largest does within a scan
+    order = np.argsort(scan_index * (rows * cols + 1) + (rows * cols - sizes).astype(np.int64), kind="stable")
+    sizes, sums = sizes[order], sums[order]
+    counts = np.bincount(scan_index, minlength=scans)
+    results = []
+    for first, count in zip(np.cumsum(counts) - counts, counts):
+        kept = slice(first, first + (count if max_lesions is None else min(count, max_lesions)))
+        results.append(lesion_summary(int(count), sizes[kept], sums[kept], dimensions))
+    return results
+
+
+def label_lesions(
+    scan_data: bytes, connectivity: Optional[int] = None, max_lesions: Optional[int] = LESION_REPORT_MAX_LESIONS
+) -> Optional[dict]:
+    """
+    Labels the lesions of a packed scan, unpacking it one slice at a time
+    :param scan_data: packed scan
+    :param connectivity: see resolve_connectivity
+    :param max_lesions:
+    :return: see lesion_summary, None if lesions aren't labelled for scans of these dimensions
+    """
+    shape, _ = read_header(scan_data)
+    connectivity = resolve_connectivity(len(shape), connectivity)
+    if connectivity is None:
+        return None
+    return label_slices(iter_slices(scan_data), connectivity, max_lesions)
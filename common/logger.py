@@ -1,7 +1,218 @@
+import atexit
+import hashlib
+import itertools
+import json
 import logging
+import logging.handlers
+import multiprocessing.util
+import os
+import queue
+import sys
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
 
-# Configuring it in a simpler way
-logging.basicConfig(level=logging.DEBUG)
+from common.config import LOG_FORMAT, LOG_LEVEL, LOG_PAYLOAD_PREVIEW_BYTES, LOG_QUEUE_SIZE, LOG_SAMPLE_RATES
+
+# Until a unit calls configure_logging (e.g. in tests and benchmarks), records are written right away to stderr
+logging.basicConfig(level=logging.INFO)
 
 # Create a logger
 logger = logging.getLogger("mediaire_task")
+
+# Once configured, logging costs the calling thread little:
+# - records are handed to a background thread through a bounded queue (see BackgroundHandler), which formats and
+#   writes them, and records are dropped rather than blocking a unit whose log can't keep up
+# - hot paths log with log_event: %-style arguments, only formatted if the record is written, and sampled per event
+# - payloads are logged as a Payload: size, hash and first bytes, instead of multi-KB dumps
+
+
+class Payload:
+    """Stands for data in a log record, written as its size, a hash and its first bytes once the record is formatted"""
+    __slots__ = ("data",)
+
+    def __init__(self, data) -> None:
+        self.data = data
+
+    def __str__(self) -> str:
+        data = self.data if isinstance(self.data, (bytes, bytearray, memoryview)) else repr(self.data).encode()
+        digest = hashlib.blake2b(data, digest_size=8).hexdigest()
+        preview = bytes(data[:LOG_PAYLOAD_PREVIEW_BYTES])
+        more = "..." if len(data) > LOG_PAYLOAD_PREVIEW_BYTES else ""
+        return f"<{len(data)} bytes blake2b:{digest} {preview!r}{more}>"
+
+    __repr__ = __str__
+
+
+class Sampler:
+    """Keeps 1 in every 1 / rate records of an event, events without a rate are always kept"""
+
+    def __init__(self, rates: Dict[str, float]) -> None:
+        self.every = {event: max(round(1 / rate), 1) for event, rate in rates.items() if rate > 0}
+        self.muted = {event for event, rate in rates.items() if rate <= 0}
+        # next() of an itertools.count is atomic, so threads don't need a lock to share it
+        self.counters = {event: itertools.count() for event, every in self.every.items() if every > 1}
+
+    def keep(self, event: str) -> bool:
+        counter = self.counters.get(event)
+        if counter is None:
+            return event not in self.muted
+        return next(counter) % self.every[event] == 0
+
+
+sampler = Sampler({})
+
+
+def log_event(event: str, msg: str, *args, **fields) -> None:
+    """
+    Logs a hot path record at INFO level, sampled by event
+    :param event: kind of record, sampled at its rate of LOG_SAMPLE_RATES
+    :param msg: %-style message, formatted with `args` by the background thread and only if the record is written
+    :param args:
+    :param fields: extra fields of the JSON output, e.g. trace_id
+    :return:
+    """
+    if logger.isEnabledFor(logging.INFO) and sampler.keep(event):
+        logger.info(msg, *args, extra={"event": event, **fields})
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the extra fields of the record (e.g. event, trace_id) next to the message"""
+    RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+    def __init__(self, unit: str) -> None:
+        super().__init__()
+        self.unit = unit
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "unit": self.unit,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in self.RECORD_FIELDS)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class BackgroundHandler(logging.handlers.QueueHandler):
+    """Queues records for a listener thread writing them with `handlers`
+
+    The caller never blocks: while the queue is full records are dropped, and how many were dropped is logged once
+    there's room again. A forked process (e.g. FrBRAIN's pool workers) gets its own queue and listener thread, flushed
+    when it exits.
+    """
+
+    def __init__(self, handlers: List[logging.Handler], queue_size: int = LOG_QUEUE_SIZE) -> None:
+        super().__init__(queue.Queue(queue_size))
+        self.handlers = handlers
+        self.queue_size = queue_size
+        self.dropped = 0
+        self.listener: Optional[logging.handlers.QueueListener] = None
+        self.start()
+
+    def start(self) -> None:
+        self.listener = logging.handlers.QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self) -> None:
+        """Writes the queued records and stops the listener thread."""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def restart_in_child(self) -> None:
+        # the listener thread isn't forked along, and the queue may have been locked by it at the time
+        self.queue = queue.Queue(self.queue_size)
+        self.dropped = 0
+        self.start()
+        # pool workers leave through os._exit, which skips atexit but not multiprocessing's finalizers
+        multiprocessing.util.Finalize(None, self.stop, exitpriority=0)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # formatting is left to the listener thread, off the hot path, records never leave this process
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            if self.dropped:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    "name": logger.name,
+                    "levelno": logging.WARNING,
+                    "levelname": logging.getLevelName(logging.WARNING),
+                    "msg": "Dropped %d log records, the log queue was full",
+                    "args": (self.dropped,),
+                }))
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+background_handler: Optional[BackgroundHandler] = None
+
+
+def configure_logging(
+    unit: str,
+    level: str = LOG_LEVEL,
+    log_format: str = LOG_FORMAT,
+    sample_rates: Optional[Dict[str, float]] = None,
+    stream=None,
+) -> BackgroundHandler:
+    """
+    Sets up the logging of a unit: records of every logger are written by a background thread
+    :param unit: name of the unit, part of every JSON record
+    :param level:
+    :param log_format: "json" or "text"
+    :param sample_rates: event -> fraction of its records kept, on top of LOG_SAMPLE_RATES
+    :param stream: where records are written, stderr by default
+    :return:
+    """
+    global background_handler, sampler
+    stream_handler = logging.StreamHandler(stream or sys.stderr)
+    if log_format == "json":
+        stream_handler.setFormatter(JsonFormatter(unit))
+    else:
+        stream_handler.setFormatter(logging.Formatter(f"%(asctime)s %(levelname)s {unit} %(name)s: %(message)s"))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    if background_handler is not None:
+        background_handler.stop()
+    background_handler = BackgroundHandler([stream_handler])
+    root.addHandler(background_handler)
+    root.setLevel(level)
+    sampler = Sampler({**LOG_SAMPLE_RATES, **(sample_rates or {})})
+    return background_handler
+
+
+def parse_sample_rates(values: Optional[List[str]]) -> Dict[str, float]:
+    """Sample rates given as event=rate, e.g. on the command line"""
+    rates = {}
+    for value in values or []:
+        event, _, rate = value.partition("=")
+        rates[event] = float(rate)
+    return rates
+
+
+def add_logging_arguments(parser) -> None:
+    parser.add_argument("--log-level", default=LOG_LEVEL, help="e.g. DEBUG, INFO, WARNING")
+    parser.add_argument("--log-format", choices=["json", "text"], default=LOG_FORMAT)
+    parser.add_argument(
+        "--log-sample", nargs="*", metavar="EVENT=RATE", help="fraction of the records of an event kept, e.g. scan_sent=1"
+    )
+
+
+def stop_logging() -> None:
+    if background_handler is not None:
+        background_handler.stop()
+
+
+atexit.register(stop_logging)
+os.register_at_fork(
+    after_in_child=lambda: background_handler.restart_in_child() if background_handler is not None else None
+)
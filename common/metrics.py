@@ -0,0 +1,375 @@
+import math
+import os
+import resource
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+
+from common.config import METRICS_HISTOGRAM_SUB_BUCKETS, METRICS_HOST
+from common.logger import logger
+
+# Counters, gauges and latency histograms of a unit, exposed in Prometheus text format on http://host:port/metrics
+# (see start_metrics_server). Nothing is recorded until the endpoint is started, so with it off an instrumented call
+# costs one attribute check.
+# Histograms are HDR-style: every power of 2 is split into METRICS_HISTOGRAM_SUB_BUCKETS linear buckets, so a value is
+# known within 1/METRICS_HISTOGRAM_SUB_BUCKETS of itself from microseconds to minutes, and only buckets that ever got
+# a value are exposed.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# values below this (e.g. 0) are counted in its bucket
+MIN_VALUE = 1e-9
+
+
+class Registry:
+    """Metrics of this process"""
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.metrics: Dict[str, "Metric"] = {}
+        self.lock = threading.Lock()
+        # process serving the endpoint, forked workers hand their samples to it (see drain)
+        self.pid = os.getpid()
+
+    def register(self, metric: "Metric") -> "Metric":
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                    raise ValueError(f"Metric {metric.name} is already registered differently")
+                return existing
+            metric.registry = self
+            self.metrics[metric.name] = metric
+        if not metric.labelnames:
+            # exposed as 0 before anything is recorded
+            metric.labels()
+        return metric
+
+    def enable(self) -> None:
+        self.enabled = True
+        self.pid = os.getpid()
+
+    def expose(self) -> str:
+        """All metrics in Prometheus text format"""
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+    def drain(self) -> dict:
+        """
+        Samples recorded in a forked worker process since its last drain, reset on the way out. Workers send them
+        back with their results and the parent merges them, so their work shows up on the parent's endpoint
+        :return: empty in the process serving the endpoint, its samples are exposed directly
+        """
+        if not self.enabled or os.getpid() == self.pid:
+            return {}
+        return {name: metric.drain() for name, metric in list(self.metrics.items()) if metric.mergeable}
+
+    def merge(self, drained: dict) -> None:
+        for name, samples in drained.items():
+            metric = self.metrics.get(name)
+            if metric is not None and samples:
+                metric.merge(samples)
+
+
+REGISTRY = Registry()
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(names: Tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+class Metric:
+    type = ""
+    # counters and histograms of forked workers are merged into the parent's, gauges are only the parent's
+    mergeable = True
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        # set when registered
+        self.registry: Optional[Registry] = None
+        # label values -> child, label values are exposed as str(value)
+        self.children: Dict[tuple, object] = {}
+        self.lock = threading.Lock()
+        self.function: Optional[Callable[[], float]] = None
+
+    def labels(self, *values) -> object:
+        """Child of these label values, created on first use"""
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    def new_child(self) -> object:
+        raise NotImplementedError
+
+    def items(self) -> List[Tuple[tuple, object]]:
+        return list(self.children.items())
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """Reads the value from `function` when scraped, so it costs nothing in between (metrics without labels)"""
+        self.function = function
+
+    def expose(self) -> List[str]:
+        """Samples of a counter or gauge, histograms have their own"""
+        if self.function is not None:
+            try:
+                return [f"{self.name} {format_value(self.function())}"]
+            except Exception as e:
+                logger.warning(f"Failed to read metric {self.name}: {e}")
+                return []
+        return [
+            f"{self.name}{format_labels(self.labelnames, values)} {format_value(child.value)}"
+            for values, child in self.items()
+        ]
+
+    def drain(self) -> dict:
+        if self.function is not None:
+            return {}
+        return {values: child.drain() for values, child in self.items()}
+
+    def merge(self, samples: dict) -> None:
+        for values, sample in samples.items():
+            self.labels(*values).merge(sample)
+
+
+class CounterValue:
+    def __init__(self, registry: Registry) -> None:
+        self.registry = registry
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        if not self.registry.enabled:
+            return
+        with self.lock:
+            self.value += amount
+
+    def drain(self) -> float:
+        with self.lock:
+            value, self.value = self.value, 0
+        return value
+
+    def merge(self, value: float) -> None:
+        with self.lock:
+            self.value += value
+
+
+class Counter(Metric):
+    """Value that only goes up, e.g. scans received"""
+    type = "counter"
+
+    def new_child(self) -> CounterValue:
+        return CounterValue(self.registry)
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+
+class GaugeValue:
+    def __init__(self, registry: Registry) -> None:
+        self.registry = registry
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def set(self, value: float) -> None:
+        if self.registry.enabled:
+            self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        if not self.registry.enabled:
+            return
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.inc(-amount)
+
+
+class Gauge(Metric):
+    """Value that goes up and down, e.g. open connections, or read from a function when scraped, e.g. a queue size"""
+    type = "gauge"
+    mergeable = False
+
+    def new_child(self) -> GaugeValue:
+        return GaugeValue(self.registry)
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1) -> None:
+        self.labels().dec(amount)
+
+
+def bucket_index(value: float, sub_buckets: int = METRICS_HISTOGRAM_SUB_BUCKETS) -> int:
+    """Bucket of a value: its power of 2, then its linear sub-bucket within it"""
+    mantissa, exponent = math.frexp(max(value, MIN_VALUE))
+    # value = mantissa * 2 ** exponent, with 0.5 <= mantissa < 1
+    return exponent * sub_buckets + int((mantissa - 0.5) * 2 * sub_buckets)
+
+
+def bucket_upper_bound(index: int, sub_buckets: int = METRICS_HISTOGRAM_SUB_BUCKETS) -> float:
+    exponent, sub_bucket = divmod(index, sub_buckets)
+    return math.ldexp(0.5 + (sub_bucket + 1) / (2 * sub_buckets), exponent)
+
+
+class HistogramValue:
+    def __init__(self, registry: Registry) -> None:
+        self.registry = registry
+        # bucket index -> values, only buckets that got a value
+        self.buckets: Dict[int, int] = {}
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        if not self.registry.enabled:
+            return
+        index = bucket_index(value)
+        with self.lock:
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+            self.count += 1
+            self.sum += value
+
+    def time(self) -> "Timer":
+        """Observes the seconds spent in a with block"""
+        return Timer(self)
+
+    def drain(self) -> tuple:
+        with self.lock:
+            sample = (self.buckets, self.count, self.sum)
+            self.buckets, self.count, self.sum = {}, 0, 0.0
+        return sample
+
+    def merge(self, sample: tuple) -> None:
+        buckets, count, total = sample
+        with self.lock:
+            for index, bucket_count in buckets.items():
+                self.buckets[index] = self.buckets.get(index, 0) + bucket_count
+            self.count += count
+            self.sum += total
+
+
+class Timer:
+    def __init__(self, histogram: HistogramValue) -> None:
+        self.histogram = histogram
+        self.started = 0.0
+
+    def __enter__(self) -> "Timer":
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class Histogram(Metric):
+    """Distribution of values, e.g. latencies in seconds"""
+    type = "histogram"
+
+    def new_child(self) -> HistogramValue:
+        return HistogramValue(self.registry)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def time(self) -> Timer:
+        return self.labels().time()
+
+    def expose(self) -> List[str]:
+        lines = []
+        for values, child in self.items():
+            with child.lock:
+                buckets, count, total = sorted(child.buckets.items()), child.count, child.sum
+            cumulative = 0
+            for index, bucket_count in buckets:
+                cumulative += bucket_count
+                labels = format_labels(self.labelnames + ("le",), values + (format_value(bucket_upper_bound(index)),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labelnames + ("le",), values + ("+Inf",))
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, values)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, values)} {count}")
+        return lines
+
+
+def counter(name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, help, labelnames))
+
+
+def gauge(name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Gauge:
+    return REGISTRY.register(Gauge(name, help, labelnames))
+
+
+def histogram(name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Histogram:
+    return REGISTRY.register(Histogram(name, help, labelnames))
+
+
+def process_cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def process_max_rss_bytes() -> float:
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.expose().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        # scrapes every few seconds would flood the log
+        pass
+
+
+def start_metrics_server(port: Optional[int], host: str = METRICS_HOST) -> Optional[ThreadingHTTPServer]:
+    """
+    Starts recording metrics and serving them on http://host:port/metrics from a daemon thread
+    :param port: None leaves metrics off
+    :param host:
+    :return: the server (server_address has the port when 0 is given), None if metrics are off
+    """
+    if port is None:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        logger.warning(f"Metrics endpoint not available on {host}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    counter("process_cpu_seconds_total", "CPU time of this process in seconds").set_function(process_cpu_seconds)
+    gauge("process_max_resident_memory_bytes", "Peak RSS of this process").set_function(process_max_rss_bytes)
+    REGISTRY.enable()
+    threading.Thread(target=server.serve_forever, name="metrics_server", daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
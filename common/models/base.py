@@ -1,15 +1,131 @@
-from typing import Dict, Any
+from datetime import datetime
+from enum import Enum
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union, get_args, get_origin
 
+from bson import ObjectId
 from pydantic import BaseModel
 
 from common.db_manager import DBManager
 
 db_manager = DBManager()
 
+# documents are written many times per scan on the hot path, so BaseDocument.bson builds them straight from the
+# fields whenever they're already of their exact type, and only hands anything else to pydantic
+
+
+class Unvalidated(Exception):
+    """Raised by a field converter for a value only pydantic knows what to do with"""
+
+
+# stands for the value of a required field that wasn't given
+_REQUIRED = object()
+
+
+def _to_float(value) -> float:
+    if type(value) is float:
+        return value
+    if type(value) is int:
+        return float(value)
+    raise Unvalidated
+
+
+def _to_datetime(value) -> datetime:
+    if type(value) is datetime:
+        return value
+    # "%Y-%m-%d %H:%M:%S" as the units exchange them, other strings are left to pydantic
+    if type(value) is str and len(value) == 19:
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            pass
+    raise Unvalidated
+
+
+def _to_str_key(key) -> str:
+    if not isinstance(key, str):
+        raise Unvalidated
+    # e.g. TraceStage keys, stored as plain strings like pydantic does
+    return str.__str__(key)
+
+
+def _list_of(kind: Optional[type], convert: Callable[[Any], Any]) -> Callable[[Any], list]:
+    def convert_list(value):
+        if type(value) is not list:
+            raise Unvalidated
+        return [item if type(item) is kind else convert(item) for item in value]
+    return convert_list
+
+
+def _dict_of(kind: Optional[type], convert: Callable[[Any], Any]) -> Callable[[Any], dict]:
+    def convert_dict(value):
+        if type(value) is not dict:
+            raise Unvalidated
+        return {_to_str_key(key): item if type(item) is kind else convert(item) for key, item in value.items()}
+    return convert_dict
+
+
+def _unvalidated(value):
+    raise Unvalidated
+
+
+EXACT_TYPES = (int, str, bool, bytes, ObjectId)
+
+
+def field_converter(annotation) -> Optional[Tuple[Optional[type], Callable[[Any], Any]]]:
+    """
+    Converter of a field type, for the types documents use
+    :param annotation: type of the field, without Optional
+    :return: type of the values stored as they are (None if there's no such type) and the function converting other
+        values as pydantic would, or raising Unvalidated when not sure; None for types without a converter
+    """
+    origin, args = get_origin(annotation), get_args(annotation)
+    if origin is list:
+        item = field_converter(args[0])
+        return item and (None, _list_of(*item))
+    if origin is dict:
+        item = field_converter(args[1])
+        return item and args[0] is str and (None, _dict_of(*item))
+    if annotation is float:
+        return float, _to_float
+    if annotation is datetime:
+        return datetime, _to_datetime
+    if annotation in EXACT_TYPES or isinstance(annotation, type) and issubclass(annotation, Enum):
+        return annotation, _unvalidated
+    return None
+
+
+# (name, type of values stored as they are, converter of other values, optional, default) of a field
+DocumentField = Tuple[str, Optional[type], Callable[[Any], Any], bool, Any]
+# document class -> its fields, None if a field can't be converted
+_field_converters: Dict[type, Optional[List[DocumentField]]] = {}
+
+
+def field_converters(cls: type) -> Optional[List[DocumentField]]:
+    if cls in _field_converters:
+        return _field_converters[cls]
+    fields = []
+    for name, field in cls.model_fields.items():
+        annotation = field.annotation
+        optional = get_origin(annotation) is Union and type(None) in get_args(annotation)
+        if optional:
+            annotation, *others = [arg for arg in get_args(annotation) if arg is not type(None)]
+            if others:
+                annotation = None
+        converter = field_converter(annotation)
+        if not converter or field.alias or field.default_factory:
+            fields = None
+            break
+        fields.append((name, *converter, optional, _REQUIRED if field.is_required() else field.default))
+    _field_converters[cls] = fields
+    return fields
+
 
 class BaseDocument(BaseModel):
     patient_id: int
     scan_id: int
+    # trace of the scan, carried over to its report: id and epoch seconds of every stage reached (see common/tracing.py)
+    trace_id: Optional[str] = None
+    stage_times: Optional[Dict[str, float]] = None
 
     class Config:
         arbitrary_types_allowed = True
@@ -20,3 +136,34 @@ class BaseDocument(BaseModel):
         if "_id" in data:
             data.pop("_id")
         return data
+
+    @classmethod
+    def bson(cls, **fields) -> Dict[str, Any]:
+        """
+        Same document as cls(**fields).to_bson(), without building the model when every field is already of its type
+        (e.g. ints, datetimes or "%Y-%m-%d %H:%M:%S" strings, lists of floats). Values needing more than that, and
+        invalid ones, go through the model, which raises as usual.
+        :param fields:
+        :return:
+        """
+        return cls.fields_to_bson(fields)
+
+    @classmethod
+    def fields_to_bson(cls, fields: Dict[str, Any]) -> Dict[str, Any]:
+        """bson taking the fields as a dict, documents with validators check what those would here first"""
+        converters = field_converters(cls)
+        if converters is not None:
+            document = {}
+            try:
+                for name, kind, convert, optional, default in converters:
+                    value = fields.get(name, default)
+                    if type(value) is kind:
+                        document[name] = value
+                    elif value is None and optional:
+                        continue
+                    else:
+                        document[name] = convert(value)
+                return document
+            except Unvalidated:
+                pass
+        return cls(**fields).to_bson()
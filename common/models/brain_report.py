@@ -1,4 +1,5 @@
 from datetime import datetime
+from typing import List, Optional
 
 from common.models.base import BaseDocument
 
@@ -7,3 +8,11 @@ class BrainReport(BaseDocument):
     report_datetime: datetime
     report_data: str
     sent: bool = False
+    # analysis details (see common/analysis.py), reports of older FrBRAIN versions don't have them
+    lesion_cells: Optional[int] = None
+    lesion_area: Optional[float] = None
+    region_density: Optional[List[List[float]]] = None
+    # connected lesions: sizes and centroids are for the largest LESION_REPORT_MAX_LESIONS lesions only
+    lesion_count: Optional[int] = None
+    lesion_sizes: Optional[List[int]] = None
+    lesion_centroids: Optional[List[List[float]]] = None
@@ -1,11 +1,50 @@
 from datetime import datetime
+from typing import Any, Dict, Optional
+
+from bson import ObjectId
+from pydantic import field_validator, model_validator
 
 from common.config import ReportStatus
 from common.models.base import BaseDocument
+from common.scan_codec import ScanFormatError, read_header, to_packed_scan
 
 
 class BrainScan(BaseDocument):
     scan_datetime: datetime
     scan_type: str
-    scan_data: str
-    report_generated: bool = ReportStatus.to_do
+    # packed scan (see common/scan_codec.py), legacy text scans are packed on the way in
+    scan_data: Optional[bytes] = None
+    # scans too large for a document are in chunk storage instead (see common/scan_store.py)
+    scan_file_id: Optional[ObjectId] = None
+    scan_size: Optional[int] = None
+    report_generated: ReportStatus = ReportStatus.to_do
+
+    @field_validator("scan_data", mode="before")
+    @classmethod
+    def pack_scan_data(cls, scan_data):
+        return None if scan_data is None else to_packed_scan(scan_data)
+
+    @model_validator(mode="after")
+    def check_scan_stored(self):
+        if self.scan_data is None and self.scan_file_id is None:
+            raise ValueError("Brain scan needs either scan_data or scan_file_id")
+        return self
+
+    @classmethod
+    def fields_to_bson(cls, fields: Dict[str, Any]) -> Dict[str, Any]:
+        # checking what the validators would: only documents with their scan, as a valid packed scan or in chunk
+        # storage, skip the model
+        scan_data = fields.get("scan_data")
+        if scan_data is None:
+            fast = fields.get("scan_file_id") is not None
+        else:
+            fast = type(scan_data) is bytes and valid_header(scan_data)
+        return super().fields_to_bson(fields) if fast else cls(**fields).to_bson()
+
+
+def valid_header(scan_data: bytes) -> bool:
+    try:
+        read_header(scan_data)
+        return True
+    except ScanFormatError:
+        return False
@@ -0,0 +1,143 @@
+import socket
+import threading
+from typing import Any, Dict, Optional, Sequence
+
+from common.config import NOTIFY_HOST, POLL_MAX_INTERVAL_S, POLL_MIN_INTERVAL_S
+from common.db_manager import DBManager
+from common.logger import logger
+
+_publish_socket: Optional[socket.socket] = None
+
+
+def notify_work(port: int, host: str = NOTIFY_HOST) -> None:
+    """
+    Tells the consumer listening on `port` that new work was stored.
+    It's fire and forget: if nobody is listening the datagram is simply dropped and the consumer's polling picks the work up
+    :param port:
+    :param host:
+    :return:
+    """
+    global _publish_socket
+    try:
+        if _publish_socket is None:
+            _publish_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            _publish_socket.setblocking(False)
+        _publish_socket.sendto(b"1", (host, port))
+    except OSError:
+        pass
+
+
+class AdaptiveBackoff:
+    """Polling interval that doubles every time a poll finds nothing and goes back to the minimum once it does"""
+
+    def __init__(
+        self, min_delay: float = POLL_MIN_INTERVAL_S, max_delay: float = POLL_MAX_INTERVAL_S, factor: float = 2
+    ) -> None:
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.delay = min_delay
+
+    def reset(self) -> None:
+        self.delay = self.min_delay
+
+    def next_delay(self) -> float:
+        """Returns how long to wait before the next poll and grows the interval for the one after."""
+        delay = self.delay
+        self.delay = min(self.delay * self.factor, self.max_delay)
+        return delay
+
+
+class WorkNotifier:
+    """Wakes up a consumer (FrBRAIN, FrHUB report client) as soon as new work is stored, instead of it sleeping a fixed time
+
+    Sources, in order of preference:
+        - MongoDB change stream on the collection (only available when MongoDB runs as a replica set)
+        - Local pub/sub: producers call notify_work(port) after storing work, which sends a datagram to this listener
+        - Whatever isn't caught by the above is picked up by the consumer polling with AdaptiveBackoff
+    """
+
+    def __init__(
+        self,
+        collection_name: str,
+        port: int,
+        host: str = NOTIFY_HOST,
+        operations: Sequence[str] = ("insert",),
+        updated_fields: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        self.collection_name = collection_name
+        self.operations = list(operations)
+        # field values of the updates that create work too (e.g. a lease released back to 'To Do'), None for no update
+        self.updated_fields = updated_fields
+        self.event = threading.Event()
+        self.running_status = True
+        self.listen_socket = self.open_listen_socket(host, port)
+        threading.Thread(target=self.watch_collection, daemon=True).start()
+        if self.listen_socket:
+            threading.Thread(target=self.listen, daemon=True).start()
+
+    @staticmethod
+    def open_listen_socket(host: str, port: int) -> Optional[socket.socket]:
+        """Binds the local pub/sub socket, None if that's not possible (e.g. another process on this host owns the port)."""
+        listen_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, "SO_REUSEPORT"):
+                listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            listen_socket.bind((host, port))
+            listen_socket.settimeout(1)
+            return listen_socket
+        except OSError as e:
+            logger.warning(f"Local work notifications not available on {host}:{port}: {e}")
+            listen_socket.close()
+            return None
+
+    def change_filter(self) -> Dict[str, Any]:
+        """Changes that create work, every other update (e.g. a scan claimed or its report saved) is left out"""
+        change_filter = {"operationType": {"$in": self.operations}}
+        if not self.updated_fields:
+            return change_filter
+        updates = {f"updateDescription.updatedFields.{field}": value for field, value in self.updated_fields.items()}
+        return {"$or": [change_filter, {"operationType": "update", **updates}]}
+
+    def watch_collection(self) -> None:
+        """Sets the event for every matching change on the collection, until stopped or change streams aren't supported."""
+        change_stream = DBManager().watch(self.collection_name, [{"$match": self.change_filter()}])
+        if change_stream is None:
+            return
+        logger.info(f"Watching {self.collection_name} for new work via change stream")
+        try:
+            with change_stream:
+                while self.running_status and change_stream.alive:
+                    if change_stream.try_next() is not None:
+                        self.event.set()
+        except Exception as e:
+            logger.warning(f"Change stream on {self.collection_name} stopped: {e}")
+
+    def listen(self) -> None:
+        """Sets the event for every datagram received from notify_work."""
+        while self.running_status:
+            try:
+                self.listen_socket.recv(64)
+                self.event.set()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Blocks until new work is announced or the timeout expires
+        :param timeout:
+        :return: True if woken up by a notification
+        """
+        notified = self.event.wait(timeout)
+        self.event.clear()
+        return notified
+
+    def stop(self) -> None:
+        self.running_status = False
+        # waking up a consumer blocked in wait() so it can notice it was stopped
+        self.event.set()
+        if self.listen_socket:
+            self.listen_socket.close()
@@ -0,0 +1,322 @@
+import asyncio
+import base64
+import json
+import socket
+import struct
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+from common import metrics
+from common.config import BRAIN_SCAN_CHUNK_SIZE, MAX_FRAME_SIZE, PROTOCOL_VERSION, AckStatus, MessageType, TraceStage
+from common.scan_codec import to_packed_scan
+from common.tracing import Trace, scan_trace
+
+# Every frame is: version (1 byte) | message type (1 byte) | payload length (4 bytes) | payload
+# all in network byte order, so a reader always knows exactly how many bytes belong to one message
+# regardless of how TCP splits or coalesces them.
+HEADER = struct.Struct("!BBI")
+HEADER_SIZE = HEADER.size
+
+Frame = Tuple[MessageType, bytes]
+
+# brain scan payload: seq | patient_id | scan_id | datetime length | type length, followed by the datetime,
+# the type and the packed scan. Older FrPACS send JSON instead, which always starts with "{" (seq's first byte is 0).
+BRAIN_SCAN_HEADER = struct.Struct("!QqqHH")
+# traced scans (see common/tracing.py) set the top bit of the type length and carry their trace after the type:
+# trace id | time FrPACS sent the scan (epoch seconds). Scans of older FrPACS don't have it
+BRAIN_SCAN_TRACED = 0x8000
+BRAIN_SCAN_TRACE = struct.Struct("!16sd")
+# streamed brain scan: the begin frame has the payload of a brain scan frame without the packed scan, every chunk frame
+# is seq | part of the packed scan, and the end frame is seq | size of the packed scan
+BRAIN_SCAN_CHUNK_HEADER = struct.Struct("!Q")
+BRAIN_SCAN_END = struct.Struct("!QQ")
+
+# acks of FrHUB may carry flow control (see fr_hub/flow_control.py): the credits granted to the connection, and for a
+# connection rejected over budget (status busy) a retry-after hint. Those rejections aren't for a scan, they have
+# sequence number 0, which no scan has. Older FrPACS ignore the extra fields
+BUSY_SEQ = 0
+
+FRAMES_SENT = metrics.counter("frames_sent_total", "Frames sent on the socket channels", ("type",))
+FRAME_BYTES_SENT = metrics.counter("frame_bytes_sent_total", "Bytes of the frames sent, headers included")
+FRAMES_RECEIVED = metrics.counter("frames_received_total", "Frames received on the socket channels", ("type",))
+FRAME_BYTES_RECEIVED = metrics.counter("frame_bytes_received_total", "Bytes of the frames received, headers included")
+
+
+class ProtocolError(Exception):
+    """Raised when the peer sends something that isn't a valid frame."""
+
+
+def _parse_header(header: bytes) -> Tuple[MessageType, int]:
+    """Validates a frame header and returns its message type and payload length."""
+    version, msg_type, length = HEADER.unpack(header)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Unsupported protocol version: {version}")
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {length} bytes exceeds the limit of {MAX_FRAME_SIZE}")
+    try:
+        msg_type = MessageType(msg_type)
+    except ValueError:
+        raise ProtocolError(f"Unknown message type: {msg_type}")
+    if metrics.REGISTRY.enabled:
+        FRAMES_RECEIVED.labels(msg_type.name).inc()
+        FRAME_BYTES_RECEIVED.inc(HEADER_SIZE + length)
+    return msg_type, length
+
+
+def encode_frame(msg_type: MessageType, payload: bytes) -> bytes:
+    """Builds a single frame for the given message type and payload."""
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {len(payload)} bytes exceeds the limit of {MAX_FRAME_SIZE}")
+    if metrics.REGISTRY.enabled:
+        FRAMES_SENT.labels(MessageType(msg_type).name).inc()
+        FRAME_BYTES_SENT.inc(HEADER_SIZE + len(payload))
+    return HEADER.pack(PROTOCOL_VERSION, msg_type, len(payload)) + payload
+
+
+def send_frame(sock: socket.socket, msg_type: MessageType, payload: bytes) -> None:
+    """Sends a single frame over a blocking socket."""
+    sock.sendall(encode_frame(msg_type, payload))
+
+
+def recv_exactly(sock: socket.socket, size: int) -> Optional[bytearray]:
+    """
+    Reads exactly `size` bytes from a blocking socket.
+    The buffer is allocated once and filled in place, so big payloads cost a single copy.
+    :return: the bytes read, or None if the peer closed the connection before sending anything
+    """
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:], size - received)
+        if count == 0:
+            if received == 0:
+                return None
+            raise ProtocolError(f"Connection closed after {received} of {size} bytes")
+        received += count
+    return buffer
+
+
+def recv_frame(sock: socket.socket) -> Optional[Frame]:
+    """
+    Reads a single frame from a blocking socket.
+    :return: (message type, payload) or None if the peer closed the connection between frames
+    """
+    header = recv_exactly(sock, HEADER_SIZE)
+    if header is None:
+        return None
+    msg_type, length = _parse_header(header)
+    if length == 0:
+        return msg_type, b""
+    payload = recv_exactly(sock, length)
+    if payload is None:
+        raise ProtocolError("Connection closed before frame payload was received")
+    return msg_type, bytes(payload)
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Optional[Frame]:
+    """
+    Reads a single frame from an asyncio stream.
+    :return: (message type, payload) or None if the peer closed the connection between frames
+    """
+    try:
+        header = await reader.readexactly(HEADER_SIZE)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ProtocolError("Connection closed in the middle of a frame header")
+    msg_type, length = _parse_header(header)
+    try:
+        payload = await reader.readexactly(length) if length else b""
+    except asyncio.IncompleteReadError:
+        raise ProtocolError("Connection closed before frame payload was received")
+    return msg_type, payload
+
+
+async def write_frame(writer: asyncio.StreamWriter, msg_type: MessageType, payload: bytes) -> None:
+    """Writes a single frame to an asyncio stream, waiting if the transport buffer is full."""
+    writer.write(encode_frame(msg_type, payload))
+    await writer.drain()
+
+
+class FrameDecoder:
+    """
+    Incremental decoder for callers that receive arbitrary chunks of the stream (e.g. non-blocking sockets).
+    Feed it whatever was received and it returns every frame that is complete so far, keeping partial
+    frames around for the next call.
+    """
+
+    def __init__(self) -> None:
+        self._buffer = bytearray()
+        self._offset = 0
+
+    def feed(self, data: bytes) -> List[Frame]:
+        """Adds received bytes to the decoder and returns the frames completed by them."""
+        self._buffer += data
+        frames = []
+        while True:
+            available = len(self._buffer) - self._offset
+            if available < HEADER_SIZE:
+                break
+            msg_type, length = _parse_header(
+                self._buffer[self._offset:self._offset + HEADER_SIZE]
+            )
+            if available < HEADER_SIZE + length:
+                break
+            start = self._offset + HEADER_SIZE
+            frames.append((msg_type, bytes(self._buffer[start:start + length])))
+            self._offset = start + length
+        # dropping consumed bytes once per feed instead of once per frame keeps this linear
+        if self._offset:
+            del self._buffer[:self._offset]
+            self._offset = 0
+        return frames
+
+    @property
+    def pending(self) -> int:
+        """Number of buffered bytes that don't form a complete frame yet."""
+        return len(self._buffer) - self._offset
+
+
+def encode_brain_scan(seq: int, scan: tuple) -> bytes:
+    """
+    Encodes the payload of a brain scan frame, the scan is sent packed as raw bytes (no base64/JSON)
+    :param seq: sequence number of the scan on its connection, echoed back in the ack
+    :param scan: (patient_id, scan_id, scan_datetime, scan_type, scan_data), legacy text scan_data gets packed,
+        optionally followed by its Trace, which must have the pacs_sent stage
+    :return:
+    """
+    return encode_brain_scan_begin(seq, scan) + to_packed_scan(scan[4])
+
+
+def encode_brain_scan_begin(seq: int, scan: tuple) -> bytes:
+    """Encodes a brain scan frame payload without its packed scan, which is also the payload of a begin frame."""
+    patient_id, scan_id, scan_datetime, scan_type = scan[:4]
+    scan_datetime = scan_datetime.encode("utf-8")
+    scan_type = scan_type.encode("utf-8")
+    type_size = len(scan_type)
+    trace = scan_trace(scan)
+    if trace is not None:
+        type_size |= BRAIN_SCAN_TRACED
+        trace = BRAIN_SCAN_TRACE.pack(bytes.fromhex(trace.trace_id), trace.stage_times[TraceStage.pacs_sent])
+    return b"".join(
+        (
+            BRAIN_SCAN_HEADER.pack(seq, patient_id, scan_id, len(scan_datetime), type_size),
+            scan_datetime,
+            scan_type,
+            trace or b"",
+        )
+    )
+
+
+def brain_scan_frames(seq: int, scan: tuple, chunk_size: int = BRAIN_SCAN_CHUNK_SIZE) -> Iterator[Frame]:
+    """
+    Frames a brain scan is sent with: one brain scan frame, or when the packed scan is bigger than `chunk_size` a begin
+    frame, chunk frames of `chunk_size` bytes and an end frame, so large scans are never held in one frame on either side
+    :param seq: sequence number of the scan, carried by every frame of the scan
+    :param scan: see encode_brain_scan
+    :param chunk_size:
+    :return:
+    """
+    scan_data = to_packed_scan(scan[4])
+    if len(scan_data) <= chunk_size:
+        yield MessageType.brain_scan, encode_brain_scan_begin(seq, scan) + scan_data
+        return
+    yield MessageType.brain_scan_begin, encode_brain_scan_begin(seq, scan)
+    for start in range(0, len(scan_data), chunk_size):
+        yield MessageType.brain_scan_chunk, BRAIN_SCAN_CHUNK_HEADER.pack(seq) + scan_data[start:start + chunk_size]
+    yield MessageType.brain_scan_end, BRAIN_SCAN_END.pack(seq, len(scan_data))
+
+
+def decode_brain_scan_chunk(payload: bytes) -> Tuple[int, bytes]:
+    """Decodes a chunk frame payload into (seq, part of the packed scan)."""
+    if len(payload) < BRAIN_SCAN_CHUNK_HEADER.size:
+        raise ProtocolError(f"Brain scan chunk is too short: {len(payload)} bytes")
+    (seq,) = BRAIN_SCAN_CHUNK_HEADER.unpack_from(payload)
+    return seq, payload[BRAIN_SCAN_CHUNK_HEADER.size:]
+
+
+def decode_brain_scan_end(payload: bytes) -> Tuple[int, int]:
+    """Decodes an end frame payload into (seq, size of the packed scan)."""
+    if len(payload) != BRAIN_SCAN_END.size:
+        raise ProtocolError(f"Invalid brain scan end frame of {len(payload)} bytes")
+    return BRAIN_SCAN_END.unpack(payload)
+
+
+def decode_brain_scan(payload: bytes) -> Tuple[int, tuple]:
+    """
+    Decodes a brain scan frame payload into its sequence number and the tuple expected by save_brain_scan, with the
+    trace of the scan as a sixth element if it has one
+    """
+    if payload[:1] == b"{":
+        return decode_legacy_brain_scan(payload)
+    if len(payload) < BRAIN_SCAN_HEADER.size:
+        raise ProtocolError(f"Brain scan payload is too short: {len(payload)} bytes")
+    seq, patient_id, scan_id, datetime_size, type_size = BRAIN_SCAN_HEADER.unpack_from(payload)
+    offset = BRAIN_SCAN_HEADER.size
+    scan_datetime = bytes(payload[offset:offset + datetime_size]).decode("utf-8")
+    offset += datetime_size
+    is_traced = type_size & BRAIN_SCAN_TRACED
+    type_size &= ~BRAIN_SCAN_TRACED
+    scan_type = bytes(payload[offset:offset + type_size]).decode("utf-8")
+    offset += type_size
+    if not is_traced:
+        return seq, (patient_id, scan_id, scan_datetime, scan_type, bytes(payload[offset:]))
+    if len(payload) < offset + BRAIN_SCAN_TRACE.size:
+        raise ProtocolError(f"Brain scan trace is cut short: {len(payload)} bytes")
+    trace_id, sent_at = BRAIN_SCAN_TRACE.unpack_from(payload, offset)
+    offset += BRAIN_SCAN_TRACE.size
+    trace = Trace(trace_id.hex(), {TraceStage.pacs_sent: sent_at})
+    return seq, (patient_id, scan_id, scan_datetime, scan_type, bytes(payload[offset:]), trace)
+
+
+def decode_legacy_brain_scan(payload: bytes) -> Tuple[int, tuple]:
+    """Decodes the JSON brain scan payload of older FrPACS (base64 text scan), the scan is packed on the way in."""
+    message = json.loads(payload)
+    brain_scan_data = message["scan"]
+    brain_scan_data[4] = to_packed_scan(base64.b64decode(brain_scan_data[4]).decode("utf-8"))
+    return message["seq"], tuple(brain_scan_data)
+
+
+class Ack(NamedTuple):
+    seq: int
+    status: AckStatus
+    message: str
+    # flow control, None in acks without it (e.g. of older FrHUB)
+    credits: Optional[int] = None
+    retry_after: Optional[float] = None
+
+
+def encode_ack(
+    seq: int, status: AckStatus, message: str = "", credits: Optional[int] = None, retry_after: Optional[float] = None
+) -> bytes:
+    """Encodes the payload of an ack frame for the scan with the given sequence number, and its flow control if any."""
+    ack = {"seq": seq, "status": status, "message": message}
+    if credits is not None:
+        ack["credits"] = credits
+    if retry_after is not None:
+        ack["retry_after"] = retry_after
+    return json.dumps(ack).encode("utf-8")
+
+
+def decode_ack(payload: bytes) -> Tuple[int, AckStatus, str]:
+    """Decodes an ack frame payload into (seq, status, message)."""
+    return decode_scan_ack(payload)[:3]
+
+
+def decode_scan_ack(payload: bytes) -> Ack:
+    """Decodes an ack frame payload, with its flow control."""
+    ack = json.loads(payload)
+    return Ack(
+        ack["seq"], AckStatus(ack["status"]), ack.get("message", ""), ack.get("credits"), ack.get("retry_after")
+    )
+
+
+def encode_brain_reports(seq: int, reports: List[dict]) -> bytes:
+    """Encodes the payload of a brain report batch frame, report datetimes must already be strings."""
+    return json.dumps({"seq": seq, "reports": reports}).encode("utf-8")
+
+
+def decode_brain_reports(payload: bytes) -> Tuple[int, List[dict]]:
+    """Decodes a brain report batch frame payload into (seq, reports)."""
+    message = json.loads(payload)
+    return message["seq"], message["reports"]
@@ -0,0 +1,264 @@
+import math
+import struct
+from typing import Iterable, Iterator, List, Tuple, Union
+
+import numpy as np
+
+from common.config import ScanCell
+
+# A packed scan is: magic (4 bytes) | format version (1 byte) | bits per cell (1 byte) | depth (2 bytes)
+# | rows (4 bytes) | cols (4 bytes) | cells, in network byte order.
+# Cells are stored row by row (slice by slice for 3D scans), 4 per byte with the first cell in the high bits.
+# Depth 0 means a 2D scan. A 10x10 scan takes 41 bytes instead of ~210 bytes of text (~280 once base64'd).
+MAGIC = b"FRSC"
+FORMAT_VERSION = 1
+BITS_PER_CELL = 2
+CELLS_PER_BYTE = 8 // BITS_PER_CELL
+HEADER = struct.Struct("!4sBBHII")
+HEADER_SIZE = HEADER.size
+
+# legacy text format: one line per row, every cell is " " (empty), "| |" (clear) or "|o|" (lesion)
+TEXT_CELLS = {" ": ScanCell.empty, "| |": ScanCell.clear, "|o|": ScanCell.lesion}
+CELL_TEXTS = np.array([" ", "| |", "|o|"], dtype=object)
+
+_SHIFTS = np.array([6, 4, 2, 0], dtype=np.uint8)
+# low bit of every cell of a packed byte
+_LOW_BITS = 0b01010101
+
+
+class ScanFormatError(ValueError):
+    """Raised for data that is neither a valid packed scan nor a valid text scan."""
+
+
+def is_packed_scan(data: Union[str, bytes]) -> bool:
+    return isinstance(data, (bytes, bytearray, memoryview)) and bytes(data[:4]) == MAGIC
+
+
+def read_header(data: bytes) -> Tuple[Tuple[int, ...], int]:
+    """
+    Parses and validates the header of a packed scan
+    :param data:
+    :return: shape of the scan ((rows, cols) or (depth, rows, cols)) and the number of cells
+    """
+    shape, cells, expected_size = parse_header(data)
+    if len(data) != expected_size:
+        raise ScanFormatError(f"Packed scan of shape {shape} should be {expected_size} bytes, got {len(data)}")
+    return shape, cells
+
+
+def parse_header(data: bytes) -> Tuple[Tuple[int, ...], int, int]:
+    """
+    Parses and validates the header of a packed scan of which only the beginning may have been received
+    :param data:
+    :return: shape of the scan, the number of cells and the size of the whole packed scan
+    """
+    if len(data) < HEADER_SIZE:
+        raise ScanFormatError(f"Packed scan is too short: {len(data)} bytes")
+    magic, version, bits, depth, rows, cols = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ScanFormatError("Not a packed scan")
+    if version != FORMAT_VERSION or bits != BITS_PER_CELL:
+        raise ScanFormatError(f"Unsupported packed scan format: version {version}, {bits} bits per cell")
+    shape = (depth, rows, cols) if depth else (rows, cols)
+    cells = math.prod(shape)
+    return shape, cells, HEADER_SIZE + -(-cells // CELLS_PER_BYTE)
+
+
+def encode_scan(cells: np.ndarray) -> bytes:
+    """
+    Packs a 2D (rows, cols) or 3D (depth, rows, cols) array of ScanCell states
+    :param cells:
+    :return:
+    """
+    if cells.ndim == 2:
+        depth, (rows, cols) = 0, cells.shape
+    elif cells.ndim == 3:
+        depth, rows, cols = cells.shape
+        if not 0 < depth < 2 ** 16:
+            raise ScanFormatError(f"Unsupported scan depth: {depth}")
+    else:
+        raise ScanFormatError(f"Scans must be 2D or 3D, got {cells.ndim} dimensions")
+    flat = np.ascontiguousarray(cells, dtype=np.uint8).ravel()
+    if flat.size and flat.max() > ScanCell.lesion:
+        raise ScanFormatError(f"Invalid cell state: {flat.max()}")
+    # padding the last byte with empty cells
+    padded = np.zeros(-(-flat.size // CELLS_PER_BYTE) * CELLS_PER_BYTE, dtype=np.uint8)
+    padded[:flat.size] = flat
+    packed = np.bitwise_or.reduce(padded.reshape(-1, CELLS_PER_BYTE) << _SHIFTS, axis=1).astype(np.uint8)
+    return HEADER.pack(MAGIC, FORMAT_VERSION, BITS_PER_CELL, depth, rows, cols) + packed.tobytes()
+
+
+def decode_scan(data: bytes) -> np.ndarray:
+    """Unpacks a packed scan into an array of ScanCell states, shaped as it was encoded."""
+    shape, cells = read_header(data)
+    packed = np.frombuffer(data, dtype=np.uint8, offset=HEADER_SIZE)
+    unpacked = (packed[:, None] >> _SHIFTS) & 3
+    return unpacked.ravel()[:cells].reshape(shape)
+
+
+def decode_scans(scans: List[bytes]) -> np.ndarray:
+    """
+    Unpacks several packed scans of the same shape at once
+    :param scans:
+    :return: array of ScanCell states shaped (scans, *shape of a scan)
+    """
+    shape, _ = read_header(scans[0])
+    if any(read_header(scan)[0] != shape for scan in scans[1:]):
+        raise ScanFormatError("Scans decoded together must have the same shape")
+    return unpack_cells(stack_cell_bytes(scans), shape)
+
+
+def stack_cell_bytes(scans: List[bytes]) -> np.ndarray:
+    """Packed cells (headers stripped) of scans of the same shape, one row per scan."""
+    return np.frombuffer(b"".join(scan[HEADER_SIZE:] for scan in scans), dtype=np.uint8).reshape(len(scans), -1)
+
+
+def unpack_cells(packed: np.ndarray, shape: Tuple[int, ...]) -> np.ndarray:
+    """
+    Unpacks the rows of stack_cell_bytes
+    :param packed: packed cells of scans of the given shape, one row per scan
+    :param shape: shape of one scan
+    :return: array of ScanCell states shaped (scans, *shape)
+    """
+    unpacked = (packed[:, :, None] >> _SHIFTS) & 3
+    return unpacked.reshape(len(packed), -1)[:, :math.prod(shape)].reshape(len(packed), *shape)
+
+
+def iter_slices(data: bytes) -> Iterator[np.ndarray]:
+    """
+    Unpacks a packed scan one slice at a time, so only one slice of a large volume is unpacked at once
+    :param data:
+    :return: 2D arrays of ScanCell states, a single one for 2D scans
+    """
+    shape, _ = read_header(data)
+    rows, cols = shape[-2:]
+    slice_cells = rows * cols
+    packed = np.frombuffer(data, dtype=np.uint8, offset=HEADER_SIZE)
+    for index in range(shape[0] if len(shape) == 3 else 1):
+        # slices don't start on a byte boundary when rows * cols isn't a multiple of 4
+        start = index * slice_cells
+        first_byte, offset = divmod(start, CELLS_PER_BYTE)
+        last_byte = -(-(start + slice_cells) // CELLS_PER_BYTE)
+        unpacked = (packed[first_byte:last_byte, None] >> _SHIFTS) & 3
+        yield unpacked.ravel()[offset:offset + slice_cells].reshape(rows, cols)
+
+
+def read_scan_chunks(chunks: Iterable[bytes]) -> Tuple[Tuple[int, ...], Iterator[np.ndarray]]:
+    """
+    Reads a packed scan given as consecutive chunks (e.g. from GridFS), only reading the chunks needed for its header
+    :param chunks:
+    :return: shape of the scan, and its slices (see iter_slices) unpacked as soon as their chunks are read
+    """
+    chunks = iter(chunks)
+    buffer = bytearray()
+    while len(buffer) < HEADER_SIZE:
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ScanFormatError(f"Packed scan is too short: {len(buffer)} bytes")
+        buffer += chunk
+    shape, _, size = parse_header(buffer)
+    return shape, iter_chunk_slices(shape, size, buffer, chunks)
+
+
+def iter_chunk_slices(
+    shape: Tuple[int, ...], size: int, buffer: bytearray, chunks: Iterator[bytes]
+) -> Iterator[np.ndarray]:
+    """
+    Slices of a packed scan read chunk by chunk, holding no more than a slice and a chunk in memory
+    :param shape:
+    :param size: size of the whole packed scan
+    :param buffer: beginning of the scan already read
+    :param chunks: rest of the scan
+    :return:
+    """
+    rows, cols = shape[-2:]
+    slice_cells = rows * cols
+    # position of buffer[0] in the packed scan
+    buffer_start = 0
+    for index in range(shape[0] if len(shape) == 3 else 1):
+        first_byte, offset = divmod(index * slice_cells, CELLS_PER_BYTE)
+        first_byte += HEADER_SIZE
+        last_byte = HEADER_SIZE + -(-(index + 1) * slice_cells // CELLS_PER_BYTE)
+        while buffer_start + len(buffer) < last_byte:
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise ScanFormatError(f"Packed scan of {size} bytes ended after {buffer_start + len(buffer)} bytes")
+            buffer += chunk
+        # dropping bytes of previous slices once they're most of the buffer, so the copies stay linear overall
+        if first_byte - buffer_start > len(buffer) // 2:
+            del buffer[:first_byte - buffer_start]
+            buffer_start = first_byte
+        packed = np.frombuffer(buffer[first_byte - buffer_start:last_byte - buffer_start], dtype=np.uint8)
+        yield ((packed[:, None] >> _SHIFTS) & 3).ravel()[offset:offset + slice_cells].reshape(rows, cols)
+    received = buffer_start + len(buffer) + sum(len(chunk) for chunk in chunks)
+    if received != size:
+        raise ScanFormatError(f"Packed scan of shape {shape} should be {size} bytes, got {received}")
+
+
+def cells_per_byte(packed: np.ndarray, state: ScanCell) -> np.ndarray:
+    """
+    Counts the cells in the given state in every packed byte, with bitwise operations instead of unpacking
+    :param packed: packed cells
+    :param state:
+    :return: array shaped like `packed`, with values between 0 and 4
+    """
+    # every cell ends up as its low bit being set if both of its bits match the state
+    high = packed >> 1 if state & 2 else ~(packed >> 1)
+    low = packed if state & 1 else ~packed
+    return np.bitwise_count(high & low & _LOW_BITS)
+
+
+def count_cells(data: bytes, state: ScanCell) -> int:
+    """Counts the cells of a packed scan in the given state, straight from the packed bytes."""
+    _, cells = read_header(data)
+    packed = np.frombuffer(data, dtype=np.uint8, offset=HEADER_SIZE)
+    count = int(cells_per_byte(packed, state).sum(dtype=np.int64))
+    if state == ScanCell.empty:
+        # padding of the last byte
+        count -= len(packed) * CELLS_PER_BYTE - cells
+    return count
+
+
+def parse_text_scan(text: str) -> np.ndarray:
+    """
+    Converts a legacy text scan into a 2D array of ScanCell states, shorter rows are padded with empty cells
+    :param text:
+    :return:
+    """
+    rows = []
+    for line in text.rstrip("\n").split("\n") if text.strip("\n") else []:
+        row = []
+        position = 0
+        while position < len(line):
+            if line[position] == " ":
+                row.append(ScanCell.empty)
+                position += 1
+                continue
+            cell = TEXT_CELLS.get(line[position:position + 3])
+            if cell is None:
+                raise ScanFormatError(f"Invalid cell {line[position:position + 3]!r} in text scan")
+            row.append(cell)
+            position += 3
+        rows.append(row)
+    cells = np.zeros((len(rows), max((len(row) for row in rows), default=0)), dtype=np.uint8)
+    for index, row in enumerate(rows):
+        cells[index, :len(row)] = row
+    return cells
+
+
+def format_text_scan(cells: np.ndarray) -> str:
+    """Converts a 2D array of ScanCell states back into the legacy text format."""
+    return "".join("".join(row) + "\n" for row in CELL_TEXTS[cells])
+
+
+def to_packed_scan(scan_data: Union[str, bytes]) -> bytes:
+    """
+    Conversion layer for legacy scans: text scans are packed, packed scans are validated and returned as they are
+    :param scan_data:
+    :return:
+    """
+    if isinstance(scan_data, str):
+        return encode_scan(parse_text_scan(scan_data))
+    scan_data = bytes(scan_data)
+    read_header(scan_data)
+    return scan_data
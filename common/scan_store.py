@@ -0,0 +1,95 @@
+from typing import Iterator, NamedTuple, Optional
+
+from bson import ObjectId
+
+from common.config import BRAIN_SCAN_CHUNK_SIZE, NeuroDataCollections
+from common.db_manager import DBManager
+from common.logger import logger
+from common.scan_codec import HEADER_SIZE, ScanFormatError, parse_header
+
+# Chunk storage of packed scans too large for a MongoDB document (16 MB), kept in GridFS behind DBManager:
+# FrHUB writes them chunk by chunk as their frames arrive, FrBRAIN reads them back chunk by chunk.
+
+
+class ScanStoreError(Exception):
+    """Raised when chunk storage can't be reached."""
+
+
+class ScanFile(NamedTuple):
+    """Packed scan in chunk storage, stored in place of the scan data"""
+    file_id: ObjectId
+    size: int
+
+
+class ScanUpload:
+    """Packed scan written to chunk storage while it's being received, the header is validated with the first bytes"""
+
+    def __init__(self, patient_id: int, scan_id: int, chunk_size: int = BRAIN_SCAN_CHUNK_SIZE) -> None:
+        self.stream = DBManager().open_upload_stream(
+            NeuroDataCollections.brain_scan_files,
+            f"{patient_id}-{scan_id}",
+            chunk_size,
+            {"patient_id": patient_id, "scan_id": scan_id},
+        )
+        if self.stream is None:
+            raise ScanStoreError(f"Can't store scan {scan_id} of patient {patient_id} in chunks")
+        self.header = bytearray()
+        # size of the whole packed scan, known once the header is in
+        self.size: Optional[int] = None
+        self.received = 0
+
+    def write(self, data: bytes) -> None:
+        if self.size is None:
+            self.header += data[:HEADER_SIZE - len(self.header)]
+            if len(self.header) == HEADER_SIZE:
+                _, _, self.size = parse_header(self.header)
+        self.received += len(data)
+        if self.size is not None and self.received > self.size:
+            raise ScanFormatError(f"Packed scan of {self.size} bytes got {self.received} bytes")
+        self.stream.write(bytes(data))
+
+    def finish(self) -> ScanFile:
+        """Flushes the last chunk, once every byte of the scan was written."""
+        if self.size is None:
+            raise ScanFormatError(f"Packed scan is too short: {self.received} bytes")
+        if self.received != self.size:
+            raise ScanFormatError(f"Packed scan of {self.size} bytes ended after {self.received} bytes")
+        self.stream.close()
+        return ScanFile(self.stream._id, self.size)
+
+    def abort(self) -> None:
+        """Deletes whatever was written of the scan."""
+        try:
+            self.stream.abort()
+        except Exception as e:
+            logger.error(f"Failed to delete partially stored scan {self.stream._id}: {e}")
+
+
+def store_scan_file(patient_id: int, scan_id: int, scan_data: bytes, chunk_size: int = BRAIN_SCAN_CHUNK_SIZE) -> ScanFile:
+    """Writes a packed scan already in memory to chunk storage."""
+    upload = ScanUpload(patient_id, scan_id, chunk_size)
+    try:
+        for start in range(0, len(scan_data), chunk_size):
+            upload.write(scan_data[start:start + chunk_size])
+        return upload.finish()
+    except Exception:
+        upload.abort()
+        raise
+
+
+def iter_scan_chunks(file_id: ObjectId) -> Iterator[bytes]:
+    """
+    Reads a packed scan from chunk storage one chunk at a time
+    :param file_id:
+    :return:
+    """
+    stream = DBManager().open_download_stream(NeuroDataCollections.brain_scan_files, file_id)
+    if stream is None:
+        raise ScanStoreError(f"Can't read scan file {file_id}")
+    with stream:
+        # iterating a GridOut gives lines, not chunks
+        yield from iter(stream.readchunk, b"")
+
+
+def delete_scan_file(file_id: ObjectId) -> bool:
+    return DBManager().delete_file(NeuroDataCollections.brain_scan_files, file_id)
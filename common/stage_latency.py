@@ -0,0 +1,124 @@
+"""
+Latency of every hop of the scans' way through the units, over the reports saved in a time window:
+
+    python3 -m common.stage_latency                 # last STAGE_LATENCY_WINDOW_S seconds
+    python3 -m common.stage_latency --window 600
+
+Hops are consecutive stages (pacs_sent -> hub_received, hub_received -> hub_persisted, ...) plus end_to_end
+(pacs_sent -> pacs_acked). Each comes with its count, mean, max and STAGE_LATENCY_PERCENTILES in milliseconds,
+computed by MongoDB in one aggregation over the traces of the brain reports (see common/tracing.py).
+Stages are timed with the clock of the unit reaching them, so hops between hosts include the skew of their clocks.
+Percentiles are exact: the durations of a hop are sorted into one array, which caps a window at about a million reports.
+"""
+import argparse
+import json
+import sys
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from common.config import STAGE_LATENCY_PERCENTILES, STAGE_LATENCY_WINDOW_S, NeuroDataCollections, TraceStage
+from common.db_manager import DBManager
+
+# (name, start stage, end stage)
+HOPS: List[Tuple[str, TraceStage, TraceStage]] = [
+    (f"{start}->{end}", start, end) for start, end in zip(list(TraceStage), list(TraceStage)[1:])
+] + [("end_to_end", TraceStage.pacs_sent, TraceStage.pacs_acked)]
+
+
+def percentile(values: str, fraction: float) -> dict:
+    """Nearest rank percentile of a sorted array"""
+    rank = {"$floor": {"$multiply": [fraction, {"$subtract": [{"$size": values}, 1]}]}}
+    return {"$arrayElemAt": [values, {"$toInt": rank}]}
+
+
+def stage_latency_pipeline(
+    since: float, until: float, percentiles: Sequence[int] = STAGE_LATENCY_PERCENTILES
+) -> List[dict]:
+    """
+    Aggregation of brain reports giving the latency statistics of every hop, in seconds
+    :param since: epoch seconds, reports saved from then on are included
+    :param until: epoch seconds, reports saved from then on are excluded
+    :param percentiles: whole percentiles
+    :return: pipeline giving one document, with the statistics of HOPS[i] as the only element of its hop_<i> list
+        (empty when no report has both stages)
+    """
+    durations = {
+        f"hop_{index}": {"$subtract": [f"$stage_times.{end}", f"$stage_times.{start}"]}
+        for index, (_, start, end) in enumerate(HOPS)
+    }
+    statistics = {
+        "_id": 0,
+        "count": {"$size": "$durations"},
+        "mean": 1,
+        "max": {"$arrayElemAt": ["$durations", -1]},
+        **{f"p{p}": percentile("$durations", p / 100) for p in percentiles},
+    }
+    return [
+        # served by the reports_report_saved index
+        {"$match": {"stage_times.report_saved": {"$gte": since, "$lt": until}}},
+        # a duration is null when either stage is missing, e.g. reports not sent yet
+        {"$project": {"_id": 0, **durations}},
+        {
+            "$facet": {
+                hop: [
+                    {"$match": {hop: {"$ne": None}}},
+                    {"$sort": {hop: 1}},
+                    {"$group": {"_id": None, "durations": {"$push": f"${hop}"}, "mean": {"$avg": f"${hop}"}}},
+                    {"$project": statistics},
+                ]
+                for hop in durations
+            }
+        },
+    ]
+
+
+def stage_latencies(
+    since: float, until: float, percentiles: Sequence[int] = STAGE_LATENCY_PERCENTILES
+) -> Optional[Dict[str, dict]]:
+    """
+    Latency statistics of every hop over the reports saved between `since` and `until` (epoch seconds)
+    :return: hop name -> count and mean, max and percentiles in milliseconds, None if the DB couldn't be queried
+    """
+    result = DBManager().aggregate(
+        NeuroDataCollections.brain_reports, stage_latency_pipeline(since, until, percentiles)
+    )
+    if result is None:
+        return None
+    hops = result[0] if result else {}
+    latencies = {}
+    for index, (name, _, _) in enumerate(HOPS):
+        statistics = (hops.get(f"hop_{index}") or [{}])[0]
+        if not statistics.get("count"):
+            latencies[name] = {"count": 0}
+            continue
+        latencies[name] = {
+            "count": statistics["count"],
+            **{key: round(value * 1000, 3) for key, value in statistics.items() if key != "count"},
+        }
+    return latencies
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Latency percentiles of every hop of the brain scans")
+    parser.add_argument("--window", type=float, default=STAGE_LATENCY_WINDOW_S, help="seconds back from now")
+    args = parser.parse_args()
+
+    until = time.time()
+    since = until - args.window
+    latencies = stage_latencies(since, until)
+    if latencies is None:
+        print("Couldn't compute the stage latencies, see the log", file=sys.stderr)
+        sys.exit(1)
+    print(json.dumps(
+        {
+            "since": datetime.fromtimestamp(since).isoformat(timespec="seconds"),
+            "until": datetime.fromtimestamp(until).isoformat(timespec="seconds"),
+            "hops_ms": latencies,
+        },
+        indent=2,
+    ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# (field, direction) pairs, as taken by pymongo's sort
+Sort = List[Tuple[str, int]]
+
+
+class StorageBackend:
+    """Storage engine behind DBManager (see common/storage/mongo.py and common/storage/sqlite.py)
+
+    Documents, queries, projections and sorts are MongoDB's, updates are the fields to $set. Methods raise on failure,
+    DBManager logs the error and returns its failure value, so the units never see backend specific exceptions.
+    """
+    name = ""
+
+    def index_names(self, collection_name: str) -> List[str]:
+        """Indexes the units rely on in a collection"""
+        raise NotImplementedError
+
+    def ensure_index(self, collection_name: str, index_name: str) -> None:
+        """Creates one of the indexes of a collection if it doesn't exist, raises if it can't be created"""
+        raise NotImplementedError
+
+    def collection_names(self) -> List[str]:
+        """Collections with indexes to ensure"""
+        raise NotImplementedError
+
+    def insert(self, collection_name: str, document: Dict):
+        """Inserts a document, setting its _id if it has none, returns the _id"""
+        raise NotImplementedError
+
+    def insert_many(
+        self, collection_name: str, documents: List[Dict], durable: bool = False, ignore_duplicates: bool = False
+    ) -> List:
+        """
+        Inserts documents, those that can be inserted are even if others can't, returns their _id
+        :param durable: only return once the documents survive a crash of the machine
+        :param ignore_duplicates: documents whose _id (or other unique key) is taken count as inserted
+        """
+        raise NotImplementedError
+
+    def insert_new(self, collection_name: str, documents: List[Dict], durable: bool = False) -> List[int]:
+        """
+        Inserts the documents whose _id and other unique keys aren't taken yet, like insert_many
+        :return: positions in `documents` of the duplicates, which weren't inserted
+        """
+        raise NotImplementedError
+
+    def find(
+        self,
+        collection_name: str,
+        query: Dict,
+        projection: Optional[Dict] = None,
+        sort: Optional[Sort] = None,
+        limit: int = 0,
+    ) -> Iterable[Dict]:
+        """Matching documents, lazily where the backend can"""
+        raise NotImplementedError
+
+    def find_one(self, collection_name: str, query: Dict, projection: Optional[Dict] = None) -> Optional[Dict]:
+        raise NotImplementedError
+
+    def find_one_and_update(self, collection_name: str, query: Dict, update: Dict) -> Optional[Dict]:
+        """Sets the fields of `update` on the first matching document, returns it updated"""
+        raise NotImplementedError
+
+    def update_one(self, collection_name: str, query: Dict, update: Dict) -> int:
+        """Sets the fields of `update` on the first matching document, returns how many documents were modified"""
+        raise NotImplementedError
+
+    def update_many(self, collection_name: str, query: Dict, update: Dict) -> int:
+        raise NotImplementedError
+
+    def claim_many(
+        self,
+        collection_name: str,
+        query: Dict,
+        update: Dict,
+        limit: int,
+        token_field: str,
+        claim_token: str,
+        projection: Optional[Dict] = None,
+        sort: Optional[Sort] = None,
+    ) -> Optional[List[Dict]]:
+        """
+        Sets the fields of `update` and the claim token on up to `limit` matching documents, so that no other process
+        claims them too
+        :return: the claimed documents, None if no document matched so nothing was claimed
+        """
+        raise NotImplementedError
+
+    def aggregate(self, collection_name: str, pipeline: List[Dict]) -> List[Dict]:
+        raise NotImplementedError(f"Aggregation pipelines aren't supported by the {self.name} storage")
+
+    def drop_collection(self, collection_name: str) -> None:
+        raise NotImplementedError
+
+    def open_upload_stream(self, bucket_name: str, filename: str, chunk_size: int, metadata: Optional[Dict] = None):
+        """File written chunk by chunk with write(), close() and abort(), its _id identifies it"""
+        raise NotImplementedError
+
+    def open_download_stream(self, bucket_name: str, file_id):
+        """File read chunk by chunk with readchunk(), which returns b"" at its end, also a context manager"""
+        raise NotImplementedError
+
+    def delete_file(self, bucket_name: str, file_id) -> None:
+        raise NotImplementedError
+
+    def watch(self, collection_name: str, pipeline: List[Dict], max_await_time_ms: int):
+        """Change stream of a collection"""
+        raise NotImplementedError(f"Change streams aren't supported by the {self.name} storage")
+
+    def close(self) -> None:
+        pass
@@ -0,0 +1,186 @@
+from typing import Dict, List, Optional
+
+from gridfs import GridFSBucket, GridIn, GridOut
+from pymongo import ASCENDING, IndexModel, MongoClient, WriteConcern
+from pymongo.errors import BulkWriteError
+
+from common.config import NeuroDataCollections, ReportStatus
+from common.storage.backend import Sort, StorageBackend
+
+# MongoDB's error code of a write breaking a unique index
+DUPLICATE_KEY = 11000
+
+
+def duplicate_positions(error: BulkWriteError) -> Optional[List[int]]:
+    """Positions of the documents an unordered insert_many failed to insert as duplicates, None for any other failure"""
+    errors = error.details.get("writeErrors", [])
+    if not errors or any(write_error.get("code") != DUPLICATE_KEY for write_error in errors):
+        return None
+    return sorted(write_error["index"] for write_error in errors)
+
+
+class MongoBackend(StorageBackend):
+    """MongoDB through pymongo, the neuroData database of `client`"""
+    name = "mongo"
+
+    # indexes the units rely on, created by DBManager.ensure_indexes when a unit starts
+    # partial indexes only cover pending documents, so they stay small however much history accumulates
+    INDEXES: Dict[str, List[IndexModel]] = {
+        NeuroDataCollections.brain_scans: [
+            # FrBRAIN claiming 'To Do' scans, oldest first
+            IndexModel(
+                [("report_generated", ASCENDING), ("_id", ASCENDING)],
+                name="scans_to_do",
+                partialFilterExpression={"report_generated": ReportStatus.to_do},
+            ),
+            # reaper looking for expired leases
+            IndexModel(
+                [("lease_expires_at", ASCENDING)],
+                name="scans_in_process",
+                partialFilterExpression={"report_generated": ReportStatus.in_process},
+            ),
+            IndexModel([("lease_token", ASCENDING)], name="scans_lease_token", sparse=True),
+            # idempotency key, a scan sent again is never stored twice
+            IndexModel([("patient_id", ASCENDING), ("scan_id", ASCENDING)], name="scans_idempotency_key", unique=True),
+        ],
+        NeuroDataCollections.brain_reports: [
+            # FrHUB claiming unsent reports
+            IndexModel(
+                [("sent", ASCENDING), ("claimed_at", ASCENDING)],
+                name="reports_unsent",
+                partialFilterExpression={"sent": False},
+            ),
+            IndexModel([("claim_token", ASCENDING)], name="reports_claim_token", sparse=True),
+            # stage latency report over a time window (see common/stage_latency.py)
+            IndexModel([("stage_times.report_saved", ASCENDING)], name="reports_report_saved", sparse=True),
+            # one report per scan, even if a FrBRAIN whose lease expired saves it as well
+            IndexModel(
+                [("patient_id", ASCENDING), ("scan_id", ASCENDING)], name="reports_idempotency_key", unique=True
+            ),
+        ],
+    }
+
+    def __init__(self, client: MongoClient) -> None:
+        self.client = client
+        self.db = client.get_database("neuroData")
+
+    @classmethod
+    def connect(cls, mongo_uri: str) -> "MongoBackend":
+        # as it's local, so not providing any authentication
+        return cls(MongoClient(mongo_uri))
+
+    def collection_names(self) -> List[str]:
+        return list(self.INDEXES)
+
+    def index_names(self, collection_name: str) -> List[str]:
+        return [index.document["name"] for index in self.INDEXES[collection_name]]
+
+    def ensure_index(self, collection_name: str, index_name: str) -> None:
+        # one index per call, a failing createIndexes command doesn't create any of the indexes it's given
+        index = next(index for index in self.INDEXES[collection_name] if index.document["name"] == index_name)
+        self.db[collection_name].create_indexes([index])
+
+    def insert(self, collection_name: str, document: Dict):
+        return self.db[collection_name].insert_one(document).inserted_id
+
+    def insert_many(
+        self, collection_name: str, documents: List[Dict], durable: bool = False, ignore_duplicates: bool = False
+    ) -> List:
+        collection = self.db[collection_name]
+        if durable:
+            collection = collection.with_options(write_concern=WriteConcern(w=1, j=True))
+        try:
+            return collection.insert_many(documents, ordered=False).inserted_ids
+        except BulkWriteError as e:
+            if ignore_duplicates and duplicate_positions(e) is not None:
+                return [document["_id"] for document in documents]
+            raise
+
+    def insert_new(self, collection_name: str, documents: List[Dict], durable: bool = False) -> List[int]:
+        collection = self.db[collection_name]
+        if durable:
+            collection = collection.with_options(write_concern=WriteConcern(w=1, j=True))
+        try:
+            collection.insert_many(documents, ordered=False)
+            return []
+        except BulkWriteError as e:
+            duplicates = duplicate_positions(e)
+            if duplicates is None:
+                raise
+            return duplicates
+
+    def find(
+        self,
+        collection_name: str,
+        query: Dict,
+        projection: Optional[Dict] = None,
+        sort: Optional[Sort] = None,
+        limit: int = 0,
+    ):
+        # projection/sort/limit are left to MongoDB so only the needed documents and fields are sent
+        cursor = self.db[collection_name].find(query, projection)
+        if sort:
+            cursor = cursor.sort(sort)
+        if limit:
+            cursor = cursor.limit(limit)
+        return cursor
+
+    def find_one(self, collection_name: str, query: Dict, projection: Optional[Dict] = None) -> Optional[Dict]:
+        return self.db[collection_name].find_one(query, projection)
+
+    def find_one_and_update(self, collection_name: str, query: Dict, update: Dict) -> Optional[Dict]:
+        return self.db[collection_name].find_one_and_update(query, {"$set": update}, return_document=True)
+
+    def update_one(self, collection_name: str, query: Dict, update: Dict) -> int:
+        return self.db[collection_name].update_one(query, {"$set": update}).modified_count
+
+    def update_many(self, collection_name: str, query: Dict, update: Dict) -> int:
+        return self.db[collection_name].update_many(query, {"$set": update}).modified_count
+
+    def claim_many(
+        self,
+        collection_name: str,
+        query: Dict,
+        update: Dict,
+        limit: int,
+        token_field: str,
+        claim_token: str,
+        projection: Optional[Dict] = None,
+        sort: Optional[Sort] = None,
+    ) -> Optional[List[Dict]]:
+        # the query is re-checked while updating, so a document claimed by someone else in between is skipped
+        collection = self.db[collection_name]
+        ids = [document["_id"] for document in self.find(collection_name, query, {"_id": 1}, sort, limit)]
+        if not ids:
+            return None
+        collection.update_many(
+            {"$and": [query, {"_id": {"$in": ids}}]},
+            {"$set": {**update, token_field: claim_token}},
+        )
+        return list(collection.find({token_field: claim_token}, projection))
+
+    def aggregate(self, collection_name: str, pipeline: List[Dict]) -> List[Dict]:
+        # stages that outgrow MongoDB's memory limit may spill to disk
+        return list(self.db[collection_name].aggregate(pipeline, allowDiskUse=True))
+
+    def drop_collection(self, collection_name: str) -> None:
+        self.db.drop_collection(collection_name)
+
+    def open_upload_stream(
+        self, bucket_name: str, filename: str, chunk_size: int, metadata: Optional[Dict] = None
+    ) -> GridIn:
+        bucket = GridFSBucket(self.db, bucket_name=bucket_name, chunk_size_bytes=chunk_size)
+        return bucket.open_upload_stream(filename, metadata=metadata)
+
+    def open_download_stream(self, bucket_name: str, file_id) -> GridOut:
+        return GridFSBucket(self.db, bucket_name=bucket_name).open_download_stream(file_id)
+
+    def delete_file(self, bucket_name: str, file_id) -> None:
+        GridFSBucket(self.db, bucket_name=bucket_name).delete(file_id)
+
+    def watch(self, collection_name: str, pipeline: List[Dict], max_await_time_ms: int):
+        # change streams need MongoDB to run as a replica set, on a standalone server this raises
+        return self.db[collection_name].watch(pipeline, max_await_time_ms=max_await_time_ms)
+
+    def close(self) -> None:
+        self.client.close()
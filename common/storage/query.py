@@ -0,0 +1,129 @@
+"""
+MongoDB query, projection, update and sort semantics on plain dicts, for storage backends that can't run MongoDB
+queries themselves (see common/storage/sqlite.py). Only what the units use is covered: equality and $eq, $ne, $in,
+$nin, $lt, $lte, $gt, $gte, $exists on (dotted) fields, $and, $or and $nor, inclusion or exclusion projections, and
+$set updates.
+"""
+import operator
+from typing import Any, Callable, Dict, List, Optional
+
+from common.storage.backend import Sort
+
+MISSING = object()
+
+COMPARISONS: Dict[str, Callable[[Any, Any], bool]] = {
+    "$lt": operator.lt,
+    "$lte": operator.le,
+    "$gt": operator.gt,
+    "$gte": operator.ge,
+}
+
+
+def get_field(document: Dict, path: str) -> Any:
+    """Value of a (dotted) field, MISSING if the document doesn't have it"""
+    value = document
+    for key in path.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return MISSING
+        value = value[key]
+    return value
+
+
+def equals(value: Any, expected: Any) -> bool:
+    # like MongoDB, null matches missing fields, and an array matches a value it contains
+    if expected is None:
+        return value is MISSING or value is None
+    if isinstance(value, list) and not isinstance(expected, list):
+        return expected in value
+    return value is not MISSING and value == expected
+
+
+def compare(value: Any, compare_with: Callable[[Any, Any], bool], bound: Any) -> bool:
+    if value is MISSING or value is None:
+        return False
+    try:
+        return compare_with(value, bound)
+    except TypeError:
+        # MongoDB only compares values of the same type
+        return False
+
+
+def matches_condition(value: Any, condition: Any) -> bool:
+    if not isinstance(condition, dict) or not any(str(key).startswith("$") for key in condition):
+        return equals(value, condition)
+    for name, argument in condition.items():
+        if name == "$eq":
+            matched = equals(value, argument)
+        elif name == "$ne":
+            matched = not equals(value, argument)
+        elif name == "$in":
+            matched = any(equals(value, expected) for expected in argument)
+        elif name == "$nin":
+            matched = not any(equals(value, expected) for expected in argument)
+        elif name == "$exists":
+            matched = (value is not MISSING) == bool(argument)
+        elif name in COMPARISONS:
+            matched = compare(value, COMPARISONS[name], argument)
+        else:
+            raise ValueError(f"Unsupported query operator: {name}")
+        if not matched:
+            return False
+    return True
+
+
+def matches(document: Dict, query: Dict) -> bool:
+    """Whether the document matches the query"""
+    for key, condition in query.items():
+        if key == "$and":
+            matched = all(matches(document, sub_query) for sub_query in condition)
+        elif key == "$or":
+            matched = any(matches(document, sub_query) for sub_query in condition)
+        elif key == "$nor":
+            matched = not any(matches(document, sub_query) for sub_query in condition)
+        elif key.startswith("$"):
+            raise ValueError(f"Unsupported query operator: {key}")
+        else:
+            matched = matches_condition(get_field(document, key), condition)
+        if not matched:
+            return False
+    return True
+
+
+def project(document: Dict, projection: Optional[Dict]) -> Dict:
+    """Top level fields kept by an inclusion projection, or all but those of an exclusion one, _id unless excluded"""
+    if not projection:
+        return document
+    included = {field for field, keep in projection.items() if keep and field != "_id"}
+    if not included:
+        return {field: value for field, value in document.items() if field not in projection}
+    fields = included if projection.get("_id", 1) == 0 else included | {"_id"}
+    return {field: value for field, value in document.items() if field in fields}
+
+
+def apply_set(document: Dict, fields: Dict) -> Dict:
+    """Applies a $set of (dotted) fields to the document, in place"""
+    for path, value in fields.items():
+        target = document
+        *parents, last = path.split(".")
+        for key in parents:
+            target = target.setdefault(key, {})
+        target[last] = value
+    return document
+
+
+def sort_key(sort: Sort) -> Callable[[Dict], tuple]:
+    """Key sorting documents like MongoDB for the ascending fields of `sort`, missing values first"""
+    def key(document: Dict) -> tuple:
+        values = []
+        for field, _ in sort:
+            value = get_field(document, field)
+            values.append((0, 0) if value is MISSING or value is None else (1, value))
+        return tuple(values)
+    return key
+
+
+def sort_documents(documents: List[Dict], sort: Sort) -> List[Dict]:
+    """Sorts by the fields of `sort`, the last one first, so descending fields can be mixed in"""
+    for field, direction in reversed(sort):
+        documents.sort(key=sort_key([(field, direction)]), reverse=direction < 0)
+    return documents
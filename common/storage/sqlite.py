@@ -0,0 +1,510 @@
+import itertools
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import bson
+from bson import ObjectId
+
+from common.config import SQLITE_BUSY_TIMEOUT_S, NeuroDataCollections
+from common.logger import logger
+from common.storage.backend import Sort, StorageBackend
+from common.storage.query import COMPARISONS, MISSING, apply_set, get_field, matches, project, sort_documents
+
+SQL_COMPARISONS = {"$lt": "<", "$lte": "<=", "$gt": ">", "$gte": ">="}
+
+
+def sql_value(value: Any):
+    """Column value of a document field, ordered in SQL like the field is in MongoDB"""
+    if value is MISSING or value is None:
+        return None
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, datetime):
+        # BSON keeps milliseconds in UTC, so do the columns
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value.isoformat(sep=" ", timespec="milliseconds")
+    if isinstance(value, ObjectId):
+        # the hex of ObjectIds sorts like they do
+        return str(value)
+    if isinstance(value, str):
+        # plain str of StrEnums
+        return str(value)
+    if isinstance(value, (int, float)):
+        return value
+    raise TypeError(f"No column value for {type(value).__name__}")
+
+
+class SQLiteBackend(StorageBackend):
+    """Embedded SQLite database in WAL mode, for single box installs, tests and benchmarks without a MongoDB server
+
+    Every collection is a table of BSON documents keyed by their _id. The fields the units query by status are
+    mirrored in indexed columns, queries on them are run in SQL and re-checked on the documents, anything else is
+    matched on the documents (see common/storage/query.py). WAL mode lets readers go on while a unit writes, writes of
+    the units are serialized by SQLite. Every thread (and process) gets its own connection.
+    Aggregation pipelines and change streams aren't supported: the stage latency report needs MongoDB, and consumers
+    fall back to notifications and polling.
+    """
+    name = "sqlite"
+
+    # fields of the documents mirrored in columns, so claims and status updates don't decode the whole table
+    COLUMNS: Dict[str, Tuple[str, ...]] = {
+        NeuroDataCollections.brain_scans: (
+            "report_generated", "lease_expires_at", "lease_token", "patient_id", "scan_id",
+        ),
+        NeuroDataCollections.brain_reports: ("sent", "claimed_at", "claim_token", "patient_id", "scan_id"),
+    }
+    INDEXES: Dict[str, Dict[str, Tuple[str, ...]]] = {
+        NeuroDataCollections.brain_scans: {
+            # FrBRAIN claiming 'To Do' scans, oldest first
+            "scans_to_do": ("report_generated", "_id"),
+            # reaper looking for expired leases
+            "scans_in_process": ("report_generated", "lease_expires_at"),
+            "scans_lease_token": ("lease_token",),
+        },
+        NeuroDataCollections.brain_reports: {
+            # FrHUB claiming unsent reports
+            "reports_unsent": ("sent", "claimed_at"),
+            "reports_claim_token": ("claim_token",),
+        },
+    }
+    UNIQUE_INDEXES: Dict[str, Dict[str, Tuple[str, ...]]] = {
+        NeuroDataCollections.brain_scans: {
+            # idempotency key, a scan sent again is never stored twice
+            "scans_idempotency_key": ("patient_id", "scan_id"),
+        },
+        NeuroDataCollections.brain_reports: {
+            # one report per scan, even if a FrBRAIN whose lease expired saves it as well
+            "reports_idempotency_key": ("patient_id", "scan_id"),
+        },
+    }
+
+    def __init__(self, path: str, busy_timeout_s: float = SQLITE_BUSY_TIMEOUT_S) -> None:
+        self.path = path
+        self.busy_timeout_s = busy_timeout_s
+        self.local = threading.local()
+        # (pid, connection) of every thread, closed by close()
+        self.connections: List[Tuple[int, sqlite3.Connection]] = []
+        self.tables = set()
+        self.lock = threading.Lock()
+
+    def connection(self) -> sqlite3.Connection:
+        """Connection of the calling thread, a forked process doesn't reuse those of its parent"""
+        connection = getattr(self.local, "connection", None)
+        if connection is None or self.local.pid != os.getpid():
+            # transactions are begun explicitly, see transaction()
+            connection = sqlite3.connect(
+                self.path, timeout=self.busy_timeout_s, isolation_level=None, check_same_thread=False
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            # committed writes survive a crash of the unit, those of the last moments may not survive a power loss
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection, self.local.pid = connection, os.getpid()
+            with self.lock:
+                self.connections.append((os.getpid(), connection))
+        return connection
+
+    @contextmanager
+    def transaction(self, durable: bool = False) -> Iterator[sqlite3.Connection]:
+        """Write transaction, holding the write lock from its start so what it reads can't change before it commits"""
+        connection = self.connection()
+        if durable:
+            # fsyncs the WAL on commit
+            connection.execute("PRAGMA synchronous=FULL")
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        finally:
+            if durable:
+                connection.execute("PRAGMA synchronous=NORMAL")
+
+    def columns(self, collection_name: str) -> Tuple[str, ...]:
+        return self.COLUMNS.get(collection_name, ())
+
+    def table(self, collection_name: str) -> str:
+        """Table of a collection, created with its indexes the first time it's used"""
+        if collection_name not in self.tables:
+            columns = "".join(f', "{column}"' for column in self.columns(collection_name))
+            connection = self.connection()
+            # no type on _id, so int and str _ids keep their type and sort order
+            connection.execute(
+                f'CREATE TABLE IF NOT EXISTS "{collection_name}" (_id PRIMARY KEY, document BLOB NOT NULL{columns})'
+            )
+            for index_name in self.index_names(collection_name):
+                try:
+                    self.create_index(collection_name, index_name)
+                except sqlite3.Error as e:
+                    # e.g. a unique index over duplicates, see DBManager.ensure_indexes
+                    logger.error(f"Error creating index {index_name} of {collection_name}: {e}")
+            self.tables.add(collection_name)
+        return collection_name
+
+    def create_index(self, collection_name: str, index_name: str) -> None:
+        unique = index_name in self.UNIQUE_INDEXES.get(collection_name, {})
+        fields = (self.UNIQUE_INDEXES if unique else self.INDEXES)[collection_name][index_name]
+        fields = ", ".join(f'"{field}"' for field in fields)
+        self.connection().execute(
+            f'CREATE {"UNIQUE " if unique else ""}INDEX IF NOT EXISTS "{index_name}" ON "{collection_name}" ({fields})'
+        )
+
+    def row(self, collection_name: str, document: Dict) -> tuple:
+        return (
+            sql_value(document["_id"]),
+            bson.encode(document),
+            *(sql_value(get_field(document, column)) for column in self.columns(collection_name)),
+        )
+
+    def column_condition(self, column: str, condition: Any) -> Tuple[str, List]:
+        """SQL of a condition on a column, raises ValueError or TypeError if it can't be run in SQL"""
+        name = f'"{column}"'
+        if not isinstance(condition, dict) or not any(str(key).startswith("$") for key in condition):
+            condition = {"$eq": condition}
+        clauses, parameters = [], []
+        for operator_name, argument in condition.items():
+            if operator_name in ("$eq", "$ne"):
+                # missing fields are NULL, and null matches them
+                if argument is None:
+                    clauses.append(f"{name} IS {'NOT ' if operator_name == '$ne' else ''}NULL")
+                elif operator_name == "$eq":
+                    clauses.append(f"{name} = ?")
+                    parameters.append(sql_value(argument))
+                else:
+                    clauses.append(f"({name} IS NULL OR {name} != ?)")
+                    parameters.append(sql_value(argument))
+            elif operator_name in ("$in", "$nin"):
+                values = [sql_value(value) for value in argument if value is not None]
+                placeholders = ", ".join("?" * len(values))
+                if operator_name == "$in":
+                    clause = f"{name} IN ({placeholders})" if values else "0"
+                    clauses.append(f"({name} IS NULL OR {clause})" if None in argument else clause)
+                else:
+                    clause = f"{name} NOT IN ({placeholders})" if values else "1"
+                    # unlike $in, null in $nin excludes missing fields
+                    null = f"{name} IS NOT NULL AND" if None in argument else f"{name} IS NULL OR"
+                    clauses.append(f"({null} {clause})")
+                parameters += values
+            elif operator_name in COMPARISONS:
+                clauses.append(f"{name} {SQL_COMPARISONS[operator_name]} ?")
+                parameters.append(sql_value(argument))
+            else:
+                raise ValueError(f"{operator_name} isn't run in SQL")
+        return " AND ".join(clauses), parameters
+
+    def where(self, collection_name: str, query: Dict) -> Tuple[List[str], List, bool]:
+        """
+        SQL of the conditions of a query on columns, the rows it selects include the documents matching the query
+        :return: clauses, their parameters, and whether they select exactly the matching documents
+        """
+        columns = ("_id",) + self.columns(collection_name)
+        clauses, parameters, exact = [], [], True
+        for key, condition in query.items():
+            if key == "$and":
+                for sub_query in condition:
+                    sub_clauses, sub_parameters, sub_exact = self.where(collection_name, sub_query)
+                    clauses += sub_clauses
+                    parameters += sub_parameters
+                    exact = exact and sub_exact
+            elif key == "$or":
+                alternatives = [self.where(collection_name, sub_query) for sub_query in condition]
+                # an alternative without clauses selects every row
+                if not alternatives or not all(sub_clauses for sub_clauses, _, _ in alternatives):
+                    exact = False
+                    continue
+                clauses.append(" OR ".join(f"({' AND '.join(sub_clauses)})" for sub_clauses, _, _ in alternatives))
+                parameters += [parameter for _, sub_parameters, _ in alternatives for parameter in sub_parameters]
+                exact = exact and all(sub_exact for _, _, sub_exact in alternatives)
+            elif key in columns:
+                try:
+                    clause, clause_parameters = self.column_condition(key, condition)
+                except (TypeError, ValueError):
+                    exact = False
+                    continue
+                clauses.append(clause)
+                parameters += clause_parameters
+            else:
+                exact = False
+        return clauses, parameters, exact
+
+    def documents(
+        self,
+        connection: sqlite3.Connection,
+        collection_name: str,
+        query: Dict,
+        sort: Optional[Sort] = None,
+        limit: int = 0,
+    ) -> Iterator[Dict]:
+        """Documents matching the query, sorted and limited in SQL when their conditions and sort fields are columns"""
+        columns = ("_id",) + self.columns(collection_name)
+        clauses, parameters, exact = self.where(collection_name, query)
+        sql = f'SELECT document FROM "{self.table(collection_name)}"'
+        if clauses:
+            sql += " WHERE " + " AND ".join(f"({clause})" for clause in clauses)
+        sorted_in_sql = not sort or all(field in columns for field, _ in sort)
+        if sort and sorted_in_sql:
+            order = (f'"{field}" {"DESC" if direction < 0 else "ASC"}' for field, direction in sort)
+            sql += " ORDER BY " + ", ".join(order)
+        if limit and exact and sorted_in_sql:
+            sql += f" LIMIT {int(limit)}"
+        documents = (bson.decode(document) for document, in connection.execute(sql, parameters))
+        documents = (document for document in documents if matches(document, query))
+        if not sorted_in_sql:
+            documents = iter(sort_documents(list(documents), sort))
+        return itertools.islice(documents, limit) if limit else documents
+
+    def set_fields(
+        self, connection: sqlite3.Connection, collection_name: str, documents: List[Dict], update: Dict
+    ) -> int:
+        """Applies a $set to the documents and writes those it changed, returns how many"""
+        columns = ", ".join(f'"{column}" = ?' for column in ("document",) + self.columns(collection_name))
+        modified = 0
+        for document in documents:
+            before = bson.encode(document)
+            apply_set(document, update)
+            _id, encoded, *values = self.row(collection_name, document)
+            if encoded != before:
+                connection.execute(
+                    f'UPDATE "{self.table(collection_name)}" SET {columns} WHERE _id = ?', (encoded, *values, _id)
+                )
+                modified += 1
+        return modified
+
+    def collection_names(self) -> List[str]:
+        return list(self.INDEXES)
+
+    def index_names(self, collection_name: str) -> List[str]:
+        return [*self.INDEXES.get(collection_name, {}), *self.UNIQUE_INDEXES.get(collection_name, {})]
+
+    def ensure_index(self, collection_name: str, index_name: str) -> None:
+        self.table(collection_name)
+        self.create_index(collection_name, index_name)
+
+    def insert(self, collection_name: str, document: Dict):
+        # like pymongo, the _id is set on the document
+        document.setdefault("_id", ObjectId())
+        with self.transaction() as connection:
+            row = self.row(collection_name, document)
+            placeholders = ", ".join("?" * len(row))
+            connection.execute(f'INSERT INTO "{self.table(collection_name)}" VALUES ({placeholders})', row)
+        return document["_id"]
+
+    def insert_many(
+        self, collection_name: str, documents: List[Dict], durable: bool = False, ignore_duplicates: bool = False
+    ) -> List:
+        for document in documents:
+            document.setdefault("_id", ObjectId())
+        rows = [self.row(collection_name, document) for document in documents]
+        if not rows:
+            return []
+        with self.transaction(durable) as connection:
+            table = self.table(collection_name)
+            changes = connection.total_changes
+            # the documents that can be inserted are, like an unordered insert_many of MongoDB
+            connection.executemany(f'INSERT OR IGNORE INTO "{table}" VALUES ({", ".join("?" * len(rows[0]))})', rows)
+            inserted = connection.total_changes - changes
+        if not ignore_duplicates and inserted < len(rows):
+            raise sqlite3.IntegrityError(f"{len(rows) - inserted} of {len(rows)} documents have a duplicate _id")
+        return [document["_id"] for document in documents]
+
+    def insert_new(self, collection_name: str, documents: List[Dict], durable: bool = False) -> List[int]:
+        for document in documents:
+            document.setdefault("_id", ObjectId())
+        rows = [self.row(collection_name, document) for document in documents]
+        duplicates = []
+        with self.transaction(durable) as connection:
+            table = self.table(collection_name)
+            for position, row in enumerate(rows):
+                inserted = connection.execute(
+                    f'INSERT OR IGNORE INTO "{table}" VALUES ({", ".join("?" * len(row))})', row
+                ).rowcount
+                if not inserted:
+                    duplicates.append(position)
+        return duplicates
+
+    def find(
+        self,
+        collection_name: str,
+        query: Dict,
+        projection: Optional[Dict] = None,
+        sort: Optional[Sort] = None,
+        limit: int = 0,
+    ) -> Iterator[Dict]:
+        for document in self.documents(self.connection(), collection_name, query, sort, limit):
+            yield project(document, projection)
+
+    def find_one(self, collection_name: str, query: Dict, projection: Optional[Dict] = None) -> Optional[Dict]:
+        return next(self.find(collection_name, query, projection, limit=1), None)
+
+    def find_one_and_update(self, collection_name: str, query: Dict, update: Dict) -> Optional[Dict]:
+        with self.transaction() as connection:
+            documents = list(self.documents(connection, collection_name, query, limit=1))
+            self.set_fields(connection, collection_name, documents, update)
+        return documents[0] if documents else None
+
+    def update_one(self, collection_name: str, query: Dict, update: Dict) -> int:
+        with self.transaction() as connection:
+            documents = list(self.documents(connection, collection_name, query, limit=1))
+            return self.set_fields(connection, collection_name, documents, update)
+
+    def update_many(self, collection_name: str, query: Dict, update: Dict) -> int:
+        with self.transaction() as connection:
+            documents = list(self.documents(connection, collection_name, query))
+            return self.set_fields(connection, collection_name, documents, update)
+
+    def claim_many(
+        self,
+        collection_name: str,
+        query: Dict,
+        update: Dict,
+        limit: int,
+        token_field: str,
+        claim_token: str,
+        projection: Optional[Dict] = None,
+        sort: Optional[Sort] = None,
+    ) -> Optional[List[Dict]]:
+        # selected and updated in one write transaction, no other process can claim the documents in between
+        with self.transaction() as connection:
+            documents = list(self.documents(connection, collection_name, query, sort, limit))
+            if not documents:
+                return None
+            self.set_fields(connection, collection_name, documents, {**update, token_field: claim_token})
+        return [project(document, projection) for document in documents]
+
+    def drop_collection(self, collection_name: str) -> None:
+        self.connection().execute(f'DROP TABLE IF EXISTS "{collection_name}"')
+        self.tables.discard(collection_name)
+
+    def bucket_tables(self, bucket_name: str) -> Tuple[str, str]:
+        """Tables of the files of a bucket and of their chunks, like GridFS' bucket.files and bucket.chunks"""
+        files, chunks = f"{bucket_name}_files", f"{bucket_name}_chunks"
+        if bucket_name not in self.tables:
+            connection = self.connection()
+            connection.execute(
+                f'CREATE TABLE IF NOT EXISTS "{files}" '
+                "(_id TEXT PRIMARY KEY, filename TEXT, length INTEGER, chunk_size INTEGER, upload_date TEXT, "
+                "metadata BLOB)"
+            )
+            connection.execute(
+                f'CREATE TABLE IF NOT EXISTS "{chunks}" '
+                "(files_id TEXT NOT NULL, n INTEGER NOT NULL, data BLOB NOT NULL, PRIMARY KEY (files_id, n))"
+            )
+            self.tables.add(bucket_name)
+        return files, chunks
+
+    def open_upload_stream(
+        self, bucket_name: str, filename: str, chunk_size: int, metadata: Optional[Dict] = None
+    ) -> "UploadStream":
+        return UploadStream(self, bucket_name, filename, chunk_size, metadata)
+
+    def open_download_stream(self, bucket_name: str, file_id) -> "DownloadStream":
+        return DownloadStream(self, bucket_name, file_id)
+
+    def delete_file(self, bucket_name: str, file_id) -> None:
+        files, chunks = self.bucket_tables(bucket_name)
+        with self.transaction() as connection:
+            connection.execute(f'DELETE FROM "{chunks}" WHERE files_id = ?', (str(file_id),))
+            if not connection.execute(f'DELETE FROM "{files}" WHERE _id = ?', (str(file_id),)).rowcount:
+                raise FileNotFoundError(f"No file {file_id} in {bucket_name}")
+
+    def close(self) -> None:
+        with self.lock:
+            for pid, connection in self.connections:
+                # connections inherited from a parent process are left to it
+                if pid == os.getpid():
+                    connection.close()
+            self.connections = []
+        self.local = threading.local()
+
+
+class UploadStream:
+    """File written chunk by chunk like GridFS' GridIn, chunks are stored once full and the file listed once closed"""
+
+    def __init__(
+        self, backend: SQLiteBackend, bucket_name: str, filename: str, chunk_size: int, metadata: Optional[Dict]
+    ) -> None:
+        self.backend = backend
+        self.files, self.chunks = backend.bucket_tables(bucket_name)
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.metadata = metadata
+        self._id = ObjectId()
+        self.buffer = bytearray()
+        self.chunk_count = 0
+        self.length = 0
+        self.closed = False
+
+    def write(self, data: bytes) -> None:
+        self.buffer += data
+        self.length += len(data)
+        while len(self.buffer) >= self.chunk_size:
+            self.write_chunk(bytes(self.buffer[:self.chunk_size]))
+            del self.buffer[:self.chunk_size]
+
+    def write_chunk(self, data: bytes) -> None:
+        self.backend.connection().execute(
+            f'INSERT INTO "{self.chunks}" VALUES (?, ?, ?)', (str(self._id), self.chunk_count, data)
+        )
+        self.chunk_count += 1
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        if self.buffer:
+            self.write_chunk(bytes(self.buffer))
+            self.buffer.clear()
+        with self.backend.transaction() as connection:
+            connection.execute(
+                f'INSERT INTO "{self.files}" VALUES (?, ?, ?, ?, ?, ?)',
+                (
+                    str(self._id), self.filename, self.length, self.chunk_size, sql_value(datetime.now(timezone.utc)),
+                    bson.encode(self.metadata) if self.metadata is not None else None,
+                ),
+            )
+        self.closed = True
+
+    def abort(self) -> None:
+        """Deletes the chunks written so far"""
+        self.backend.connection().execute(f'DELETE FROM "{self.chunks}" WHERE files_id = ?', (str(self._id),))
+        self.buffer.clear()
+        self.closed = True
+
+
+class DownloadStream:
+    """File read chunk by chunk like GridFS' GridOut"""
+
+    def __init__(self, backend: SQLiteBackend, bucket_name: str, file_id) -> None:
+        self.backend = backend
+        files, self.chunks = backend.bucket_tables(bucket_name)
+        self.file_id = str(file_id)
+        row = backend.connection().execute(f'SELECT length FROM "{files}" WHERE _id = ?', (self.file_id,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(f"No file {file_id} in {bucket_name}")
+        self.length = row[0]
+        self.next_chunk = 0
+
+    def readchunk(self) -> bytes:
+        """Next chunk, b"" at the end of the file"""
+        row = self.backend.connection().execute(
+            f'SELECT data FROM "{self.chunks}" WHERE files_id = ? AND n = ?', (self.file_id, self.next_chunk)
+        ).fetchone()
+        if row is None:
+            return b""
+        self.next_chunk += 1
+        return row[0]
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> "DownloadStream":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
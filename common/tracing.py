@@ -0,0 +1,48 @@
+import time
+import uuid
+from typing import Dict, List, NamedTuple, Optional
+
+from common.config import TraceStage
+
+# Every scan gets a trace id when FrPACS sends it, carried in its frame, on its BrainScan document and on its
+# BrainReport. Along with it goes the wall clock time (epoch seconds) the scan reached every TraceStage, so the latency
+# of every hop can be computed afterwards (see common/stage_latency.py).
+# Scans travel as (patient_id, scan_id, scan_datetime, scan_type, scan_data) tuples, a traced scan has its Trace as a
+# sixth element.
+
+
+class Trace(NamedTuple):
+    trace_id: str
+    # stage -> epoch seconds, filled in as the scan moves on
+    stage_times: Dict[str, float]
+
+
+def new_trace(stage: Optional[TraceStage] = None) -> Trace:
+    """Starts a trace, timing `stage` now"""
+    return Trace(uuid.uuid4().hex, {stage: time.time()} if stage else {})
+
+
+def scan_trace(scan: tuple) -> Optional[Trace]:
+    return scan[5] if len(scan) > 5 else None
+
+
+def traced(scan: tuple, stage: TraceStage) -> tuple:
+    """
+    Times the scan reaching `stage` now
+    :param scan: scan tuple, with or without its trace
+    :param stage:
+    :return: the scan with its trace, which is started here for scans that have none (e.g. sent by older FrPACS)
+    """
+    trace = scan_trace(scan)
+    if trace is None:
+        return (*scan[:5], new_trace(stage))
+    trace.stage_times[stage] = time.time()
+    return scan
+
+
+def record_stage(documents: List[dict], stage: TraceStage) -> None:
+    """Times the traced documents reaching `stage` now, right before they're written"""
+    now = time.time()
+    for document in documents:
+        if "stage_times" in document:
+            document["stage_times"][stage] = now
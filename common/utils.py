@@ -1,87 +1,303 @@
-import random as rn
-from datetime import datetime
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple, Union
 
-from common.config import NeuroDataCollections
+import numpy as np
+from pymongo import ASCENDING
+
+from common.analysis import analyze_scan_chunks, analyze_scans, format_report
+from common.config import (
+    BRAIN_REPORT_CLAIM_TIMEOUT_S,
+    BRAIN_SCAN_INLINE_MAX_SIZE,
+    BRAIN_SCAN_LEASE_S,
+    AckStatus,
+    NeuroDataCollections,
+    ReportStatus,
+    ScanCell,
+    TraceStage,
+)
 from common.db_manager import DBManager
-from common.logger import logger
+from common.logger import log_event, logger
 from common.models.brain_report import BrainReport
 from common.models.brain_scan import BrainScan
+from common.scan_codec import ScanFormatError, encode_scan, to_packed_scan
+from common.scan_store import ScanFile, delete_scan_file, iter_scan_chunks, store_scan_file
+from common.tracing import record_stage, scan_trace
 
 db_manager = DBManager()
 
 
-def generate_brain_scan(rows=10, cols=10, lesion_prob=0.2) -> str:
+def generate_brain_scan(rows=10, cols=10, lesion_prob=0.2) -> bytes:
+    """
+    Generates a random 2D brain scan in the packed "FRSC" format: a header (magic, version, bits per cell, depth,
+    rows, cols) followed by the cells, 2 bits each (see common/scan_codec.py)
+    :param rows: rows of the scan
+    :param cols: columns of the scan
+    :param lesion_prob: probability of a cell being occupied, occupied cells being clear or lesion with equal
+        probability (ScanCell), the others empty
+    :return: packed scan, 16 header bytes and rows * cols / 4 bytes of cells (rounded up)
     """
-    Generates random brain scan of10*10 grid where each cell having probability of 20% lesion i.e. 'o'
-    :param rows:
-    :param cols:
-    :param lesion_prob:
+    rng = np.random.default_rng()
+    # occupied cells are either clear or lesion with equal probability
+    occupied = rng.random((rows, cols)) < lesion_prob
+    cells = np.where(occupied, rng.integers(ScanCell.clear, ScanCell.lesion + 1, size=(rows, cols)), ScanCell.empty)
+    return encode_scan(cells)
+
+
+def brain_scan_fields(scan_data: tuple) -> dict:
+    """
+    Fields of the BrainScan document of a received scan, scans too large for a document are put in chunk storage
+    :param scan_data: (patient_id, scan_id, scan_datetime, scan_type, scan data), the scan data being a packed or text
+        scan, or the ScanFile of a scan already in chunk storage (streamed scans), optionally followed by its Trace
     :return:
     """
-    scan = ""
-    for _ in range(rows):
-        row = "".join(
-            rn.choice(["| |", "|o|"]) if rn.random() < lesion_prob else " "
-            for _ in range(cols)
-        )
-        scan += row + "\n"
-    return scan
+    patient_id, scan_id, scan_datetime, scan_type, data = scan_data[:5]
+    fields = {"patient_id": patient_id, "scan_id": scan_id, "scan_datetime": scan_datetime, "scan_type": scan_type}
+    trace = scan_trace(scan_data)
+    if trace:
+        fields.update(trace_id=trace.trace_id, stage_times=trace.stage_times)
+    if not isinstance(data, ScanFile):
+        data = to_packed_scan(data)
+        if len(data) > BRAIN_SCAN_INLINE_MAX_SIZE:
+            data = store_scan_file(patient_id, scan_id, data)
+    if isinstance(data, ScanFile):
+        fields.update(scan_file_id=data.file_id, scan_size=data.size)
+    else:
+        fields["scan_data"] = data
+    return fields
 
 
-def save_brain_scan(scan_data: tuple) -> bool:
-    """Saves brain scan in DB"""
-    try:
-        brain_scan = BrainScan(
-            patient_id=scan_data[0],
-            scan_id=scan_data[1],
-            scan_datetime=scan_data[2],
-            scan_type=scan_data[3],
-            scan_data=scan_data[4],
-        )
-        db_manager.insert(NeuroDataCollections.brain_scans, brain_scan.to_bson())
-        return True
-    except Exception as e:
-        logger.error(f"Failed to save brain scan: {e}")
-        return False
+def build_brain_scan(scan_data: tuple) -> BrainScan:
+    """BrainScan of a received scan, see brain_scan_fields"""
+    return BrainScan(**brain_scan_fields(scan_data))
+
+
+def brain_scan_document(scan_data: tuple) -> dict:
+    """Same as build_brain_scan(scan_data).to_bson(), without building the model for scans that are valid already"""
+    return BrainScan.fields_to_bson(brain_scan_fields(scan_data))
+
+
+def save_brain_scan(scan_data: tuple) -> Union[bool, AckStatus]:
+    """Saves brain scan in DB, unless it's stored already (see save_brain_scans)"""
+    return save_brain_scans([scan_data], durable=False)[0]
+
+
+def record_persisted(documents: List[dict]) -> None:
+    """
+    Times the traced scans reaching brain_scans now that their insert returned, with one more write per batch: stamped
+    before the insert, hub_persisted would credit the insert's latency to the next hop
+    :param documents: documents of the scans inserted, with their _id
+    """
+    traced = [document for document in documents if "stage_times" in document]
+    if not traced:
+        return
+    record_stage(traced, TraceStage.hub_persisted)
+    db_manager.update_many(
+        NeuroDataCollections.brain_scans,
+        {"_id": {"$in": [document["_id"] for document in traced]}},
+        {f"stage_times.{TraceStage.hub_persisted}": traced[0]["stage_times"][TraceStage.hub_persisted]},
+    )
+
+
+def save_brain_scans(scans: List[tuple], durable: bool = True) -> List[Union[bool, AckStatus]]:
+    """
+    Saves several brain scans in DB with a single insert. (patient_id, scan_id) is the idempotency key of a scan, a
+    scan sent again (e.g. after its ack was lost) isn't stored twice
+    :param scans: tuples in the same format as for save_brain_scan
+    :param durable: only return once the scans are in MongoDB's journal
+    :return: for every scan True if it was saved, AckStatus.duplicate (truthy as well) if it was stored already, False
+        if saving it failed
+    """
+    results = [False] * len(scans)
+    documents = []
+    positions = []
+    for position, scan_data in enumerate(scans):
+        try:
+            documents.append(brain_scan_document(scan_data))
+            positions.append(position)
+        except Exception as e:
+            # one invalid scan shouldn't fail the whole batch
+            logger.error(f"Failed to save brain scan: {e}")
+    duplicates = None
+    if documents:
+        duplicates = db_manager.insert_new(NeuroDataCollections.brain_scans, documents, durable=durable)
+    if duplicates is None:
+        not_stored = documents
+    else:
+        for position in positions:
+            results[position] = True
+        for duplicate in duplicates:
+            results[positions[duplicate]] = AckStatus.duplicate
+        not_stored = [documents[duplicate] for duplicate in duplicates]
+        skipped = set(duplicates)
+        record_persisted([document for position, document in enumerate(documents) if position not in skipped])
+        if duplicates:
+            log_event("scan_duplicate", "Didn't store %d brain scans again", len(duplicates))
+    # chunks of scans that won't be stored would never be read
+    for document in not_stored:
+        if "scan_file_id" in document:
+            delete_scan_file(document["scan_file_id"])
+    return results
+
+
+def analyze_scan(scan_data: Union[str, bytes], connectivity: Optional[int] = None) -> str:
+    """
+    Analyzes the brain scan to find lesions
+    :param scan_data:
+    :param connectivity: lesions are groups of connected lesion cells, 4 or 8 for 2D scans and 6 or 26 for 3D scans
+    :return: report text
+    """
+    analysis = analyze_scans([scan_data], connectivity=connectivity)[0]
+    if analysis is None:
+        raise ScanFormatError("Invalid brain scan")
+    return format_report(analysis)
 
 
-def analyze_scan(scan_data: str) -> str:
-    """Analyzes the brain scan to find lesions."""
-    lesion_count = scan_data.count("o")
-    return f"The analysed scan showed {lesion_count} brain lesions."
+def analyze_brain_scans(scans: List[dict]) -> List[Optional[dict]]:
+    """
+    Analyzes brain scan documents: scans stored inline are analyzed together in one batch, scans in chunk storage
+    are analyzed one by one while their chunks are read
+    :param scans: documents with scan_data or scan_file_id
+    :return: analysis of every scan, None for the ones that aren't valid scans (see analyze_scans)
+    """
+    analyses: List[Optional[dict]] = [None] * len(scans)
+    inline = [position for position, scan in enumerate(scans) if scan.get("scan_file_id") is None]
+    for position, analysis in zip(inline, analyze_scans([scans[position].get("scan_data") for position in inline])):
+        analyses[position] = analysis
+    for position, scan in enumerate(scans):
+        if scan.get("scan_file_id") is None:
+            continue
+        try:
+            analyses[position] = analyze_scan_chunks(iter_scan_chunks(scan["scan_file_id"]))
+        except ScanFormatError as e:
+            logger.error(f"Invalid brain scan in chunk storage {scan['scan_file_id']}: {e}")
+    return analyses
 
 
 def save_brain_report(report_data: dict) -> bool:
     """saves brain report into DB"""
     try:
         # we need to keep metadata as well as "sent" (default False) which will tell FrHUB taht this report is not being sent to FrPACS
-        brain_report = BrainReport(
+        brain_report = BrainReport.bson(
             patient_id=report_data["patient_id"],
             scan_id=report_data["scan_id"],
             report_datetime=datetime.now(),
             report_data=report_data["report_data"],
             sent=False,
         )
-        db_manager.insert(NeuroDataCollections.brain_reports, brain_report.to_bson())
+        db_manager.insert(NeuroDataCollections.brain_reports, brain_report)
         return True
     except Exception as e:
         logger.error(f"Failed to save brain report: {e}")
         return False
 
 
-def fetch_brain_report() -> dict | None:
-    """Fetch brain report as well as update its staus as Sent to avoid duplicate sending"""
-    report = db_manager.fetch_one_and_update(
+def save_brain_reports(reports: List[dict]) -> bool:
+    """
+    Saves several brain reports in DB with a single insert. (patient_id, scan_id) is the idempotency key of a report:
+    a FrBRAIN whose lease on a scan expired may still save its report, the report of the scan's new owner isn't saved
+    again, so FrPACS gets a single report per scan
+    :param reports: dicts with patient_id, scan_id, report_data and optionally the analysis details and the trace of
+        BrainReport
+    :return: whether all of them were saved, or stored already
+    """
+    try:
+        documents = [
+            BrainReport.fields_to_bson({**report, "report_datetime": datetime.now(), "sent": False}) for report in reports
+        ]
+    except Exception as e:
+        logger.error(f"Failed to save brain reports: {e}")
+        return False
+    record_stage(documents, TraceStage.report_saved)
+    if not documents:
+        return False
+    duplicates = db_manager.insert_new(NeuroDataCollections.brain_reports, documents)
+    if duplicates:
+        log_event("report_duplicate", "Didn't store %d brain reports again", len(duplicates))
+    return duplicates is not None
+
+
+def claim_brain_scans(owner: str, limit: int, lease_s: float = BRAIN_SCAN_LEASE_S) -> Tuple[Optional[str], List[dict]]:
+    """
+    Atomically moves up to `limit` scans from 'To Do' to 'In Process' under a lease, so no other FrBRAIN processes them
+    :param owner: FrBRAIN instance claiming the scans
+    :param limit:
+    :param lease_s: how long the scans stay claimed before the reaper hands them out again
+    :return: lease token (needed to update the claimed scans) and the scans
+    """
+    lease_token, scans = db_manager.claim_many(
+        NeuroDataCollections.brain_scans,
+        {"report_generated": ReportStatus.to_do},
+        {
+            "report_generated": ReportStatus.in_process,
+            "lease_owner": owner,
+            "lease_expires_at": datetime.now() + timedelta(seconds=lease_s),
+        },
+        limit,
+        token_field="lease_token",
+        projection={
+            "patient_id": 1, "scan_id": 1, "scan_data": 1, "scan_file_id": 1, "lease_token": 1, "trace_id": 1,
+            "stage_times": 1,
+        },
+        # oldest first, served by the scans_to_do index
+        sort=[("_id", ASCENDING)],
+    )
+    # only the sampled scans are timed, with one more write per claim
+    traced = [scan for scan in scans if scan.get("trace_id")]
+    if traced:
+        record_stage(traced, TraceStage.brain_claimed)
+        db_manager.update_many(
+            NeuroDataCollections.brain_scans,
+            {"_id": {"$in": [scan["_id"] for scan in traced]}},
+            {f"stage_times.{TraceStage.brain_claimed}": traced[0]["stage_times"][TraceStage.brain_claimed]},
+        )
+    return lease_token, scans
+
+
+def release_expired_scan_leases() -> Optional[int]:
+    """Puts scans left 'In Process' past their lease (e.g. by a crashed FrBRAIN) back to 'To Do'"""
+    released = db_manager.update_many(
+        NeuroDataCollections.brain_scans,
+        {"report_generated": ReportStatus.in_process, "lease_expires_at": {"$lt": datetime.now()}},
+        {"report_generated": ReportStatus.to_do, "lease_owner": None, "lease_token": None, "lease_expires_at": None},
+    )
+    if released:
+        logger.warning(f"Released {released} brain scans with an expired lease")
+    return released
+
+
+def fetch_brain_reports(limit: int) -> Tuple[Optional[str], List[dict]]:
+    """
+    Claims up to `limit` unsent brain reports so that no other FrHUB sends them as well
+    :param limit:
+    :return: claim token (needed to mark them as sent) and the reports
+    """
+    now = datetime.now()
+    claim_token, reports = db_manager.claim_many(
+        NeuroDataCollections.brain_reports,
+        {
+            "sent": False,
+            # claims of a FrHUB that crashed before marking its reports sent expire
+            "$or": [
+                {"claim_token": None},
+                {"claimed_at": {"$lt": now - timedelta(seconds=BRAIN_REPORT_CLAIM_TIMEOUT_S)}},
+            ],
+        },
+        {"claimed_at": now},
+        limit,
+        projection={"_id": 0, "patient_id": 1, "scan_id": 1, "report_datetime": 1, "report_data": 1, "trace_id": 1},
+    )
+    return claim_token, reports
+
+
+def mark_brain_reports_sent(claim_token: str, stage_times: Optional[Dict[str, float]] = None) -> Optional[int]:
+    """
+    Marks all reports of a claim as sent with a single write, to avoid duplicate sending
+    :param claim_token:
+    :param stage_times: when the reports were sent and acked by FrPACS, recorded on their traces
+    :return:
+    """
+    return db_manager.update_many(
         NeuroDataCollections.brain_reports,
-        {"sent": False},
-        {"sent": True},
+        {"claim_token": claim_token},
+        {"sent": True, **{f"stage_times.{stage}": at for stage, at in (stage_times or {}).items()}},
     )
-    if report:
-        report_data = {
-            "patient_id": report["patient_id"],
-            "scan_id": report["scan_id"],
-            "report_datetime": report["report_datetime"],
-            "report_data": report["report_data"],
-        }
-        return report_data
-    return None
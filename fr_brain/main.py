@@ -1,10 +1,51 @@
+import argparse
+import sys
 import threading
 
-from common.logger import logger
+from common.config import (
+    BRAIN_PROCESSOR_CHUNKSIZE,
+    BRAIN_PROCESSOR_MAX_TASKS_PER_CHILD,
+    BRAIN_PROCESSOR_WORKERS,
+    FR_BRAIN_METRICS_PORT,
+)
+from common.db_manager import IDEMPOTENCY_INDEXES, DBManager
+from common.logger import add_logging_arguments, configure_logging, logger, parse_sample_rates
+from common.metrics import start_metrics_server
 from fr_brain.processor import FrBRAINScanProcessor
 
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Runs FrBRAIN")
+    parser.add_argument("--workers", type=int, default=BRAIN_PROCESSOR_WORKERS, help="worker processes (default: CPUs)")
+    parser.add_argument(
+        "--chunksize", type=int, default=BRAIN_PROCESSOR_CHUNKSIZE, help="batches of scans handed to a worker at once"
+    )
+    parser.add_argument(
+        "--max-tasks-per-child",
+        type=int,
+        default=BRAIN_PROCESSOR_MAX_TASKS_PER_CHILD,
+        help="tasks (chunksize batches of scans each) processed by a worker before it is replaced",
+    )
+    parser.add_argument("--metrics-port", type=int, default=FR_BRAIN_METRICS_PORT, help="port of the /metrics endpoint")
+    add_logging_arguments(parser)
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    brain_scan_processor_instance = FrBRAINScanProcessor()
+    args = parse_args()
+    # workers forked off the processor restart the background log writer (see BackgroundHandler)
+    configure_logging("fr_brain", args.log_level, args.log_format, parse_sample_rates(args.log_sample))
+    # before the worker pool is forked, so workers record metrics too (see Registry.drain)
+    start_metrics_server(args.metrics_port)
+    # so claiming scans and reaping leases don't scan the whole collection
+    missing_indexes = set(DBManager().ensure_indexes()) & set(IDEMPOTENCY_INDEXES)
+    if missing_indexes:
+        # scans or reports sent again would be stored twice, see "Idempotent ingest" in README.md
+        logger.error(f"Not starting FrBRAIN without the unique indexes {sorted(missing_indexes)}")
+        sys.exit(1)
+    brain_scan_processor_instance = FrBRAINScanProcessor(
+        workers=args.workers, chunksize=args.chunksize, max_tasks_per_child=args.max_tasks_per_child
+    )
     processor_thread = threading.Thread(target=brain_scan_processor_instance.process_brain_scans)
     processor_thread.start()
     try:
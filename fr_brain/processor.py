@@ -1,10 +1,42 @@
 import multiprocessing
+import multiprocessing.pool
+import os
+import queue
+import socket
+import threading
 import time
+import uuid
+from typing import Callable, Iterator, List, Optional, Tuple
 
-from common.config import NeuroDataCollections, ReportStatus
+from common import metrics
+from common.analysis import format_report
+from common.config import (
+    BRAIN_PROCESSOR_BATCH_SIZE,
+    BRAIN_PROCESSOR_CHUNKSIZE,
+    BRAIN_PROCESSOR_MAX_PENDING,
+    BRAIN_PROCESSOR_MAX_TASKS_PER_CHILD,
+    BRAIN_PROCESSOR_WORKERS,
+    BRAIN_REPORT_NOTIFY_PORT,
+    BRAIN_SCAN_CLAIM_BATCH_SIZE,
+    BRAIN_SCAN_LEASE_REAP_INTERVAL_S,
+    BRAIN_SCAN_NOTIFY_PORT,
+    NeuroDataCollections,
+    ReportStatus,
+    TraceStage,
+)
 from common.db_manager import DBManager
-from common.logger import logger
-from common.utils import analyze_scan, save_brain_report
+from common.logger import log_event, logger
+from common.notifier import AdaptiveBackoff, WorkNotifier, notify_work
+from common.utils import analyze_brain_scans, claim_brain_scans, release_expired_scan_leases, save_brain_reports
+
+SCANS_CLAIMED = metrics.counter("fr_brain_scans_claimed_total", "Brain scans claimed from DB")
+SCANS_PROCESSED = metrics.counter("fr_brain_scans_processed_total", "Brain scans processed", ("result",))
+SCAN_ANALYZE_SECONDS = metrics.histogram(
+    "fr_brain_scan_analyze_seconds", "Analysis time per brain scan, scans analyzed together share the batch's time"
+)
+PENDING_SCANS = metrics.gauge("fr_brain_pending_scans", "Brain scans claimed but not processed yet")
+BUSY_BATCHES = metrics.gauge("fr_brain_busy_batches", "Batches of brain scans dispatched to the worker pool and not done yet")
+POOL_WORKERS = metrics.gauge("fr_brain_pool_workers", "Processes of the worker pool")
 
 
 class FrBRAINScanProcessor:
@@ -16,68 +48,190 @@ class FrBRAINScanProcessor:
             So, we're keeping flag in brain_scan collection so we'll fetch only those brain scans i.e. "report_generated" as "To Do"
              ('To Do' means report yet to be processed), make it 'In Progress' when processing is beign done and make it 'Done' when it's done
         - Above will also cover the requirement, even if multiple instances of BrainProcessor runs, we'll only generate report for each scan only Once via above key
+            Scans are claimed atomically and in bulk ('To Do' -> 'In Process' in one write, see claim_brain_scans) under a
+            lease with this processor as owner. Scans whose lease expired, because the FrBRAIN processing them crashed,
+            are put back to 'To Do' by a periodic reaper.
+        - When there are no scans it waits for FrHUB to announce new ones (see WorkNotifier) instead of sleeping,
+            polling with a growing interval only as a fallback
+        - Scans are processed by one worker pool living as long as the processor. Claimed scans are streamed to it through a
+            bounded queue (at most `max_pending` scans dispatched but not yet processed) and results come back in
+            completion order, so a slow scan doesn't hold back the others. Workers are replaced after
+            `max_tasks_per_child` tasks to cap their memory growth.
+        - Every task is a batch of up to `batch_size` scans, analyzed with one vectorized call (see common/analysis.py)
+            and saved with one insert, so pickling/IPC and DB round trips are paid per batch instead of per scan.
+        - Scans too large for a document are read from chunk storage chunk by chunk, and analyzed slice by slice as the
+            chunks come in, so a worker never holds a whole large scan in memory.
     """
 
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        workers: Optional[int] = BRAIN_PROCESSOR_WORKERS,
+        chunksize: int = BRAIN_PROCESSOR_CHUNKSIZE,
+        max_tasks_per_child: Optional[int] = BRAIN_PROCESSOR_MAX_TASKS_PER_CHILD,
+        max_pending: int = BRAIN_PROCESSOR_MAX_PENDING,
+        claim_batch_size: int = BRAIN_SCAN_CLAIM_BATCH_SIZE,
+        batch_size: int = BRAIN_PROCESSOR_BATCH_SIZE,
+        pool_factory: Optional[Callable[..., multiprocessing.pool.Pool]] = None,
+    ) -> None:
         self.running = True
+        self.workers = workers or multiprocessing.cpu_count()
+        self.chunksize = chunksize
+        self.max_tasks_per_child = max_tasks_per_child
+        self.max_pending = max_pending
+        self.claim_batch_size = claim_batch_size
+        self.batch_size = batch_size
+        # builds the worker pool from (processes, maxtasksperchild), multiprocessing.Pool when None.
+        # Benchmarks on an in-memory DB stand-in use a thread pool, worker processes wouldn't see its data
+        self.pool_factory = pool_factory
+        # lease owner written on claimed scans, unique per running processor
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        # one slot per scan claimed but not processed yet
+        self.pending_slots = threading.Semaphore(max_pending)
+        # batches of claimed scans waiting for a worker
+        self.scans: queue.Queue = queue.Queue(maxsize=max_pending)
 
-    def fetch_and_process_scan(self, scan_id):
-        """Processes single brain scan and generate report"""
+    @staticmethod
+    def process_scan_batch(scans: List[dict]) -> Tuple[int, dict]:
+        """
+        Analyzes a batch of claimed brain scans in one vectorized call and saves their reports with one insert
+        :param scans: claimed scans, see claim_brain_scans
+        :return: number of scans handled, so their slots can be freed, and the metrics recorded by the worker meanwhile
+            (see Registry.drain)
+        """
         db_manager = DBManager()
+        scan_ids = [scan["_id"] for scan in scans]
+        # only touching the scans while they're still under our lease
+        leased_scans = {"_id": {"$in": scan_ids}, "lease_token": {"$in": list({scan["lease_token"] for scan in scans})}}
         try:
-            # we're udpating a scan to 'In Process' so that other processes knows that this scan in being processed not pick this scan
-            scan = db_manager.fetch_one_and_update(
-                NeuroDataCollections.brain_scans,
-                {"_id": scan_id},
-                {"report_generated": ReportStatus.in_process}
-            )
-            if scan:
-                logger.info(f"Processing scan: {scan_id}")
-                # analyzing the scan data to find lesions
-                scan["report_data"] = analyze_scan(scan["scan_data"])
-                # saving the report to the DB
-                save_report_response = save_brain_report(scan)
-                if save_report_response:
-                    logger.info(
-                        f"Generated and saved report, for scan ID {scan_id}"
-                    )
-                    # after successful process, have to update the status of this scan as 'Done' in DB
-                    db_manager.update(
-                        NeuroDataCollections.brain_scans,
-                        {"_id": scan_id},
-                        {"report_generated": ReportStatus.done}
-                    )
-                    logger.info(f"Finished processing scan: {scan_id}")
+            log_event("scan_batch_processed", "Processing scans: %s", scan_ids)
+            # analyzing the scan data of the whole batch to find lesions, large scans are read chunk by chunk
+            started = time.perf_counter()
+            analyses = analyze_brain_scans(scans)
+            analyzed_at = time.time()
+            analyze_seconds = (time.perf_counter() - started) / len(scans)
+            for _ in scans:
+                SCAN_ANALYZE_SECONDS.observe(analyze_seconds)
+            reports = [
+                {
+                    "patient_id": scan["patient_id"],
+                    "scan_id": scan["scan_id"],
+                    "report_data": format_report(analysis),
+                    **analysis,
+                    # the report carries on the trace of its scan
+                    "trace_id": scan.get("trace_id"),
+                    "stage_times": {**scan.get("stage_times", {}), TraceStage.analyzed: analyzed_at},
+                }
+                for scan, analysis in zip(scans, analyses)
+                if analysis is not None
+            ]
+            invalid_ids = [scan["_id"] for scan, analysis in zip(scans, analyses) if analysis is None]
+            if invalid_ids:
+                SCANS_PROCESSED.labels("invalid").inc(len(invalid_ids))
+                logger.error(f"Error processing these scans, they aren't valid brain scans: {invalid_ids}")
+                db_manager.update_many(
+                    NeuroDataCollections.brain_scans,
+                    {**leased_scans, "_id": {"$in": invalid_ids}},
+                    {"report_generated": ReportStatus.error}
+                )
+            # saving the reports to the DB, if that fails the scans are retried once their lease expires
+            if reports and save_brain_reports(reports):
+                log_event("scan_batch_processed", "Generated and saved %d reports", len(reports))
+                # waking up FrHUB's report client so the reports are sent right away
+                notify_work(BRAIN_REPORT_NOTIFY_PORT)
+                # after successful process, have to update the status of these scans as 'Done' in DB
+                done_ids = [scan_id for scan_id in scan_ids if scan_id not in invalid_ids]
+                SCANS_PROCESSED.labels("done").inc(len(done_ids))
+                db_manager.update_many(
+                    NeuroDataCollections.brain_scans,
+                    {**leased_scans, "_id": {"$in": done_ids}},
+                    {"report_generated": ReportStatus.done}
+                )
+                log_event("scan_batch_processed", "Finished processing scans: %s", done_ids)
         except Exception as e:
-            # changing report status to 'Error' in case an exception occurs while processing this scan
-            logger.error(f"Error processing this scan {scan_id}: {e}")
-            db_manager.update(
+            # changing report status to 'Error' in case an exception occurs while processing these scans
+            logger.error(f"Error processing these scans {scan_ids}: {e}")
+            SCANS_PROCESSED.labels("error").inc(len(scans))
+            db_manager.update_many(
                 NeuroDataCollections.brain_scans,
-                {"_id": scan_id},
+                leased_scans,
                 {"report_generated": ReportStatus.error}
             )
+        return len(scans), metrics.REGISTRY.drain()
 
     def process_brain_scans(self) -> None:
         """Processes all available brain scans"""
+        # new scans, and scans whose expired lease was released (see release_expired_scan_leases)
+        notifier = WorkNotifier(
+            NeuroDataCollections.brain_scans,
+            BRAIN_SCAN_NOTIFY_PORT,
+            updated_fields={"report_generated": ReportStatus.to_do},
+        )
+        backoff = AdaptiveBackoff()
+        next_reap = time.monotonic()
         try:
-            while self.running:
-                # to avoid issues of pickling
-                db_manager = DBManager()
-                # fetching only those scans, whose reports are not yet generated
-                all_scans = db_manager.fetch_all(
-                    NeuroDataCollections.brain_scans,
-                    {"report_generated": ReportStatus.to_do}
-                )
-                if all_scans:
-                    # processing scans in multiprocessing environment
-                    with multiprocessing.Pool(processes=multiprocessing.cpu_count()) as pool:
-                        pool.map(self.fetch_and_process_scan, [scan["_id"] for scan in all_scans])
-                else:
-                    logger.info("No pending scans to process. Waiting for scan...")
-                    # sleep for 5 seconds before checking again as there is no scan
-                    time.sleep(5)
+            pool_factory = self.pool_factory or multiprocessing.Pool
+            POOL_WORKERS.set(self.workers)
+            with pool_factory(processes=self.workers, maxtasksperchild=self.max_tasks_per_child) as pool:
+                # the pool's task handler thread pulls scans from the queue until the None sentinel
+                results = pool.imap_unordered(self.process_scan_batch, iter(self.scans.get, None), self.chunksize)
+                collector = threading.Thread(target=self.collect_results, args=(results,), daemon=True)
+                collector.start()
+                try:
+                    while self.running:
+                        if time.monotonic() >= next_reap:
+                            release_expired_scan_leases()
+                            next_reap = time.monotonic() + BRAIN_SCAN_LEASE_REAP_INTERVAL_S
+                        slots = self.acquire_slots(self.claim_batch_size)
+                        if not slots:
+                            break
+                        # claiming only as many scans as can be processed right away, so leases don't run out in the queue
+                        _, scans = claim_brain_scans(self.owner, slots)
+                        for _ in range(slots - len(scans)):
+                            self.pending_slots.release()
+                        if scans:
+                            backoff.reset()
+                            log_event("scans_claimed", "Claimed %d brain scans", len(scans))
+                            SCANS_CLAIMED.inc(len(scans))
+                            PENDING_SCANS.inc(len(scans))
+                            for start in range(0, len(scans), self.batch_size):
+                                BUSY_BATCHES.inc()
+                                self.scans.put(scans[start:start + self.batch_size])
+                        else:
+                            logger.info("No pending scans to process. Waiting for scan...")
+                            # waking up as soon as FrHUB stores a scan, otherwise checking again after the backoff delay
+                            notifier.wait(backoff.next_delay())
+                finally:
+                    # letting the workers finish the claimed scans before the pool is torn down
+                    self.scans.put(None)
+                    pool.close()
+                    collector.join()
         except Exception as e:
             logger.error(f"Exception in processing brain scans: {e}")
+        finally:
+            notifier.stop()
+
+    def acquire_slots(self, limit: int) -> int:
+        """
+        Waits for at least one free slot, then takes as many more as are free
+        :param limit: max slots to take
+        :return: number of slots taken, 0 if the processor was stopped meanwhile
+        """
+        while not self.pending_slots.acquire(timeout=1):
+            if not self.running:
+                return 0
+        slots = 1
+        while slots < limit and self.pending_slots.acquire(blocking=False):
+            slots += 1
+        return slots
+
+    def collect_results(self, results: Iterator) -> None:
+        """Frees the slots of every processed batch, in the order they finish, and merges the metrics of the workers."""
+        for processed, worker_metrics in results:
+            metrics.REGISTRY.merge(worker_metrics)
+            BUSY_BATCHES.dec()
+            PENDING_SCANS.dec(processed)
+            for _ in range(processed):
+                self.pending_slots.release()
 
     def stop(self) -> None:
         """Stops the processing of brain scans."""
@@ -1,7 +1,14 @@
+import multiprocessing
+import os
+import tempfile
 import threading
+import time
 import unittest
 from unittest.mock import patch
 
+from common.config import NeuroDataCollections, ReportStatus
+from common.storage.sqlite import SQLiteBackend
+from common.utils import generate_brain_scan, release_expired_scan_leases
 from fr_brain.processor import FrBRAINScanProcessor
 
 
@@ -32,6 +39,102 @@ class TestFrBRAINScanProcessor(unittest.TestCase):
         # Ensure the thread has stopped
         self.assertFalse(processor_thread.is_alive())
 
+    @patch("fr_brain.processor.WorkNotifier")
+    @patch("fr_brain.processor.save_brain_reports", return_value=False)
+    @patch("fr_brain.processor.release_expired_scan_leases")
+    @patch("fr_brain.processor.claim_brain_scans")
+    def test_process_brain_scans_reuses_worker_pool(self, mock_claim, mock_reap, mock_save, mock_notifier):
+        """Test claimed scans of every round are streamed to the same pool, never claiming more than it can take"""
+        processor = FrBRAINScanProcessor(workers=2, max_pending=8)
+        to_do = [{"_id": i, "patient_id": 1, "scan_id": i, "lease_token": "lease", "scan_data": "|o|"} for i in range(20)]
+
+        def claim(owner, limit):
+            claimed = to_do[:limit]
+            del to_do[:limit]
+            return "lease", claimed
+
+        mock_claim.side_effect = claim
+        mock_notifier.return_value.wait.side_effect = lambda _: time.sleep(0.05)
+
+        with patch("fr_brain.processor.multiprocessing.Pool", wraps=multiprocessing.Pool) as mock_pool:
+            processor_thread = threading.Thread(target=processor.process_brain_scans)
+            processor_thread.start()
+            time.sleep(0.5)
+            processor.stop()
+            processor_thread.join(timeout=10)
+
+        self.assertFalse(processor_thread.is_alive())
+        mock_pool.assert_called_once_with(processes=2, maxtasksperchild=processor.max_tasks_per_child)
+        # never claiming more scans than there are free slots
+        mock_claim.assert_any_call(processor.owner, 8)
+        mock_reap.assert_called()
+        self.assertEqual(to_do, [])
+        # all claimed scans came back from the workers and freed their slot
+        self.assertEqual(processor.acquire_slots(10), 8)
+
+    @patch("fr_brain.processor.notify_work")
+    @patch("fr_brain.processor.DBManager.update_many")
+    @patch("fr_brain.processor.save_brain_reports", return_value=True)
+    def test_process_scan_batch(self, mock_save_reports, mock_update_many, mock_notify):
+        """Test a batch is analyzed and reported together, invalid scans are marked as errors"""
+        scans = [
+            {"_id": 1, "patient_id": 1, "scan_id": 11, "lease_token": "lease", "scan_data": "|o||o|\n| |  \n"},
+            {"_id": 2, "patient_id": 2, "scan_id": 12, "lease_token": "lease", "scan_data": b"not a scan"},
+            {"_id": 3, "patient_id": 3, "scan_id": 13, "lease_token": "lease", "scan_data": generate_brain_scan(4, 4, 0)},
+        ]
+        self.assertEqual(FrBRAINScanProcessor.process_scan_batch(scans), (3, {}))
+
+        reports = mock_save_reports.call_args.args[0]
+        self.assertEqual([report["scan_id"] for report in reports], [11, 13])
+        # the two lesion cells are connected, so they're one lesion
+        self.assertEqual(reports[0]["report_data"], "The analysed scan showed 1 brain lesions.")
+        self.assertEqual(reports[0]["lesion_sizes"], [2])
+        self.assertEqual(reports[1]["lesion_cells"], 0)
+        updates = {
+            update.args[2]["report_generated"]: update.args[1]["_id"]["$in"] for update in mock_update_many.call_args_list
+        }
+        self.assertEqual(updates, {ReportStatus.error: [2], ReportStatus.done: [1, 3]})
+        mock_notify.assert_called_once()
+
+    @patch("fr_brain.processor.notify_work")
+    @patch("fr_brain.processor.DBManager.update_many")
+    def test_report_of_expired_lease_is_saved_once(self, mock_update_many, mock_notify):
+        """Test a scan processed by a FrBRAIN whose lease expired and by its new owner gets a single report"""
+        with tempfile.TemporaryDirectory() as directory:
+            backend = SQLiteBackend(os.path.join(directory, "neuro_data.db"))
+            try:
+                with patch("common.utils.db_manager.insert_new", side_effect=backend.insert_new):
+                    for lease_token in ("expired", "new"):
+                        scan = {"_id": 1, "patient_id": 1, "scan_id": 11, "lease_token": lease_token, "scan_data": "|o|"}
+                        FrBRAINScanProcessor.process_scan_batch([scan])
+                reports = list(backend.find(NeuroDataCollections.brain_reports, {}))
+            finally:
+                backend.close()
+
+        self.assertEqual([(report["patient_id"], report["scan_id"]) for report in reports], [(1, 11)])
+        # the new owner still marks the scan as done
+        self.assertEqual(mock_update_many.call_count, 2)
+
+    def test_acquire_slots_is_bounded(self):
+        """Test claiming is limited to the free slots, and waiting for one gives up when stopped"""
+        processor = FrBRAINScanProcessor(workers=1, max_pending=3)
+        self.assertEqual(processor.acquire_slots(2), 2)
+        self.assertEqual(processor.acquire_slots(5), 1)
+
+        threading.Timer(0.2, processor.stop).start()
+        self.assertEqual(processor.acquire_slots(1), 0)
+
+    @patch("common.utils.db_manager.update_many", return_value=2)
+    def test_release_expired_scan_leases(self, mock_update_many):
+        """Test only 'In Process' scans with an expired lease go back to 'To Do'"""
+        self.assertEqual(release_expired_scan_leases(), 2)
+
+        _, query, update = mock_update_many.call_args.args
+        self.assertEqual(query["report_generated"], ReportStatus.in_process)
+        self.assertIn("$lt", query["lease_expires_at"])
+        self.assertEqual(update["report_generated"], ReportStatus.to_do)
+        self.assertIsNone(update["lease_token"])
+
     # TODO: methods
     def fetch_and_process_scan(self, mock_stop):
         pass
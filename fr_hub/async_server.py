@@ -0,0 +1,236 @@
+import asyncio
+import threading
+import time
+from typing import Optional
+
+from common.config import (
+    BRAIN_SCAN_BACKLOG,
+    BRAIN_SCAN_HOST,
+    BRAIN_SCAN_MAX_CONNECTIONS,
+    BRAIN_SCAN_MAX_IN_FLIGHT,
+    BRAIN_SCAN_PORT,
+    BRAIN_SCAN_WAL_DIR,
+    AckStatus,
+    MessageType,
+    TraceStage,
+)
+from common.logger import log_event, logger
+from common.protocol import ProtocolError, decode_brain_scan, encode_ack, read_frame, write_frame
+from common.tracing import traced
+from fr_hub.dedup import RecentScanKeys, discard_duplicate, scan_key
+from fr_hub.flow_control import FlowController
+from fr_hub.group_commit import BrainScanGroupCommitter
+from fr_hub.scan_stream import BrainScanStreams
+from fr_hub.wal import WriteAheadLog
+from fr_hub.server import (
+    ACTIVE_CONNECTIONS,
+    CONNECTIONS_ACCEPTED,
+    CONNECTIONS_REJECTED,
+    SCAN_ACKS,
+    SCAN_FAILED_ACK,
+    busy_ack,
+    record_ack,
+    scan_ack,
+)
+
+
+class FrHUBAsyncBrainScanServer:
+    """Handles incoming brain scans from FrPACS on a single asyncio event loop
+
+    Same behaviour as FrHUBBrainScanServer, but instead of one thread per connection every connection is a
+    coroutine, so thousands of FrPACS senders can be connected at once.
+        - MongoDB calls are blocking, so scans are handed to a BrainScanGroupCommitter and the loop keeps serving other connections
+        - Connections above `max_connections`, or while FrHUB is over its load budget, are told to retry later and
+          closed straight away instead of piling up (see FlowController)
+        - Up to `max_in_flight` scans per connection are stored concurrently and acked as each insert completes
+        - Chunks of streamed scans are written to chunk storage in the default executor, one at a time per connection
+        - Scans stored lately are acked as duplicates without a DB round trip (see RecentScanKeys)
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        backlog: int = BRAIN_SCAN_BACKLOG,
+        max_connections: int = BRAIN_SCAN_MAX_CONNECTIONS,
+        max_in_flight: int = BRAIN_SCAN_MAX_IN_FLIGHT,
+        committer: Optional[BrainScanGroupCommitter] = None,
+        flow_control: Optional[FlowController] = None,
+        recent_keys: Optional[RecentScanKeys] = None,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.max_connections = max_connections
+        self.max_in_flight = max_in_flight
+        self.committer = committer or BrainScanGroupCommitter()
+        self.flow_control = flow_control or FlowController(self.committer, max_credits=max_in_flight)
+        self.recent_keys = recent_keys or RecentScanKeys()
+        self.active_connections = 0
+        self.running_status = True
+        # set once the server is listening, so callers can wait for it before connecting
+        self.ready = threading.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stop_event: Optional[asyncio.Event] = None
+
+    async def store_brain_scan(
+        self, writer: asyncio.StreamWriter, in_flight: asyncio.Semaphore, seq: int, brain_scan: tuple
+    ) -> None:
+        """
+        Stores a single scan and sends its ack to FrPACS
+        :param writer:
+        :param in_flight: released so the connection can read the next scan
+        :param seq: sequence number of the scan
+        :param brain_scan:
+        :return:
+        """
+        received_at = time.perf_counter()
+        try:
+            # stored with the next batch by the committer threads while this loop serves other connections
+            save_scan_response = await asyncio.wrap_future(self.committer.submit(brain_scan))
+            status, ack = scan_ack(seq, save_scan_response, self.flow_control.credits())
+            if save_scan_response:
+                self.recent_keys.add(scan_key(brain_scan))
+            if status == AckStatus.stored:
+                log_event("scan_stored", "Brain Scan received and saved via FrHUB: %s", seq)
+            await write_frame(writer, MessageType.ack, ack)
+            record_ack(status, received_at)
+        except Exception as e:
+            logger.error(f"Exception in acknowledging brain scan {seq}: {e}")
+        finally:
+            in_flight.release()
+
+    async def acknowledge_duplicate(self, writer: asyncio.StreamWriter, seq: int, brain_scan: tuple) -> None:
+        """Acks a scan stored lately as a duplicate, without storing it"""
+        received_at = time.perf_counter()
+        await asyncio.get_running_loop().run_in_executor(None, discard_duplicate, brain_scan)
+        _, ack = scan_ack(seq, AckStatus.duplicate, self.flow_control.credits())
+        await write_frame(writer, MessageType.ack, ack)
+        record_ack(AckStatus.duplicate, received_at)
+        log_event("scan_duplicate", "Brain scan %s of patient %s stored already", brain_scan[1], brain_scan[0], seq=seq)
+
+    async def handle_brain_scan(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Handles incoming brain scans of one FrPACS connection, stores them and sends acknowledgement to FrPACS.
+        :param reader:
+        :param writer:
+        :return:
+        """
+        addr = writer.get_extra_info("peername")
+        retry_after = self.flow_control.admit(self.active_connections, self.max_connections)
+        if retry_after is not None:
+            logger.warning(
+                f"Rejecting connection from {addr}, {self.active_connections} connections open, "
+                f"load {self.flow_control.load():.2f}: retry after {retry_after} s"
+            )
+            CONNECTIONS_REJECTED.inc()
+            try:
+                await write_frame(writer, MessageType.ack, busy_ack(retry_after))
+            except OSError as e:
+                logger.warning(f"Couldn't tell {addr} to retry later: {e}")
+            finally:
+                writer.close()
+            return
+
+        self.active_connections += 1
+        CONNECTIONS_ACCEPTED.inc()
+        ACTIVE_CONNECTIONS.inc()
+        logger.info(f"Connection is accepted from {addr}")
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        pending = set()
+        loop = asyncio.get_running_loop()
+        streams = BrainScanStreams()
+        try:
+            while True:
+                frame = await read_frame(reader)
+                if frame is None:
+                    break
+                msg_type, payload = frame
+                if msg_type == MessageType.brain_scan:
+                    seq, brain_scan = decode_brain_scan(payload)
+                    log_event(
+                        "scan_received", "Received brain scan %s of patient %s, %d bytes",
+                        brain_scan[1], brain_scan[0], len(payload), seq=seq,
+                    )
+                elif msg_type in BrainScanStreams.MESSAGE_TYPES:
+                    # writing to chunk storage blocks, the next frame is only read once the chunk is written
+                    received = await loop.run_in_executor(None, streams.receive, msg_type, payload)
+                    if received is None:
+                        continue
+                    seq, brain_scan = received
+                    if brain_scan is None:
+                        await write_frame(
+                            writer, MessageType.ack,
+                            encode_ack(seq, AckStatus.error, SCAN_FAILED_ACK, self.flow_control.credits()),
+                        )
+                        SCAN_ACKS.labels(AckStatus.error).inc()
+                        continue
+                else:
+                    logger.warning(f"Ignoring unexpected message type from FrPACS: {msg_type}")
+                    continue
+
+                if self.recent_keys.seen(scan_key(brain_scan)):
+                    await self.acknowledge_duplicate(writer, seq, brain_scan)
+                    continue
+                # scans of older FrPACS start their trace here
+                brain_scan = traced(brain_scan, TraceStage.hub_received)
+                # not reading further while too many scans are being stored lets TCP flow control slow FrPACS down
+                await in_flight.acquire()
+                task = asyncio.create_task(self.store_brain_scan(writer, in_flight, seq, brain_scan))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        except (ConnectionError, ProtocolError) as e:
+            logger.error(f"Connection error in handling brain scan from {addr}: {e}")
+        except Exception as e:
+            logger.error(f"Exception in handling brain scan: {e}")
+        finally:
+            # scans cut off in the middle of their stream are never stored
+            await loop.run_in_executor(None, streams.abort)
+            # acks of scans still being stored go out before the connection is closed
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+            self.active_connections -= 1
+            ACTIVE_CONNECTIONS.dec()
+            writer.close()
+
+    async def serve(self) -> None:
+        """Starts listening and serves connections until stop() is called."""
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        server = await asyncio.start_server(
+            self.handle_brain_scan, self.host, self.port, backlog=self.backlog
+        )
+        logger.info(f"FrHUB (asyncio) is listening for brain scans on {self.host}:{self.port}")
+        self.ready.set()
+        try:
+            async with server:
+                # stop() may have been called before the loop was ready
+                if self.running_status:
+                    await self._stop_event.wait()
+        finally:
+            # flushing the scans still queued without blocking the loop
+            await self._loop.run_in_executor(None, self.committer.stop)
+
+    def run_brain_scan_server(self) -> None:
+        """
+        It will listen to incoming brain scans, blocking the calling thread until stopped.
+        :return:
+        """
+        try:
+            asyncio.run(self.serve())
+        except Exception as e:
+            logger.error(f"Exception while handling FrHUB server: {e}")
+
+    def stop(self) -> None:
+        self.running_status = False
+        if self._loop and self._stop_event:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+
+
+def main(wal_dir: str = BRAIN_SCAN_WAL_DIR):
+    # Receiver for brain scan, acking scans once they're in the write-ahead log if there's one
+    committer = WriteAheadLog(wal_dir) if wal_dir else None
+    server = FrHUBAsyncBrainScanServer(host=BRAIN_SCAN_HOST, port=BRAIN_SCAN_PORT, committer=committer)
+    server_thread = threading.Thread(target=server.run_brain_scan_server)
+    server_thread.start()
+    return server
@@ -1,11 +1,26 @@
-import json
 import socket
 import threading
 import time
 
-from common.config import BRAIN_REPORT_PORT, BRAIN_REPORT_HOST
-from common.logger import logger
-from common.utils import fetch_brain_report
+from common import metrics
+from common.config import (
+    BRAIN_REPORT_BATCH_SIZE,
+    BRAIN_REPORT_HOST,
+    BRAIN_REPORT_NOTIFY_PORT,
+    BRAIN_REPORT_PORT,
+    MessageType,
+    NeuroDataCollections,
+    TraceStage,
+)
+from common.logger import Payload, log_event, logger
+from common.notifier import AdaptiveBackoff, WorkNotifier
+from common.protocol import decode_ack, encode_brain_reports, recv_frame, send_frame
+from common.utils import fetch_brain_reports, mark_brain_reports_sent
+
+REPORTS_SENT = metrics.counter("fr_hub_reports_sent_total", "Brain reports sent to FrPACS", ("result",))
+REPORT_BATCH_ACK_SECONDS = metrics.histogram(
+    "fr_hub_report_batch_ack_seconds", "Time from sending a batch of brain reports to FrPACS acknowledging it"
+)
 
 
 class FrHUBBrainReportClient:
@@ -16,19 +31,28 @@ class FrHUBBrainReportClient:
         - In case FrHUB is stopped and restarted, it must fetch pending brain reports from persistent storage and send it to FrPACS
         - If FrPACS stops, some brain reports will be failed to be sent to FrPACS, which is fine
            There is no need to retry or persistent storage required here for these failures, we'll just log them.
+        - Reports are claimed, sent and marked as sent in batches of up to `batch_size`, so draining a backlog
+           costs a few DB calls and one FrPACS round trip per batch instead of per report.
+        - When there is nothing to send it waits for FrBRAIN to announce new reports (see WorkNotifier),
+           polling with a growing interval only as a fallback.
     """
 
-    def __init__(self, host: str, port: int) -> None:
+    def __init__(self, host: str, port: int, batch_size: int = BRAIN_REPORT_BATCH_SIZE) -> None:
         self.host = host
         self.port = port
+        self.batch_size = batch_size
         self.client_socket = None
         self.running_status = True
+        self.seq = 0
+        self.notifier = None
+        self.backoff = AdaptiveBackoff()
 
     def send_brain_report(self) -> None:
         """
         Sends brain reports to FrPACS.
         :return:
         """
+        self.notifier = WorkNotifier(NeuroDataCollections.brain_reports, BRAIN_REPORT_NOTIFY_PORT)
         try:
             while self.running_status:
                 try:
@@ -41,38 +65,56 @@ class FrHUBBrainReportClient:
                 except Exception as e:
                     logger.error(f"FrPACS is not available to receive reports: {e}")
 
-                # Fetch stored brain reports from DB and send it to FrPACS via socket
+                # Fetch stored brain reports from DB and send them to FrPACS via socket in one frame
                 # failed cases would be logged only as per requriemenet.
-                # also it's fetching single report at a time which increases our DB call.
-                # In an actual environment, we can also optimize it by fetching in batches to reduce DB calls
-                report = fetch_brain_report()
-                if report:
-                    # Convert datetime object to string for JSON serialization
-                    report["report_datetime"] = report["report_datetime"].strftime(
-                        "%Y-%m-%d %H:%M:%S"
-                    )
-                    logger.info(f"Sending brain report to FrPACS: {report}")
+                # the claim token makes sure another FrHUB instance doesn't send the same reports
+                claim_token, reports = fetch_brain_reports(self.batch_size)
+                if reports:
+                    self.backoff.reset()
+                    for report in reports:
+                        # Convert datetime object to string for JSON serialization
+                        report["report_datetime"] = report["report_datetime"].strftime(
+                            "%Y-%m-%d %H:%M:%S"
+                        )
+                    log_event("report_batch_sent", "Sending %d brain reports to FrPACS: %s", len(reports), Payload(reports))
 
+                    # recorded on the traces of the reports when they're marked as sent
+                    stage_times = {TraceStage.report_sent: time.time()}
                     try:
-                        report_data = json.dumps(report)
-                        self.client_socket.sendall(report_data.encode("utf-8"))
-                        # receiving acknowledgment from FrPACS
-                        response = self.client_socket.recv(1024).decode("utf-8")
-                        logger.info(
-                            f"Received an acknowledgment from FrPACS: {response}"
+                        self.seq += 1
+                        sent_at = time.perf_counter()
+                        send_frame(
+                            self.client_socket,
+                            MessageType.brain_report_batch,
+                            encode_brain_reports(self.seq, reports),
                         )
+                        # receiving acknowledgment from FrPACS
+                        frame = recv_frame(self.client_socket)
+                        if frame is None:
+                            raise ConnectionError("FrPACS closed the connection before acknowledging")
+                        _, _, response = decode_ack(frame[1])
+                        stage_times[TraceStage.pacs_acked] = time.time()
+                        REPORT_BATCH_ACK_SECONDS.observe(time.perf_counter() - sent_at)
+                        REPORTS_SENT.labels("received").inc(len(reports))
+                        log_event("report_batch_acked", "Received an acknowledgment from FrPACS: %s", response)
                     except Exception as e:
-                        logger.error(f"Failed to send brain report: {e}")
-                        logger.error(f"Report not sent: {report}")
+                        logger.error(f"Failed to send brain reports: {e}")
+                        logger.error(
+                            f"Reports not sent (patient, scan): {[(r['patient_id'], r['scan_id']) for r in reports]}"
+                        )
+                        REPORTS_SENT.labels("failed").inc(len(reports))
                         self.close_socket()
+                    # as before, failed reports aren't retried, so the whole batch is marked sent with one write
+                    mark_brain_reports_sent(claim_token, stage_times)
                 else:
                     logger.info("No pending reports to process. Waiting for report...")
-                    # sleep for 5 seconds before checking again as there is no report to send
-                    time.sleep(5)
+                    # waking up as soon as FrBRAIN stores a report, otherwise checking again after the backoff delay
+                    self.notifier.wait(self.backoff.next_delay())
 
         except Exception as e:
             logger.error(f"Exception in send_brain_reports: {e}")
         finally:
+            self.notifier.stop()
             self.close_socket()
 
     def close_socket(self) -> None:
@@ -83,6 +125,8 @@ class FrHUBBrainReportClient:
 
     def stop(self) -> None:
         self.running_status = False
+        if self.notifier:
+            self.notifier.stop()
         self.close_socket()
 
 
@@ -0,0 +1,58 @@
+import threading
+from collections import OrderedDict
+from typing import Tuple
+
+from common import metrics
+from common.config import BRAIN_SCAN_RECENT_KEYS
+from common.scan_store import ScanFile, delete_scan_file
+
+RECENT_KEY_HITS = metrics.counter(
+    "fr_hub_recent_scan_key_hits_total", "Brain scans acked as duplicates without a DB round trip"
+)
+
+ScanKey = Tuple[int, int]
+
+
+def scan_key(brain_scan: tuple) -> ScanKey:
+    """Idempotency key of a received scan: (patient_id, scan_id)"""
+    return brain_scan[0], brain_scan[1]
+
+
+def discard_duplicate(brain_scan: tuple) -> None:
+    """Deletes the chunks a streamed scan acked as a duplicate was written to while it was received"""
+    if isinstance(brain_scan[4], ScanFile):
+        delete_scan_file(brain_scan[4].file_id)
+
+
+class RecentScanKeys:
+    """Keys of the scans FrHUB stored lately, the least recently seen ones dropped beyond `capacity`
+
+    A FrPACS that lost the ack of a scan (e.g. its connection was reset) may send it again. If the scan is stored
+    already it's acked as a duplicate straight away, neither stored nor analysed twice. Keys are only added once their
+    scan is stored, so a scan whose storing failed is never taken for a duplicate. Older retransmissions, and those of
+    scans still being stored, are caught by the unique index of brain_scans instead.
+    """
+
+    def __init__(self, capacity: int = BRAIN_SCAN_RECENT_KEYS) -> None:
+        self.capacity = capacity
+        self.keys: OrderedDict = OrderedDict()
+        # keys are added by the group commit threads and looked up by the connections
+        self.lock = threading.Lock()
+
+    def seen(self, key: ScanKey) -> bool:
+        """Whether the scan was stored lately"""
+        with self.lock:
+            if key not in self.keys:
+                return False
+            self.keys.move_to_end(key)
+        RECENT_KEY_HITS.inc()
+        return True
+
+    def add(self, key: ScanKey) -> None:
+        if not self.capacity:
+            return
+        with self.lock:
+            self.keys[key] = None
+            self.keys.move_to_end(key)
+            if len(self.keys) > self.capacity:
+                self.keys.popitem(last=False)
@@ -0,0 +1,71 @@
+from typing import Optional
+
+from common import metrics
+from common.config import (
+    BRAIN_SCAN_LATENCY_BUDGET_S,
+    BRAIN_SCAN_MAX_IN_FLIGHT,
+    BRAIN_SCAN_QUEUE_BUDGET,
+    BRAIN_SCAN_RETRY_AFTER_S,
+)
+from fr_hub.group_commit import BrainScanGroupCommitter
+
+LOAD = metrics.gauge("fr_hub_scan_load", "Brain scan persistence load, 1 is the full budget")
+CREDITS_GRANTED = metrics.gauge("fr_hub_scan_credits", "Credits granted with the latest brain scan ack")
+
+
+class FlowController:
+    """Slows FrPACS senders down when storing scans falls behind, instead of queueing more and more of them
+
+    The load of FrHUB is how far its group commit is into its budget: the larger of the scans waiting for their batch
+    over `queue_budget` and the batch write time over `latency_budget_s`. It's at least the full budget once the group
+    commit is stalled (the WAL drainer stopped at a corrupt record), acked scans not reaching FrBRAIN any more.
+        - Every ack grants its connection credits: how many scans it may have unacknowledged. Up to half the budget
+          that's `max_credits`, then fewer and fewer down to 1 at the full budget, so every admitted connection keeps
+          trickling (and gets acks to learn that the load went down again).
+        - Over the budget, and above the connection limit of the server, new connections are rejected with a
+          retry-after hint.
+    Memory then stays bounded by connections * credits scans, and the write latency by the budget.
+    """
+
+    def __init__(
+        self,
+        committer: BrainScanGroupCommitter,
+        max_credits: int = BRAIN_SCAN_MAX_IN_FLIGHT,
+        queue_budget: int = BRAIN_SCAN_QUEUE_BUDGET,
+        latency_budget_s: float = BRAIN_SCAN_LATENCY_BUDGET_S,
+        retry_after_s: float = BRAIN_SCAN_RETRY_AFTER_S,
+    ) -> None:
+        self.committer = committer
+        self.max_credits = max_credits
+        self.queue_budget = queue_budget
+        self.latency_budget_s = latency_budget_s
+        self.retry_after_s = retry_after_s
+        LOAD.set_function(self.load)
+
+    def load(self) -> float:
+        load = max(
+            self.committer.queue_depth() / self.queue_budget, self.committer.write_latency() / self.latency_budget_s
+        )
+        return max(load, 1.0) if self.committer.stalled() else load
+
+    def credits(self) -> int:
+        """Credits to grant with an ack"""
+        load = self.load()
+        if load <= 0.5:
+            credits = self.max_credits
+        else:
+            credits = max(round(self.max_credits * 2 * (1 - load)), 1)
+        CREDITS_GRANTED.set(credits)
+        return credits
+
+    def admit(self, active_connections: int, max_connections: int) -> Optional[float]:
+        """
+        Whether a new connection may send scans
+        :param active_connections: connections open before this one
+        :param max_connections: connection limit of the server
+        :return: None if it's admitted, else the seconds it should wait before connecting again
+        """
+        load = self.load()
+        if load < 1 and active_connections < max_connections:
+            return None
+        return round(self.retry_after_s * max(load, 1), 3)
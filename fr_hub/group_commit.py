@@ -0,0 +1,143 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, List, Tuple
+
+from common import metrics
+from common.config import (
+    BRAIN_SCAN_BATCH_MAX_LINGER_MS,
+    BRAIN_SCAN_BATCH_MAX_SIZE,
+    BRAIN_SCAN_BATCH_WRITERS,
+    BRAIN_SCAN_NOTIFY_PORT,
+)
+from common.logger import log_event, logger
+from common.notifier import notify_work
+from common.utils import save_brain_scans
+
+COMMIT_QUEUE_DEPTH = metrics.gauge("fr_hub_scan_commit_queue", "Received brain scans waiting for their batch")
+BATCH_SIZE = metrics.histogram("fr_hub_scan_batch_size", "Brain scans written per insert")
+BATCH_WRITE_SECONDS = metrics.histogram("fr_hub_scan_batch_write_seconds", "Time to store a batch of brain scans")
+# weight of the latest batch in the moving average of batch write times
+WRITE_SECONDS_WEIGHT = 0.2
+
+
+class BrainScanGroupCommitter:
+    """Write-behind buffer that stores brain scans in batches
+
+    Instead of one insert per received scan, scans arriving within `max_linger_ms` of each other (up to
+    `max_batch_size` of them) are written with a single insert_many. Each submitted scan gets a Future that is
+    resolved only after its batch has been durably written, so FrHUB can ack FrPACS from it.
+    While one batch is being written the next one keeps filling up, so batches grow on their own under load.
+    """
+
+    def __init__(
+        self,
+        max_batch_size: int = BRAIN_SCAN_BATCH_MAX_SIZE,
+        max_linger_ms: float = BRAIN_SCAN_BATCH_MAX_LINGER_MS,
+        writers: int = BRAIN_SCAN_BATCH_WRITERS,
+    ) -> None:
+        self.max_batch_size = max_batch_size
+        self.max_linger = max_linger_ms / 1000
+        self.pending: queue.Queue = queue.Queue()
+        self.running_status = True
+        # moving average of batch write times, and perf_counter every writer thread started its current write at
+        self.write_seconds = 0.0
+        self.writes_started: Dict[int, float] = {}
+        self.writer_threads = [
+            threading.Thread(target=self.write_batches, name=f"fr_hub_group_commit_{i}", daemon=True)
+            for i in range(writers)
+        ]
+        for writer_thread in self.writer_threads:
+            writer_thread.start()
+        COMMIT_QUEUE_DEPTH.set_function(self.pending.qsize)
+
+    def submit(self, scan: tuple) -> Future:
+        """
+        Queues a scan to be stored with the next batch
+        :param scan: tuple in the format expected by save_brain_scan
+        :return: Future resolving to True once the scan is stored, False if storing it failed
+        """
+        future = Future()
+        if not self.running_status:
+            future.set_result(False)
+            return future
+        self.pending.put((scan, future))
+        return future
+
+    def queue_depth(self) -> int:
+        return self.pending.qsize()
+
+    def write_latency(self) -> float:
+        """
+        How long storing a batch takes lately: the moving average of batch write times, or how long the current write
+        has been going on if that's longer (e.g. MongoDB hanging). 0 while there's nothing to write.
+        """
+        now = time.perf_counter()
+        running = [now - started for started in list(self.writes_started.values())]
+        if not running and self.pending.empty():
+            return 0.0
+        return max([self.write_seconds, *running])
+
+    def stalled(self) -> bool:
+        """Whether stored scans stopped making their way to FrBRAIN, which nothing but FrHUB restarting fixes"""
+        return False
+
+    def next_batch(self) -> List[Tuple[tuple, Future]]:
+        """Waits for the first scan, then collects more until the batch is full or the linger time is over."""
+        batch = []
+        while not batch:
+            try:
+                batch.append(self.pending.get(timeout=0.5))
+            except queue.Empty:
+                if not self.running_status:
+                    return batch
+        deadline = time.monotonic() + self.max_linger
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                # anything already queued is taken without waiting, even once the linger time is over
+                batch.append(self.pending.get(timeout=remaining) if remaining > 0 else self.pending.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def write_batches(self) -> None:
+        """Writes batches until stopped and the queue is drained."""
+        while self.running_status or not self.pending.empty():
+            batch = self.next_batch()
+            if not batch:
+                continue
+            started = self.writes_started[threading.get_ident()] = time.perf_counter()
+            try:
+                results = self.write_batch([scan for scan, _ in batch])
+            except Exception as e:
+                logger.error(f"Exception in writing batch of {len(batch)} brain scans: {e}")
+                results = [False] * len(batch)
+            finally:
+                del self.writes_started[threading.get_ident()]
+            seconds = time.perf_counter() - started
+            BATCH_WRITE_SECONDS.observe(seconds)
+            self.write_seconds += WRITE_SECONDS_WEIGHT * (seconds - self.write_seconds)
+            BATCH_SIZE.observe(len(batch))
+            log_event("scan_batch_stored", "Stored batch of %d brain scans", len(batch))
+            for (_, future), saved in zip(batch, results):
+                future.set_result(saved)
+
+    def write_batch(self, scans: List[tuple]) -> List[bool]:
+        """Stores a batch of scans durably, for every scan whether it was stored"""
+        results = save_brain_scans(scans)
+        if any(results):
+            # waking up FrBRAIN instead of letting it find the scans on its next poll
+            notify_work(BRAIN_SCAN_NOTIFY_PORT)
+        return results
+
+    def stop(self) -> None:
+        """Stops accepting scans and waits for the queued ones to be written."""
+        self.running_status = False
+        for writer_thread in self.writer_threads:
+            writer_thread.join()
+        # scans submitted while the writers were shutting down
+        while not self.pending.empty():
+            _, future = self.pending.get_nowait()
+            future.set_result(False)
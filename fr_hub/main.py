@@ -1,12 +1,48 @@
+import argparse
+import sys
 import threading
 
+from async_server import main as async_brain_scan_server
 from client import main as brain_report_client
-from common.logger import logger
+from common.config import BRAIN_SCAN_WAL_DIR, FR_HUB_METRICS_PORT
+from common.db_manager import IDEMPOTENCY_INDEXES, DBManager
+from common.logger import add_logging_arguments, configure_logging, logger, parse_sample_rates
+from common.metrics import start_metrics_server
 from server import main as brain_scan_server
 
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Runs FrHUB")
+    # 'threads' spawns one thread per FrPACS connection, 'asyncio' serves all connections on one event loop
+    parser.add_argument(
+        "--server",
+        choices=["threads", "asyncio"],
+        default="threads",
+        help="mode of the brain scan server",
+    )
+    parser.add_argument(
+        "--wal-dir", default=BRAIN_SCAN_WAL_DIR, help="directory of the write-ahead log scans are acked from, none if empty"
+    )
+    parser.add_argument("--metrics-port", type=int, default=FR_HUB_METRICS_PORT, help="port of the /metrics endpoint")
+    add_logging_arguments(parser)
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
+    args = parse_args()
+    configure_logging("fr_hub", args.log_level, args.log_format, parse_sample_rates(args.log_sample))
+    start_metrics_server(args.metrics_port)
+    # so the report client's claims don't scan the whole collection
+    missing_indexes = set(DBManager().ensure_indexes()) & set(IDEMPOTENCY_INDEXES)
+    if missing_indexes:
+        # scans or reports sent again would be stored twice, see "Idempotent ingest" in README.md
+        logger.error(f"Not starting FrHUB without the unique indexes {sorted(missing_indexes)}")
+        sys.exit(1)
     brain_report_client = brain_report_client()
-    brain_scan_server = brain_scan_server()
+    if args.server == "asyncio":
+        brain_scan_server = async_brain_scan_server(args.wal_dir)
+    else:
+        brain_scan_server = brain_scan_server(args.wal_dir)
     try:
         while True:
             threading.Event().wait(1)
@@ -0,0 +1,83 @@
+from typing import Dict, Optional, Tuple
+
+from common.config import MessageType
+from common.logger import log_event, logger
+from common.protocol import ProtocolError, decode_brain_scan, decode_brain_scan_chunk, decode_brain_scan_end
+from common.scan_codec import ScanFormatError
+from common.scan_store import ScanUpload
+
+
+class BrainScanStreams:
+    """Assembles the brain scans a FrPACS connection sends as a stream of frames (see brain_scan_frames)
+
+    Chunks are written to chunk storage as they arrive (see ScanUpload), so FrHUB only holds one chunk of a large scan
+    in memory. Once the end frame of a scan arrives it's stored like any other scan, with the ScanFile it was written to
+    as its scan data.
+    """
+
+    MESSAGE_TYPES = (MessageType.brain_scan_begin, MessageType.brain_scan_chunk, MessageType.brain_scan_end)
+
+    def __init__(self) -> None:
+        # scans being received by sequence number, None once storing one failed (its remaining chunks are dropped)
+        self.uploads: Dict[int, Optional[Tuple[tuple, ScanUpload]]] = {}
+
+    def receive(self, msg_type: MessageType, payload: bytes) -> Optional[Tuple[int, Optional[tuple]]]:
+        """
+        Handles one frame of a streamed scan, writing to chunk storage blocks
+        :param msg_type: one of MESSAGE_TYPES
+        :param payload:
+        :return: None until the scan is complete, then its sequence number and the scan to store, in the format
+            expected by save_brain_scan (None if the scan couldn't be stored)
+        """
+        if msg_type == MessageType.brain_scan_begin:
+            seq, brain_scan = decode_brain_scan(payload)
+            log_event("scan_received", "Receiving brain scan %s of patient %s in chunks", brain_scan[1], brain_scan[0])
+            try:
+                self.uploads[seq] = (brain_scan, ScanUpload(brain_scan[0], brain_scan[1]))
+            except Exception as e:
+                logger.error(f"Failed to store brain scan {brain_scan[1]} of patient {brain_scan[0]}: {e}")
+                self.uploads[seq] = None
+            return None
+
+        if msg_type == MessageType.brain_scan_chunk:
+            seq, chunk = decode_brain_scan_chunk(payload)
+            upload = self.get_upload(seq)
+            if upload is not None:
+                try:
+                    upload[1].write(chunk)
+                except Exception as e:
+                    logger.error(f"Failed to store brain scan {upload[0][1]} of patient {upload[0][0]}: {e}")
+                    upload[1].abort()
+                    self.uploads[seq] = None
+            return None
+
+        seq, size = decode_brain_scan_end(payload)
+        upload = self.get_upload(seq)
+        del self.uploads[seq]
+        if upload is None:
+            return seq, None
+        brain_scan, scan_upload = upload
+        try:
+            if size != scan_upload.received:
+                raise ScanFormatError(f"Brain scan of {size} bytes ended after {scan_upload.received} bytes")
+            scan_file = scan_upload.finish()
+        except Exception as e:
+            logger.error(f"Failed to store brain scan {brain_scan[1]} of patient {brain_scan[0]}: {e}")
+            scan_upload.abort()
+            return seq, None
+        log_event(
+            "scan_received", "Received brain scan %s of patient %s, %d bytes in chunks", brain_scan[1], brain_scan[0], size
+        )
+        return seq, (*brain_scan[:4], scan_file, *brain_scan[5:])
+
+    def get_upload(self, seq: int) -> Optional[Tuple[tuple, ScanUpload]]:
+        if seq not in self.uploads:
+            raise ProtocolError(f"Frame of brain scan {seq} which wasn't begun")
+        return self.uploads[seq]
+
+    def abort(self) -> None:
+        """Deletes what was stored of the scans still being received, e.g. when the connection is lost."""
+        for upload in self.uploads.values():
+            if upload is not None:
+                upload[1].abort()
+        self.uploads.clear()
@@ -1,11 +1,65 @@
-import base64
-import json
+import queue
 import socket
 import threading
+import time
+from concurrent.futures import Future
+from functools import partial
+from typing import Optional, Tuple, Union
 
-from common.config import BRAIN_SCAN_PORT, BRAIN_SCAN_HOST
-from common.logger import logger
-from common.utils import save_brain_scan
+from common import metrics
+from common.config import (
+    BRAIN_SCAN_BACKLOG,
+    BRAIN_SCAN_HOST,
+    BRAIN_SCAN_MAX_CONNECTIONS,
+    BRAIN_SCAN_MAX_IN_FLIGHT,
+    BRAIN_SCAN_PORT,
+    BRAIN_SCAN_WAL_DIR,
+    AckStatus,
+    MessageType,
+    TraceStage,
+)
+from common.logger import log_event, logger
+from common.protocol import BUSY_SEQ, decode_brain_scan, encode_ack, recv_frame, send_frame
+from common.tracing import traced
+from fr_hub.dedup import RecentScanKeys, ScanKey, discard_duplicate, scan_key
+from fr_hub.flow_control import FlowController
+from fr_hub.group_commit import BrainScanGroupCommitter
+from fr_hub.scan_stream import BrainScanStreams
+from fr_hub.wal import WriteAheadLog
+
+SCAN_STORED_ACK = "FRHub received the brain scan and successfully stored it"
+SCAN_FAILED_ACK = "FRHub failed to store the brain scan"
+SCAN_DUPLICATE_ACK = "FrHUB had stored the brain scan already"
+BUSY_ACK = "FrHUB is over its budget, connect again later"
+
+CONNECTIONS_ACCEPTED = metrics.counter("fr_hub_connections_accepted_total", "FrPACS connections accepted")
+CONNECTIONS_REJECTED = metrics.counter(
+    "fr_hub_connections_rejected_total", "FrPACS connections over the limit or the load budget"
+)
+ACTIVE_CONNECTIONS = metrics.gauge("fr_hub_active_connections", "FrPACS connections open")
+SCAN_ACKS = metrics.counter("fr_hub_scan_acks_total", "Brain scan acks sent to FrPACS", ("status",))
+SCAN_ACK_SECONDS = metrics.histogram(
+    "fr_hub_scan_ack_seconds", "Time from receiving the last frame of a brain scan to sending its ack"
+)
+
+
+def record_ack(status: AckStatus, received_at: float) -> None:
+    SCAN_ACKS.labels(status).inc()
+    SCAN_ACK_SECONDS.observe(time.perf_counter() - received_at)
+
+
+def scan_ack(seq: int, saved: Union[bool, AckStatus], credits: int) -> Tuple[AckStatus, bytes]:
+    """Status and ack of a scan from the result of storing it (see save_brain_scans)"""
+    if saved == AckStatus.duplicate:
+        return AckStatus.duplicate, encode_ack(seq, AckStatus.duplicate, SCAN_DUPLICATE_ACK, credits)
+    if saved:
+        return AckStatus.stored, encode_ack(seq, AckStatus.stored, SCAN_STORED_ACK, credits)
+    return AckStatus.error, encode_ack(seq, AckStatus.error, SCAN_FAILED_ACK, credits)
+
+
+def busy_ack(retry_after: float) -> bytes:
+    """Ack rejecting a connection, see FlowController.admit"""
+    return encode_ack(BUSY_SEQ, AckStatus.busy, BUSY_ACK, retry_after=retry_after)
 
 
 class FrHUBBrainScanServer:
@@ -16,47 +70,198 @@ class FrHUBBrainScanServer:
         - If FrHUB stops, FrPACS will continue generating brain scans, but they will not be received here, rather failed scans would only be logged (already logging in FRPACS)
         - It should conitnue processing scan after restarting
         - We are using simple network communication here while receiving brain scans
+        - FrPACS may pipeline scans, so every scan is stored in the background and acked (with its sequence number) as soon as it is stored
+        - Scans are stored in batches by a BrainScanGroupCommitter, a scan is only acked after its batch is written
+        - Large scans arrive as a stream of frames and are written to chunk storage as they arrive (see BrainScanStreams)
+        - Acks grant FrPACS credits according to how far behind storing scans FrHUB is, and over its budget new
+          connections are rejected with a retry-after hint (see FlowController)
+        - A scan stored already (same patient_id and scan_id) is acked as a duplicate and not stored again, those
+          stored lately without a DB round trip (see RecentScanKeys)
+        - Acks of a connection are sent by its own sender thread, the group commit threads only queue them: a FrPACS
+          that stops reading its acks only blocks its own connection, not the batch writes of all of them
     """
 
-    def __init__(self, host: str, port: int) -> None:
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        backlog: int = BRAIN_SCAN_BACKLOG,
+        max_in_flight: int = BRAIN_SCAN_MAX_IN_FLIGHT,
+        committer: Optional[BrainScanGroupCommitter] = None,
+        flow_control: Optional[FlowController] = None,
+        max_connections: int = BRAIN_SCAN_MAX_CONNECTIONS,
+        recent_keys: Optional[RecentScanKeys] = None,
+    ) -> None:
         self.host = host
         self.port = port
+        self.backlog = backlog
+        self.max_in_flight = max_in_flight
+        self.max_connections = max_connections
         self.server_socket = None
         self.running_status = True
+        self.committer = committer or BrainScanGroupCommitter()
+        self.flow_control = flow_control or FlowController(self.committer, max_credits=max_in_flight)
+        self.recent_keys = recent_keys or RecentScanKeys()
+        self.active_connections = 0
+        self.connections_lock = threading.Lock()
+
+    def acknowledge_brain_scan(
+        self, acks: queue.Queue, in_flight: threading.BoundedSemaphore, seq: int, key: ScanKey, received_at: float,
+        future: Future,
+    ) -> None:
+        """
+        Queues the ack of a scan for the sender thread of its connection once storing it has finished. This runs on
+        a group commit thread, which mustn't wait for the socket
+        :param acks: ack queue of the connection, see send_acks
+        :param in_flight: released once the ack is sent, so the connection can read the next scan
+        :param seq: sequence number of the scan
+        :param key: idempotency key of the scan
+        :param received_at: perf_counter when the scan was received
+        :param future: result of storing the scan
+        :return:
+        """
+        try:
+            save_scan_response = not future.exception() and future.result()
+            status, ack = scan_ack(seq, save_scan_response, self.flow_control.credits())
+            if save_scan_response:
+                self.recent_keys.add(key)
+            if status == AckStatus.stored:
+                log_event("scan_stored", "Brain Scan received and saved via FrHUB: %s", seq)
+            acks.put((status, ack, received_at))
+        except Exception as e:
+            logger.error(f"Exception in acknowledging brain scan {seq}: {e}")
+            in_flight.release()
+
+    def acknowledge_duplicate(
+        self, acks: queue.Queue, in_flight: threading.BoundedSemaphore, seq: int, brain_scan: tuple, received_at: float
+    ) -> None:
+        """Acks a scan stored lately as a duplicate, without storing it"""
+        discard_duplicate(brain_scan)
+        _, ack = scan_ack(seq, AckStatus.duplicate, self.flow_control.credits())
+        in_flight.acquire()
+        acks.put((AckStatus.duplicate, ack, received_at))
+        log_event("scan_duplicate", "Brain scan %s of patient %s stored already", brain_scan[1], brain_scan[0], seq=seq)
 
     @staticmethod
-    def handle_brain_scan(client_socket: socket.socket) -> None:
+    def send_acks(client_socket: socket.socket, acks: queue.Queue, in_flight: threading.BoundedSemaphore) -> None:
+        """
+        Sends the queued acks of a connection until it's closed (None is queued). Every queued ack holds an in-flight
+        slot, released once it's sent. Once sending failed the connection is shut down, and the acks still queued
+        are dropped
+        """
+        broken = False
+        while True:
+            queued = acks.get()
+            if queued is None:
+                return
+            status, ack, received_at = queued
+            try:
+                if not broken:
+                    send_frame(client_socket, MessageType.ack, ack)
+                    if received_at is None:
+                        SCAN_ACKS.labels(status).inc()
+                    else:
+                        record_ack(status, received_at)
+            except Exception as e:
+                broken = True
+                logger.error(f"Exception in sending acks, closing the connection: {e}")
+                try:
+                    # wakes up the connection's thread reading scans
+                    client_socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            finally:
+                in_flight.release()
+
+    def handle_brain_scan(self, client_socket: socket.socket) -> None:
         """
         Handles incoming brain scans and stores them persistently (we could use any data store) and sends acknowledgenment to FrPACS.
         :param client_socket:
         :return:
         """
+        in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        acks: queue.Queue = queue.Queue()
+        sender_thread = threading.Thread(
+            target=self.send_acks, args=(client_socket, acks, in_flight), name="fr_hub_ack_sender", daemon=True
+        )
+        sender_thread.start()
+        streams = BrainScanStreams()
         try:
             while True:
-                brain_scan_data = client_socket.recv(1024).decode("utf-8")
-                if not brain_scan_data:
+                # each frame carries exactly one scan (or one part of a streamed scan), no matter how TCP splits or merges the stream
+                frame = recv_frame(client_socket)
+                if frame is None:
                     break
+                msg_type, payload = frame
+                if msg_type == MessageType.brain_scan:
+                    seq, brain_scan = decode_brain_scan(payload)
+                    log_event(
+                        "scan_received", "Received brain scan %s of patient %s, %d bytes",
+                        brain_scan[1], brain_scan[0], len(payload), seq=seq,
+                    )
+                elif msg_type in BrainScanStreams.MESSAGE_TYPES:
+                    received = streams.receive(msg_type, payload)
+                    if received is None:
+                        continue
+                    seq, brain_scan = received
+                    if brain_scan is None:
+                        ack = encode_ack(seq, AckStatus.error, SCAN_FAILED_ACK, self.flow_control.credits())
+                        in_flight.acquire()
+                        acks.put((AckStatus.error, ack, None))
+                        continue
+                else:
+                    logger.warning(f"Ignoring unexpected message type from FrPACS: {msg_type}")
+                    continue
 
-                logger.info(f"Received brain scan: {brain_scan_data}")
-                brain_scan_data = json.loads(brain_scan_data)
-                brain_scan_data[4] = base64.b64decode(brain_scan_data[4]).decode(
-                    "utf-8"
+                received_at = time.perf_counter()
+                key = scan_key(brain_scan)
+                if self.recent_keys.seen(key):
+                    self.acknowledge_duplicate(acks, in_flight, seq, brain_scan, received_at)
+                    continue
+                # scans of older FrPACS start their trace here
+                brain_scan = traced(brain_scan, TraceStage.hub_received)
+                # once too many scans of this connection are being stored we stop reading,
+                # so TCP flow control slows FrPACS down instead of queueing scans here
+                in_flight.acquire()
+                try:
+                    # Saves the brain scan with the next batch, the ack is sent once the batch is written
+                    future = self.committer.submit(brain_scan)
+                except Exception:
+                    in_flight.release()
+                    raise
+                future.add_done_callback(
+                    partial(self.acknowledge_brain_scan, acks, in_flight, seq, key, received_at)
                 )
-                # Saves the brain scan
-                save_scan_response = save_brain_scan(tuple(brain_scan_data))
-                if save_scan_response:
-                    response = (
-                        "FRHub received the brain scan and successfully stored it"
-                    )
-                    # Sending acknowledgement to FrPACS
-                    client_socket.sendall(response.encode("utf-8"))
-                    logger.info(f"Brain Scan received and saved via FrHUB: {save_scan_response}")
         except Exception as e:
             logger.error(f"Exception in handling brain scan: {e}")
         finally:
+            # scans cut off in the middle of their stream are never stored
+            streams.abort()
+            # waiting for the scans still being stored, so their acks go out before the connection is closed
+            for _ in range(self.max_in_flight):
+                in_flight.acquire()
+            acks.put(None)
+            sender_thread.join()
+            with self.connections_lock:
+                self.active_connections -= 1
+            ACTIVE_CONNECTIONS.dec()
             if client_socket:
                 client_socket.close()
 
+    def reject_connection(self, client_socket: socket.socket, addr, retry_after: float) -> None:
+        """Tells FrPACS to connect again in `retry_after` seconds and closes the connection"""
+        logger.warning(
+            f"Rejecting connection from {addr}, {self.active_connections} connections open, "
+            f"load {self.flow_control.load():.2f}: retry after {retry_after} s"
+        )
+        CONNECTIONS_REJECTED.inc()
+        try:
+            send_frame(client_socket, MessageType.ack, busy_ack(retry_after))
+        except OSError as e:
+            logger.warning(f"Couldn't tell {addr} to retry later: {e}")
+        finally:
+            client_socket.close()
+
     def run_brain_scan_server(self) -> None:
         """
         It will listen to incoming brain scans.
@@ -68,14 +273,26 @@ class FrHUBBrainScanServer:
                 # binding to the host and port
                 self.server_socket.bind((self.host, self.port))
                 # enabling server to accept connections
-                self.server_socket.listen(5)
+                self.server_socket.listen(self.backlog)
                 logger.info(
                     f"FrHUB is listening for brain scans on {self.host}:{self.port}"
                 )
             # server is listening here
             while self.running_status:
                 client_socket, addr = self.server_socket.accept()
+                # no thread is started for connections FrHUB couldn't keep up with
+                with self.connections_lock:
+                    retry_after = self.flow_control.admit(self.active_connections, self.max_connections)
+                    if retry_after is None:
+                        self.active_connections += 1
+                if retry_after is not None:
+                    self.reject_connection(client_socket, addr, retry_after)
+                    continue
                 logger.info(f"Connection is accepted from {addr}")
+                CONNECTIONS_ACCEPTED.inc()
+                ACTIVE_CONNECTIONS.inc()
+                # acks are small and pipelined, Nagle's algorithm would hold them back waiting for more data
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
                 client_handler = threading.Thread(
                     target=self.handle_brain_scan, args=(client_socket,)
                 )
@@ -90,11 +307,13 @@ class FrHUBBrainScanServer:
         self.running_status = False
         if self.server_socket:
             self.server_socket.close()
+        self.committer.stop()
 
 
-def main():
-    # Receiver for brain scan
-    server = FrHUBBrainScanServer(host=BRAIN_SCAN_HOST, port=BRAIN_SCAN_PORT)
-    server_thread = threading.Thread(target=server.run_brain_scan_server())
+def main(wal_dir: str = BRAIN_SCAN_WAL_DIR):
+    # Receiver for brain scan, acking scans once they're in the write-ahead log if there's one
+    committer = WriteAheadLog(wal_dir) if wal_dir else None
+    server = FrHUBBrainScanServer(host=BRAIN_SCAN_HOST, port=BRAIN_SCAN_PORT, committer=committer)
+    server_thread = threading.Thread(target=server.run_brain_scan_server)
     server_thread.start()
     return server
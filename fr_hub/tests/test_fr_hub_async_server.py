@@ -0,0 +1,88 @@
+import socket
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from common.config import AckStatus, MessageType, TraceStage
+from common.protocol import decode_ack, decode_scan_ack, encode_brain_scan, recv_frame, send_frame
+from common.scan_codec import to_packed_scan
+from fr_hub.async_server import FrHUBAsyncBrainScanServer
+from fr_hub.server import SCAN_STORED_ACK
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class TestFrHUBAsyncBrainScanServer(unittest.TestCase):
+
+    def setUp(self):
+        self.port = free_port()
+        self.server = FrHUBAsyncBrainScanServer(host="127.0.0.1", port=self.port)
+        self.server_thread = threading.Thread(target=self.server.run_brain_scan_server)
+        self.server_thread.start()
+        self.assertTrue(self.server.ready.wait(timeout=5))
+
+    def tearDown(self):
+        self.server.stop()
+        self.server_thread.join(timeout=5)
+        self.assertFalse(self.server_thread.is_alive())
+
+    @patch("fr_hub.group_commit.save_brain_scans", side_effect=lambda scans: [True] * len(scans))
+    def test_handle_brain_scan_success(self, mock_save):
+        """Test a scan is saved and acknowledged"""
+        scan = encode_brain_scan(7, (1, 2, "2025-01-01 00:00:00", "BRAIN", "|o|"))
+        with socket.create_connection(("127.0.0.1", self.port)) as client_socket:
+            send_frame(client_socket, MessageType.brain_scan, scan)
+            msg_type, response = recv_frame(client_socket)
+
+        self.assertEqual(msg_type, MessageType.ack)
+        self.assertEqual(decode_ack(response), (7, AckStatus.stored, SCAN_STORED_ACK))
+        # the text scan travels and is stored packed
+        mock_save.assert_called_once()
+        (saved,) = mock_save.call_args.args[0]
+        self.assertEqual(saved[:5], (1, 2, "2025-01-01 00:00:00", "BRAIN", to_packed_scan("|o|")))
+        # scans sent without a trace start theirs in FrHUB
+        self.assertEqual(list(saved[5].stage_times), [TraceStage.hub_received])
+
+    @patch("fr_hub.group_commit.save_brain_scans")
+    def test_pipelined_scans_are_acked_by_sequence(self, mock_save):
+        """Test several scans sent without waiting are each acked with their own sequence number"""
+        # second scan fails to be stored
+        mock_save.side_effect = lambda scans: [scan[1] != 2 for scan in scans]
+        with socket.create_connection(("127.0.0.1", self.port)) as client_socket:
+            for seq in range(1, 4):
+                send_frame(
+                    client_socket,
+                    MessageType.brain_scan,
+                    encode_brain_scan(seq, (1, seq, "2025-01-01 00:00:00", "BRAIN", "| |")),
+                )
+            acks = {}
+            for _ in range(3):
+                seq, status, _ = decode_ack(recv_frame(client_socket)[1])
+                acks[seq] = status
+
+        self.assertEqual(acks, {1: AckStatus.stored, 2: AckStatus.error, 3: AckStatus.stored})
+
+    def test_rejects_connections_above_limit(self):
+        """Test connections above max_connections are told to retry later and closed straight away"""
+        self.server.max_connections = 1
+        with socket.create_connection(("127.0.0.1", self.port)) as first:
+            # making sure the first connection is registered before opening the second one
+            for _ in range(50):
+                if self.server.active_connections:
+                    break
+                time.sleep(0.01)
+            with socket.create_connection(("127.0.0.1", self.port)) as second:
+                second.settimeout(2)
+                _, payload = recv_frame(second)
+                self.assertEqual(decode_scan_ack(payload).status, AckStatus.busy)
+                self.assertIsNone(recv_frame(second))
+            first.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
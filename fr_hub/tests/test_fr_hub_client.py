@@ -1,4 +1,13 @@
+import socket
+import threading
+import time
 import unittest
+from datetime import datetime
+from unittest.mock import patch
+
+from common.config import TraceStage
+from fr_hub.client import FrHUBBrainReportClient
+from fr_pacs.server import FrPACSBrainReportServer
 
 
 class TestFrPACSBrainReportClient(unittest.TestCase):
@@ -14,8 +23,37 @@ class TestFrPACSBrainReportClient(unittest.TestCase):
     def test_send_brain_report_socket_creation_failure(self):
         pass
 
-    def test_send_brain_report_receives_acknowledgment(self):
-        pass
+    @patch("fr_hub.client.WorkNotifier")
+    @patch("fr_hub.client.mark_brain_reports_sent")
+    @patch("fr_hub.client.fetch_brain_reports")
+    def test_send_brain_report_receives_acknowledgment(self, mock_fetch, mock_mark_sent, mock_notifier):
+        """Test a claimed batch is sent in one frame, acked by FrPACS and marked sent in one write"""
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        server = FrPACSBrainReportServer(host="127.0.0.1", port=port)
+        server_thread = threading.Thread(target=server.run_brain_report_server, daemon=True)
+        server_thread.start()
+        time.sleep(0.2)
+
+        reports = [
+            {"patient_id": 1, "scan_id": i, "report_datetime": datetime(2025, 1, 1), "report_data": "report"}
+            for i in range(3)
+        ]
+        mock_fetch.side_effect = [("token", reports), (None, [])]
+        client = FrHUBBrainReportClient(host="127.0.0.1", port=port, batch_size=3)
+        # waiting for new reports stops the client
+        mock_notifier.return_value.wait.side_effect = lambda _: client.stop()
+        with self.assertLogs("mediaire_task", level="INFO") as logs:
+            client.send_brain_report()
+        server.stop()
+
+        mock_fetch.assert_called_with(3)
+        mock_mark_sent.assert_called_once()
+        claim_token, stage_times = mock_mark_sent.call_args.args
+        self.assertEqual(claim_token, "token")
+        self.assertEqual(list(stage_times), [TraceStage.report_sent, TraceStage.pacs_acked])
+        self.assertIn("FrPACS received 3 brain reports successfully", "\n".join(logs.output))
 
     def test_send_brain_report_close_socket(self):
         pass
@@ -0,0 +1,76 @@
+import socket
+import threading
+import unittest
+from unittest.mock import patch
+
+from common.config import AckStatus, MessageType
+from common.protocol import decode_ack, encode_brain_scan, recv_frame, send_frame
+from common.utils import save_brain_scans
+from fr_hub.async_server import FrHUBAsyncBrainScanServer
+from fr_hub.dedup import RecentScanKeys
+from fr_hub.server import SCAN_DUPLICATE_ACK
+from fr_hub.tests.test_fr_hub_async_server import free_port
+
+
+class TestRecentScanKeys(unittest.TestCase):
+
+    def test_least_recently_seen_key_is_dropped(self):
+        """Test keys beyond the capacity are dropped, the least recently seen one first"""
+        recent_keys = RecentScanKeys(capacity=2)
+        recent_keys.add((1, 1))
+        recent_keys.add((1, 2))
+        self.assertTrue(recent_keys.seen((1, 1)))
+        recent_keys.add((1, 3))
+
+        self.assertTrue(recent_keys.seen((1, 1)))
+        self.assertFalse(recent_keys.seen((1, 2)))
+        self.assertTrue(recent_keys.seen((1, 3)))
+
+    def test_no_capacity_keeps_no_key(self):
+        """Test a capacity of 0 leaves all duplicates to the DB"""
+        recent_keys = RecentScanKeys(capacity=0)
+        recent_keys.add((1, 1))
+        self.assertFalse(recent_keys.seen((1, 1)))
+
+
+class TestSaveBrainScans(unittest.TestCase):
+
+    @patch("common.utils.db_manager")
+    def test_duplicates_are_reported(self, mock_db_manager):
+        """Test scans stored already are reported as duplicates, truthy like stored scans"""
+        mock_db_manager.insert_new.return_value = [1]
+        scans = [(1, scan_id, "2025-01-01 00:00:00", "BRAIN", "|o|") for scan_id in range(3)]
+
+        self.assertEqual(save_brain_scans(scans), [True, AckStatus.duplicate, True])
+        mock_db_manager.insert_new.return_value = None
+        self.assertEqual(save_brain_scans(scans), [False, False, False])
+
+
+class TestFrHUBDuplicateScans(unittest.TestCase):
+
+    def setUp(self):
+        self.port = free_port()
+        self.server = FrHUBAsyncBrainScanServer(host="127.0.0.1", port=self.port)
+        self.server_thread = threading.Thread(target=self.server.run_brain_scan_server)
+        self.server_thread.start()
+        self.assertTrue(self.server.ready.wait(timeout=5))
+
+    def tearDown(self):
+        self.server.stop()
+        self.server_thread.join(timeout=5)
+
+    @patch("fr_hub.group_commit.save_brain_scans", side_effect=lambda scans: [True] * len(scans))
+    def test_scan_sent_again_is_acked_as_duplicate(self, mock_save):
+        """Test a scan stored lately is acked as a duplicate without being stored again"""
+        scan = (1, 2, "2025-01-01 00:00:00", "BRAIN", "|o|")
+        with socket.create_connection(("127.0.0.1", self.port)) as client_socket:
+            send_frame(client_socket, MessageType.brain_scan, encode_brain_scan(1, scan))
+            self.assertEqual(decode_ack(recv_frame(client_socket)[1])[1], AckStatus.stored)
+            send_frame(client_socket, MessageType.brain_scan, encode_brain_scan(2, scan))
+            self.assertEqual(decode_ack(recv_frame(client_socket)[1]), (2, AckStatus.duplicate, SCAN_DUPLICATE_ACK))
+
+        mock_save.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import socket
+import threading
+import time
+import unittest
+
+from common.config import AckStatus, MessageType
+from common.protocol import BUSY_SEQ, decode_scan_ack, recv_frame
+from fr_hub.flow_control import FlowController
+from fr_hub.server import FrHUBBrainScanServer
+
+
+class Backlog:
+    """Stands in for the group commit, with a given number of scans waiting and batch write time"""
+
+    def __init__(self, queue_depth: int = 0, write_latency: float = 0.0) -> None:
+        self.depth = queue_depth
+        self.latency = write_latency
+        self.drainer_stopped = False
+
+    def queue_depth(self) -> int:
+        return self.depth
+
+    def write_latency(self) -> float:
+        return self.latency
+
+    def stalled(self) -> bool:
+        return self.drainer_stopped
+
+
+class TestFlowController(unittest.TestCase):
+
+    def test_credits_shrink_with_the_load(self):
+        """Test full credits up to half the budget, then fewer down to 1 at the full budget and over it"""
+        backlog = Backlog()
+        flow_control = FlowController(backlog, max_credits=8, queue_budget=100, latency_budget_s=1)
+        self.assertEqual(flow_control.credits(), 8)
+        backlog.depth = 50
+        self.assertEqual(flow_control.credits(), 8)
+        backlog.depth = 75
+        self.assertEqual(flow_control.credits(), 4)
+        backlog.depth = 500
+        self.assertEqual(flow_control.credits(), 1)
+
+    def test_load_is_the_larger_of_queue_and_latency(self):
+        """Test a slow write counts even when few scans are waiting"""
+        flow_control = FlowController(Backlog(10, 0.8), queue_budget=100, latency_budget_s=1)
+        self.assertAlmostEqual(flow_control.load(), 0.8)
+
+    def test_admit(self):
+        """Test connections are rejected over the budget or the connection limit, longer the higher the load"""
+        backlog = Backlog()
+        flow_control = FlowController(backlog, queue_budget=100, latency_budget_s=1, retry_after_s=2)
+        self.assertIsNone(flow_control.admit(3, 4))
+        self.assertEqual(flow_control.admit(4, 4), 2)
+        backlog.depth = 300
+        self.assertEqual(flow_control.admit(0, 4), 6)
+
+    def test_stalled_log_is_over_budget(self):
+        """Test connections are rejected and given 1 credit once the WAL drainer stopped, however low the load"""
+        backlog = Backlog()
+        flow_control = FlowController(backlog, max_credits=8, queue_budget=100, latency_budget_s=1, retry_after_s=2)
+        backlog.drainer_stopped = True
+        self.assertEqual(flow_control.credits(), 1)
+        self.assertEqual(flow_control.admit(0, 4), 2)
+
+
+class TestFrHUBFlowControl(unittest.TestCase):
+
+    def test_connection_over_budget_is_told_to_retry(self):
+        """Test a connection while FrHUB is over its budget gets a busy ack with a retry-after hint, then is closed"""
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        flow_control = FlowController(Backlog(write_latency=5), latency_budget_s=1, retry_after_s=1)
+        server = FrHUBBrainScanServer(host="127.0.0.1", port=port, flow_control=flow_control)
+        threading.Thread(target=server.run_brain_scan_server, daemon=True).start()
+        time.sleep(0.2)
+
+        with socket.create_connection(("127.0.0.1", port), timeout=2) as client_socket:
+            msg_type, payload = recv_frame(client_socket)
+            closed = recv_frame(client_socket)
+        server.stop()
+
+        self.assertEqual(msg_type, MessageType.ack)
+        ack = decode_scan_ack(payload)
+        self.assertEqual((ack.seq, ack.status, ack.retry_after), (BUSY_SEQ, AckStatus.busy, 5))
+        self.assertIsNone(closed)
+        self.assertEqual(server.active_connections, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import time
+import unittest
+from unittest.mock import patch
+
+from fr_hub.group_commit import BrainScanGroupCommitter
+
+
+def scan(scan_id: int) -> tuple:
+    return 1, scan_id, "2025-01-01 00:00:00", "BRAIN", "|o|"
+
+
+class TestBrainScanGroupCommitter(unittest.TestCase):
+
+    @patch("fr_hub.group_commit.save_brain_scans", side_effect=lambda scans: [True] * len(scans))
+    def test_scans_within_linger_are_written_together(self, mock_save):
+        """Test scans submitted within the linger time end up in one insert"""
+        committer = BrainScanGroupCommitter(max_batch_size=100, max_linger_ms=200, writers=1)
+        futures = [committer.submit(scan(i)) for i in range(10)]
+
+        self.assertTrue(all(future.result(timeout=2) for future in futures))
+        committer.stop()
+        mock_save.assert_called_once_with([scan(i) for i in range(10)])
+
+    @patch("fr_hub.group_commit.save_brain_scans", side_effect=lambda scans: [True] * len(scans))
+    def test_batches_are_capped_at_max_size(self, mock_save):
+        """Test no batch is bigger than max_batch_size"""
+        committer = BrainScanGroupCommitter(max_batch_size=4, max_linger_ms=50, writers=1)
+        futures = [committer.submit(scan(i)) for i in range(10)]
+
+        self.assertTrue(all(future.result(timeout=2) for future in futures))
+        committer.stop()
+        batch_sizes = [len(call.args[0]) for call in mock_save.call_args_list]
+        self.assertEqual(sum(batch_sizes), 10)
+        self.assertLessEqual(max(batch_sizes), 4)
+
+    @patch("fr_hub.group_commit.save_brain_scans", side_effect=lambda scans: [True] * len(scans))
+    def test_single_scan_waits_at_most_linger(self, mock_save):
+        """Test a lone scan is written once the linger time is over"""
+        committer = BrainScanGroupCommitter(max_batch_size=100, max_linger_ms=20, writers=1)
+        started = time.monotonic()
+        self.assertTrue(committer.submit(scan(1)).result(timeout=2))
+        self.assertLess(time.monotonic() - started, 1)
+        committer.stop()
+
+    @patch("fr_hub.group_commit.save_brain_scans", side_effect=Exception("DB is down"))
+    def test_failed_batch_resolves_false(self, mock_save):
+        """Test every scan of a failed batch is reported as not stored"""
+        committer = BrainScanGroupCommitter(max_batch_size=10, max_linger_ms=20, writers=1)
+        futures = [committer.submit(scan(i)) for i in range(3)]
+
+        self.assertEqual([future.result(timeout=2) for future in futures], [False, False, False])
+        committer.stop()
+
+    @patch("fr_hub.group_commit.save_brain_scans", side_effect=lambda scans: [True] * len(scans))
+    def test_stop_flushes_queued_scans(self, mock_save):
+        """Test scans queued before stop() are still written"""
+        committer = BrainScanGroupCommitter(max_batch_size=100, max_linger_ms=1000, writers=1)
+        futures = [committer.submit(scan(i)) for i in range(5)]
+        committer.stop()
+
+        self.assertTrue(all(future.result(timeout=0) for future in futures))
+        self.assertFalse(committer.submit(scan(6)).result(timeout=0))
+
+
+if __name__ == '__main__':
+    unittest.main()
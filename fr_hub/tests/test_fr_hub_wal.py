@@ -0,0 +1,229 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from bson import ObjectId
+
+from common.config import TraceStage
+from common.scan_store import ScanFile
+from common.tracing import traced
+
+from fr_hub.wal import RECORD_HEADER, WalPosition, WriteAheadLog, read_records
+
+
+def scan(scan_id: int) -> tuple:
+    return 1, scan_id, "2025-01-01 00:00:00", "BRAIN", "|o|"
+
+
+def wait_for(condition, timeout: float = 5) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+def inserted(mock_insert_new) -> list:
+    """Documents of the successful inserts"""
+    return [
+        document
+        for call, result in zip(mock_insert_new.call_args_list, mock_insert_new.returned)
+        if result is not None
+        for document in call.args[1]
+    ]
+
+
+def mongo(*available: bool):
+    """insert_new side effect, succeeding (without duplicates) or failing in the given order and then succeeding"""
+    outcomes = list(available)
+
+    def insert_new(collection_name, documents, durable=False):
+        result = [] if not outcomes or outcomes.pop(0) else None
+        insert_new.returned.append(result)
+        return result
+
+    insert_new.returned = []
+    return insert_new
+
+
+@patch("fr_hub.wal.notify_work")
+class TestWriteAheadLog(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def start(self, side_effect, **kwargs) -> WriteAheadLog:
+        patcher = patch("fr_hub.wal.DBManager.insert_new", side_effect=side_effect)
+        self.mock_insert_new = patcher.start()
+        self.mock_insert_new.returned = getattr(side_effect, "returned", [])
+        self.addCleanup(patcher.stop)
+        update_patcher = patch("fr_hub.wal.DBManager.update_many")
+        self.mock_update_many = update_patcher.start()
+        self.addCleanup(update_patcher.stop)
+        return WriteAheadLog(self.directory.name, fsync_ms=5, retry_s=0.05, **kwargs)
+
+    def test_scans_are_acked_from_the_log_and_drained(self, mock_notify):
+        """Test scans are acked once logged, loaded into MongoDB with their _id, and the checkpoint follows"""
+        wal = self.start(mongo())
+        futures = [wal.submit(scan(i)) for i in range(10)]
+        self.assertTrue(all(future.result(timeout=2) for future in futures))
+        self.assertTrue(wait_for(lambda: wal.drained == wal.durable))
+        wal.stop()
+
+        documents = inserted(self.mock_insert_new)
+        self.assertEqual([document["scan_id"] for document in documents], list(range(10)))
+        self.assertEqual(len({document["_id"] for document in documents}), 10)
+        self.assertTrue(all(call.kwargs["durable"] for call in self.mock_insert_new.call_args_list))
+        self.assertEqual(wal.read_checkpoint(), wal.durable)
+        mock_notify.assert_called()
+
+    def test_ingest_goes_on_while_mongo_is_unavailable(self, mock_notify):
+        """Test scans are still acked while loading them fails, and are loaded once MongoDB is back"""
+        wal = self.start(mongo(False, False, False))
+        futures = [wal.submit(scan(i)) for i in range(5)]
+        self.assertTrue(all(future.result(timeout=2) for future in futures))
+        self.assertTrue(wait_for(lambda: len(inserted(self.mock_insert_new)) == 5))
+        wal.stop()
+        self.assertGreaterEqual(self.mock_insert_new.call_count, 4)
+
+    def test_restart_resumes_from_the_checkpoint(self, mock_notify):
+        """Test scans acked but not loaded before a stop are loaded, once, by the next start"""
+        wal = self.start(mongo(*[False] * 1000))
+        futures = [wal.submit(scan(i)) for i in range(3)]
+        self.assertTrue(all(future.result(timeout=2) for future in futures))
+        wal.stop()
+        self.assertEqual(inserted(self.mock_insert_new), [])
+        self.assertEqual(wal.read_checkpoint(), WalPosition(0, 0))
+        patch.stopall()
+
+        wal = self.start(mongo())
+        self.assertTrue(wait_for(lambda: wal.drained == wal.durable))
+        self.assertTrue(wal.submit(scan(3)).result(timeout=2))
+        self.assertTrue(wait_for(lambda: wal.drained == wal.durable))
+        wal.stop()
+        self.assertEqual([document["scan_id"] for document in inserted(self.mock_insert_new)], [0, 1, 2, 3])
+
+    def test_torn_record_is_cut_off(self, mock_notify):
+        """Test a record cut short by a crash is dropped on restart and the log goes on after the whole ones"""
+        wal = self.start(mongo(*[False] * 1000))
+        self.assertTrue(wal.submit(scan(1)).result(timeout=2))
+        wal.stop()
+        path = wal.segment_path(0)
+        with open(path, "ab") as segment:
+            segment.write(b"\x00\x00\x01\x00torn")
+        patch.stopall()
+
+        wal = self.start(mongo())
+        self.assertEqual(os.path.getsize(path), wal.durable.offset)
+        self.assertTrue(wal.submit(scan(2)).result(timeout=2))
+        self.assertTrue(wait_for(lambda: wal.drained == wal.durable))
+        wal.stop()
+        self.assertEqual([document["scan_id"] for _, document in read_records(path)], [1, 2])
+        self.assertEqual([document["scan_id"] for document in inserted(self.mock_insert_new)], [1, 2])
+
+    def test_corrupt_record_stops_the_drainer(self, mock_notify):
+        """Test a corrupt record in an older segment keeps the segment, instead of skipping the records after it"""
+        wal = self.start(mongo(*[False] * 1000), segment_bytes=400, max_batch_size=1)
+        futures = [wal.submit(scan(i)) for i in range(6)]
+        self.assertTrue(all(future.result(timeout=2) for future in futures))
+        wal.stop()
+        path = wal.segment_path(0)
+        self.assertGreater(len(list(read_records(path))), 1)
+        with open(path, "r+b") as segment:
+            segment.seek(RECORD_HEADER.size + 10)
+            segment.write(b"\xff")
+        patch.stopall()
+
+        wal = self.start(mongo())
+        self.assertTrue(wait_for(lambda: not wal.drainer_thread.is_alive()))
+        self.assertTrue(wal.stalled())
+        wal.stop()
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(wal.read_checkpoint(), WalPosition(0, 0))
+        self.assertEqual(inserted(self.mock_insert_new), [])
+
+    def test_corrupt_record_of_the_current_segment_is_kept(self, mock_notify):
+        """Test a corrupt record followed by acked ones isn't cut off as a torn one on restart"""
+        wal = self.start(mongo(*[False] * 1000))
+        futures = [wal.submit(scan(i)) for i in range(5)]
+        self.assertTrue(all(future.result(timeout=2) for future in futures))
+        wal.stop()
+        path = wal.segment_path(0)
+        size = os.path.getsize(path)
+        record_1 = next(read_records(path))[0]
+        with open(path, "r+b") as segment:
+            segment.seek(record_1 + RECORD_HEADER.size + 10)
+            segment.write(b"\xff")
+        patch.stopall()
+
+        wal = self.start(mongo())
+        self.assertEqual(os.path.getsize(path), size)
+        self.assertEqual(wal.durable, WalPosition(1, 0))
+        self.assertTrue(wal.submit(scan(5)).result(timeout=2))
+        self.assertTrue(wait_for(lambda: not wal.drainer_thread.is_alive()))
+        wal.stop()
+        self.assertEqual([document["scan_id"] for document in inserted(self.mock_insert_new)], [0])
+        self.assertEqual([document["scan_id"] for _, document in read_records(wal.segment_path(1))], [5])
+
+    def test_drained_segments_are_deleted(self, mock_notify):
+        """Test the log rolls over to new segments and the drained ones are deleted"""
+        wal = self.start(mongo(), segment_bytes=200, max_batch_size=1)
+        futures = [wal.submit(scan(i)) for i in range(6)]
+        self.assertTrue(all(future.result(timeout=2) for future in futures))
+        self.assertGreater(wal.durable.segment, 1)
+        self.assertTrue(wait_for(lambda: wal.drained == wal.durable))
+        wal.stop()
+        self.assertEqual(wal.segments(), [wal.durable.segment])
+        self.assertEqual([document["scan_id"] for document in inserted(self.mock_insert_new)], list(range(6)))
+        self.assertEqual(wal.backlog_bytes(), 0)
+
+    def test_drained_scans_are_timed_as_persisted(self, mock_notify):
+        """Test traced scans are timed as persisted once loaded into brain_scans, not when logged"""
+        wal = self.start(mongo())
+        self.assertTrue(wal.submit(traced(scan(1), TraceStage.hub_received)).result(timeout=2))
+        self.assertTrue(wait_for(lambda: wal.drained == wal.durable))
+        wal.stop()
+        (document,) = inserted(self.mock_insert_new)
+        self.assertIn(TraceStage.hub_persisted, document["stage_times"])
+        _, query, update = self.mock_update_many.call_args.args
+        self.assertEqual(query, {"_id": {"$in": [document["_id"]]}})
+        self.assertIn(f"stage_times.{TraceStage.hub_persisted}", update)
+
+    def test_invalid_scan_is_not_acked(self, mock_notify):
+        """Test a scan that can't be made a document is reported as not stored, the others of its batch are logged"""
+        wal = self.start(mongo())
+        invalid = wal.submit((1, 2, "2025-01-01 00:00:00", "BRAIN", b"not a packed scan"))
+        valid = wal.submit(scan(3))
+        self.assertFalse(invalid.result(timeout=2))
+        self.assertTrue(valid.result(timeout=2))
+        wal.stop()
+
+    @patch("fr_hub.wal.delete_scan_file")
+    @patch("fr_hub.wal.DBManager.fetch_all", return_value=[])
+    def test_streamed_retransmission_chunks_are_deleted(self, mock_fetch_all, mock_delete, mock_notify):
+        """Test a streamed scan the drainer finds stored already under its key has its chunks deleted"""
+        wal = self.start(lambda collection_name, documents, durable=False: list(range(len(documents))))
+        file_id = ObjectId()
+        self.assertTrue(wal.submit((1, 2, "2025-01-01 00:00:00", "BRAIN", ScanFile(file_id, 100))).result(timeout=2))
+        self.assertTrue(wait_for(lambda: wal.drained == wal.durable))
+        wal.stop()
+        mock_delete.assert_called_once_with(file_id)
+
+    @patch("fr_hub.wal.delete_scan_file")
+    def test_reloaded_scan_chunks_are_kept(self, mock_delete, mock_notify):
+        """Test a streamed scan loaded already before a crash (same _id) keeps its chunks"""
+        document = {"_id": ObjectId(), "patient_id": 1, "scan_id": 2, "scan_file_id": ObjectId()}
+        db_manager = MagicMock()
+        db_manager.fetch_all.return_value = [{"_id": document["_id"]}]
+        WriteAheadLog.discard_duplicates(db_manager, [document])
+        db_manager.fetch_all.return_value = None
+        WriteAheadLog.discard_duplicates(db_manager, [document])
+        mock_delete.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
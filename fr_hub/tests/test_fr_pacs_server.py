@@ -1,4 +1,16 @@
+import socket
+import threading
+import time
 import unittest
+from unittest.mock import patch
+
+from common.config import AckStatus, MessageType, TraceStage
+from common.protocol import brain_scan_frames, decode_ack, encode_brain_scan, recv_frame, send_frame
+from common.scan_store import ScanFile
+from common.tracing import traced
+from common.utils import generate_brain_scan
+from fr_hub.group_commit import BrainScanGroupCommitter
+from fr_hub.server import FrHUBBrainScanServer
 
 
 class TestFrPACSBrainScanServer(unittest.TestCase):
@@ -13,6 +25,108 @@ class TestFrPACSBrainScanServer(unittest.TestCase):
     def test_handle_brain_scan_failure(self):
         pass
 
+    @patch("fr_hub.group_commit.save_brain_scans")
+    def test_handle_brain_scan_pipelined_acks(self, mock_save):
+        """Test pipelined scans are all stored and acked with their sequence numbers"""
+        mock_save.side_effect = lambda scans: [scan[1] != 2 for scan in scans]
+        server = FrHUBBrainScanServer(host="127.0.0.1", port=0, max_in_flight=2)
+        hub_socket, pacs_socket = socket.socketpair()
+        handler = threading.Thread(target=server.handle_brain_scan, args=(hub_socket,))
+        handler.start()
+
+        for seq in range(1, 6):
+            send_frame(
+                pacs_socket,
+                MessageType.brain_scan,
+                encode_brain_scan(seq, (1, seq, "2025-01-01 00:00:00", "BRAIN", "|o|")),
+            )
+        acks = {}
+        for _ in range(5):
+            seq, status, _ = decode_ack(recv_frame(pacs_socket)[1])
+            acks[seq] = status
+        pacs_socket.close()
+        handler.join(timeout=2)
+        server.stop()
+
+        self.assertFalse(handler.is_alive())
+        self.assertEqual(sum(len(call.args[0]) for call in mock_save.call_args_list), 5)
+        self.assertEqual(acks[2], AckStatus.error)
+        self.assertEqual(sorted(seq for seq, status in acks.items() if status == AckStatus.stored), [1, 3, 4, 5])
+
+    @patch("fr_hub.scan_stream.ScanUpload")
+    @patch("fr_hub.group_commit.save_brain_scans")
+    def test_handle_streamed_brain_scan(self, mock_save, mock_scan_upload):
+        """Test a scan sent in chunks is written to chunk storage as it arrives and stored once it ended"""
+        mock_save.side_effect = lambda scans: [True for _ in scans]
+        upload = mock_scan_upload.return_value
+        upload.received = 0
+        upload.write.side_effect = lambda chunk: setattr(upload, "received", upload.received + len(chunk))
+        upload.finish.return_value = ScanFile("file", 0)
+        server = FrHUBBrainScanServer(host="127.0.0.1", port=0)
+        hub_socket, pacs_socket = socket.socketpair()
+        handler = threading.Thread(target=server.handle_brain_scan, args=(hub_socket,))
+        handler.start()
+
+        scan_data = generate_brain_scan(20, 20)
+        scan = traced((1, 2, "2025-01-01 00:00:00", "BRAIN", scan_data), TraceStage.pacs_sent)
+        frames = list(brain_scan_frames(7, scan, chunk_size=16))
+        for msg_type, payload in frames:
+            send_frame(pacs_socket, msg_type, payload)
+        seq, status, _ = decode_ack(recv_frame(pacs_socket)[1])
+        pacs_socket.close()
+        handler.join(timeout=2)
+        server.stop()
+
+        self.assertEqual((seq, status), (7, AckStatus.stored))
+        self.assertEqual(len(frames), 2 + len(upload.write.call_args_list))
+        self.assertEqual(b"".join(call.args[0] for call in upload.write.call_args_list), scan_data)
+        (saved,) = mock_save.call_args.args[0]
+        self.assertEqual(saved[:5], (1, 2, "2025-01-01 00:00:00", "BRAIN", ScanFile("file", 0)))
+        # the trace comes with the begin frame
+        self.assertEqual(saved[5].trace_id, scan[5].trace_id)
+        self.assertEqual(list(saved[5].stage_times), [TraceStage.pacs_sent, TraceStage.hub_received])
+
+    @patch("fr_hub.group_commit.save_brain_scans", side_effect=lambda scans: [True for _ in scans])
+    def test_client_not_reading_acks_doesnt_block_the_others(self, mock_save):
+        """Test a FrPACS that stops reading its acks only holds up its own connection, not the group commit"""
+        server = FrHUBBrainScanServer(
+            host="127.0.0.1", port=0, committer=BrainScanGroupCommitter(max_linger_ms=1, writers=1)
+        )
+        handlers, pacs_sockets = [], []
+        for _ in range(2):
+            hub_socket, pacs_socket = socket.socketpair()
+            hub_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1024)
+            handler = threading.Thread(target=server.handle_brain_scan, args=(hub_socket,), daemon=True)
+            handler.start()
+            handlers.append(handler)
+            pacs_sockets.append(pacs_socket)
+        stuck, healthy = pacs_sockets
+
+        def flood():
+            try:
+                for seq in range(1, 1000):
+                    scan = (1, seq, "2025-01-01 00:00:00", "BRAIN", "|o|")
+                    send_frame(stuck, MessageType.brain_scan, encode_brain_scan(seq, scan))
+            except OSError:
+                pass
+
+        flooder = threading.Thread(target=flood, daemon=True)
+        flooder.start()
+        # the acks of the stuck connection fill its send buffer
+        time.sleep(0.5)
+        healthy.settimeout(2)
+        send_frame(healthy, MessageType.brain_scan, encode_brain_scan(1, (2, 1, "2025-01-01 00:00:00", "BRAIN", "|o|")))
+        self.assertEqual(decode_ack(recv_frame(healthy)[1])[:2], (1, AckStatus.stored))
+
+        for pacs_socket in pacs_sockets:
+            # wakes up the flooding thread, closing alone wouldn't while it's sending
+            pacs_socket.shutdown(socket.SHUT_RDWR)
+            pacs_socket.close()
+        for handler in handlers:
+            handler.join(timeout=2)
+        server.stop()
+        self.assertFalse(any(handler.is_alive() for handler in handlers))
+
 
 if __name__ == '__main__':
     unittest.main()
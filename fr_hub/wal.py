@@ -0,0 +1,351 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Iterator, List, NamedTuple, Tuple
+
+import bson
+from bson import ObjectId
+
+from common import metrics
+from common.config import (
+    BRAIN_SCAN_BATCH_MAX_SIZE,
+    BRAIN_SCAN_NOTIFY_PORT,
+    BRAIN_SCAN_WAL_DRAIN_BATCH_SIZE,
+    BRAIN_SCAN_WAL_FSYNC_MS,
+    BRAIN_SCAN_WAL_RETRY_S,
+    BRAIN_SCAN_WAL_SEGMENT_BYTES,
+    NeuroDataCollections,
+)
+from common.db_manager import DBManager
+from common.logger import log_event, logger
+from common.notifier import notify_work
+from common.scan_store import delete_scan_file
+from common.utils import brain_scan_document, record_persisted
+from fr_hub.group_commit import BrainScanGroupCommitter
+
+# a record is its BSON document preceded by its size and CRC32, so a torn write at the end of the log is detected
+RECORD_HEADER = struct.Struct("!II")
+SEGMENT_SUFFIX = ".wal"
+CHECKPOINT_FILE = "checkpoint.json"
+
+WAL_FSYNC_SECONDS = metrics.histogram("fr_hub_wal_fsync_seconds", "Time to write and fsync a batch to the WAL")
+WAL_BACKLOG_BYTES = metrics.gauge("fr_hub_wal_backlog_bytes", "Bytes of the WAL not loaded into MongoDB yet")
+WAL_DRAINED = metrics.counter("fr_hub_wal_drained_total", "Brain scans loaded from the WAL into MongoDB")
+WAL_DRAIN_FAILURES = metrics.counter("fr_hub_wal_drain_failures_total", "Failed loads of WAL batches into MongoDB")
+WAL_DRAINER_STOPPED = metrics.gauge("fr_hub_wal_drainer_stopped", "1 once the drainer stopped at a corrupt WAL record")
+
+
+class WalPosition(NamedTuple):
+    segment: int
+    offset: int
+
+
+def encode_record(document: dict) -> bytes:
+    payload = bson.encode(document)
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_records(path: str, offset: int = 0, end: int = -1) -> Iterator[Tuple[int, dict]]:
+    """
+    Reads the records of a segment through a memory map, so the OS pages it in rather than copying it all at once
+    :param path: segment file
+    :param offset: where the first record starts
+    :param end: where to stop, the end of the file if negative
+    :return: (offset after the record, document) of every whole record, stopping at the first torn or corrupt one
+    """
+    with open(path, "rb") as segment_file:
+        size = os.fstat(segment_file.fileno()).st_size
+        end = size if end < 0 else min(end, size)
+        if end <= offset:
+            return
+        with mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ) as segment:
+            while offset + RECORD_HEADER.size <= end:
+                payload_size, crc = RECORD_HEADER.unpack_from(segment, offset)
+                start = offset + RECORD_HEADER.size
+                if start + payload_size > end:
+                    return
+                payload = segment[start:start + payload_size]
+                if zlib.crc32(payload) != crc:
+                    return
+                offset = start + payload_size
+                yield offset, bson.decode(payload)
+
+
+def torn_tail(path: str, offset: int) -> bool:
+    """
+    Whether the bytes of a segment from `offset` on are a record cut short by a crash: the record there reaches the end
+    of the file, so no acked record follows it
+    :param path: segment file
+    :param offset: where the first record that can't be read starts
+    """
+    with open(path, "rb") as segment_file:
+        size = os.fstat(segment_file.fileno()).st_size
+        segment_file.seek(offset)
+        header = segment_file.read(RECORD_HEADER.size)
+    if len(header) < RECORD_HEADER.size:
+        return True
+    payload_size, _ = RECORD_HEADER.unpack(header)
+    return offset + RECORD_HEADER.size + payload_size >= size
+
+
+class WriteAheadLog(BrainScanGroupCommitter):
+    """Group commit to a local append-only log instead of MongoDB, drained into MongoDB in the background
+
+    Scans are acked as soon as they're in the log: each batch of the group commit is appended to the current segment
+    file with a single write and fsync. The records are the BrainScan documents with their _id, so FrBRAIN gets
+    the same documents as without the log. A drainer thread reads the segments back through a memory map and loads
+    them into the brain_scans collection with one insert per batch, then checkpoints how far it got and deletes the
+    segments it's done with. While MongoDB is unavailable the drainer keeps trying and FrHUB keeps accepting scans.
+    On restart the drainer resumes from the checkpoint, and a torn record at the end of the log (crash during a write)
+    is cut off: it was never acked. A corrupt record followed by others is kept with them, the log going on in a new
+    segment, and the drainer stops there: FrHUB is then over its load budget (see FlowController) until restarted. Scans loaded but not checkpointed before a crash are loaded again, their _id
+    makes that a no-op, as the idempotency key does for retransmissions.
+    Large scans still go to chunk storage (MongoDB) before being logged, the log only keeps their file id.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        segment_bytes: int = BRAIN_SCAN_WAL_SEGMENT_BYTES,
+        max_batch_size: int = BRAIN_SCAN_BATCH_MAX_SIZE,
+        fsync_ms: float = BRAIN_SCAN_WAL_FSYNC_MS,
+        drain_batch_size: int = BRAIN_SCAN_WAL_DRAIN_BATCH_SIZE,
+        retry_s: float = BRAIN_SCAN_WAL_RETRY_S,
+    ) -> None:
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.drain_batch_size = drain_batch_size
+        self.retry_s = retry_s
+        os.makedirs(directory, exist_ok=True)
+        self.drained = self.read_checkpoint()
+        self.durable = self.recover()
+        self.file = open(self.segment_path(self.durable.segment), "ab")
+        if not self.durable.offset:
+            self.sync_directory()
+        self.appended = threading.Event()
+        self.drainer_stopped = False
+        WAL_DRAINER_STOPPED.set(0)
+        WAL_BACKLOG_BYTES.set_function(self.backlog_bytes)
+        # a single writer keeps the records in the order of their batches
+        super().__init__(max_batch_size=max_batch_size, max_linger_ms=fsync_ms, writers=1)
+        self.drainer_thread = threading.Thread(target=self.drain, name="fr_hub_wal_drainer", daemon=True)
+        self.drainer_thread.start()
+
+    def segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:010d}{SEGMENT_SUFFIX}")
+
+    def segments(self) -> List[int]:
+        return sorted(
+            int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX)
+        )
+
+    def read_checkpoint(self) -> WalPosition:
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT_FILE)) as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+            return WalPosition(checkpoint["segment"], checkpoint["offset"])
+        except FileNotFoundError:
+            segments = self.segments()
+            return WalPosition(segments[0] if segments else 0, 0)
+
+    def write_checkpoint(self, position: WalPosition) -> None:
+        """Replaces the checkpoint atomically, a crash leaves either the former or the new one"""
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        with open(f"{path}.tmp", "w") as checkpoint_file:
+            json.dump(position._asdict(), checkpoint_file)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.replace(f"{path}.tmp", path)
+        self.sync_directory()
+
+    def sync_directory(self) -> None:
+        """Makes created, renamed and deleted files of the log directory durable"""
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def recover(self) -> WalPosition:
+        """
+        End of the log: the last segment is cut after its last whole record if a torn one follows it. If that's a
+        corrupt record followed by acked ones instead, the segment is left as it is and the log goes on in a new one.
+        """
+        segments = self.segments()
+        if not segments:
+            return WalPosition(self.drained.segment, 0)
+        last = segments[-1]
+        path = self.segment_path(last)
+        offset = self.drained.offset if last == self.drained.segment else 0
+        for offset, _ in read_records(path, offset):
+            pass
+        if os.path.getsize(path) > offset:
+            if not torn_tail(path, offset):
+                logger.error(
+                    f"Brain scan WAL has a corrupt record followed by acked ones: {path} at {offset}, the segment is "
+                    f"kept for them to be recovered and the drainer stops there"
+                )
+                return WalPosition(last + 1, 0)
+            logger.warning(f"Cutting off a torn record at the end of the brain scan WAL: {path} at {offset}")
+            os.truncate(path, offset)
+        return WalPosition(last, offset)
+
+    def write_batch(self, scans: List[tuple]) -> List[bool]:
+        """
+        Appends the scans to the log, they're durable once this returns. The log can't tell a retransmission from a
+        new scan, so every logged scan is acked as stored: only retransmissions caught by the recent keys of FrHUB
+        (see RecentScanKeys) are acked as duplicates, the others are skipped by the drainer (see discard_duplicates)
+        """
+        results, documents = [], []
+        for scan_data in scans:
+            try:
+                document = brain_scan_document(scan_data)
+                document["_id"] = ObjectId()
+                documents.append(document)
+                results.append(True)
+            except Exception as e:
+                logger.error(f"Failed to save brain scan: {e}")
+                results.append(False)
+        if not documents:
+            return results
+        data = b"".join(encode_record(document) for document in documents)
+
+        started = time.perf_counter()
+        segment, offset = self.durable
+        if offset and offset + len(data) > self.segment_bytes:
+            self.file.close()
+            segment, offset = segment + 1, 0
+            self.file = open(self.segment_path(segment), "ab")
+            self.sync_directory()
+        try:
+            self.file.write(data)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        except Exception:
+            # the next batch mustn't be appended after a partial record, which would end the log for the drainer
+            self.file.truncate(offset)
+            raise
+        WAL_FSYNC_SECONDS.observe(time.perf_counter() - started)
+        self.durable = WalPosition(segment, offset + len(data))
+        self.appended.set()
+        return results
+
+    def read_batch(self, position: WalPosition, durable: WalPosition) -> Tuple[List[dict], WalPosition]:
+        """Documents of up to drain_batch_size records from `position` on, and the position after them"""
+        end = durable.offset if position.segment == durable.segment else -1
+        documents = []
+        for offset, document in read_records(self.segment_path(position.segment), position.offset, end):
+            documents.append(document)
+            position = WalPosition(position.segment, offset)
+            if len(documents) >= self.drain_batch_size:
+                break
+        return documents, position
+
+    def segment_end(self, position: WalPosition) -> bool:
+        """Whether `position` is the end of its segment, rather than a record that can't be read"""
+        return position.offset >= os.path.getsize(self.segment_path(position.segment))
+
+    def drain(self) -> None:
+        """Loads the log into MongoDB until stopped, then what's left of it unless MongoDB is unavailable"""
+        db_manager = DBManager()
+        position = self.drained
+        while True:
+            durable = self.durable
+            if position == durable:
+                if not self.writer_threads_alive():
+                    break
+                self.appended.wait(0.5)
+                self.appended.clear()
+                continue
+            documents, end = self.read_batch(position, durable)
+            if not documents:
+                if position.segment < durable.segment and self.segment_end(position):
+                    # done with this segment, the writer has moved on to the next one
+                    self.checkpoint(WalPosition(position.segment + 1, 0))
+                    position = self.drained
+                    continue
+                # a corrupt record: the scans after it were acked, so the segment is kept for them to be recovered
+                logger.error(
+                    f"Brain scan WAL has a corrupt record at {position}, it's drained up to there and not any further"
+                )
+                self.drainer_stopped = True
+                WAL_DRAINER_STOPPED.set(1)
+                break
+            duplicates = db_manager.insert_new(NeuroDataCollections.brain_scans, documents, durable=True)
+            if duplicates is None:
+                WAL_DRAIN_FAILURES.inc()
+                if not self.writer_threads_alive():
+                    logger.warning(f"Brain scan WAL isn't drained, the rest is loaded on the next start: {position}")
+                    break
+                time.sleep(self.retry_s)
+                continue
+            skipped = set(duplicates)
+            # with the log, scans are persisted for FrBRAIN once they're in brain_scans
+            record_persisted([document for index, document in enumerate(documents) if index not in skipped])
+            if duplicates:
+                self.discard_duplicates(db_manager, [documents[duplicate] for duplicate in duplicates])
+            WAL_DRAINED.inc(len(documents))
+            log_event("wal_drained", "Loaded %d brain scans from the WAL into MongoDB", len(documents))
+            # waking up FrBRAIN instead of letting it find the scans on its next poll
+            notify_work(BRAIN_SCAN_NOTIFY_PORT)
+            self.checkpoint(end)
+            position = end
+
+    @staticmethod
+    def discard_duplicates(db_manager: DBManager, documents: List[dict]) -> None:
+        """
+        Handles documents of the log that weren't inserted, breaking a unique index: either they were loaded before a
+        crash (same _id), or they're retransmissions of scans stored already, whose chunks would never be read
+        """
+        loaded = db_manager.fetch_all(
+            NeuroDataCollections.brain_scans, {"_id": {"$in": [document["_id"] for document in documents]}}, {"_id": 1}
+        )
+        if loaded is None:
+            # keeping chunks that may not be needed rather than deleting those of a stored scan
+            logger.warning(f"Couldn't tell {len(documents)} brain scans of the WAL loaded already from retransmissions")
+            return
+        loaded_ids = {document["_id"] for document in loaded}
+        retransmissions = [document for document in documents if document["_id"] not in loaded_ids]
+        for document in retransmissions:
+            if "scan_file_id" in document:
+                delete_scan_file(document["scan_file_id"])
+        if retransmissions:
+            log_event("scan_duplicate", "Didn't load %d brain scans of the WAL again", len(retransmissions))
+
+    def checkpoint(self, position: WalPosition) -> None:
+        """Records that the log is drained up to `position` and deletes the segments before it"""
+        self.write_checkpoint(position)
+        self.drained = position
+        for segment in self.segments():
+            if segment < position.segment:
+                os.remove(self.segment_path(segment))
+
+    def stalled(self) -> bool:
+        """Whether the drainer stopped at a corrupt record, so what's acked from now on piles up in the log"""
+        return self.drainer_stopped
+
+    def writer_threads_alive(self) -> bool:
+        return self.running_status or any(writer_thread.is_alive() for writer_thread in self.writer_threads)
+
+    def backlog_bytes(self) -> int:
+        drained, durable = self.drained, self.durable
+        if drained.segment == durable.segment:
+            return durable.offset - drained.offset
+        backlog = durable.offset - drained.offset
+        for segment in range(drained.segment, durable.segment):
+            try:
+                backlog += os.path.getsize(self.segment_path(segment))
+            except FileNotFoundError:
+                pass
+        return backlog
+
+    def stop(self) -> None:
+        """Stops accepting scans, logs the queued ones and waits for the drainer to load what it can."""
+        super().stop()
+        self.appended.set()
+        self.drainer_thread.join()
+        self.file.close()
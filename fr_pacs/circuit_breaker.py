@@ -0,0 +1,97 @@
+import random
+import threading
+import time
+
+from common.config import (
+    BRAIN_SCAN_CIRCUIT_FAILURES,
+    BRAIN_SCAN_RECONNECT_MAX_S,
+    BRAIN_SCAN_RECONNECT_S,
+    CircuitState,
+)
+
+
+class Backoff:
+    """Jittered exponential backoff: the n-th delay in a row is between half and all of base_s * 2 ** (n - 1), capped at
+    max_s. The jitter keeps the connections of a pool (and FrPACS instances) from retrying in lockstep."""
+
+    def __init__(
+        self, base_s: float = BRAIN_SCAN_RECONNECT_S, max_s: float = BRAIN_SCAN_RECONNECT_MAX_S, rng=random
+    ) -> None:
+        self.base_s = base_s
+        self.max_s = max_s
+        self.rng = rng
+        self.attempts = 0
+
+    def next_delay(self) -> float:
+        self.attempts += 1
+        # the exponent is capped so long outages don't overflow it
+        delay = min(self.base_s * 2 ** min(self.attempts - 1, 32), self.max_s)
+        return delay / 2 + self.rng.uniform(0, delay / 2)
+
+    def reset(self) -> None:
+        self.attempts = 0
+
+
+class CircuitBreaker:
+    """Whether the connections of the FrPACS pool may try to reach FrHUB
+
+        - closed: FrHUB is up, or failed fewer than `failure_threshold` attempts in a row, every connection may connect
+        - open: FrHUB is considered down, nobody connects until the retry time, drawn from `backoff`
+        - half_open: the retry time is over and a single connection probes FrHUB. Its success closes the circuit, its
+          failure opens it again for the next, longer, delay
+    """
+
+    def __init__(self, failure_threshold: int = BRAIN_SCAN_CIRCUIT_FAILURES, backoff: Backoff = None) -> None:
+        self.failure_threshold = failure_threshold
+        self.backoff = backoff or Backoff()
+        self.state = CircuitState.closed
+        # failed attempts in a row, of any connection
+        self.failures = 0
+        # monotonic time the open circuit lets a probe through
+        self.retry_at = 0.0
+        self.lock = threading.Lock()
+
+    def allow_attempt(self) -> bool:
+        """Whether a connection may try to connect now, the first one allowed after the retry time is the probe"""
+        with self.lock:
+            if self.state == CircuitState.closed:
+                return True
+            if self.state == CircuitState.open and time.monotonic() >= self.retry_at:
+                self.state = CircuitState.half_open
+                return True
+            return False
+
+    def wait_time(self) -> float:
+        """Seconds until the open circuit lets a probe through, 0 if it isn't open"""
+        if self.state != CircuitState.open:
+            return 0.0
+        return max(self.retry_at - time.monotonic(), 0.0)
+
+    def record_success(self) -> bool:
+        """
+        A connection connected
+        :return: whether this closed the circuit
+        """
+        with self.lock:
+            closed = self.state != CircuitState.closed
+            self.state = CircuitState.closed
+            self.failures = 0
+            self.backoff.reset()
+            return closed
+
+    def record_failure(self) -> float:
+        """
+        A connection couldn't connect
+        :return: seconds the circuit opened for, 0 if this didn't open it
+        """
+        with self.lock:
+            self.failures += 1
+            # an attempt started before the circuit opened doesn't extend its delay
+            if self.state == CircuitState.open:
+                return 0.0
+            if self.state == CircuitState.closed and self.failures < self.failure_threshold:
+                return 0.0
+            delay = self.backoff.next_delay()
+            self.retry_at = time.monotonic() + delay
+            self.state = CircuitState.open
+            return delay
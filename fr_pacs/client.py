@@ -1,13 +1,346 @@
-import base64
-import json
+import queue
 import random as rn
 import socket
 import threading
+import time
+import uuid
 from datetime import datetime
+from typing import Dict, List, Optional, Tuple
 
-from common.config import BRAIN_SCAN_PORT, BRAIN_SCAN_HOST
-from common.logger import logger
+from common import metrics
+from common.config import (
+    BRAIN_SCAN_ACK_TIMEOUT_S,
+    BRAIN_SCAN_CIRCUIT_FAILURES,
+    BRAIN_SCAN_CONNECTIONS,
+    BRAIN_SCAN_HOST,
+    BRAIN_SCAN_PORT,
+    BRAIN_SCAN_RATE,
+    BRAIN_SCAN_RECONNECT_MAX_S,
+    BRAIN_SCAN_RECONNECT_S,
+    BRAIN_SCAN_WINDOW,
+    AckStatus,
+    CircuitState,
+    MessageType,
+    TraceStage,
+)
+from common.logger import log_event, logger
+from common.protocol import BUSY_SEQ, brain_scan_frames, decode_scan_ack, recv_frame, send_frame
+from common.tracing import scan_trace, traced
 from common.utils import generate_brain_scan
+from fr_pacs.circuit_breaker import Backoff, CircuitBreaker
+
+SCANS_SENT = metrics.counter("fr_pacs_scans_sent_total", "Brain scans sent to FrHUB")
+SCANS_NOT_SENT = metrics.counter("fr_pacs_scans_not_sent_total", "Brain scans given up on, logged as not sent")
+SCAN_ACKS = metrics.counter("fr_pacs_scan_acks_total", "Acks received from FrHUB", ("status",))
+SCAN_ACK_SECONDS = metrics.histogram("fr_pacs_scan_ack_seconds", "Time from sending a brain scan to its ack")
+IN_FLIGHT_SCANS = metrics.gauge("fr_pacs_in_flight_scans", "Brain scans sent but not acknowledged yet")
+CONNECTIONS_UP = metrics.gauge("fr_pacs_connections_up", "Connections of the sender pool connected to FrHUB")
+CONNECTION_FAILURES = metrics.counter(
+    "fr_pacs_connection_failures_total", "Connections of the sender pool that failed or were dropped", ("reason",)
+)
+CONNECTIONS_REPLACED = metrics.counter(
+    "fr_pacs_connections_replaced_total", "Broken connections of the sender pool connected again"
+)
+CIRCUIT_OPEN = metrics.gauge("fr_pacs_circuit_open", "1 while FrHUB is considered down and isn't connected to")
+
+
+def new_scan_id() -> int:
+    """Scan id unique across FrPACS instances and restarts, positive and within the int64 of the scan frames"""
+    return uuid.uuid4().int >> 65
+
+
+class ScanConnection:
+    """
+    One persistent connection of the sender pool to FrHUB
+
+    It has its own sending thread, taking scans from the pool while it has room in its window, and its own ack thread.
+    The window is also bounded by the credits FrHUB grants with its acks (see fr_hub/flow_control.py): a new connection
+    starts with a single credit until its first ack, and acks of older FrHUB, without credits, leave the window as is.
+    A connection FrHUB rejects as over its budget doesn't connect again before the retry-after time it's given.
+    Broken connections (send or ack errors, or scans unacknowledged for BRAIN_SCAN_ACK_TIMEOUT_S) are closed, their
+    unacknowledged scans are logged as not sent, and a new connection is made for the next scan. Failed attempts to
+    connect are retried with jittered exponential backoff, and only while the client's circuit breaker lets them.
+    """
+
+    def __init__(self, client: "FrPACSBrainScanClient", index: int) -> None:
+        self.client = client
+        self.index = index
+        self.socket: Optional[socket.socket] = None
+        self.seq = 0
+        # scans sent but not yet acknowledged by FrHUB, with the perf_counter they were sent at, keyed by sequence number
+        self.in_flight: Dict[int, Tuple[tuple, float]] = {}
+        self.lock = threading.Lock()
+        # notified whenever a scan may be sent: acks, dropped scans and more credits
+        self.can_send = threading.Condition(self.lock)
+        # scans FrHUB lets this connection have unacknowledged, None for older FrHUB not granting credits
+        self.credits: Optional[int] = None
+        self.thread: Optional[threading.Thread] = None
+        # health
+        self.connected_at: Optional[float] = None
+        self.last_ack_at: Optional[float] = None
+        self.scans_sent = 0
+        self.scans_acked = 0
+        # connection attempts failed in a row
+        self.failures = 0
+        self.replacements = 0
+        # monotonic time before which a connection that couldn't connect doesn't try again
+        self.retry_at = 0.0
+        self.backoff = Backoff(client.reconnect_s, client.reconnect_max_s)
+        # monotonic time before which FrHUB asked not to connect again
+        self.busy_until = 0.0
+
+    @property
+    def connected(self) -> bool:
+        return self.socket is not None
+
+    def health(self) -> dict:
+        return {
+            "connection": self.index,
+            "connected": self.connected,
+            "connected_at": self.connected_at,
+            "last_ack_at": self.last_ack_at,
+            "scans_sent": self.scans_sent,
+            "scans_acked": self.scans_acked,
+            "in_flight": len(self.in_flight),
+            "credits": self.credits,
+            "failures": self.failures,
+            "replacements": self.replacements,
+        }
+
+    def start(self) -> None:
+        """Connects (success or failure doesn't matter, see send_brain_scans) and starts the sending thread."""
+        try:
+            self.connect()
+        except Exception as e:
+            self.connect_failed(e)
+        self.thread = threading.Thread(target=self.send_brain_scans, name=f"fr_pacs-sender-{self.index}", daemon=True)
+        self.thread.start()
+
+    def send_brain_scans(self) -> None:
+        """Sends scans of the pool until the client is stopped"""
+        try:
+            while self.client.running_status:
+                self.check_stalled()
+                # waiting until fewer than `window` scans are unacknowledged
+                if not self.acquire_slot():
+                    break
+
+                client_socket = self.socket
+                if client_socket is None:
+                    # the other connections take the scans meanwhile, and while none is up the scans wait for the
+                    # circuit to open (see FrPACSBrainScanClient.circuit_opened)
+                    delay = self.reconnect_delay() or self.client.circuit.wait_time()
+                    if delay:
+                        self.client.stopped.wait(min(delay, 1))
+                        continue
+                    if not self.client.circuit.allow_attempt():
+                        # another connection is probing FrHUB
+                        self.client.stopped.wait(0.1)
+                        continue
+                    try:
+                        client_socket = self.connect()
+                    except Exception as e:
+                        self.connect_failed(e)
+                        continue
+
+                scan = self.client.next_scan()
+                if scan is None:
+                    continue
+
+                self.send(client_socket, scan)
+        except Exception as e:
+            logger.error(f"Exception in send_brain_scans of connection {self.index}: {e}")
+        finally:
+            self.close_socket()
+
+    def send(self, client_socket: socket.socket, scan: tuple) -> None:
+        # the trace id goes along with the scan, so its way through FrHUB and FrBRAIN can be timed
+        scan = traced(scan, TraceStage.pacs_sent)
+        with self.lock:
+            self.seq += 1
+            seq = self.seq
+            self.in_flight[seq] = scan, time.perf_counter()
+        try:
+            # sending the scan (in several frames if it's large), its ack is handled by receive_acks
+            log_event(
+                "scan_sent", "Sending brain scan %s of patient %s to FrHUB, %d bytes",
+                scan[1], scan[0], len(scan[4]), seq=seq, connection=self.index, trace_id=scan[5].trace_id,
+            )
+            for msg_type, payload in brain_scan_frames(seq, scan):
+                send_frame(client_socket, msg_type, payload)
+            self.scans_sent += 1
+            SCANS_SENT.inc()
+        except Exception as e:
+            logger.error(f"Exception while sending brain scans on connection {self.index}: {e}")
+            # in case if FrHub suddenly stops so it'll come to exception when sending the data,
+            # To survive reboots - we have to make sure it gets closed and then empty so that in next loop FrPACS can try to re-connect again (to check if FrHUB is restarted)
+            # this also logs every unacknowledged scan of the connection as not sent
+            CONNECTION_FAILURES.labels("send").inc()
+            self.close_socket(client_socket)
+            # the ack thread may have closed the connection before this scan was registered
+            self.drop_scan(seq)
+
+    def acquire_slot(self) -> bool:
+        """
+        Blocks until a scan may be sent without exceeding the window or the credits granted by FrHUB, False if the
+        client is stopped meanwhile. Only this connection's sending thread adds scans, so the slot stays free.
+        """
+        while True:
+            with self.can_send:
+                if len(self.in_flight) < self.send_limit():
+                    return True
+                if not self.client.running_status:
+                    return False
+                notified = self.can_send.wait(timeout=1)
+            if not notified:
+                self.check_stalled()
+
+    def send_limit(self) -> int:
+        return self.client.window if self.credits is None else min(self.client.window, self.credits)
+
+    def reconnect_delay(self) -> float:
+        """Seconds to wait before connecting again: the backoff of the failed attempts, or as long as FrHUB asked"""
+        return max(max(self.busy_until, self.retry_at) - time.monotonic(), 0)
+
+    def check_stalled(self) -> None:
+        """Replaces the connection if its oldest unacknowledged scan has been waiting for longer than the ack timeout"""
+        with self.lock:
+            oldest = next(iter(self.in_flight.values()), None)
+        if oldest is not None and time.perf_counter() - oldest[1] > BRAIN_SCAN_ACK_TIMEOUT_S:
+            logger.warning(
+                f"No ack from FrHUB for {BRAIN_SCAN_ACK_TIMEOUT_S} s on connection {self.index}, replacing it: "
+                f"{self.health()}"
+            )
+            CONNECTION_FAILURES.labels("stalled").inc()
+            self.close_socket()
+
+    def connect(self) -> socket.socket:
+        """Connects to FrHUB and starts reading acknowledgements of this connection."""
+        if not self.client.running_status:
+            raise ConnectionError("FrPACS is stopping")
+        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            client_socket.connect((self.client.host, self.client.port))
+            # scans are pipelined, so they shouldn't wait for the ack of the previous one (Nagle's algorithm)
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.lock:
+                # stop closes the connections it finds, so one made meanwhile mustn't be kept
+                if not self.client.running_status:
+                    raise ConnectionError("FrPACS is stopping")
+                self.socket = client_socket
+                # a single scan until FrHUB grants credits with its first ack
+                self.credits = 1
+        except Exception:
+            client_socket.close()
+            raise
+        self.backoff.reset()
+        if self.client.circuit.record_success():
+            self.client.circuit_closed()
+        if self.connected_at is not None:
+            self.replacements += 1
+            CONNECTIONS_REPLACED.inc()
+            logger.info(f"Connection {self.index} to FrHUB replaced: {self.health()}")
+        self.connected_at = time.time()
+        self.failures = 0
+        threading.Thread(
+            target=self.receive_acks, args=(client_socket,), name=f"fr_pacs-acks-{self.index}", daemon=True
+        ).start()
+        return client_socket
+
+    def connect_failed(self, error: Exception) -> None:
+        self.failures += 1
+        delay = self.backoff.next_delay()
+        self.retry_at = time.monotonic() + delay
+        CONNECTION_FAILURES.labels("connect").inc()
+        open_for = self.client.circuit.record_failure()
+        if open_for:
+            self.client.circuit_opened(open_for, error)
+        elif self.client.circuit.state == CircuitState.closed:
+            # while the circuit is open the client logs the outage, once per probe
+            logger.warning(
+                f"Connection {self.index} couldn't connect to FrHUB ({self.failures} in a row), trying again in "
+                f"{delay:.2f} s: {error}"
+            )
+
+    def receive_acks(self, client_socket: socket.socket) -> None:
+        """
+        Reads acknowledgements sent by FrHUB and frees the window slot of each acknowledged scan
+        :param client_socket: connection this thread belongs to
+        :return:
+        """
+        try:
+            while self.client.running_status:
+                frame = recv_frame(client_socket)
+                if frame is None:
+                    raise ConnectionError("FrHUB closed the connection")
+                msg_type, payload = frame
+                if msg_type != MessageType.ack:
+                    logger.warning(f"Ignoring unexpected message type from FrHUB: {msg_type}")
+                    continue
+
+                seq, status, response, credits, retry_after = decode_scan_ack(payload)
+                if seq == BUSY_SEQ and status == AckStatus.busy:
+                    self.rejected(client_socket, response, retry_after)
+                    return
+                with self.can_send:
+                    in_flight = self.in_flight.pop(seq, None)
+                    # acks of older FrHUB don't grant credits, the window alone applies
+                    self.credits = credits
+                    self.can_send.notify()
+                if in_flight is None:
+                    # scan was already given up on when its connection was reset
+                    continue
+                scan, sent_at = in_flight
+                self.last_ack_at = time.time()
+                self.scans_acked += 1
+                SCAN_ACKS.labels(status).inc()
+                SCAN_ACK_SECONDS.observe(time.perf_counter() - sent_at)
+                # a duplicate was stored by an earlier send of the scan
+                if status in (AckStatus.stored, AckStatus.duplicate):
+                    log_event(
+                        "scan_acked", "Received an acknowledgment in FrPACS from FrHUB: %s", response,
+                        seq=seq, connection=self.index,
+                    )
+                else:
+                    logger.error(f"FrHUB couldn't store brain scan: {response}")
+                    logger.error(f"This scan isn't being sent: {self.client.describe_scan(scan)}")
+        except Exception as e:
+            if self.client.running_status and client_socket is self.socket:
+                logger.error(f"Exception while receiving acknowledgments on connection {self.index}: {e}")
+                CONNECTION_FAILURES.labels("ack").inc()
+                self.close_socket(client_socket)
+
+    def rejected(self, client_socket: socket.socket, response: str, retry_after: Optional[float]) -> None:
+        """FrHUB is over its budget: closing the connection and not connecting again for `retry_after` seconds"""
+        retry_after = BRAIN_SCAN_RECONNECT_S if retry_after is None else retry_after
+        logger.warning(f"FrHUB rejected connection {self.index}, connecting again in {retry_after} s: {response}")
+        self.busy_until = time.monotonic() + retry_after
+        CONNECTION_FAILURES.labels("rejected").inc()
+        self.close_socket(client_socket)
+
+    def drop_scan(self, seq: int) -> None:
+        """Gives up on an unacknowledged scan, logging it as not sent."""
+        with self.can_send:
+            in_flight = self.in_flight.pop(seq, None)
+            self.can_send.notify()
+        if in_flight:
+            SCANS_NOT_SENT.inc()
+            logger.error(f"This scan isn't being sent: {self.client.describe_scan(in_flight[0])}")
+
+    def close_socket(self, client_socket: Optional[socket.socket] = None) -> None:
+        """
+        Closes the socket connection, unacknowledged scans of it are logged as not sent.
+        :param client_socket: only close if this is still the current connection
+        :return:
+        """
+        with self.lock:
+            if not self.socket or (client_socket and client_socket is not self.socket):
+                return
+            self.socket.close()
+            self.socket = None
+            lost_scans = list(self.in_flight)
+        for seq in lost_scans:
+            self.drop_scan(seq)
 
 
 class FrPACSBrainScanClient:
@@ -18,79 +351,185 @@ class FrPACSBrainScanClient:
         - Here the requirement was if FrHUB stops, FrPACS should just log those failed cases instead of persisting the data
         - So, first I am connecting to server (success or failure doesn't matter),
             creating brain scans and then trying to send the scan. If connections is successful, it'll be sent else it's going to log the failed sent scan
+        - Scans are sent over a pool of `connections` persistent connections (see ScanConnection), so one FrPACS can
+            keep several FrHUB threads busy. Scans go to whichever connection has room in its window first, and while a
+            connection can't connect the others take its share; scans are only logged as not sent when none is up.
+        - Scans are pipelined: up to `window` scans per connection can be unacknowledged at once, acks are read by a
+            separate thread and matched to their scan by sequence number. `window=1` is the old send-and-wait behaviour.
+        - Scans larger than BRAIN_SCAN_CHUNK_SIZE are streamed in chunk frames, see brain_scan_frames
+        - Scans are generated at `rate` per second (0 for as fast as the connections take them), independently of
+            connection attempts. Those back off exponentially with jitter, and once `circuit_failures` attempts in a
+            row failed the circuit opens (see CircuitBreaker): FrHUB is considered down, the scans waiting for a
+            connection are logged as not sent, scans generated meanwhile are counted and logged sampled, and a single
+            connection probes FrHUB every backoff delay. So an outage costs neither CPU nor a flood of log lines.
 
     """
 
-    def __init__(self, host: str, port: int) -> None:
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        window: int = BRAIN_SCAN_WINDOW,
+        connections: int = BRAIN_SCAN_CONNECTIONS,
+        rate: float = BRAIN_SCAN_RATE,
+        reconnect_s: float = BRAIN_SCAN_RECONNECT_S,
+        reconnect_max_s: float = BRAIN_SCAN_RECONNECT_MAX_S,
+        circuit_failures: int = BRAIN_SCAN_CIRCUIT_FAILURES,
+    ) -> None:
         self.host = host
         self.port = port
-        self.client_socket = None
+        self.window = window
+        self.rate = rate
+        self.reconnect_s = reconnect_s
+        self.reconnect_max_s = reconnect_max_s
+        self.circuit = CircuitBreaker(circuit_failures, Backoff(reconnect_s, reconnect_max_s))
+        # scans not sent since the circuit last opened
+        self.scans_not_sent = 0
         self.running_status = True
+        self.stopped = threading.Event()
+        # scans generated but not taken by a connection yet
+        self.scans: queue.Queue = queue.Queue(connections)
+        self.connections: List[ScanConnection] = [ScanConnection(self, index) for index in range(connections)]
+        IN_FLIGHT_SCANS.set_function(lambda: sum(len(connection.in_flight) for connection in self.connections))
+        CONNECTIONS_UP.set_function(self.connected_count)
+        CIRCUIT_OPEN.set_function(lambda: int(self.circuit.state != CircuitState.closed))
+
+    @property
+    def in_flight(self) -> Dict[Tuple[int, int], Tuple[tuple, float]]:
+        """Unacknowledged scans of every connection, keyed by connection and sequence number"""
+        return {
+            (connection.index, seq): in_flight
+            for connection in self.connections
+            for seq, in_flight in list(connection.in_flight.items())
+        }
+
+    def connected_count(self) -> int:
+        return sum(connection.connected for connection in self.connections)
+
+    def health(self) -> List[dict]:
+        return [connection.health() for connection in self.connections]
 
     def send_brain_scan(self) -> None:
         """
-        Sends the brain scan to FrHUB
+        Generates brain scans and hands them to the connections of the pool, until the client is stopped
         :return:
         """
         try:
+            for connection in self.connections:
+                connection.start()
 
+            next_at = time.monotonic()
             while self.running_status:
-                # generating the scans
-                patient_id = rn.randint(1, 1000)
-                scan_id = rn.randint(1, 10000)
-                scan_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                scan_data = generate_brain_scan()
-                # encoding the data here
-                encoded_scan = base64.b64encode(scan_data.encode("utf-8")).decode(
-                    "utf-8"
-                )
-                data_to_send = json.dumps(
-                    (patient_id, scan_id, scan_datetime, "BRAIN", encoded_scan)
-                )
-
-                # connecting the client and sending rbain scans
-                # here successful connection doesn't matter as per given requriements
-                try:
-                    if not self.client_socket:
-                        self.client_socket = socket.socket(
-                            socket.AF_INET, socket.SOCK_STREAM
-                        )
-                        self.client_socket.connect((self.host, self.port))
-
-                    # sending the scan
-                    logger.info(f"Sending brain scan to FrHUB: {data_to_send}")
-                    self.client_socket.sendall(data_to_send.encode("utf-8"))
-                    # receiving an acknowledgement from FrHub
-                    response = self.client_socket.recv(1024).decode("utf-8")
-                    logger.info(f"Received an acknowledgment in FrPACS from FrHUB: {response}")
-                except Exception as e:
-                    logger.error(f"Exception while sending brain scans: {e}")
-                    # as per requirement, we only need to log the failed cases if scan couldn't get sent, no need to persist it
-                    logger.error(f"This scan isn't being sent: {scan_data}")
-
-                    # in case if FrHub suddenly stops so it'll come to exception when sending the data,
-                    # To survive reboots - we have to make sure it gets closed and then empty so that in next loop FrPACS can try to re-connect again (to check if FrHUB is restarted)
-                    self.close_socket()
+                if self.rate:
+                    delay = next_at - time.monotonic()
+                    if delay > 0 and self.stopped.wait(delay):
+                        break
+                    # a generator that fell behind (e.g. waiting for a connection) doesn't catch up in a burst
+                    next_at = max(next_at, time.monotonic()) + 1 / self.rate
+                elif self.circuit.state != CircuitState.closed:
+                    # as fast as FrHUB takes them is not at all while it's down
+                    self.stopped.wait(min(max(self.circuit.wait_time(), 0.1), 1))
+                    continue
+
+                scan = self.generate_scan()
+
+                # waiting until a connection takes it
+                while self.running_status:
+                    if self.circuit.state != CircuitState.closed:
+                        self.scan_not_sent(scan)
+                        break
+                    try:
+                        self.scans.put(scan, timeout=1)
+                        break
+                    except queue.Full:
+                        continue
 
         except Exception as e:
             logger.error(f"Exception in send_brain_scan: {e}")
         finally:
-            self.close_socket()
+            for connection in self.connections:
+                if connection.thread is not None:
+                    connection.thread.join(timeout=2)
+
+    @staticmethod
+    def generate_scan() -> tuple:
+        """
+        Generates a brain scan. (patient_id, scan_id) is the idempotency key FrHUB stores scans by, so every scan gets
+        a new random 63 bit scan_id: random ids from a small range would have new scans taken for retransmissions
+        :return: (patient_id, scan_id, scan_datetime, scan_type, scan_data)
+        """
+        patient_id = rn.randint(1, 1000)
+        scan_id = new_scan_id()
+        scan_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        return patient_id, scan_id, scan_datetime, "BRAIN", generate_brain_scan()
+
+    def next_scan(self) -> Optional[tuple]:
+        """Next scan to send, None if there's none for a second or the client is stopped"""
+        try:
+            return self.scans.get(timeout=1)
+        except queue.Empty:
+            return None
+
+    def scan_not_sent(self, scan: tuple) -> None:
+        """A scan generated while FrHUB is down, its count is logged with every failed probe"""
+        self.scans_not_sent += 1
+        SCANS_NOT_SENT.inc()
+        log_event("scan_not_sent", "This scan isn't being sent, FrHUB is down: %s", self.describe_scan(scan))
+
+    def circuit_opened(self, open_for: float, error: Exception) -> None:
+        """FrHUB is considered down: the scans waiting for a connection are logged as not sent."""
+        while True:
+            try:
+                scan = self.scans.get_nowait()
+            except queue.Empty:
+                break
+            if scan is not None:
+                self.scans_not_sent += 1
+                SCANS_NOT_SENT.inc()
+                # as per requirement, we only need to log the failed cases if scan couldn't get sent, no need to persist it
+                logger.error(f"This scan isn't being sent: {self.describe_scan(scan)}")
+        logger.warning(
+            f"FrHUB is down ({self.circuit.failures} attempts to connect failed in a row, {self.scans_not_sent} scans "
+            f"not sent), trying again in {open_for:.2f} s: {error}"
+        )
+
+    def circuit_closed(self) -> None:
+        logger.info(f"FrHUB is reachable again, {self.scans_not_sent} scans weren't sent while it was down")
+        self.scans_not_sent = 0
+
+    @staticmethod
+    def describe_scan(scan: tuple) -> str:
+        """Identifies a scan in the logs, its data is packed binary and not meant to be read from there."""
+        patient_id, scan_id, scan_datetime, scan_type = scan[:4]
+        trace = scan_trace(scan)
+        description = f"patient {patient_id}, scan {scan_id}, {scan_type} taken at {scan_datetime}"
+        return f"{description}, trace {trace.trace_id}" if trace else description
 
-    def close_socket(self) -> None:
-        """Closes the socket connection."""
-        if self.client_socket:
-            self.client_socket.close()
-            self.client_socket = None
+    def close_sockets(self) -> None:
+        """Closes every connection, unacknowledged scans are logged as not sent."""
+        for connection in self.connections:
+            connection.close_socket()
 
     def stop(self) -> None:
         self.running_status = False
-        self.close_socket()
+        self.stopped.set()
+        # waking up the connections waiting for a scan, scans not taken yet are dropped
+        while True:
+            try:
+                self.scans.get_nowait()
+            except queue.Empty:
+                break
+        for _ in self.connections:
+            try:
+                self.scans.put_nowait(None)
+            except queue.Full:
+                break
+        self.close_sockets()
 
 
-def main():
+def main(connections: int = BRAIN_SCAN_CONNECTIONS, rate: float = BRAIN_SCAN_RATE):
     # For sending brain scan
-    client = FrPACSBrainScanClient(host=BRAIN_SCAN_HOST, port=BRAIN_SCAN_PORT)
+    client = FrPACSBrainScanClient(host=BRAIN_SCAN_HOST, port=BRAIN_SCAN_PORT, connections=connections, rate=rate)
     client_thread = threading.Thread(target=client.send_brain_scan)
     client_thread.start()
     return client
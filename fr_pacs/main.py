@@ -1,11 +1,31 @@
+import argparse
 import threading
 
 from client import main as brain_scan_client
-from common.logger import logger
+from common.config import BRAIN_SCAN_CONNECTIONS, BRAIN_SCAN_RATE, FR_PACS_METRICS_PORT
+from common.logger import add_logging_arguments, configure_logging, logger, parse_sample_rates
+from common.metrics import start_metrics_server
 from server import main as brain_report_server
 
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Runs FrPACS")
+    parser.add_argument(
+        "--connections", type=int, default=BRAIN_SCAN_CONNECTIONS, help="persistent connections sending scans to FrHUB"
+    )
+    parser.add_argument(
+        "--rate", type=float, default=BRAIN_SCAN_RATE, help="scans generated per second, 0 for as fast as FrHUB takes them"
+    )
+    parser.add_argument("--metrics-port", type=int, default=FR_PACS_METRICS_PORT, help="port of the /metrics endpoint")
+    add_logging_arguments(parser)
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    brain_scan_client = brain_scan_client()
+    args = parse_args()
+    configure_logging("fr_pacs", args.log_level, args.log_format, parse_sample_rates(args.log_sample))
+    start_metrics_server(args.metrics_port)
+    brain_scan_client = brain_scan_client(args.connections, args.rate)
     brain_report_server = brain_report_server()
     try:
         while True:
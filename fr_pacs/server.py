@@ -1,8 +1,14 @@
 import socket
 import threading
+from typing import Callable, List, Optional
 
-from common.config import BRAIN_REPORT_HOST, BRAIN_REPORT_PORT
-from common.logger import logger
+from common import metrics
+from common.config import BRAIN_REPORT_HOST, BRAIN_REPORT_PORT, AckStatus, MessageType
+from common.logger import log_event, logger
+from common.protocol import decode_brain_reports, encode_ack, recv_frame, send_frame
+
+CONNECTIONS_ACCEPTED = metrics.counter("fr_pacs_connections_accepted_total", "FrHUB connections accepted")
+REPORTS_RECEIVED = metrics.counter("fr_pacs_reports_received_total", "Brain reports received from FrHUB")
 
 
 class FrPACSBrainReportServer:
@@ -14,14 +20,15 @@ class FrPACSBrainReportServer:
 
     """
 
-    def __init__(self, host: str, port: int) -> None:
+    def __init__(self, host: str, port: int, on_brain_reports: Optional[Callable[[List[dict]], None]] = None) -> None:
         self.host = host
         self.port = port
+        # called with every batch of received reports, e.g. by benchmarks timing their arrival
+        self.on_brain_reports = on_brain_reports
         self.server_socket = None
         self.running_status = True
 
-    @staticmethod
-    def handle_brain_report(client_socket: socket.socket) -> None:
+    def handle_brain_report(self, client_socket: socket.socket) -> None:
         """
         handles the brain reports coming from FrHUB
 
@@ -30,13 +37,27 @@ class FrPACSBrainReportServer:
         """
         try:
             while True:
-                brain_report_data = client_socket.recv(1024).decode("utf-8")
-                if not brain_report_data:
+                # FrHUB sends reports in batches, one batch per frame
+                frame = recv_frame(client_socket)
+                if frame is None:
                     break
-                logger.info(f"Received brain report: {brain_report_data}")
-                response = f"FrPACS received the brain report successfully: {brain_report_data}"
+                msg_type, payload = frame
+                if msg_type != MessageType.brain_report_batch:
+                    logger.warning(f"Ignoring unexpected message type from FrHUB: {msg_type}")
+                    continue
+                seq, brain_reports = decode_brain_reports(payload)
+                REPORTS_RECEIVED.inc(len(brain_reports))
+                for brain_report_data in brain_reports:
+                    log_event(
+                        "report_received", "Received brain report of scan %s of patient %s: %s",
+                        brain_report_data["scan_id"], brain_report_data["patient_id"], brain_report_data["report_data"],
+                        trace_id=brain_report_data.get("trace_id"),
+                    )
+                if self.on_brain_reports:
+                    self.on_brain_reports(brain_reports)
+                response = f"FrPACS received {len(brain_reports)} brain reports successfully"
                 # sending acknowledgement to FrHUB
-                client_socket.sendall(response.encode("utf-8"))
+                send_frame(client_socket, MessageType.ack, encode_ack(seq, AckStatus.received, response))
         except Exception as e:
             logger.error(f"Exception while handling message: {e}")
         finally:
@@ -65,6 +86,7 @@ class FrPACSBrainReportServer:
             while self.running_status:
                 client_socket, addr = self.server_socket.accept()
                 logger.info(f"Connection is accepted from {addr}")
+                CONNECTIONS_ACCEPTED.inc()
                 client_handler = threading.Thread(
                     target=self.handle_brain_report, args=(client_socket,)
                 )
@@ -0,0 +1,71 @@
+import random
+import time
+import unittest
+
+from common.config import CircuitState
+from fr_pacs.circuit_breaker import Backoff, CircuitBreaker
+
+
+class TestBackoff(unittest.TestCase):
+
+    def test_delays_double_with_jitter_up_to_the_cap(self):
+        """Test the n-th delay is between half and all of base * 2 ** (n - 1), and never over the cap"""
+        backoff = Backoff(base_s=1, max_s=8, rng=random.Random(7))
+        for ceiling in (1, 2, 4, 8, 8, 8):
+            delay = backoff.next_delay()
+            self.assertGreaterEqual(delay, ceiling / 2)
+            self.assertLessEqual(delay, ceiling)
+        backoff.reset()
+        self.assertLessEqual(backoff.next_delay(), 1)
+
+    def test_long_outage_doesnt_overflow(self):
+        """Test thousands of attempts in a row still give a delay within the cap"""
+        backoff = Backoff(base_s=1, max_s=30)
+        for _ in range(5000):
+            delay = backoff.next_delay()
+        self.assertLessEqual(delay, 30)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_opens_after_failures_in_a_row(self):
+        """Test the circuit stays closed below the threshold and a success resets the count"""
+        circuit = CircuitBreaker(failure_threshold=3, backoff=Backoff(base_s=10, max_s=10))
+        self.assertEqual(circuit.record_failure(), 0)
+        self.assertEqual(circuit.record_failure(), 0)
+        self.assertFalse(circuit.record_success())
+        self.assertEqual(circuit.record_failure(), 0)
+        self.assertEqual(circuit.record_failure(), 0)
+        self.assertGreaterEqual(circuit.record_failure(), 5)
+        self.assertEqual(circuit.state, CircuitState.open)
+        self.assertFalse(circuit.allow_attempt())
+        self.assertGreater(circuit.wait_time(), 4)
+
+    def test_single_probe_once_the_delay_is_over(self):
+        """Test an open circuit lets a single attempt through after its delay, whose outcome closes or reopens it"""
+        circuit = CircuitBreaker(failure_threshold=1, backoff=Backoff(base_s=0.01, max_s=0.01))
+        circuit.record_failure()
+        time.sleep(0.02)
+        self.assertTrue(circuit.allow_attempt())
+        self.assertEqual(circuit.state, CircuitState.half_open)
+        self.assertFalse(circuit.allow_attempt())
+        self.assertGreater(circuit.record_failure(), 0)
+        self.assertEqual(circuit.state, CircuitState.open)
+
+        time.sleep(0.02)
+        self.assertTrue(circuit.allow_attempt())
+        self.assertTrue(circuit.record_success())
+        self.assertEqual((circuit.state, circuit.failures), (CircuitState.closed, 0))
+        self.assertTrue(circuit.allow_attempt())
+
+    def test_late_failure_doesnt_extend_the_delay(self):
+        """Test an attempt failing after the circuit opened leaves the delay as it is"""
+        circuit = CircuitBreaker(failure_threshold=1, backoff=Backoff(base_s=1, max_s=1))
+        circuit.record_failure()
+        retry_at = circuit.retry_at
+        self.assertEqual(circuit.record_failure(), 0)
+        self.assertEqual(circuit.retry_at, retry_at)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,17 +1,62 @@
+import logging
+import os
+import shutil
 import socket
+import tempfile
 import threading
+import time
 import unittest
 from unittest.mock import patch, MagicMock
 
+from common.config import LOG_SAMPLE_RATES, AckStatus, CircuitState, MessageType, NeuroDataCollections
+from common.logger import Sampler
+from common.protocol import encode_ack, encode_frame
+from common.storage.sqlite import SQLiteBackend
+from common.utils import brain_scan_document
+from fr_hub.flow_control import FlowController
+from fr_hub.server import FrHUBBrainScanServer
+from fr_hub.tests.test_fr_hub_flow_control import Backlog
 from fr_pacs.client import FrPACSBrainScanClient
 
 
+def framed_recv_into(*frames):
+    """Builds a `recv_into` side effect that delivers the given frames once and then blocks like an idle socket."""
+    stream = bytearray(b"".join(encode_frame(msg_type, payload) for msg_type, payload in frames))
+    position = [0]
+    idle = threading.Event()
+
+    def recv_into(buffer, size=0):
+        size = min(size or len(buffer), len(stream) - position[0])
+        if not size:
+            idle.wait()
+        buffer[:size] = stream[position[0]:position[0] + size]
+        position[0] += size
+        return size
+
+    return recv_into
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def wait_for(condition, timeout: float = 5) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
 class TestFrPACSBrainScanClient(unittest.TestCase):
 
     def setUp(self):
         self.host = "127.0.0.1"
         self.port = 12345
-        self.client = FrPACSBrainScanClient(host=self.host, port=self.port)
+        self.client = FrPACSBrainScanClient(host=self.host, port=self.port, connections=1)
         self.client.running_status = True
 
     @patch('socket.socket')
@@ -23,12 +68,19 @@ class TestFrPACSBrainScanClient(unittest.TestCase):
         mock_socket.return_value = mock_client_socket
         mock_client_socket.sendall.return_value = None
         mock_client_socket.close.return_value = None
+        mock_client_socket.recv_into.side_effect = framed_recv_into(
+            (MessageType.ack, encode_ack(1, AckStatus.stored))
+        )
 
         # Running `send_brain_scan` in a separate thread
         scan_thread = threading.Thread(target=self.client.send_brain_scan)
         scan_thread.start()
 
         # Stop client after short delay
+        for _ in range(100):
+            if mock_client_socket.sendall.called:
+                break
+            time.sleep(0.01)
         self.client.stop()
         scan_thread.join(timeout=1)  # Ensure the thread stops within 1 second
 
@@ -49,12 +101,182 @@ class TestFrPACSBrainScanClient(unittest.TestCase):
     def test_send_brain_scan_socket_creation_failure(self):
         pass
 
-    def test_send_brain_scan_receives_acknowledgment(self):
-        pass
+    @patch("fr_hub.group_commit.save_brain_scans", side_effect=lambda scans: [True] * len(scans))
+    def test_send_brain_scan_receives_acknowledgment(self, mock_save):
+        """Test acks from FrHUB free the window so pipelined sending keeps going"""
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        server = FrHUBBrainScanServer(host="127.0.0.1", port=port)
+        server_thread = threading.Thread(target=server.run_brain_scan_server, daemon=True)
+        server_thread.start()
+        time.sleep(0.2)
+
+        client = FrPACSBrainScanClient(host="127.0.0.1", port=port, window=4, connections=1)
+        scan_thread = threading.Thread(target=client.send_brain_scan)
+        scan_thread.start()
+        # more scans than the window can only be stored if acks keep coming back
+        stored = 0
+        for _ in range(100):
+            stored = sum(len(call.args[0]) for call in mock_save.call_args_list)
+            if stored >= 20:
+                break
+            time.sleep(0.05)
+        client.stop()
+        server.stop()
+        scan_thread.join(timeout=2)
+
+        self.assertGreaterEqual(stored, 20)
+        self.assertFalse(scan_thread.is_alive())
+        self.assertEqual(client.in_flight, {})
 
     def test_send_brain_scan_close_socket(self):
         pass
 
+    @patch("fr_hub.group_commit.save_brain_scans", side_effect=lambda scans: [True] * len(scans))
+    def test_scans_are_spread_over_the_pool(self, mock_save):
+        """Test every connection of the pool sends scans, and a broken connection is replaced"""
+        port = free_port()
+        server = FrHUBBrainScanServer(host="127.0.0.1", port=port)
+        threading.Thread(target=server.run_brain_scan_server, daemon=True).start()
+        time.sleep(0.2)
+
+        client = FrPACSBrainScanClient(host="127.0.0.1", port=port, window=2, connections=3)
+        scan_thread = threading.Thread(target=client.send_brain_scan)
+        scan_thread.start()
+        self.assertTrue(wait_for(lambda: all(health["scans_acked"] for health in client.health())))
+
+        # FrHUB drops one of the connections
+        broken = client.connections[0]
+        broken.socket.shutdown(socket.SHUT_RDWR)
+        self.assertTrue(wait_for(lambda: broken.replacements == 1 and broken.connected))
+        acked = broken.scans_acked
+        self.assertTrue(wait_for(lambda: broken.scans_acked > acked))
+        client.stop()
+        server.stop()
+        scan_thread.join(timeout=2)
+
+        self.assertFalse(scan_thread.is_alive())
+        self.assertEqual(client.connected_count(), 0)
+
+    def test_scans_are_not_sent_without_any_connection(self):
+        """Test scans are logged as not sent while no connection of the pool can connect"""
+        client = FrPACSBrainScanClient(host="127.0.0.1", port=free_port(), connections=2)
+        scan_thread = threading.Thread(target=client.send_brain_scan)
+        with self.assertLogs("mediaire_task", level="ERROR") as logs:
+            scan_thread.start()
+            self.assertTrue(wait_for(lambda: any("isn't being sent" in line for line in logs.output)))
+            client.stop()
+            scan_thread.join(timeout=2)
+        self.assertFalse(scan_thread.is_alive())
+        self.assertTrue(all(health["failures"] for health in client.health()))
+
+    @patch("fr_hub.group_commit.save_brain_scans", side_effect=lambda scans: [True] * len(scans))
+    def test_credits_limit_unacknowledged_scans(self, mock_save):
+        """Test a connection never has more scans unacknowledged than FrHUB grants, whatever its window"""
+        port = free_port()
+        # 90 % into the budget leaves 2 of the 10 credits
+        flow_control = FlowController(Backlog(queue_depth=90), max_credits=10, queue_budget=100)
+        server = FrHUBBrainScanServer(host="127.0.0.1", port=port, flow_control=flow_control)
+        threading.Thread(target=server.run_brain_scan_server, daemon=True).start()
+        time.sleep(0.2)
+
+        client = FrPACSBrainScanClient(host="127.0.0.1", port=port, window=8, connections=1)
+        connection = client.connections[0]
+        scan_thread = threading.Thread(target=client.send_brain_scan)
+        scan_thread.start()
+        most_in_flight = 0
+        deadline = time.monotonic() + 5
+        while connection.scans_acked < 20 and time.monotonic() < deadline:
+            most_in_flight = max(most_in_flight, len(connection.in_flight))
+            time.sleep(0.001)
+        client.stop()
+        server.stop()
+        scan_thread.join(timeout=2)
+
+        self.assertGreaterEqual(connection.scans_acked, 20)
+        self.assertEqual(connection.credits, 2)
+        self.assertLessEqual(most_in_flight, 2)
+
+    def test_rejected_connection_waits_before_connecting_again(self):
+        """Test a connection FrHUB rejects over its budget only connects again after the retry-after time"""
+        port = free_port()
+        flow_control = FlowController(Backlog(queue_depth=200), queue_budget=100, retry_after_s=10)
+        server = FrHUBBrainScanServer(host="127.0.0.1", port=port, flow_control=flow_control)
+        threading.Thread(target=server.run_brain_scan_server, daemon=True).start()
+        time.sleep(0.2)
+
+        client = FrPACSBrainScanClient(host="127.0.0.1", port=port, connections=1)
+        connection = client.connections[0]
+        scan_thread = threading.Thread(target=client.send_brain_scan)
+        with self.assertLogs("mediaire_task", level="WARNING") as logs:
+            scan_thread.start()
+            self.assertTrue(wait_for(lambda: connection.busy_until > time.monotonic()))
+            time.sleep(0.5)
+            client.stop()
+            server.stop()
+            scan_thread.join(timeout=2)
+
+        self.assertFalse(scan_thread.is_alive())
+        self.assertEqual(sum("FrHUB rejected connection 0" in line for line in logs.output), 1)
+        self.assertGreater(connection.busy_until - time.monotonic(), 15)
+
+    @patch("common.logger.sampler", Sampler(LOG_SAMPLE_RATES))
+    def test_outage_keeps_cpu_and_log_volume_bounded(self):
+        """Test while FrHUB is down scans keep being generated at their rate, but attempts to connect back off and
+        neither CPU time nor log records grow with the scans"""
+        client = FrPACSBrainScanClient(
+            host="127.0.0.1", port=free_port(), connections=4, rate=200, reconnect_s=0.01, reconnect_max_s=0.2,
+        )
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logging.getLogger("mediaire_task").addHandler(handler)
+        scan_thread = threading.Thread(target=client.send_brain_scan)
+        try:
+            started, cpu_started = time.monotonic(), time.process_time()
+            scan_thread.start()
+            time.sleep(3)
+            wall, cpu = time.monotonic() - started, time.process_time() - cpu_started
+            client.stop()
+            scan_thread.join(timeout=2)
+        finally:
+            logging.getLogger("mediaire_task").removeHandler(handler)
+
+        self.assertFalse(scan_thread.is_alive())
+        self.assertEqual(client.circuit.state, CircuitState.open)
+        # scans are generated at the rate, not as fast as connections fail
+        self.assertGreater(client.scans_not_sent, 300)
+        self.assertLess(client.scans_not_sent, 700)
+        # attempts back off to every 0.1 to 0.2 s, one probe at a time
+        self.assertLess(sum(health["failures"] for health in client.health()), 40)
+        self.assertLess(cpu / wall, 0.3)
+        self.assertLess(len(records), 60)
+
+
+class TestGeneratedScans(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.backend = SQLiteBackend(os.path.join(self.directory, "neuro_data.db"))
+        for index_name in self.backend.index_names(NeuroDataCollections.brain_scans):
+            self.backend.ensure_index(NeuroDataCollections.brain_scans, index_name)
+
+    def tearDown(self):
+        self.backend.close()
+        shutil.rmtree(self.directory)
+
+    @patch("fr_pacs.client.generate_brain_scan", return_value="|o|")
+    def test_new_scans_are_never_taken_for_duplicates(self, _):
+        """Test freshly generated scans are all stored under the unique (patient_id, scan_id) index"""
+        # random scan ids out of 10000 would have had ~20 collisions of keys among these
+        scans = [FrPACSBrainScanClient.generate_scan() for _ in range(20000)]
+        duplicates = self.backend.insert_new(
+            NeuroDataCollections.brain_scans, [brain_scan_document(scan) for scan in scans]
+        )
+        self.assertEqual(duplicates, [])
+        self.assertEqual(self.backend.insert_new(NeuroDataCollections.brain_scans, [brain_scan_document(scans[0])]), [0])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+
+import numpy as np
+
+from common.analysis import analyze_cells, analyze_scan_chunks, analyze_scans, format_report
+from common.config import ScanCell
+from common.scan_codec import encode_scan
+from common.utils import analyze_scan, generate_brain_scan
+
+
+class TestAnalysis(unittest.TestCase):
+
+    def test_batch_matches_single_scans(self):
+        """Test analyzing a batch gives the same result as analyzing its scans one by one."""
+        scans = [generate_brain_scan(32, 32, 0.5) for _ in range(5)]
+        self.assertEqual(analyze_scans(scans), [analyze_scans([scan])[0] for scan in scans])
+
+    def test_lesion_count_area_and_density(self):
+        """Test lesion cells, area and per-region density of a known scan."""
+        cells = np.zeros((4, 4), dtype=np.uint8)
+        cells[0, 0] = cells[0, 1] = cells[3, 3] = ScanCell.lesion
+        cells[1, 1] = ScanCell.clear
+        analysis = analyze_scans([encode_scan(cells)], regions=2)[0]
+        self.assertEqual(analysis["lesion_cells"], 3)
+        self.assertEqual(analysis["lesion_area"], 3 / 16)
+        self.assertEqual(analysis["region_density"], [[0.5, 0.0], [0.0, 0.25]])
+
+    def test_mixed_shapes_and_formats(self):
+        """Test a batch can mix shapes, legacy text scans and invalid data."""
+        analyses = analyze_scans([generate_brain_scan(3, 5), "|o| |o|\n", b"garbage", generate_brain_scan(8, 8)])
+        self.assertEqual(analyses[1]["lesion_cells"], 2)
+        self.assertIsNone(analyses[2])
+        self.assertTrue(all(analysis is not None for analysis in analyses[:2] + analyses[3:]))
+
+    def test_3d_scan(self):
+        """Test 3D scans count lesions over all slices."""
+        cells = np.full((3, 4, 4), ScanCell.lesion, dtype=np.uint8)
+        analysis = analyze_scans([encode_scan(cells)], regions=2)[0]
+        self.assertEqual(analysis["lesion_cells"], 48)
+        self.assertEqual(analysis["region_density"], [[1.0, 1.0], [1.0, 1.0]])
+        self.assertEqual(analysis["lesion_count"], 1)
+
+    def test_scan_chunks_match_batch(self):
+        """Test analyzing a scan chunk by chunk gives the same analysis as analyzing it whole."""
+        cells = np.random.randint(0, 3, (3, 9, 10)).astype(np.uint8)
+        for scan_data in (encode_scan(cells), encode_scan(cells[0]), generate_brain_scan(3, 3)):
+            chunks = [scan_data[start:start + 5] for start in range(0, len(scan_data), 5)]
+            self.assertEqual(analyze_scan_chunks(chunks), analyze_scans([scan_data])[0])
+
+    def test_regions_larger_than_scan(self):
+        """Test a scan smaller than the region grid gets one region per cell."""
+        analysis = analyze_cells(np.array([[[ScanCell.lesion, ScanCell.empty]]]), regions=4)[0]
+        self.assertEqual(analysis["region_density"], [[1.0, 0.0]])
+
+    def test_analyze_scan_report(self):
+        """Test the single scan helper keeps the report text."""
+        analysis = {"lesion_cells": 7}
+        self.assertEqual(format_report(analysis), "The analysed scan showed 7 brain lesions.")
+        self.assertEqual(analyze_scan("|o| |o|\n"), "The analysed scan showed 2 brain lesions.")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,9 @@
 import unittest
 from unittest.mock import patch
 
-from pymongo.errors import PyMongoError
+from pymongo.errors import BulkWriteError, PyMongoError
 
-from common.db_manager import DBManager
+from common.db_manager import IDEMPOTENCY_INDEXES, DBManager
 
 
 class TestDBManager(unittest.TestCase):
@@ -29,6 +29,132 @@ class TestDBManager(unittest.TestCase):
             inserted_id = db_manager.insert("test_coll", {"key": "value"})
             self.assertIsNone(inserted_id)
 
+    def test_insert_many_success(self):
+        """Test several documents are inserted with one call."""
+        with patch("pymongo.collection.Collection.insert_many") as mock_insert_many:
+            mock_insert_many.return_value.inserted_ids = ["1", "2"]
+            db_manager = DBManager()
+            inserted_ids = db_manager.insert_many("test_coll", [{"key": 1}, {"key": 2}])
+            self.assertEqual(inserted_ids, ["1", "2"])
+            mock_insert_many.assert_called_once_with([{"key": 1}, {"key": 2}], ordered=False)
+
+    def test_insert_many_failure(self):
+        """Test insert_many method handles exceptions."""
+        with patch("pymongo.collection.Collection.insert_many", side_effect=PyMongoError("Insertion Error")):
+            db_manager = DBManager()
+            inserted_ids = db_manager.insert_many("test_coll", [{"key": 1}], durable=True)
+            self.assertIsNone(inserted_ids)
+
+    def test_insert_many_ignores_duplicates(self):
+        """Test documents already inserted only count as inserted when duplicates are ignored."""
+        duplicate = BulkWriteError({"writeErrors": [{"index": 0, "code": 11000, "errmsg": "E11000 duplicate key"}]})
+        with patch("pymongo.collection.Collection.insert_many", side_effect=duplicate):
+            db_manager = DBManager()
+            self.assertIsNone(db_manager.insert_many("test_coll", [{"_id": 1}, {"_id": 2}]))
+            inserted_ids = db_manager.insert_many("test_coll", [{"_id": 1}, {"_id": 2}], ignore_duplicates=True)
+            self.assertEqual(inserted_ids, [1, 2])
+
+        other_error = BulkWriteError({"writeErrors": [{"index": 0, "code": 121, "errmsg": "validation failed"}]})
+        with patch("pymongo.collection.Collection.insert_many", side_effect=other_error):
+            self.assertIsNone(DBManager().insert_many("test_coll", [{"_id": 1}], ignore_duplicates=True))
+
+    def test_insert_new_skips_duplicates(self):
+        """Test documents breaking a unique index are reported by position, other write errors fail the insert."""
+        duplicate = BulkWriteError({"writeErrors": [{"index": 1, "code": 11000, "errmsg": "E11000 duplicate key"}]})
+        with patch("pymongo.collection.Collection.insert_many", side_effect=duplicate):
+            self.assertEqual(DBManager().insert_new("test_coll", [{"scan_id": 1}, {"scan_id": 2}]), [1])
+
+        other_error = BulkWriteError({"writeErrors": [{"index": 0, "code": 121, "errmsg": "validation failed"}]})
+        with patch("pymongo.collection.Collection.insert_many", side_effect=other_error):
+            self.assertIsNone(DBManager().insert_new("test_coll", [{"scan_id": 1}]))
+
+        with patch("pymongo.collection.Collection.insert_many") as mock_insert_many:
+            self.assertEqual(DBManager().insert_new("test_coll", [{"scan_id": 1}], durable=True), [])
+
+    def test_claim_many_nothing_to_claim(self):
+        """Test claim_many doesn't write anything when no document matches."""
+        with patch("pymongo.collection.Collection.find") as mock_find, \
+                patch("pymongo.collection.Collection.update_many") as mock_update_many:
+            mock_find.return_value.limit.return_value = []
+            db_manager = DBManager()
+            self.assertEqual(db_manager.claim_many("test_coll", {"sent": False}, {}, 10), (None, []))
+            mock_update_many.assert_not_called()
+
+    def test_claim_many_success(self):
+        """Test claim_many re-checks the query while claiming and returns the claimed documents."""
+        with patch("pymongo.collection.Collection.find") as mock_find, \
+                patch("pymongo.collection.Collection.update_many") as mock_update_many:
+            mock_find.return_value.limit.return_value = [{"_id": 1}, {"_id": 2}]
+            db_manager = DBManager()
+            claim_token, _ = db_manager.claim_many("test_coll", {"sent": False}, {"owner": "a"}, 2)
+            mock_update_many.assert_called_once_with(
+                {"$and": [{"sent": False}, {"_id": {"$in": [1, 2]}}]},
+                {"$set": {"owner": "a", "claim_token": claim_token}},
+            )
+            mock_find.assert_called_with({"claim_token": claim_token}, None)
+
+    def test_ensure_indexes_success(self):
+        """Test every declared index is created, one at a time."""
+        with patch("pymongo.collection.Collection.create_indexes") as mock_create_indexes:
+            db_manager = DBManager()
+            self.assertEqual(db_manager.ensure_indexes(), [])
+            self.assertEqual(
+                mock_create_indexes.call_count, sum(len(indexes) for indexes in DBManager.INDEXES.values())
+            )
+
+    def test_ensure_indexes_failure(self):
+        """Test ensure_indexes handles exceptions."""
+        with patch("pymongo.collection.Collection.create_indexes", side_effect=PyMongoError("Index Error")):
+            db_manager = DBManager()
+            self.assertEqual(
+                db_manager.ensure_indexes(),
+                [index.document["name"] for indexes in DBManager.INDEXES.values() for index in indexes],
+            )
+
+    def test_failing_index_keeps_the_others(self):
+        """Test a unique index that can't be created over duplicates leaves the other indexes created."""
+        def create_indexes(indexes):
+            if indexes[0].document.get("unique"):
+                raise PyMongoError("E11000 duplicate key error")
+
+        with patch("pymongo.collection.Collection.create_indexes", side_effect=create_indexes) as mock_create_indexes:
+            db_manager = DBManager()
+            self.assertEqual(db_manager.ensure_indexes(), list(IDEMPOTENCY_INDEXES))
+            created = {call.args[0][0].document["name"] for call in mock_create_indexes.call_args_list}
+            self.assertIn("scans_to_do", created)
+            self.assertIn("reports_unsent", created)
+
+    def test_fetch_all_with_projection_sort_and_limit(self):
+        """Test projection, sort and limit are passed on to MongoDB."""
+        with patch("pymongo.collection.Collection.find") as mock_find:
+            mock_find.return_value.sort.return_value.limit.return_value = [{"_id": 1}]
+            db_manager = DBManager()
+            documents = db_manager.fetch_all("test_coll", {"sent": False}, {"_id": 1}, [("_id", 1)], 5)
+            self.assertEqual(documents, [{"_id": 1}])
+            mock_find.assert_called_once_with({"sent": False}, {"_id": 1})
+            mock_find.return_value.sort.assert_called_once_with([("_id", 1)])
+            mock_find.return_value.sort.return_value.limit.assert_called_once_with(5)
+
+    def test_iterate_yields_documents(self):
+        """Test iterate goes through the cursor lazily."""
+        with patch("pymongo.collection.Collection.find", return_value=iter([{"_id": 1}, {"_id": 2}])) as mock_find:
+            db_manager = DBManager()
+            documents = db_manager.iterate("test_coll", {"sent": False})
+            mock_find.assert_not_called()
+            self.assertEqual(list(documents), [{"_id": 1}, {"_id": 2}])
+
+    def test_iterate_failure(self):
+        """Test iterate stops when the query fails."""
+        with patch("pymongo.collection.Collection.find", side_effect=PyMongoError("Find Error")):
+            db_manager = DBManager()
+            self.assertEqual(list(db_manager.iterate("test_coll", {"sent": False})), [])
+
+    def test_claim_many_failure(self):
+        """Test claim_many method handles exceptions."""
+        with patch("pymongo.collection.Collection.find", side_effect=PyMongoError("Find Error")):
+            db_manager = DBManager()
+            self.assertEqual(db_manager.claim_many("test_coll", {"sent": False}, {}, 10), (None, []))
+
     # TODO:
     def test_fetch_one_failure(self):
         pass
@@ -4,8 +4,9 @@ import time
 
 import pytest
 
-from common.config import BRAIN_SCAN_PORT, BRAIN_SCAN_HOST, BRAIN_REPORT_PORT, BRAIN_REPORT_HOST
+from common.config import BRAIN_SCAN_PORT, BRAIN_SCAN_HOST, BRAIN_REPORT_PORT, BRAIN_REPORT_HOST, AckStatus, MessageType
 from common.db_manager import DBManager
+from common.protocol import decode_ack, encode_brain_reports, encode_brain_scan, recv_frame, send_frame
 from fr_brain.processor import FrBRAINScanProcessor
 from fr_hub.server import FrHUBBrainScanServer
 from fr_pacs.server import FrPACSBrainReportServer
@@ -55,24 +56,30 @@ class TestIntegration:
         # sending brain scan
         client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         client_socket.connect((BRAIN_SCAN_HOST, BRAIN_SCAN_PORT))
-        client_socket.sendall(b"test brain scan")
-        response = client_socket.recv(1024)
+        scan = encode_brain_scan(1, (1, 1, "2025-01-01 00:00:00", "BRAIN", " |o| "))
+        send_frame(client_socket, MessageType.brain_scan, scan)
+        msg_type, response = recv_frame(client_socket)
         client_socket.close()
 
         # Verifying the response from FrHUBBrainScanServer
-        assert response == b"FRHub received the brain scan and successfully stored it"
+        assert msg_type == MessageType.ack
+        assert decode_ack(response) == (
+            1, AckStatus.stored, "FRHub received the brain scan and successfully stored it"
+        )
 
         time.sleep(1)
 
         # Simulate sending a brain report from FrHUBBrainReportClient to FrPACSBrainReportServer
         client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         client_socket.connect((BRAIN_REPORT_HOST, BRAIN_REPORT_PORT))
-        client_socket.sendall(b"test brain report")
-        response = client_socket.recv(1024)
+        report = {"patient_id": 1, "scan_id": 1, "report_datetime": "2025-01-01 00:00:00", "report_data": "test"}
+        send_frame(client_socket, MessageType.brain_report_batch, encode_brain_reports(1, [report]))
+        msg_type, response = recv_frame(client_socket)
         client_socket.close()
 
         # Verify the response from FrPACSBrainReportServer
-        assert response == b"FrPACS received the brain report successfully: test brain report"
+        assert msg_type == MessageType.ack
+        assert decode_ack(response) == (1, AckStatus.received, "FrPACS received 1 brain reports successfully")
 
         # Verify that the DBManager methods were called
         DBManager.insert.assert_called()
@@ -0,0 +1,79 @@
+import unittest
+
+import numpy as np
+
+from common.analysis import analyze_scans
+from common.config import ScanCell
+from common.lesions import label_lesions, label_scan_batch, label_slices
+from common.scan_codec import encode_scan
+from common.utils import analyze_scan, generate_brain_scan
+
+
+def lesion_cells(shape, *positions) -> np.ndarray:
+    cells = np.full(shape, ScanCell.clear, dtype=np.uint8)
+    for position in positions:
+        cells[position] = ScanCell.lesion
+    return cells
+
+
+class TestLesions(unittest.TestCase):
+
+    def test_2d_connectivity(self):
+        """Test diagonal lesion cells are one lesion with 8-connectivity and separate ones with 4-connectivity."""
+        cells = lesion_cells((4, 4), (0, 0), (1, 1), (1, 2), (3, 0))
+        self.assertEqual(
+            label_lesions(encode_scan(cells), 8),
+            {"lesion_count": 2, "lesion_sizes": [3, 1], "lesion_centroids": [[0.67, 1.0], [3.0, 0.0]]},
+        )
+        self.assertEqual(label_lesions(encode_scan(cells), 4)["lesion_sizes"], [2, 1, 1])
+
+    def test_3d_connectivity(self):
+        """Test lesions are merged across slices by faces with 6-connectivity and also by corners with 26."""
+        cells = lesion_cells((3, 3, 3), (0, 0, 0), (1, 0, 0), (2, 1, 1))
+        self.assertEqual(
+            label_lesions(encode_scan(cells), 6),
+            {"lesion_count": 2, "lesion_sizes": [2, 1], "lesion_centroids": [[0.5, 0.0, 0.0], [2.0, 1.0, 1.0]]},
+        )
+        self.assertEqual(label_lesions(encode_scan(cells), 26)["lesion_sizes"], [3])
+
+    def test_lesion_merged_by_a_later_slice(self):
+        """Test lesions separate in the first slices are merged once a later slice connects them."""
+        cells = lesion_cells((3, 1, 5), (0, 0, 0), (0, 0, 4), (1, 0, 0), (1, 0, 4), *[(2, 0, col) for col in range(5)])
+        self.assertEqual(label_lesions(encode_scan(cells), 6)["lesion_sizes"], [9])
+
+    def test_u_shape(self):
+        """Test runs only connected through rows further down end up in one lesion."""
+        cells = lesion_cells((3, 5), (0, 0), (0, 4), (1, 0), (1, 4), *[(2, col) for col in range(5)])
+        self.assertEqual(label_lesions(encode_scan(cells), 4)["lesion_count"], 1)
+
+    def test_max_lesions(self):
+        """Test only the largest lesions are detailed, but all are counted."""
+        cells = lesion_cells((1, 9), (0, 0), (0, 2), (0, 3), (0, 5), (0, 6), (0, 7))
+        lesions = label_slices([cells], 4, max_lesions=2)
+        self.assertEqual(lesions["lesion_count"], 3)
+        self.assertEqual(lesions["lesion_sizes"], [3, 2])
+
+    def test_batch_matches_single_scans(self):
+        """Test labelling 2D scans together gives the same lesions as labelling them one by one."""
+        scans = [generate_brain_scan(12, 9, 0.7) for _ in range(5)]
+        for connectivity in (4, 8):
+            batch = analyze_scans(scans, connectivity=connectivity)
+            for scan, analysis in zip(scans, batch):
+                single = label_lesions(scan, connectivity)
+                self.assertEqual({key: analysis[key] for key in single}, single)
+
+    def test_empty_scans(self):
+        """Test scans without lesions, or without cells, have no lesions."""
+        self.assertEqual(label_lesions(encode_scan(lesion_cells((3, 4, 4)))), {
+            "lesion_count": 0, "lesion_sizes": [], "lesion_centroids": []
+        })
+        self.assertEqual(label_scan_batch(np.zeros((2, 0, 3), dtype=np.uint8), 8)[1]["lesion_count"], 0)
+
+    def test_unsupported_connectivity(self):
+        """Test connectivities other than 4, 8, 6 and 26 are rejected."""
+        with self.assertRaises(ValueError):
+            analyze_scan("|o|\n", connectivity=5)
+
+
+if __name__ == '__main__':
+    unittest.main()
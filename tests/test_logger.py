@@ -0,0 +1,97 @@
+import io
+import json
+import logging
+import os
+import unittest
+
+from common import logger as log
+from common.logger import BackgroundHandler, JsonFormatter, Payload, Sampler, configure_logging, log_event
+
+
+class TestLogger(unittest.TestCase):
+
+    def tearDown(self):
+        log.stop_logging()
+        log.background_handler = None
+        log.sampler = Sampler({})
+        # back to the default of log records written right away
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        logging.basicConfig(level=logging.INFO)
+
+    def test_payload_is_summarized(self):
+        """Test payloads are logged as size, hash and first bytes."""
+        text = str(Payload(b"x" * 1000))
+        self.assertTrue(text.startswith("<1000 bytes blake2b:"))
+        self.assertIn("xxxx'...>", text)
+        self.assertLess(len(text), 100)
+        self.assertEqual(str(Payload([1, 2])), str(Payload(b"[1, 2]")))
+
+    def test_sampler(self):
+        """Test 1 in every 1 / rate records of an event are kept, other events always."""
+        sampler = Sampler({"scan_sent": 0.25, "muted": 0})
+        self.assertEqual(sum(sampler.keep("scan_sent") for _ in range(100)), 25)
+        self.assertFalse(sampler.keep("muted"))
+        self.assertTrue(all(sampler.keep("other") for _ in range(10)))
+
+    def test_json_output(self):
+        """Test records are written as JSON with their extra fields, by the background thread."""
+        stream = io.StringIO()
+        handler = configure_logging("fr_hub", sample_rates={"scan_stored": 1}, stream=stream)
+        log_event("scan_stored", "Brain Scan received and saved via FrHUB: %s", 7, trace_id="abc")
+        handler.stop()
+        entry = json.loads(stream.getvalue())
+        self.assertEqual(entry["message"], "Brain Scan received and saved via FrHUB: 7")
+        self.assertEqual((entry["unit"], entry["level"]), ("fr_hub", "INFO"))
+        self.assertEqual((entry["event"], entry["trace_id"]), ("scan_stored", "abc"))
+
+    def test_events_are_sampled(self):
+        """Test events are sampled at their rate, warnings are always written."""
+        stream = io.StringIO()
+        handler = configure_logging("fr_pacs", log_format="text", sample_rates={"scan_sent": 0.1}, stream=stream)
+        for scan_id in range(20):
+            log_event("scan_sent", "Sending brain scan %s", scan_id)
+        log.logger.warning("FrHUB is slow")
+        handler.stop()
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].endswith("INFO fr_pacs mediaire_task: Sending brain scan 0"))
+        self.assertTrue(lines[2].endswith("FrHUB is slow"))
+
+    def test_full_queue_drops_records(self):
+        """Test records are dropped instead of blocking while the queue is full, and the drop is reported."""
+        stream = io.StringIO()
+        stream_handler = logging.StreamHandler(stream)
+        stream_handler.setFormatter(JsonFormatter("fr_brain"))
+        handler = BackgroundHandler([stream_handler], queue_size=2)
+        # nobody reads the queue
+        handler.stop()
+        for index in range(5):
+            handler.handle(logging.makeLogRecord({"msg": f"record {index}"}))
+        self.assertEqual(handler.dropped, 3)
+        handler.queue.get_nowait()
+        handler.queue.get_nowait()
+        handler.handle(logging.makeLogRecord({"msg": "record 5"}))
+        self.assertEqual(handler.dropped, 0)
+        self.assertEqual(handler.queue.get_nowait().getMessage(), "Dropped 3 log records, the log queue was full")
+
+    def test_forked_process_writes_its_records(self):
+        """Test a forked process starts its own writer and flushes it when it exits."""
+        read_fd, write_fd = os.pipe()
+        stream = os.fdopen(write_fd, "w")
+        handler = configure_logging("fr_brain", stream=stream)
+        pid = os.fork()
+        if pid == 0:
+            log.logger.info("from the worker")
+            log.stop_logging()
+            os._exit(0)
+        os.waitpid(pid, 0)
+        handler.stop()
+        stream.close()
+        with os.fdopen(read_fd) as output:
+            self.assertEqual(json.loads(output.read())["message"], "from the worker")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import unittest
+import urllib.error
+import urllib.request
+
+from common import metrics
+from common.metrics import Counter, Gauge, Histogram, Registry, bucket_index, bucket_upper_bound
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+        self.registry.enable()
+
+    def test_nothing_recorded_while_disabled(self):
+        """Test metrics are no-ops until the endpoint is started"""
+        registry = Registry()
+        counter = registry.register(Counter("scans_total", "Scans"))
+        histogram = registry.register(Histogram("latency_seconds", "Latency"))
+        counter.inc()
+        histogram.observe(0.1)
+        self.assertEqual(counter.labels().value, 0)
+        self.assertEqual(histogram.labels().count, 0)
+
+    def test_counter_and_gauge_exposition(self):
+        """Test counters and gauges are exposed in Prometheus text format, with escaped labels"""
+        counter = self.registry.register(Counter("acks_total", "Acks sent", ("status",)))
+        gauge = self.registry.register(Gauge("queue", "Queued scans"))
+        counter.labels("stored").inc()
+        counter.labels("stored").inc(2)
+        counter.labels('say "hi"').inc()
+        gauge.set(5)
+        gauge.dec()
+        text = self.registry.expose()
+        self.assertIn("# TYPE acks_total counter\n", text)
+        self.assertIn('acks_total{status="stored"} 3\n', text)
+        self.assertIn('acks_total{status="say \\"hi\\""} 1\n', text)
+        self.assertIn("# HELP queue Queued scans\n", text)
+        self.assertIn("queue 4\n", text)
+
+        gauge.set_function(lambda: 7)
+        self.assertIn("queue 7\n", self.registry.expose())
+
+    def test_histogram_buckets(self):
+        """Test a value's bucket is within 1/8 of it, from microseconds to minutes"""
+        for value in (1e-6, 3.3e-5, 0.001, 0.5, 1, 7.77, 600):
+            upper = bucket_upper_bound(bucket_index(value))
+            self.assertGreater(upper, value)
+            self.assertLessEqual(upper, value * (1 + 1 / 8) + 1e-12)
+        self.assertLess(bucket_index(0.001), bucket_index(0.0011))
+
+    def test_histogram_exposition(self):
+        """Test only buckets with values are exposed, cumulatively, along with +Inf, sum and count"""
+        histogram = self.registry.register(Histogram("ack_seconds", "Ack latency"))
+        for value in (0.001, 0.001, 0.5):
+            histogram.observe(value)
+        lines = [line for line in self.registry.expose().splitlines() if line.startswith("ack_seconds")]
+        self.assertEqual(len(lines), 5)
+        self.assertTrue(lines[0].endswith(" 2"))
+        self.assertTrue(lines[1].endswith(" 3"))
+        self.assertEqual(lines[2], 'ack_seconds_bucket{le="+Inf"} 3')
+        self.assertEqual(lines[3], "ack_seconds_sum 0.502")
+        self.assertEqual(lines[4], "ack_seconds_count 3")
+
+    def test_worker_metrics_are_merged(self):
+        """Test counters and histograms recorded in a forked worker end up in the parent's"""
+        counter = self.registry.register(Counter("processed_total", "Processed", ("result",)))
+        histogram = self.registry.register(Histogram("analyze_seconds", "Analysis"))
+        # the parent drains nothing, its samples are exposed directly
+        counter.labels("done").inc()
+        self.assertEqual(self.registry.drain(), {})
+
+        # as seen from a worker forked off the parent
+        worker = Registry()
+        worker.enabled, worker.pid = True, -1
+        worker_counter = worker.register(Counter("processed_total", "Processed", ("result",)))
+        worker_histogram = worker.register(Histogram("analyze_seconds", "Analysis"))
+        worker_counter.labels("done").inc(4)
+        worker_histogram.observe(0.2)
+        drained = worker.drain()
+        self.assertEqual(worker_counter.labels("done").value, 0)
+
+        self.registry.merge(drained)
+        self.assertEqual(counter.labels("done").value, 5)
+        self.assertEqual(histogram.labels().count, 1)
+        self.assertEqual(histogram.labels().sum, 0.2)
+
+    def test_metrics_endpoint(self):
+        """Test the endpoint serves the registry on /metrics only"""
+        server = metrics.start_metrics_server(0)
+        try:
+            self.assertTrue(metrics.REGISTRY.enabled)
+            url = f"http://127.0.0.1:{server.server_address[1]}"
+            with urllib.request.urlopen(f"{url}/metrics", timeout=5) as response:
+                self.assertTrue(response.headers["Content-Type"].startswith("text/plain; version=0.0.4"))
+                self.assertIn("# TYPE process_cpu_seconds_total counter", response.read().decode())
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(f"{url}/other", timeout=5)
+        finally:
+            server.shutdown()
+            server.server_close()
+            metrics.REGISTRY.enabled = False
+
+    def test_metrics_off(self):
+        """Test no endpoint is started without a port"""
+        self.assertIsNone(metrics.start_metrics_server(None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+from datetime import datetime
+
+from bson import ObjectId
+from pydantic import ValidationError
+
+from common.config import ReportStatus, TraceStage
+from common.models.brain_report import BrainReport
+from common.models.brain_scan import BrainScan
+from common.scan_codec import decode_scan, format_text_scan
+from common.utils import generate_brain_scan
+
+
+class TestFastDocuments(unittest.TestCase):
+
+    def assertSameDocument(self, model, **fields):
+        document = model.bson(**fields)
+        self.assertEqual(document, model(**fields).to_bson())
+        self.assertEqual(list(document), list(model(**fields).to_bson()))
+        return document
+
+    def test_brain_scan(self):
+        """Test brain scans, inline or in chunk storage, get the document of the model."""
+        scan = {"patient_id": 1, "scan_id": 2, "scan_datetime": "2025-01-01 00:00:00", "scan_type": "BRAIN"}
+        document = self.assertSameDocument(
+            BrainScan, **scan, scan_data=generate_brain_scan(), trace_id="abc",
+            stage_times={TraceStage.hub_received: 1.0},
+        )
+        self.assertEqual(document["scan_datetime"], datetime(2025, 1, 1))
+        self.assertEqual(document["report_generated"], ReportStatus.to_do)
+        self.assertEqual(type(next(iter(document["stage_times"]))), str)
+        self.assertSameDocument(BrainScan, **scan, scan_file_id=ObjectId(), scan_size=416)
+
+    def test_brain_report(self):
+        """Test brain reports get the document of the model, with ints of float fields converted."""
+        document = self.assertSameDocument(
+            BrainReport, patient_id=1, scan_id=2, report_datetime=datetime.now(), report_data="1 brain lesions.",
+            lesion_area=1, region_density=[[0.5, 1]], lesion_sizes=[1], stage_times={"analyzed": 2},
+        )
+        self.assertEqual(document["lesion_area"], 1.0)
+        self.assertEqual(type(document["region_density"][0][1]), float)
+        self.assertNotIn("lesion_count", document)
+
+    def test_other_values_go_through_the_model(self):
+        """Test values the fast path doesn't take as they are are still converted by the model."""
+        text_scan = format_text_scan(decode_scan(generate_brain_scan()))
+        self.assertSameDocument(
+            BrainScan, patient_id="1", scan_id=2, scan_datetime="2025-01-01T00:00:00.123", scan_type="BRAIN",
+            scan_data=text_scan,
+        )
+
+    def test_invalid_documents_raise(self):
+        """Test the fast path raises for whatever the model raises for."""
+        scan = {"patient_id": 1, "scan_id": 2, "scan_datetime": "2025-01-01 00:00:00", "scan_type": "BRAIN"}
+        with self.assertRaises(ValidationError):
+            BrainScan.bson(**scan)
+        with self.assertRaises(ValidationError):
+            BrainScan.bson(**scan, scan_data=generate_brain_scan()[:-1])
+        with self.assertRaises(ValidationError):
+            BrainScan.bson(**{**scan, "scan_datetime": "not a date"}, scan_data=generate_brain_scan())
+        with self.assertRaises(ValidationError):
+            BrainReport.bson(patient_id=1, scan_id=2, report_datetime=datetime.now())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import socket
+import time
+import unittest
+from unittest.mock import patch
+
+from common.notifier import AdaptiveBackoff, WorkNotifier, notify_work
+
+
+def free_udp_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+class TestAdaptiveBackoff(unittest.TestCase):
+    def test_delay_grows_up_to_max(self):
+        """Test the delay doubles on every empty poll and is capped at max_delay"""
+        backoff = AdaptiveBackoff(min_delay=0.1, max_delay=0.5)
+        self.assertEqual([backoff.next_delay() for _ in range(5)], [0.1, 0.2, 0.4, 0.5, 0.5])
+
+    def test_reset_goes_back_to_min(self):
+        """Test finding work makes the next poll happen after the minimum delay again"""
+        backoff = AdaptiveBackoff(min_delay=0.1, max_delay=5)
+        backoff.next_delay()
+        backoff.next_delay()
+        backoff.reset()
+        self.assertEqual(backoff.next_delay(), 0.1)
+
+
+@patch("common.notifier.DBManager.watch", return_value=None)
+class TestWorkNotifier(unittest.TestCase):
+    def test_notify_work_wakes_up_waiter(self, mock_watch):
+        """Test a waiting consumer is woken up by notify_work long before its timeout"""
+        port = free_udp_port()
+        notifier = WorkNotifier("brain_scans", port)
+        try:
+            started = time.monotonic()
+            notify_work(port)
+            self.assertTrue(notifier.wait(5))
+            self.assertLess(time.monotonic() - started, 1)
+        finally:
+            notifier.stop()
+
+    def test_wait_times_out_without_work(self, mock_watch):
+        """Test wait returns False after the timeout when nothing was announced"""
+        notifier = WorkNotifier("brain_scans", free_udp_port())
+        try:
+            self.assertFalse(notifier.wait(0.05))
+        finally:
+            notifier.stop()
+
+    def test_stop_wakes_up_waiter(self, mock_watch):
+        """Test stopping the notifier releases a consumer blocked in wait"""
+        notifier = WorkNotifier("brain_scans", free_udp_port())
+        notifier.stop()
+        self.assertTrue(notifier.wait(5))
+
+    def test_change_stream_leaves_out_updates_not_creating_work(self, mock_watch):
+        """Test the change stream matches the configured operations and updates, not every update of the collection"""
+        notifier = WorkNotifier("brain_scans", free_udp_port(), updated_fields={"report_generated": "To Do"})
+        notifier.stop()
+        self.assertEqual(notifier.change_filter(), {"$or": [
+            {"operationType": {"$in": ["insert"]}},
+            {"operationType": "update", "updateDescription.updatedFields.report_generated": "To Do"},
+        ]})
+        notifier = WorkNotifier("brain_reports", free_udp_port())
+        notifier.stop()
+        self.assertEqual(notifier.change_filter(), {"operationType": {"$in": ["insert"]}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import base64
+import json
+import socket
+import struct
+import threading
+import unittest
+
+from common.config import MessageType, PROTOCOL_VERSION, TraceStage
+from common.protocol import (
+    FrameDecoder,
+    ProtocolError,
+    brain_scan_frames,
+    decode_brain_scan,
+    decode_brain_scan_chunk,
+    decode_brain_scan_end,
+    encode_brain_scan,
+    encode_frame,
+    recv_frame,
+    send_frame,
+)
+from common.scan_codec import to_packed_scan
+from common.tracing import Trace, traced
+from common.utils import generate_brain_scan
+
+
+class TestFrameDecoder(unittest.TestCase):
+    def test_single_frame(self):
+        """Test a complete frame is decoded in one feed."""
+        decoder = FrameDecoder()
+        frames = decoder.feed(encode_frame(MessageType.brain_scan, b"scan"))
+        self.assertEqual(frames, [(MessageType.brain_scan, b"scan")])
+        self.assertEqual(decoder.pending, 0)
+
+    def test_partial_reads(self):
+        """Test a frame split into single bytes is only returned once complete."""
+        decoder = FrameDecoder()
+        data = encode_frame(MessageType.ack, b"stored")
+        frames = []
+        for i in range(len(data)):
+            frames.extend(decoder.feed(data[i:i + 1]))
+        self.assertEqual(frames, [(MessageType.ack, b"stored")])
+
+    def test_coalesced_frames(self):
+        """Test several frames arriving in one chunk are all returned in order."""
+        decoder = FrameDecoder()
+        data = b"".join(encode_frame(MessageType.brain_scan, str(i).encode()) for i in range(5))
+        frames = decoder.feed(data + encode_frame(MessageType.ack, b"x")[:3])
+        self.assertEqual([payload for _, payload in frames], [b"0", b"1", b"2", b"3", b"4"])
+        self.assertEqual(decoder.pending, 3)
+
+    def test_unsupported_version(self):
+        """Test frames from another protocol version are rejected."""
+        with self.assertRaises(ProtocolError):
+            FrameDecoder().feed(struct.pack("!BBI", PROTOCOL_VERSION + 1, MessageType.ack, 0))
+
+    def test_unknown_message_type(self):
+        """Test unknown message types are rejected."""
+        with self.assertRaises(ProtocolError):
+            FrameDecoder().feed(struct.pack("!BBI", PROTOCOL_VERSION, 250, 0))
+
+
+class TestSocketFraming(unittest.TestCase):
+    def setUp(self):
+        self.left, self.right = socket.socketpair()
+
+    def tearDown(self):
+        self.left.close()
+        self.right.close()
+
+    def test_large_payload_round_trip(self):
+        """Test multi-megabyte payloads survive being split across many recv calls."""
+        payload = bytes(range(256)) * (8 * 1024 * 4)
+        sender = threading.Thread(target=send_frame, args=(self.left, MessageType.brain_scan, payload))
+        sender.start()
+        msg_type, received = recv_frame(self.right)
+        sender.join()
+        self.assertEqual(msg_type, MessageType.brain_scan)
+        self.assertEqual(received, payload)
+
+    def test_clean_close_returns_none(self):
+        """Test closing the connection between frames is reported as None."""
+        self.left.close()
+        self.assertIsNone(recv_frame(self.right))
+
+    def test_close_mid_frame_raises(self):
+        """Test closing the connection in the middle of a frame is a protocol error."""
+        self.left.sendall(encode_frame(MessageType.brain_scan, b"truncated")[:8])
+        self.left.close()
+        with self.assertRaises(ProtocolError):
+            recv_frame(self.right)
+
+
+class TestBrainScanMessage(unittest.TestCase):
+
+    def test_round_trip(self):
+        """Test a brain scan payload decodes to the tuple expected by save_brain_scan, with the scan still packed."""
+        scan = (1, 2, "2025-01-01 00:00:00", "BRAIN", generate_brain_scan(64, 64))
+        self.assertEqual(decode_brain_scan(encode_brain_scan(7, scan)), (7, scan))
+
+    def test_traced_round_trip(self):
+        """Test the trace id and send time of a traced scan travel with it, the other stages stay with the sender."""
+        scan = traced((1, 2, "2025-01-01 00:00:00", "BRAIN", generate_brain_scan(8, 8)), TraceStage.pacs_sent)
+        scan[5].stage_times[TraceStage.hub_received] = 0.0
+        seq, decoded = decode_brain_scan(encode_brain_scan(7, scan))
+        self.assertEqual(decoded[:5], scan[:5])
+        sent_at = scan[5].stage_times[TraceStage.pacs_sent]
+        self.assertEqual(decoded[5], Trace(scan[5].trace_id, {TraceStage.pacs_sent: sent_at}))
+
+    def test_text_scan_is_packed(self):
+        """Test legacy text scans are sent packed."""
+        seq, scan = decode_brain_scan(encode_brain_scan(1, (1, 2, "2025-01-01 00:00:00", "BRAIN", " |o|\n| |  \n")))
+        self.assertEqual(scan[4], to_packed_scan(" |o|\n| |  \n"))
+
+    def test_legacy_json_payload(self):
+        """Test the JSON payload of older FrPACS is still understood."""
+        text_scan = "|o| \n"
+        payload = json.dumps(
+            {"seq": 3, "scan": [1, 2, "2025-01-01 00:00:00", "BRAIN", base64.b64encode(text_scan.encode()).decode()]}
+        ).encode("utf-8")
+        self.assertEqual(
+            decode_brain_scan(payload), (3, (1, 2, "2025-01-01 00:00:00", "BRAIN", to_packed_scan(text_scan)))
+        )
+
+    def test_truncated_payload_raises(self):
+        """Test a payload shorter than the scan header is a protocol error."""
+        with self.assertRaises(ProtocolError):
+            decode_brain_scan(b"\x00\x01")
+
+    def test_small_scan_is_one_frame(self):
+        """Test scans up to the chunk size are sent in a single brain scan frame."""
+        scan = (1, 2, "2025-01-01 00:00:00", "BRAIN", generate_brain_scan(10, 10))
+        self.assertEqual(list(brain_scan_frames(7, scan)), [(MessageType.brain_scan, encode_brain_scan(7, scan))])
+
+    def test_large_scan_is_streamed(self):
+        """Test larger scans are sent as begin, chunk and end frames carrying their sequence number."""
+        scan = (1, 2, "2025-01-01 00:00:00", "BRAIN", generate_brain_scan(64, 64))
+        frames = list(brain_scan_frames(7, scan, chunk_size=300))
+        msg_types = [msg_type for msg_type, _ in frames]
+        self.assertEqual(msg_types[:2], [MessageType.brain_scan_begin, MessageType.brain_scan_chunk])
+        self.assertEqual(msg_types[-1], MessageType.brain_scan_end)
+
+        self.assertEqual(decode_brain_scan(frames[0][1]), (7, scan[:4] + (b"",)))
+        chunks = [decode_brain_scan_chunk(payload) for _, payload in frames[1:-1]]
+        self.assertEqual({seq for seq, _ in chunks}, {7})
+        self.assertTrue(all(len(chunk) <= 300 for _, chunk in chunks))
+        self.assertEqual(b"".join(chunk for _, chunk in chunks), scan[4])
+        self.assertEqual(decode_brain_scan_end(frames[-1][1]), (7, len(scan[4])))
+
+
+if __name__ == '__main__':
+    unittest.main()
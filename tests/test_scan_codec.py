@@ -0,0 +1,104 @@
+import unittest
+
+import numpy as np
+
+from common.config import ScanCell
+from common.scan_codec import (
+    HEADER_SIZE,
+    ScanFormatError,
+    cells_per_byte,
+    count_cells,
+    decode_scan,
+    encode_scan,
+    format_text_scan,
+    iter_slices,
+    read_scan_chunks,
+    parse_text_scan,
+    to_packed_scan,
+)
+from common.utils import analyze_scan, generate_brain_scan
+
+
+class TestScanCodec(unittest.TestCase):
+
+    def test_round_trip_2d(self):
+        """Test 2D scans of any size, including ones not filling the last byte, survive packing."""
+        for shape in [(1, 1), (10, 10), (3, 7), (256, 255)]:
+            cells = np.random.randint(0, 3, shape).astype(np.uint8)
+            self.assertTrue(np.array_equal(decode_scan(encode_scan(cells)), cells))
+
+    def test_iter_slices(self):
+        """Test slices unpacked one at a time match the whole scan, also when they don't start on a byte boundary."""
+        cells = np.random.randint(0, 3, (5, 3, 3)).astype(np.uint8)
+        self.assertTrue(np.array_equal(np.stack(list(iter_slices(encode_scan(cells)))), cells))
+        self.assertEqual(len(list(iter_slices(encode_scan(cells[0])))), 1)
+
+    def test_read_scan_chunks(self):
+        """Test a scan read in chunks of any size gives the same slices, and truncated or padded scans are rejected."""
+        cells = np.random.randint(0, 3, (4, 5, 3)).astype(np.uint8)
+        scan_data = encode_scan(cells)
+        for chunk_size in (1, 7, len(scan_data)):
+            chunks = [scan_data[start:start + chunk_size] for start in range(0, len(scan_data), chunk_size)]
+            shape, slices = read_scan_chunks(chunks)
+            self.assertEqual(shape, (4, 5, 3))
+            self.assertTrue(np.array_equal(np.stack(list(slices)), cells))
+        for invalid in (scan_data[:-1], scan_data + b"\x00", scan_data[:HEADER_SIZE - 1]):
+            with self.assertRaises(ScanFormatError):
+                list(read_scan_chunks([invalid])[1])
+
+    def test_round_trip_3d(self):
+        """Test 3D scans keep their depth."""
+        cells = np.random.randint(0, 3, (4, 5, 6)).astype(np.uint8)
+        decoded = decode_scan(encode_scan(cells))
+        self.assertEqual(decoded.shape, (4, 5, 6))
+        self.assertTrue(np.array_equal(decoded, cells))
+
+    def test_packed_size(self):
+        """Test cells take 2 bits each."""
+        self.assertEqual(len(encode_scan(np.zeros((1024, 1024), dtype=np.uint8))), HEADER_SIZE + 1024 * 1024 // 4)
+
+    def test_count_cells(self):
+        """Test cells are counted from the packed bytes, padding isn't counted as empty cells."""
+        cells = np.array([[ScanCell.lesion, ScanCell.clear, ScanCell.empty], [ScanCell.lesion, ScanCell.empty, 0]])
+        data = encode_scan(cells)
+        self.assertEqual(count_cells(data, ScanCell.lesion), 2)
+        self.assertEqual(count_cells(data, ScanCell.clear), 1)
+        self.assertEqual(count_cells(data, ScanCell.empty), 3)
+
+    def test_cells_per_byte(self):
+        """Test bitwise counting per packed byte matches counting unpacked cells."""
+        cells = np.random.randint(0, 3, (16, 16)).astype(np.uint8)
+        packed = np.frombuffer(encode_scan(cells)[HEADER_SIZE:], dtype=np.uint8)
+        for state in ScanCell:
+            expected = (cells.reshape(-1, 4) == state).sum(axis=1)
+            self.assertTrue(np.array_equal(cells_per_byte(packed, state), expected))
+
+    def test_text_conversion(self):
+        """Test legacy text scans convert to cell states and back."""
+        text = "|o| | |\n  |o|\n"
+        cells = parse_text_scan(text)
+        self.assertTrue(np.array_equal(cells, [[2, 0, 1], [0, 0, 2]]))
+        self.assertEqual(format_text_scan(cells), text)
+        self.assertTrue(np.array_equal(decode_scan(to_packed_scan(text)), cells))
+
+    def test_invalid_text_scan(self):
+        """Test text that isn't made of scan cells is rejected."""
+        with self.assertRaises(ScanFormatError):
+            parse_text_scan("|x|")
+
+    def test_invalid_packed_scan(self):
+        """Test truncated or foreign bytes are rejected."""
+        data = encode_scan(np.zeros((10, 10), dtype=np.uint8))
+        with self.assertRaises(ScanFormatError):
+            to_packed_scan(data[:-1])
+        with self.assertRaises(ScanFormatError):
+            to_packed_scan(b"not a scan at all")
+
+    def test_analyze_scan(self):
+        """Test packed and legacy text scans give the same report."""
+        data = generate_brain_scan(50, 50, lesion_prob=0.5)
+        self.assertEqual(analyze_scan(data), analyze_scan(format_text_scan(decode_scan(data))))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+from unittest.mock import patch
+
+from bson import ObjectId
+
+from common.config import NeuroDataCollections
+from common.scan_codec import HEADER_SIZE, ScanFormatError
+from common.scan_store import ScanFile, ScanStoreError, ScanUpload, iter_scan_chunks, store_scan_file
+from common.utils import build_brain_scan, generate_brain_scan
+
+
+class TestScanStore(unittest.TestCase):
+
+    @patch("common.scan_store.DBManager.open_upload_stream")
+    def test_store_scan_in_chunks(self, mock_open_upload_stream):
+        """Test a scan is written chunk by chunk to its GridFS file."""
+        stream = mock_open_upload_stream.return_value
+        stream._id = ObjectId()
+        scan_data = generate_brain_scan(20, 20)
+
+        self.assertEqual(store_scan_file(1, 2, scan_data, chunk_size=32), ScanFile(stream._id, len(scan_data)))
+        self.assertEqual(mock_open_upload_stream.call_args.args[:3], (NeuroDataCollections.brain_scan_files, "1-2", 32))
+        written = [call.args[0] for call in stream.write.call_args_list]
+        self.assertEqual(b"".join(written), scan_data)
+        self.assertTrue(all(len(chunk) <= 32 for chunk in written))
+        stream.close.assert_called_once()
+
+    @patch("common.scan_store.DBManager.open_upload_stream")
+    def test_invalid_scan_is_rejected(self, mock_open_upload_stream):
+        """Test an upload fails on an invalid header, on more bytes than the header announces, or when cut short."""
+        scan_data = generate_brain_scan(4, 4)
+        with self.assertRaises(ScanFormatError):
+            ScanUpload(1, 2).write(b"x" * HEADER_SIZE)
+        with self.assertRaises(ScanFormatError):
+            ScanUpload(1, 2).write(scan_data + b"\x00")
+        upload = ScanUpload(1, 2)
+        upload.write(scan_data[:-1])
+        with self.assertRaises(ScanFormatError):
+            upload.finish()
+        mock_open_upload_stream.return_value.close.assert_not_called()
+
+    @patch("common.scan_store.DBManager.open_upload_stream", return_value=None)
+    def test_storage_unavailable(self, mock_open_upload_stream):
+        """Test an upload can't start when GridFS isn't reachable."""
+        with self.assertRaises(ScanStoreError):
+            ScanUpload(1, 2)
+
+    @patch("common.scan_store.DBManager.open_download_stream")
+    def test_iter_scan_chunks(self, mock_open_download_stream):
+        """Test a stored scan is read chunk by chunk."""
+        stream = mock_open_download_stream.return_value
+        stream.readchunk.side_effect = [b"ab", b"c", b""]
+        self.assertEqual(list(iter_scan_chunks(ObjectId())), [b"ab", b"c"])
+        stream.__exit__.assert_called_once()
+
+    @patch("common.utils.store_scan_file")
+    @patch("common.utils.BRAIN_SCAN_INLINE_MAX_SIZE", 100)
+    def test_large_scans_go_to_chunk_storage(self, mock_store_scan_file):
+        """Test scans over the inline limit are stored in chunks and referenced from their document."""
+        mock_store_scan_file.return_value = ScanFile(ObjectId(), 416)
+        small, large = generate_brain_scan(10, 10), generate_brain_scan(40, 40)
+
+        self.assertEqual(build_brain_scan((1, 2, "2025-01-01 00:00:00", "BRAIN", small)).scan_data, small)
+        brain_scan = build_brain_scan((1, 3, "2025-01-01 00:00:00", "BRAIN", large)).to_bson()
+        mock_store_scan_file.assert_called_once_with(1, 3, large)
+        self.assertNotIn("scan_data", brain_scan)
+        self.assertEqual(brain_scan["scan_file_id"], mock_store_scan_file.return_value.file_id)
+        self.assertEqual(brain_scan["scan_size"], 416)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import time
+import unittest
+from unittest.mock import patch
+
+from common.config import AckStatus, NeuroDataCollections, TraceStage
+from common.stage_latency import HOPS, stage_latencies, stage_latency_pipeline
+from common.tracing import record_stage, traced
+from common.utils import claim_brain_scans, save_brain_scans
+
+
+class TestTracing(unittest.TestCase):
+
+    def test_trace_is_started_once(self):
+        """Test a scan without a trace gets one, and later stages are added to it."""
+        scan = traced((1, 2, "2025-01-01 00:00:00", "BRAIN", b""), TraceStage.hub_received)
+        trace_id = scan[5].trace_id
+        scan = traced(scan, TraceStage.hub_persisted)
+        self.assertEqual(scan[5].trace_id, trace_id)
+        self.assertEqual(list(scan[5].stage_times), [TraceStage.hub_received, TraceStage.hub_persisted])
+
+    def test_record_stage_skips_untraced_documents(self):
+        """Test only documents with stage times get the stage."""
+        documents = [{"stage_times": {}}, {}]
+        record_stage(documents, TraceStage.report_saved)
+        self.assertIn(TraceStage.report_saved, documents[0]["stage_times"])
+        self.assertEqual(documents[1], {})
+
+    @patch("common.utils.db_manager")
+    def test_hub_persisted_is_timed_after_the_insert(self, mock_db_manager):
+        """Test scans are timed as persisted once their insert returned, duplicates aren't timed"""
+        inserts = []
+
+        def insert_new(collection_name, documents, durable=False):
+            for _id, document in enumerate(documents):
+                document["_id"] = _id
+            inserts.append((time.time(), [dict(document["stage_times"]) for document in documents]))
+            return [1]
+
+        mock_db_manager.insert_new.side_effect = insert_new
+        scans = [
+            traced((1, scan_id, "2025-01-01 00:00:00", "BRAIN", "|o|"), TraceStage.hub_received) for scan_id in (1, 2)
+        ]
+        self.assertEqual(save_brain_scans(scans), [True, AckStatus.duplicate])
+
+        ((inserted_at, stage_times),) = inserts
+        self.assertTrue(all(TraceStage.hub_persisted not in times for times in stage_times))
+        collection_name, query, update = mock_db_manager.update_many.call_args.args
+        self.assertEqual((collection_name, query), (NeuroDataCollections.brain_scans, {"_id": {"$in": [0]}}))
+        self.assertGreaterEqual(update[f"stage_times.{TraceStage.hub_persisted}"], inserted_at)
+
+    @patch("common.utils.db_manager")
+    def test_only_traced_scans_are_timed_as_claimed(self, mock_db_manager):
+        """Test claiming scans writes brain_claimed on the traced ones only, untraced scans aren't written again"""
+        scans = [{"_id": 1, "trace_id": "ab", "stage_times": {}}, {"_id": 2}]
+        mock_db_manager.claim_many.return_value = ("token", scans)
+        self.assertEqual(claim_brain_scans("brain", 2), ("token", scans))
+
+        self.assertNotIn(f"stage_times.{TraceStage.brain_claimed}", mock_db_manager.claim_many.call_args.args[2])
+        collection_name, query, update = mock_db_manager.update_many.call_args.args
+        self.assertEqual((collection_name, query), (NeuroDataCollections.brain_scans, {"_id": {"$in": [1]}}))
+        self.assertEqual(update, {f"stage_times.{TraceStage.brain_claimed}": scans[0]["stage_times"]["brain_claimed"]})
+
+        mock_db_manager.reset_mock()
+        mock_db_manager.claim_many.return_value = ("token", [{"_id": 3}])
+        claim_brain_scans("brain", 1)
+        mock_db_manager.update_many.assert_not_called()
+
+
+class TestStageLatency(unittest.TestCase):
+
+    def test_hops(self):
+        """Test every stage is the start of one hop and end to end covers the whole trip."""
+        self.assertEqual([start for _, start, _ in HOPS[:-1]], list(TraceStage)[:-1])
+        self.assertEqual(HOPS[-1], ("end_to_end", TraceStage.pacs_sent, TraceStage.pacs_acked))
+
+    def test_pipeline_matches_window(self):
+        """Test the reports are selected by the time they were saved."""
+        pipeline = stage_latency_pipeline(10.0, 20.0, percentiles=(50, 99))
+        self.assertEqual(pipeline[0], {"$match": {"stage_times.report_saved": {"$gte": 10.0, "$lt": 20.0}}})
+        statistics = pipeline[-1]["$facet"]["hop_0"][-1]["$project"]
+        self.assertEqual(set(statistics), {"_id", "count", "mean", "max", "p50", "p99"})
+
+    @patch("common.stage_latency.DBManager.aggregate")
+    def test_latencies_in_milliseconds(self, mock_aggregate):
+        """Test statistics are converted to milliseconds and hops without reports have a count of 0."""
+        mock_aggregate.return_value = [
+            {"hop_0": [{"count": 3, "mean": 0.002, "max": 0.005, "p50": 0.001}], "hop_1": []}
+        ]
+        latencies = stage_latencies(10.0, 20.0)
+        self.assertEqual(mock_aggregate.call_args.args[0], NeuroDataCollections.brain_reports)
+        self.assertEqual(latencies["pacs_sent->hub_received"], {"count": 3, "mean": 2.0, "max": 5.0, "p50": 1.0})
+        self.assertEqual(latencies["hub_received->hub_persisted"], {"count": 0})
+        self.assertEqual(latencies["end_to_end"], {"count": 0})
+
+    @patch("common.stage_latency.DBManager.aggregate", return_value=None)
+    def test_latencies_failure(self, mock_aggregate):
+        """Test a failed aggregation is reported as None."""
+        self.assertIsNone(stage_latencies(10.0, 20.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
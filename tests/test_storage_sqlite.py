@@ -0,0 +1,209 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta
+
+from common.config import NeuroDataCollections, ReportStatus
+from common.storage.query import matches, project
+from common.storage.sqlite import SQLiteBackend
+
+
+class TestQuery(unittest.TestCase):
+
+    def test_matches(self):
+        """Test queries match documents like MongoDB does."""
+        document = {"sent": False, "scan_id": 3, "stage_times": {"analyzed": 1.5}, "tags": ["a", "b"]}
+        self.assertTrue(matches(document, {"sent": False, "claim_token": None}))
+        self.assertTrue(matches(document, {"scan_id": {"$in": [1, 3]}, "stage_times.analyzed": {"$gte": 1}}))
+        self.assertTrue(matches(document, {"tags": "a", "$or": [{"scan_id": 1}, {"claim_token": {"$exists": False}}]}))
+        self.assertFalse(matches(document, {"scan_id": {"$lt": "4"}}))
+        self.assertFalse(matches(document, {"$nor": [{"scan_id": 3}]}))
+
+    def test_project(self):
+        """Test inclusion projections keep _id unless excluded, exclusion ones drop the given fields."""
+        document = {"_id": 1, "scan_id": 2, "scan_data": b"x"}
+        self.assertEqual(project(document, {"scan_id": 1}), {"_id": 1, "scan_id": 2})
+        self.assertEqual(project(document, {"_id": 0, "scan_id": 1}), {"scan_id": 2})
+        self.assertEqual(project(document, {"scan_data": 0}), {"_id": 1, "scan_id": 2})
+
+
+class TestSQLiteBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.backend = SQLiteBackend(os.path.join(self.directory, "neuro_data.db"))
+        for collection_name in self.backend.collection_names():
+            for index_name in self.backend.index_names(collection_name):
+                self.backend.ensure_index(collection_name, index_name)
+
+    def tearDown(self):
+        self.backend.close()
+        shutil.rmtree(self.directory)
+
+    def insert_scans(self, count):
+        return self.backend.insert_many(
+            NeuroDataCollections.brain_scans,
+            [{"scan_id": index, "report_generated": ReportStatus.to_do} for index in range(count)],
+        )
+
+    def test_wal_mode_and_indexes(self):
+        """Test the database is in WAL mode and claiming 'To Do' scans uses the status index."""
+        connection = self.backend.connection()
+        self.assertEqual(connection.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        plan = connection.execute(
+            'EXPLAIN QUERY PLAN SELECT document FROM "brain_scans" WHERE "report_generated" = ? ORDER BY "_id"',
+            (ReportStatus.to_do,),
+        ).fetchall()
+        self.assertIn("scans_to_do", str(plan))
+
+    def test_unique_index_over_duplicates(self):
+        """Test a unique index that can't be created over duplicates raises, the other indexes are still created."""
+        connection = self.backend.connection()
+        connection.execute('DROP INDEX "scans_idempotency_key"')
+        connection.execute('DROP INDEX "scans_to_do"')
+        self.backend.insert_many(NeuroDataCollections.brain_scans, [{"patient_id": 1, "scan_id": 1} for _ in range(2)])
+        self.backend.tables.clear()
+
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.backend.ensure_index(NeuroDataCollections.brain_scans, "scans_idempotency_key")
+        self.backend.ensure_index(NeuroDataCollections.brain_scans, "scans_to_do")
+        indexes = {row[1] for row in connection.execute('PRAGMA index_list("brain_scans")')}
+        self.assertIn("scans_to_do", indexes)
+        self.assertNotIn("scans_idempotency_key", indexes)
+
+    def test_insert_and_find(self):
+        """Test documents round trip with their _id and types, sorted, limited and projected."""
+        ids = self.insert_scans(5)
+        self.assertEqual(len(set(ids)), 5)
+        scans = list(self.backend.find(
+            NeuroDataCollections.brain_scans, {"scan_id": {"$gte": 1}}, {"_id": 0, "scan_id": 1}, [("scan_id", -1)], 2
+        ))
+        self.assertEqual(scans, [{"scan_id": 4}, {"scan_id": 3}])
+        scan = self.backend.find_one(NeuroDataCollections.brain_scans, {"_id": ids[2]})
+        self.assertEqual(scan, {"_id": ids[2], "scan_id": 2, "report_generated": ReportStatus.to_do})
+
+    def test_insert_many_duplicates(self):
+        """Test duplicate _ids fail the insert unless ignored, the other documents are inserted either way."""
+        ids = self.insert_scans(1)
+        with self.assertRaises(Exception):
+            self.backend.insert_many(NeuroDataCollections.brain_scans, [{"_id": ids[0]}, {"scan_id": 1}])
+        inserted = self.backend.insert_many(
+            NeuroDataCollections.brain_scans, [{"_id": ids[0]}, {"scan_id": 2}], durable=True, ignore_duplicates=True
+        )
+        self.assertEqual(inserted[0], ids[0])
+        self.assertEqual(len(list(self.backend.find(NeuroDataCollections.brain_scans, {}))), 3)
+
+    def test_insert_new(self):
+        """Test scans already stored under their (patient_id, scan_id) are skipped and reported by position."""
+        scans = [{"patient_id": 1, "scan_id": scan_id} for scan_id in range(3)]
+        self.assertEqual(self.backend.insert_new(NeuroDataCollections.brain_scans, scans[:2]), [])
+        self.assertEqual(self.backend.insert_new(NeuroDataCollections.brain_scans, scans + scans[2:], True), [0, 1, 3])
+        self.assertEqual(len(list(self.backend.find(NeuroDataCollections.brain_scans, {"patient_id": 1}))), 3)
+
+    def test_claim_many(self):
+        """Test scans are claimed oldest first, once, with their dotted fields set."""
+        ids = self.insert_scans(5)
+        claimed = self.backend.claim_many(
+            NeuroDataCollections.brain_scans,
+            {"report_generated": ReportStatus.to_do},
+            {"report_generated": ReportStatus.in_process, "stage_times.brain_claimed": 1.0},
+            3,
+            "lease_token",
+            "first",
+            {"lease_token": 1, "stage_times": 1},
+            [("_id", 1)],
+        )
+        self.assertEqual(
+            claimed, [{"_id": _id, "lease_token": "first", "stage_times": {"brain_claimed": 1.0}} for _id in ids[:3]]
+        )
+        claimed = self.backend.claim_many(
+            NeuroDataCollections.brain_scans,
+            {"report_generated": ReportStatus.to_do},
+            {"report_generated": ReportStatus.in_process},
+            3,
+            "lease_token",
+            "second",
+        )
+        self.assertEqual([scan["_id"] for scan in claimed], ids[3:])
+        self.assertIsNone(self.backend.claim_many(
+            NeuroDataCollections.brain_scans, {"report_generated": ReportStatus.to_do}, {}, 3, "lease_token", "third"
+        ))
+
+    def test_concurrent_claims_dont_overlap(self):
+        """Test threads claiming at the same time never get the same report."""
+        self.backend.insert_many(NeuroDataCollections.brain_reports, [{"sent": False} for _ in range(200)])
+        claimed = []
+
+        def claim(token):
+            while True:
+                reports = self.backend.claim_many(
+                    NeuroDataCollections.brain_reports,
+                    {"sent": False, "claim_token": None},
+                    {"claimed_at": datetime.now()},
+                    7,
+                    "claim_token",
+                    token,
+                )
+                if not reports:
+                    return
+                claimed.extend(report["_id"] for report in reports)
+
+        threads = [threading.Thread(target=claim, args=(str(index),)) for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(claimed), 200)
+        self.assertEqual(len(set(claimed)), 200)
+
+    def test_update(self):
+        """Test updates count the documents they changed, and queries on datetimes and null match like MongoDB."""
+        self.insert_scans(3)
+        now = datetime.now()
+        leased = {"report_generated": ReportStatus.in_process, "lease_expires_at": now - timedelta(seconds=1)}
+        self.backend.update_many(
+            NeuroDataCollections.brain_scans, {"scan_id": {"$in": [0, 1]}}, {**leased, "lease_token": None}
+        )
+        expired = {"report_generated": ReportStatus.in_process, "lease_expires_at": {"$lt": now}}
+        released = {"report_generated": ReportStatus.to_do}
+        self.assertEqual(self.backend.update_one(NeuroDataCollections.brain_scans, expired, {"lease_token": None}), 0)
+        self.assertEqual(self.backend.update_many(NeuroDataCollections.brain_scans, expired, released), 2)
+        scan = self.backend.find_one_and_update(NeuroDataCollections.brain_scans, {"scan_id": 2}, {"sent": True})
+        self.assertTrue(scan["sent"])
+        self.assertEqual(len(list(self.backend.find(NeuroDataCollections.brain_scans, {"lease_expires_at": None}))), 1)
+
+    def test_files(self):
+        """Test a file is stored in chunks, read back chunk by chunk, and deleted."""
+        upload = self.backend.open_upload_stream(NeuroDataCollections.brain_scan_files, "1-2", 4, {"scan_id": 2})
+        upload.write(b"0123456")
+        upload.write(b"789")
+        upload.close()
+        with self.backend.open_download_stream(NeuroDataCollections.brain_scan_files, upload._id) as download:
+            self.assertEqual(list(iter(download.readchunk, b"")), [b"0123", b"4567", b"89"])
+        self.backend.delete_file(NeuroDataCollections.brain_scan_files, upload._id)
+        with self.assertRaises(FileNotFoundError):
+            self.backend.open_download_stream(NeuroDataCollections.brain_scan_files, upload._id)
+
+    def test_aborted_upload_is_not_listed(self):
+        """Test an aborted upload leaves neither its file nor its chunks."""
+        upload = self.backend.open_upload_stream(NeuroDataCollections.brain_scan_files, "1-2", 4)
+        upload.write(b"01234567")
+        upload.abort()
+        with self.assertRaises(FileNotFoundError):
+            self.backend.open_download_stream(NeuroDataCollections.brain_scan_files, upload._id)
+        chunks = self.backend.connection().execute('SELECT COUNT(*) FROM "brain_scan_files_chunks"').fetchone()[0]
+        self.assertEqual(chunks, 0)
+
+    def test_unsupported(self):
+        """Test aggregation pipelines and change streams are reported as unsupported."""
+        with self.assertRaises(NotImplementedError):
+            self.backend.aggregate(NeuroDataCollections.brain_reports, [])
+        with self.assertRaises(NotImplementedError):
+            self.backend.watch(NeuroDataCollections.brain_scans, [], 1000)
+
+
+if __name__ == "__main__":
+    unittest.main()